@@ -10,3 +10,4 @@ from .processes import *
 from .time import *
 from .utilities.enums import *
 from .utilities import logging, set_logging_handlers, SimpleQuote
+from .pricing_engine_base import set_rands_cache, clear_rands_cache, LsmcRegressor, PathFunctional
@@ -6,8 +6,12 @@ Licensed under the Apache License, Version 2.0
 """
 from .analytic_engine_base import AnalyticEngine
 from .mc_engine_base import McEngine
-from .pde_engine_base import FdmEngine, FdmGrid, FdmGridwithBound
+from .lsmc import LsmcRegressor
+from .path_functional import PathFunctional
+from .pde_engine_base import FdmEngine, FdmGrid, FdmGridwithBound, fdm_price_grid
 from .quad_engine_base import QuadEngine
+from .rands_cache import RandsCache, set_rands_cache, clear_rands_cache
 from .tree_engine_base import BiTreeEngine
 
-__all__ = ['AnalyticEngine', 'McEngine', 'FdmEngine', 'FdmGrid', 'FdmGridwithBound', 'QuadEngine', 'BiTreeEngine']
+__all__ = ['AnalyticEngine', 'McEngine', 'FdmEngine', 'FdmGrid', 'FdmGridwithBound', 'fdm_price_grid', 'QuadEngine',
+           'BiTreeEngine', 'RandsCache', 'set_rands_cache', 'clear_rands_cache', 'LsmcRegressor', 'PathFunctional']
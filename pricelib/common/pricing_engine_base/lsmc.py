@@ -0,0 +1,123 @@
+#!/user/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2024 Galaxy Technologies
+Licensed under the Apache License, Version 2.0
+"""
+import numpy as np
+from scipy.linalg import cho_factor, cho_solve, solve_triangular, LinAlgError
+from ..utilities.enums import LsmcBasis
+
+
+class LsmcRegressor:
+    """最小二乘蒙特卡洛(LSMC, Longstaff-Schwartz)的延续价值回归与向后归纳，可用于美式、百慕大式等可提前行权的产品
+    在每个可行权时点，以实值路径的标的价格的基函数为自变量，对持有到下一时点的折现价值做线性最小二乘回归，拟合值即延续价值的估计。
+    基函数在缩放后的价格x = S / scale上计算(scale通常取执行价)，避免高次幂的数值溢出；缩放不改变多项式基函数张成的空间，
+    拟合值与直接用S回归相同。回归是闭式的线性最小二乘，由QR分解或正规方程求解，不需要迭代优化"""
+
+    def __init__(self, basis=LsmcBasis.Polynomial, degree=2, solver="normal", realized_cashflow=False):
+        """构造函数
+        Args:
+            basis: LsmcBasis枚举类，基函数，Polynomial为1, x, ..., x^degree；Laguerre为加权Laguerre多项式exp(-x/2)L_k(x)
+            degree: int，基函数的最高次数，基函数个数为degree + 1
+            solver: str，'normal'(默认)为正规方程X'X b = X'y的Cholesky分解求解，X'X由一次矩阵乘法得到，速度最快；
+                    'qr'为对基函数矩阵做QR分解求解，数值更稳定，适用于次数较高、基函数矩阵病态的情形
+            realized_cashflow: bool，实值路径的价值更新方式。默认False为取延续价值拟合值与行权价值的较大者；
+                               True为Longstaff-Schwartz原始算法，行权价值不低于延续价值拟合值时行权，否则保留已实现的折现现金流
+        """
+        if basis not in (LsmcBasis.Polynomial, LsmcBasis.Laguerre):
+            raise ValueError(f"LSMC基函数应为LsmcBasis.Polynomial或LsmcBasis.Laguerre，当前输入为{basis}")
+        if int(degree) != degree or degree < 1:
+            raise ValueError(f"LSMC基函数的最高次数应为正整数，当前输入为{degree}")
+        if solver not in ("qr", "normal"):
+            raise ValueError(f"LSMC回归的求解方法应为'qr'或'normal'，当前输入为{solver}")
+        self.basis = basis
+        self.degree = int(degree)
+        self.solver = solver
+        self.realized_cashflow = realized_cashflow
+
+    @property
+    def n_basis(self):
+        """基函数个数"""
+        return self.degree + 1
+
+    def design_matrix(self, x):
+        """基函数矩阵
+        Args:
+            x: np.ndarray，长度为n的缩放后的标的价格
+        Returns: np.ndarray，(n, degree + 1)的基函数矩阵，float64
+        """
+        x = np.asarray(x, dtype=np.float64)
+        design = np.empty((self.n_basis, x.size))  # 按行存储每个基函数，转置后是列优先的(n, degree + 1)矩阵
+        design[0] = 1
+        if self.basis == LsmcBasis.Polynomial:
+            for k in range(1, self.n_basis):
+                np.multiply(design[k - 1], x, out=design[k])
+            return design.T
+        # Laguerre多项式的三项递推: L_{k+1}(x) = ((2k + 1 - x) L_k(x) - k L_{k-1}(x)) / (k + 1)
+        design[1] = 1 - x
+        for k in range(1, self.degree):
+            design[k + 1] = ((2 * k + 1 - x) * design[k] - k * design[k - 1]) / (k + 1)
+        design *= np.exp(-x / 2)
+        return design.T
+
+    def fit(self, x, y):
+        """线性最小二乘回归系数，基函数矩阵奇异(例如实值路径的价格全部相同)时取最小范数解
+        Args:
+            x: np.ndarray，长度为n的缩放后的标的价格
+            y: np.ndarray，长度为n的被解释变量
+        Returns: np.ndarray，长度为degree + 1的回归系数
+        """
+        return self._solve(self.design_matrix(x), np.asarray(y, dtype=np.float64))
+
+    def fit_predict(self, x, y):
+        """回归的拟合值，即延续价值的估计，参数见fit"""
+        design = self.design_matrix(x)
+        return design @ self._solve(design, np.asarray(y, dtype=np.float64))
+
+    def _solve(self, design, y):
+        """求解线性最小二乘问题 min |design @ b - y|"""
+        try:
+            if self.solver == "normal":
+                return cho_solve(cho_factor(design.T @ design), design.T @ y)
+            q_mat, r_mat = np.linalg.qr(design)
+            r_diag = np.abs(np.diag(r_mat))
+            if r_diag.min() > 1e-12 * r_diag.max():
+                return solve_triangular(r_mat, q_mat.T @ y)
+        except LinAlgError:
+            pass
+        return np.linalg.lstsq(design, y, rcond=None)[0]
+
+    def backward_induction(self, paths, exercise_fn, step_disc, exercise_rows=None, scale=1.):
+        """LSMC向后归纳，只保留当前时点的折现价值与行权价值两个长度为n的向量
+        Args:
+            paths: np.ndarray，(n_row, n)的价格路径矩阵，第0行为估值日
+            exercise_fn: Callable，输入行号与该行的价格向量，返回立即行权的价值(可以为负，非负的路径参与回归)
+            step_disc: float或np.ndarray，(n_row - 1,)的相邻两行之间的折现因子，第i个元素将第i+1行的价值折现到第i行
+            exercise_rows: np.ndarray，可以提前行权的行号(1 ~ n_row - 2)，默认None为每一行都可以行权；最后一行总是行权
+            scale: float，基函数自变量的缩放，x = S / scale
+        Returns: np.ndarray，长度为n的每条路径折现到估值日的价值
+        """
+        n_row = paths.shape[0]
+        value = np.maximum(np.asarray(exercise_fn(n_row - 1, paths[-1]), dtype=np.float64), 0)
+        if n_row == 1:
+            return value
+        step_disc = np.broadcast_to(np.asarray(step_disc, dtype=np.float64), (n_row - 1,))
+        exercisable = np.zeros(n_row, dtype=bool)
+        exercisable[np.arange(1, n_row - 1) if exercise_rows is None else exercise_rows] = True
+        exercisable[[0, -1]] = False
+        for i in range(n_row - 2, 0, -1):
+            value *= step_disc[i]
+            if not exercisable[i]:
+                continue
+            exercise_value = np.asarray(exercise_fn(i, paths[i]), dtype=np.float64)
+            itm = np.flatnonzero(exercise_value >= 0)
+            if itm.size <= self.n_basis:  # 实值路径数不足以拟合全部回归系数
+                continue
+            itm_value, itm_exercise = value.take(itm), exercise_value.take(itm)
+            hold_value = self.fit_predict(paths[i].take(itm) / scale, itm_value)
+            if self.realized_cashflow:
+                value[itm] = np.where(itm_exercise >= hold_value, itm_exercise, itm_value)
+            else:
+                value[itm] = np.maximum(hold_value, itm_exercise)
+        return value * step_disc[0]
@@ -5,23 +5,46 @@ Copyright (C) 2024 Galaxy Technologies
 Licensed under the Apache License, Version 2.0
 """
 from abc import ABCMeta
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import suppress
+import datetime
+from functools import partial
+import threading
+import time
 import numpy as np
 from scipy.stats import norm, qmc
 from ..processes import StochProcessBase
-from ..utilities.enums import RandsMethod, LdMethod, ProcessType, EngineType
+from ..utilities.enums import RandsMethod, LdMethod, ProcessType, EngineType, UpDown, VolType
 from ..utilities.patterns import Observer
 from ..utilities.utility import logging
+from ..time import global_evaluation_date
 from .engine_base import PricingEngineBase
+from .rands_cache import global_rands_cache
+
+# Broadie-Glasserman-Kou离散观察修正系数 -zeta(1/2)/sqrt(2*pi)
+_BGK_BETA = 0.5825971579390106
+
+# numba默认的workqueue线程层不允许多个线程同时调用parallel=True的函数，多线程模拟时路径演化需要串行进入
+_EVOLVE_LOCK = threading.Lock()
+
+# 逐步更新路径泛函时，低差异序列的每个点跨越全部时间步，只能按路径分块生成，未设置chunk_size时每块的路径数
+_STREAM_LD_CHUNK = 2 ** 14
+
+# 低差异序列每次转换为正态随机数的点数，norm.ppf的float64中间结果只占一块的内存，与路径数无关
+_LD_BLOCK = 2 ** 10
 
 
 class McEngine(PricingEngineBase, Observer, metaclass=ABCMeta):
     """蒙特卡洛模拟定价引擎基类
     观察者，观察随机过程process对象，当process对象的属性变化时，自动更新状态，会重新生成价格路径"""
     engine_type = EngineType.McEngine
+    pathwise_greeks = False  # payoff关于路径连续时为True，单次模拟的希腊字母使用路径导数，否则使用似然比
+    supports_stream_paths = False  # 定价引擎提供路径泛函(PathFunctional)时为True，可以设置stream_paths=True
 
     def __init__(self, stoch_process: StochProcessBase = None, n_path=100000, rands_method=RandsMethod.LowDiscrepancy,
-                 antithetic_variate=True, ld_method=LdMethod.Sobol, seed=0, *,
+                 antithetic_variate=True, ld_method=LdMethod.Sobol, seed=0, *, chunk_size=None, n_workers=None,
+                 one_pass_greeks=False, dtype=np.float64, control_variates=False, target_rel_error=None,
+                 time_budget=None, importance_shift=None, mlmc_levels=None, mlmc_rmse=None, stream_paths=False,
                  s=None, r=None, q=None, vol=None):
         """构造函数
         Args:
@@ -31,6 +54,33 @@ class McEngine(PricingEngineBase, Observer, metaclass=ABCMeta):
             antithetic_variate: bool，是否使用对立变量法
             ld_method: 若使用了低差异序列，指定低差异序列方法，LdMethod枚举类，Sobol序列/Halton序列
             seed: int，随机数种子
+            chunk_size: int，分块模拟时每块的路径数，默认None为一次性生成全部路径；
+                        设置后逐块生成路径并累加payoff，不保存完整路径矩阵，峰值内存为O(chunk_size × n_step)
+            n_workers: int，并行模拟的线程数，默认None为单线程；大于1时各块路径由线程池并行计算payoff，
+                       未设置chunk_size时按线程数均分路径。每一块有独立且可复现的随机数流，chunk_size固定时结果与线程数无关
+            one_pass_greeks: bool，pv_and_greeks是否在同一组模拟路径上用路径导数/似然比估计希腊字母，默认False为共同随机数的差分法重新定价，
+                             见_pv_and_greeks
+            dtype: 随机数与价格路径的浮点类型，np.float64(默认)或np.float32。float32的内存占用与内存带宽减半，
+                   伪随机数直接以float32生成(与float64模式的随机数流不同)，低差异序列逐块转换后存为float32(与float64模式的
+                   随机数相同)；价格精度约为1e-6相对误差量级，payoff的求和与方差仍以float64累加
+            control_variates: bool，是否使用控制变量法，默认False。由各定价引擎提供期望已知的控制变量(到期标的价格、
+                              闭式解已知的欧式/几何平均/连续障碍期权等)，在同一组路径上回归最优系数，见_mc_expectation
+            target_rel_error: float，自适应模拟的目标相对误差(标准误差/|现值|)，默认None。设置target_rel_error或time_budget时
+                              逐块模拟(每块chunk_size条路径，未设置chunk_size时为n_path的1/16)，每块之后更新标准误差，
+                              达到目标相对误差、超过时间预算或已模拟n_path条路径时停止，实际路径数记录在n_path_used中
+            time_budget: float，自适应模拟的时间预算(秒)，默认None为不限时
+            importance_shift: float或'auto'，重要性抽样的漂移平移量，默认None为不使用。用Girsanov变换将驱动标的价格的布朗运动
+                              在到期日的均值平移importance_shift个标准差(负数向下，用于深度虚值的敲入/看跌数字期权)，
+                              payoff乘以似然比还原为原测度下的期望，各定价引擎的payoff函数无需修改；
+                              'auto'为先用少量路径试算候选平移量，选择加权payoff方差最小者，见_tune_importance_shift
+            mlmc_levels: int，多层蒙特卡洛(MLMC)的层数，默认None为不使用。仅BSM过程，且定价引擎提供各层网格上的payoff时有效
+                         (MCAutoCallableEngine、MCAsianEngine、MCBarrierEngine)，第l层每2^(mlmc_levels-1-l)个交易日模拟一次，
+                         最细层逐日模拟，见_mlmc_expectation
+            mlmc_rmse: float，MLMC的目标均方根误差，按各层方差与计算量分配路径数；默认None为总计算量与n_path条逐日路径相同
+            stream_paths: bool，是否不保存价格路径矩阵，默认False。仅定价引擎提供路径泛函时有效(supports_stream_paths)，
+                          逐个时间步演化全部路径，同时更新payoff所需的少量状态，峰值内存为O(n_path × 状态数)，
+                          可以模拟千万条路径，见_functional_expectation；不能与控制变量、自适应模拟、重要性抽样、
+                          多层蒙特卡洛、单次模拟希腊字母同时使用
         在未设置stoch_process时，(stoch_process=None)，会默认创建BSMprocess，需要输入以下变量进行初始化
             s: float，标的价格
             r: float，无风险利率
@@ -38,6 +88,8 @@ class McEngine(PricingEngineBase, Observer, metaclass=ABCMeta):
             vol: float，波动率
         """
         super().__init__(stoch_process=stoch_process, s=s, r=r, q=q, vol=vol)
+        if stoch_process is None and self.process is not None:  # 由s、r、q、vol创建的默认BSM过程，也要观察其参数变化
+            self.process.add_observer(self)
         # MC模拟路径数
         if n_path % 2 != 0 and antithetic_variate:
             n_path += 1
@@ -45,12 +97,44 @@ class McEngine(PricingEngineBase, Observer, metaclass=ABCMeta):
         self.rands_method = rands_method  # 生成随机数方法
         self._ld_method = ld_method  # 低差异序列方法
         self._antithetic_variate = antithetic_variate  # 是否使用对立变量
+        self._dtype = self._check_dtype(dtype)  # 随机数与价格路径的浮点类型
         self.seed = seed  # 随机数种子
+        self.chunk_size = chunk_size  # 分块模拟时每块的路径数
+        self.n_workers = n_workers  # 并行模拟的线程数
+        self.one_pass_greeks = one_pass_greeks  # 是否在同一组模拟路径上估计希腊字母
+        self.control_variates = control_variates  # 是否使用控制变量法
+        self.target_rel_error = target_rel_error  # 自适应模拟的目标相对误差
+        self.time_budget = time_budget  # 自适应模拟的时间预算(秒)
+        self.importance_shift = self._check_importance_shift(importance_shift)  # 重要性抽样的漂移平移量
+        self.importance_shift_used = None  # 最近一次使用重要性抽样时实际采用的平移量
+        if mlmc_levels is not None and (int(mlmc_levels) != mlmc_levels or mlmc_levels < 1):
+            raise ValueError(f"多层蒙特卡洛的层数应为正整数，当前输入为{mlmc_levels}")
+        self.mlmc_levels = mlmc_levels  # 多层蒙特卡洛的层数
+        self.mlmc_rmse = mlmc_rmse  # 多层蒙特卡洛的目标均方根误差
+        if stream_paths and not self.supports_stream_paths:
+            raise ValueError(f"{type(self).__name__}不支持逐步更新路径泛函(stream_paths=True)")
+        if stream_paths and (control_variates or target_rel_error is not None or time_budget is not None
+                             or importance_shift is not None or mlmc_levels is not None or one_pass_greeks):
+            raise ValueError("逐步更新路径泛函(stream_paths=True)时不保存价格路径，不能与控制变量、自适应模拟、重要性抽样、"
+                             "多层蒙特卡洛、单次模拟希腊字母同时使用")
+        self.stream_paths = stream_paths  # 是否不保存价格路径矩阵，逐步更新路径泛函
+        self.mlmc_n_paths = None  # 最近一次多层蒙特卡洛估值中各层的样本数
+        self.mlmc_level_var = None  # 最近一次多层蒙特卡洛估值中各层样本的方差
+        self.mc_value = None  # 最近一次蒙特卡洛估值
+        self.n_path_used = None  # 最近一次蒙特卡洛估值实际模拟的路径数
+        self.std_error = None  # 最近一次蒙特卡洛估值的标准误差
+        self.cv_beta = None  # 最近一次使用控制变量法时，各控制变量的回归系数
+        self.variance_reduction = None  # 最近一次使用控制变量法时，payoff方差与控制后残差方差之比
+        self.greeks_std_error = None  # 最近一次单次模拟希腊字母的标准误差
+        self._greeks_record = None  # 单次模拟希腊字母时记录的随机数、价格路径与payoff
         self.__reset_rands = True  # 重置随机数标志位
         self.__reset_paths = True  # 重置路径标志位
+        self.__rescale_paths = False  # 已有价格路径能否按期初价格缩放复用，随机数或标的价格以外的参数改变后不能复用
         self.rands = None  # 随机数矩阵
         self.s_paths = None  # 价格路径矩阵
         self.var_paths = None  # 方差路径矩阵
+        self._path_steps = None  # 已有价格路径所在的时间步，None为逐日的全部时间步
+        self._path_spot = None  # 已有价格路径的期初价格
 
     def set_stoch_process(self, stoch_process):
         """设置随机过程，先将自己从原来的随机过程的观察者列表中移除，再将自己加入新的随机过程的观察者列表"""
@@ -61,6 +145,7 @@ class McEngine(PricingEngineBase, Observer, metaclass=ABCMeta):
         self.rands = None  # 更换随机过程之后需要重新生成随机数
         self.__reset_rands = True  # 更换随机过程之后需要重新生成随机数
         self.__reset_paths = True  # 更换随机过程之后需要重新生成路径
+        self.__rescale_paths = False
 
     def remove_self(self):
         """删除对象自己，del自己之前，先将自己从被观察者的列表中移除"""
@@ -70,9 +155,12 @@ class McEngine(PricingEngineBase, Observer, metaclass=ABCMeta):
     def update(self, observable, *args, **kwargs):
         """被观察者的值发生变化时，自动调用update方法，通知观察者"""
         self.__reset_paths = True  # process自动向观察者发送通知, 参数已改变, 重置路径标志位，重新生成路径
+        self.__rescale_paths = False  # 标的价格以外的参数已改变，已有价格路径不能再缩放复用
 
     def reset_paths_flag(self):
-        """重置路径标志位，重新生成路径"""
+        """重置路径标志位，重新生成路径
+        定价引擎在传入标的价格spot时调用。随机过程的其他参数未变时，价格路径关于期初价格线性的随机过程
+        (常数波动率的BSM过程、Heston过程)将已有价格路径按spot缩放，不重新演化，见path_generator"""
         self.__reset_paths = True
 
     @property
@@ -84,6 +172,35 @@ class McEngine(PricingEngineBase, Observer, metaclass=ABCMeta):
         self._antithetic_variate = new_value
         self.__reset_paths = True  # 重置路径标志位，重新生成路径
         self.__reset_rands = True  # 重置随机数标志位，重新生成随机数
+        self.__rescale_paths = False
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+    @dtype.setter
+    def dtype(self, new_value):
+        self._dtype = self._check_dtype(new_value)
+        self.__reset_paths = True  # 重置路径标志位，重新生成路径
+        self.__reset_rands = True  # 重置随机数标志位，重新生成随机数
+        self.__rescale_paths = False
+
+    @staticmethod
+    def _check_dtype(dtype):
+        """检查随机数与价格路径的浮点类型，返回np.dtype"""
+        dtype = np.dtype(dtype)
+        if dtype not in (np.float32, np.float64):
+            raise ValueError(f"随机数与价格路径的浮点类型应为np.float64或np.float32，当前输入为{dtype}")
+        return dtype
+
+    @staticmethod
+    def _check_importance_shift(importance_shift):
+        """检查重要性抽样的平移量，应为None、实数或'auto'"""
+        if importance_shift is None or importance_shift == 'auto':
+            return importance_shift
+        if isinstance(importance_shift, (int, float, np.number)):
+            return float(importance_shift)
+        raise ValueError(f"重要性抽样的平移量应为None、实数或'auto'，当前输入为{importance_shift}")
 
     @property
     def ld_method(self):
@@ -94,10 +211,12 @@ class McEngine(PricingEngineBase, Observer, metaclass=ABCMeta):
         self._ld_method = new_value
         self.__reset_paths = True  # 重置路径标志位，重新生成路径
         self.__reset_rands = True  # 重置随机数标志位，重新生成随机数
+        self.__rescale_paths = False
 
     def _randoms_generator(self, shape):  # 参数rands_method控制随机数获取方法，LD_method低差异序列生成方法；
         """生成随机数，返回shape形状的随机数矩阵
-        如果需要的随机数矩阵的形状大于已有随机数矩阵的形状，则重新生成随机数矩阵，否则复用已有随机数矩阵
+        如果需要的随机数矩阵的形状大于已有随机数矩阵的形状，则先查找进程内共享的随机数缓存(见rands_cache.RandsCache)，
+        未命中时重新生成随机数矩阵并放入缓存，否则复用已有随机数矩阵。缓存的随机数矩阵由多个引擎共享，是只读的
             rands_method: 控制随机数生成方法，包括伪随机数和低差异序列两种方法
             _ld_method: 控制低差异序列生成方法，包括Sobol和Halton两种低差异序列类型
         Args:
@@ -109,97 +228,1112 @@ class McEngine(PricingEngineBase, Observer, metaclass=ABCMeta):
             logging.info("复用已有随机数")
             return self.rands[:shape[0], :shape[1]]
         else:
-            np.random.seed(self.seed)
+            self.__rescale_paths = False  # 随机数已改变，已有价格路径不能再缩放复用
+            low_discrepancy = self.rands_method == RandsMethod.LowDiscrepancy
+            key = (self.rands_method, self._ld_method if low_discrepancy else None, shape[0], self.seed,
+                   self._dtype)
+            if self.seed is not None:
+                rands = global_rands_cache().get(key, shape[1], prefix=low_discrepancy)
+                if rands is not None:
+                    logging.info("复用缓存的随机数")
+                    self.rands = rands
+                    self.__reset_rands = False
+                    return self.rands
             if self.rands_method == RandsMethod.Pseudorandom:
-                self.rands = np.random.standard_normal(shape)
+                draw, _, _ = self._pseudo_rng()
+                self.rands = draw(shape)
             elif self.rands_method == RandsMethod.LowDiscrepancy:
-                if self._ld_method == LdMethod.Sobol:
-                    sampler = qmc.Sobol(d=shape[0], scramble=True, seed=self.seed)
-                elif self._ld_method == LdMethod.Halton:
-                    sampler = qmc.Halton(d=shape[0], scramble=True, seed=self.seed)
-                else:
-                    raise ValueError(
-                        f'随机数生成方法输入错误，应为（Halton, Sobol）二者之一， 当前输入为{RandsMethod}')
-                sampler.fast_forward(30)  # 跳过前三十项
-                uniform_rands = sampler.random(shape[1]).transpose()
-                np.random.shuffle(uniform_rands)
-                self.rands = norm.ppf(uniform_rands)
+                self.rands = self._ld_normals([self._ld_sampler(shape[0], 30)], shape[1])  # 跳过前三十项
             else:
                 raise ValueError(
                     f'随机数生成方法输入错误，应为（RandsMethod.LowDiscrepancy, RandsMethod.Pseudorandom）二者之一， 当前输入为{RandsMethod}')
+            if self.seed is not None:
+                self.rands = global_rands_cache().put(key, self.rands)
             self.__reset_rands = False  # 重置随机数标志位
             return self.rands
 
-    def path_generator(self, n_step, spot=None, t_step_per_year=243):
+    def path_generator(self, n_step, spot=None, t_step_per_year=243, steps=None):
         """根据标的种类和标的参数，生成价格路径，返回价格路径矩阵
-        如果标的参数不变，且需要的价格路径矩阵的形状 ≤ 已有价格路径矩阵的形状，则复用已有价格路径矩阵，否则重新生成价格路径矩阵
+        如果标的参数不变，且需要的价格路径矩阵的形状 ≤ 已有价格路径矩阵的形状，则复用已有价格路径矩阵；
+        如果只有期初价格改变，且随机过程的价格路径关于期初价格线性(见_spot_scalable)，则将已有价格路径按期初价格缩放，
+        否则重新生成价格路径矩阵(复用已有的随机数)
         Args:
             n_step: int，价格路径的时间步数
             spot: float，标的期初价格
             t_step_per_year: int，每年的时间步数
+            steps: np.ndarray，只在这些升序的时间步(1~n_step)上模拟，默认None为逐步模拟全部时间步，见_evolve_paths
         Returns: self.s_paths，价格路径矩阵
         """
-        if (self.s_paths is not None and (not self.__reset_paths)
-                and self.s_paths.shape[0] >= n_step + 1 and self.s_paths.shape[1] >= self.n_path
-                and spot == self.process.spot()):
-            logging.info("复用已有价格路径")
-            return self.s_paths[:n_step + 1, :self.n_path]
+        if self.s_paths is not None and self.s_paths.shape[1] >= self.n_path:
+            if steps is None and self._path_steps is None and self.s_paths.shape[0] >= n_step + 1:
+                rows = slice(0, n_step + 1)
+            elif steps is not None and self._path_steps is not None and np.array_equal(steps, self._path_steps):
+                rows = slice(None)
+            else:
+                rows = None
+            if rows is not None and (not self.__reset_paths) and spot == self._path_spot:
+                logging.info("复用已有价格路径")
+                return self.s_paths[rows, :self.n_path]
+            if rows is not None and self.__rescale_paths:
+                logging.info("按期初价格缩放已有价格路径")
+                self.s_paths = self.s_paths * (spot / self._path_spot)
+                self.s_paths[0] = spot
+                self._path_spot = spot
+                self.__reset_paths = False
+                return self.s_paths[rows, :self.n_path]
         # else:
-        return self._regenerate_paths(n_step, self.n_path, spot, t_step_per_year)
+        return self._regenerate_paths(n_step, self.n_path, spot, t_step_per_year, steps)
 
-    def _regenerate_paths(self, n_step, n_path, spot, t_step_per_year):
+    def _spot_scalable(self):
+        """价格路径是否关于期初价格线性，即用同一组随机数演化时，期初价格乘以c，整条价格路径也乘以c
+        常数波动率的BSM过程(欧拉格式与对数欧拉格式)与Heston过程成立；局部波动率依赖价格水平，不成立"""
+        if self.process() == ProcessType.BSProcess1D:
+            return getattr(self.process.vol, "vol_type", None) == VolType.CV
+        return self.process() == ProcessType.Heston
+
+    def _regenerate_paths(self, n_step, n_path, spot, t_step_per_year, steps=None):
         """生成价格路径的执行函数
         Args:
             n_step: int，价格路径的时间步数
             n_path: int，模拟路径数量
             spot: float，标的期初价格
             t_step_per_year: int，每年的时间步数
+            steps: np.ndarray，只在这些时间步上模拟，默认None为逐步模拟全部时间步
         Returns:
         """
-        self.s_paths = np.empty(shape=(n_step + 1, n_path))
-        dt = 1 / t_step_per_year
+        shape, _ = self._randoms_layout(n_step if steps is None else len(steps), n_path)
+        rands = self._randoms_generator(shape=shape)  # 不覆盖self.rands，时间步较少时只取已有随机数的一部分，之后仍可完整复用
+        self.s_paths, self.var_paths = self._evolve_paths(rands, spot, 1 / t_step_per_year, steps)
+        self._path_steps = None if steps is None else np.array(steps)
+        self._path_spot = spot
+        self.__reset_paths = False  # 重置路径标志位
+        self.__rescale_paths = self._spot_scalable()
+        return self.s_paths
 
+    def _randoms_layout(self, n_step, n_path):
+        """随机数矩阵的布局
+        BSM过程: 使用对立变量时为(n_step, n_path/2)，否则为(n_step, n_path)
+        Heston过程: 左半部分是价格的随机数，右半部分是方差的随机数，使用对立变量时为(n_step, n_path)，否则为(n_step, 2*n_path)
+        Args:
+            n_step: int，价格路径的时间步数
+            n_path: int，模拟路径数量
+        Returns:
+            shape: tuple，随机数矩阵的形状
+            offsets: tuple，各组随机数在矩阵中的起始列
+        """
         if self.process() == ProcessType.BSProcess1D:
             if self.antithetic_variate:
                 if n_path % 2 != 0:
                     n_path += 1
-                half_n_path = n_path // 2
-                self.rands = self._randoms_generator(shape=(n_step, half_n_path))
-                rand_s = np.concatenate((self.rands, -self.rands), axis=1)
+                return (n_step, n_path // 2), (0,)
+            return (n_step, n_path), (0,)
+        if self.process() == ProcessType.Heston:
+            if self.antithetic_variate:
+                return (n_step, n_path), (0, n_path // 2)
+            return (n_step, n_path * 2), (0, n_path)
+        raise ValueError(f'随机过程类型输入错误，应为（ProcessType.BSProcess1D, ProcessType.Heston）二者之一，'
+                         f'当前输入为{self.process()}')
+
+    def _evolve_paths(self, rands, spot, dt, steps=None, antithetic=None):
+        """由标准正态随机数矩阵演化出价格路径，随机数矩阵的布局见_randoms_layout，整条路径由随机过程的evolve_paths一次演化
+        指定steps时只在这些时间步上模拟，BSM过程使用对数欧拉格式evolve_log_paths，常数波动率时跨越多个时间步也没有离散化误差；
+        Heston过程需要使用QE或完全截断格式(HestonScheme.QE/FullTruncation)，其中QE格式在较大步长下偏差仍较小
+        Args:
+            rands: np.ndarray，标准正态随机数矩阵，行数为时间步数(指定steps时为len(steps))
+            spot: float，标的期初价格
+            dt: float，年化时间步长
+            steps: np.ndarray，升序的时间步序号(1~n_step)，路径矩阵的第k行(k≥1)是第steps[k-1]步的价格，默认None为逐步模拟
+            antithetic: bool，随机数是否为对立变量的布局，默认None为self.antithetic_variate
+        Returns:
+            s_paths: np.ndarray，价格路径矩阵
+            var_paths: np.ndarray，方差路径矩阵，BSM过程为None
+        """
+        antithetic = self.antithetic_variate if antithetic is None else antithetic
+        if steps is not None:
+            if self.process() == ProcessType.BSProcess1D:
+                return self.process.evolve_log_paths(spot, np.asarray(steps) * dt, rands, antithetic), None
+            if self.process() == ProcessType.Heston:
+                return self.process.evolve_log_paths(spot, np.asarray(steps) * dt, rands[:, :rands.shape[1] // 2],
+                                                     rands[:, rands.shape[1] // 2:], antithetic)
+            raise ValueError(f'只在部分时间步上模拟仅支持ProcessType.BSProcess1D与ProcessType.Heston，'
+                             f'当前输入为{self.process()}')
+        if self.process() == ProcessType.BSProcess1D:
+            return self.process.evolve_paths(spot, dt, rands, antithetic), None
+        if self.process() == ProcessType.Heston:
+            return self.process.evolve_paths(spot, dt, rands[:, :rands.shape[1] // 2], rands[:, rands.shape[1] // 2:],
+                                             antithetic)
+        raise ValueError(f'随机过程类型输入错误，应为（ProcessType.BSProcess1D, ProcessType.Heston）二者之一，'
+                         f'当前输入为{self.process()}')
+
+    def _chunk_bounds(self, n_col, chunk_size=None):
+        """将随机数矩阵的n_col列按chunk_size切分为首尾相接的列区间，使用对立变量时每列对应两条路径"""
+        chunk_size = self.chunk_size if chunk_size is None else chunk_size
+        chunk = chunk_size // 2 if self.antithetic_variate else chunk_size
+        chunk = max(int(chunk), 1)
+        return [(start, min(start + chunk, n_col)) for start in range(0, n_col, chunk)]
+
+    def _randoms_chunk_generator(self, shape, bounds, offsets=(0,)):
+        """分块生成随机数的生成器，每块随机数与_randoms_generator(shape)重新生成的矩阵中对应列的随机数逐位相同
+            伪随机数: 按行优先顺序生成，先记录每一行各偏移列处的随机数发生器状态，分块时从各自的状态继续生成
+            低差异序列: 每个偏移列对应一个快进到该位置的序列发生器，逐块连续抽样，再按相同的维度置换打乱
+        Args:
+            shape: tuple，(n_row, n_col)，完整随机数矩阵的形状
+            bounds: List[tuple]，从0开始升序且首尾相接的列区间(start, end)
+            offsets: tuple，各组随机数在完整矩阵中的起始列
+        Yields: np.ndarray，完整矩阵中各组[offset+start, offset+end)列的水平拼接
+        """
+        n_row, n_col = shape
+        if self.rands_method == RandsMethod.Pseudorandom:
+            draw, get_state, set_state = self._pseudo_rng()
+            states = [[None] * len(offsets) for _ in range(n_row)]
+            for i in range(n_row):
+                position = 0
+                for k, offset in enumerate(offsets):
+                    self._skip_normals(draw, offset - position)
+                    position = offset
+                    states[i][k] = get_state()
+                self._skip_normals(draw, n_col - position)
+            for start, end in bounds:
+                block = np.empty(shape=(n_row, (end - start) * len(offsets)), dtype=self._dtype)
+                for i in range(n_row):
+                    for k in range(len(offsets)):
+                        set_state(states[i][k])
+                        block[i, k * (end - start):(k + 1) * (end - start)] = draw(end - start)
+                        states[i][k] = get_state()
+                yield block
+        elif self.rands_method == RandsMethod.LowDiscrepancy:
+            samplers = [self._ld_sampler(n_row, 30 + offset) for offset in offsets]  # 跳过前三十项
+            for start, end in bounds:
+                yield self._ld_normals(samplers, end - start)
+        else:
+            raise ValueError(
+                f'随机数生成方法输入错误，应为（RandsMethod.LowDiscrepancy, RandsMethod.Pseudorandom）二者之一， 当前输入为{RandsMethod}')
+
+    def _randoms_chunk(self, shape, bound, offsets, seed_seq):
+        """随机访问地生成一块随机数，供并行模拟使用
+            伪随机数: 使用该块独立的随机数流seed_seq(由SeedSequence.spawn派生)，与单线程的伪随机数不同
+            低差异序列: 快进到该块的位置，与_randoms_chunk_generator生成的随机数逐位相同
+        Args:
+            shape: tuple，(n_row, n_col)，完整随机数矩阵的形状
+            bound: tuple，(start, end)，该块的列区间
+            offsets: tuple，各组随机数在完整矩阵中的起始列
+            seed_seq: np.random.SeedSequence，该块的随机数种子序列
+        Returns: np.ndarray，完整矩阵中各组[offset+start, offset+end)列的水平拼接
+        """
+        n_row = shape[0]
+        start, end = bound
+        if self.rands_method == RandsMethod.Pseudorandom:
+            return np.random.default_rng(seed_seq).standard_normal((n_row, (end - start) * len(offsets)),
+                                                                    dtype=self._dtype)
+        if self.rands_method == RandsMethod.LowDiscrepancy:
+            return self._ld_normals([self._ld_sampler(n_row, 30 + offset + start) for offset in offsets], end - start)
+        raise ValueError(
+            f'随机数生成方法输入错误，应为（RandsMethod.LowDiscrepancy, RandsMethod.Pseudorandom）二者之一， 当前输入为{RandsMethod}')
+
+    def _ld_sampler(self, dim, skip):
+        """创建加扰的低差异序列发生器，并快进skip项"""
+        if self._ld_method == LdMethod.Sobol:
+            sampler = qmc.Sobol(d=dim, scramble=True, seed=self.seed)
+        elif self._ld_method == LdMethod.Halton:
+            sampler = qmc.Halton(d=dim, scramble=True, seed=self.seed)
+        else:
+            raise ValueError(f'随机数生成方法输入错误，应为（Halton, Sobol）二者之一， 当前输入为{RandsMethod}')
+        sampler.fast_forward(skip)
+        return sampler
+
+    def _ld_permutation(self, dim):
+        """低差异序列各维度的置换，即np.random.seed(seed)后np.random.shuffle对矩阵各行的打乱方式"""
+        permutation = np.arange(dim)
+        np.random.RandomState(self.seed).shuffle(permutation)
+        return permutation
+
+    def _ld_normals(self, samplers, n):
+        """从各低差异序列发生器依次连续抽取n个点，打乱维度后转换为标准正态随机数，水平拼接为self.dtype类型的矩阵
+        每次只转换_LD_BLOCK个点，float64的均匀分布与norm.ppf中间结果不随路径数增长
+        Args:
+            samplers: List[qmc.QMCEngine]，低差异序列发生器，见_ld_sampler
+            n: int，每个发生器抽取的点数
+        Returns: np.ndarray，(维度, n × len(samplers))的标准正态随机数矩阵
+        """
+        dim = samplers[0].d
+        permutation = self._ld_permutation(dim)
+        rands = np.empty(shape=(dim, n * len(samplers)), dtype=self._dtype)
+        for k, sampler in enumerate(samplers):
+            for start in range(0, n, _LD_BLOCK):
+                end = min(start + _LD_BLOCK, n)
+                rands[:, k * n + start:k * n + end] = norm.ppf(sampler.random(end - start).transpose()[permutation])
+        return rands
+
+    def _pseudo_rng(self):
+        """按行优先顺序生成伪随机数的发生器，返回(draw, get_state, set_state)，draw(size)生成self.dtype类型的标准正态随机数
+            float64: np.random.RandomState，与np.random.seed(seed)后np.random.standard_normal生成的随机数相同
+            float32: np.random.Generator，直接生成float32随机数，不经过float64的中间结果，随机数流与float64模式不同
+        """
+        if self._dtype == np.float32:
+            rng = np.random.default_rng(self.seed)
+
+            def set_state(state):
+                rng.bit_generator.state = state
+
+            return partial(rng.standard_normal, dtype=np.float32), lambda: rng.bit_generator.state, set_state
+        rng = np.random.RandomState(self.seed)
+        return rng.standard_normal, rng.get_state, rng.set_state
+
+    @staticmethod
+    def _skip_normals(draw, n, batch=1 << 20):
+        """使伪随机数发生器跳过n个标准正态随机数，分批抽取以限制内存
+        Args:
+            draw: 生成标准正态随机数的函数，见_pseudo_rng
+            n: int，跳过的随机数个数
+            batch: int，每批抽取的随机数个数
+        """
+        while n > 0:
+            draw(min(n, batch))
+            n -= batch
+
+    def path_chunk_generator(self, n_step, spot, t_step_per_year=243, steps=None):
+        """分块生成价格路径的生成器，不缓存路径矩阵，峰值内存为O(chunk_size × n_step)
+        对于相同的随机数种子，所有块合起来与一次性生成的价格路径逐位相同，仅路径的排列顺序不同
+        Args:
+            n_step: int，价格路径的时间步数
+            spot: float，标的期初价格
+            t_step_per_year: int，每年的时间步数
+            steps: np.ndarray，只在这些时间步上模拟，默认None为逐步模拟全部时间步
+        Yields: np.ndarray，(n_step + 1, 不超过chunk_size)的价格路径矩阵，指定steps时为(len(steps) + 1, 不超过chunk_size)
+        """
+        shape, offsets = self._randoms_layout(n_step if steps is None else len(steps), self.n_path)
+        n_col = shape[1] // len(offsets)
+        for rands in self._randoms_chunk_generator(shape, self._chunk_bounds(n_col), offsets):
+            s_paths, _ = self._evolve_paths(rands, spot, 1 / t_step_per_year, steps)
+            yield s_paths
+
+    def _functional_expectation(self, functional_factory, n_step, spot, t_step_per_year):
+        """逐步更新路径泛函的蒙特卡洛期望，不保存随机数矩阵与价格路径矩阵，标准误差记录在self.std_error中
+        每个时间步只保留全部路径的当前价格(与Heston过程的方差)向量，由随机过程的evolve演化一步后交给路径泛函更新状态，
+        与一次演化整条路径的evolve_paths结果相同(至多相差浮点舍入误差)。
+            伪随机数: 未设置chunk_size时逐行生成随机数，与_randoms_generator生成的随机数矩阵逐行相同，峰值内存为O(n_path × 状态数)
+            低差异序列: 每个点跨越全部时间步，按路径分块(chunk_size，未设置时为2^14条)生成随机数，每块内逐步演化
+        Args:
+            functional_factory: Callable，无参数，返回一个新的PathFunctional路径泛函对象，每块路径使用一个
+            n_step: int，价格路径的时间步数
+            spot: float，标的期初价格
+            t_step_per_year: int，每年的时间步数
+        Returns: float，payoff的均值
+        """
+        self.cv_beta, self.variance_reduction, self.importance_shift_used = None, None, None
+        shape, offsets = self._randoms_layout(n_step, self.n_path)
+        n_col = shape[1] // len(offsets)
+        dt = 1 / t_step_per_year
+        if self.rands_method == RandsMethod.Pseudorandom and self.chunk_size is None:
+            draw, _, _ = self._pseudo_rng()
+            stats = [self._payoff_stats(self._stream_payoff(
+                functional_factory(), (draw(shape[1]) for _ in range(shape[0])), n_col, spot, dt))]
+        else:
+            bounds = self._chunk_bounds(n_col, self.chunk_size or _STREAM_LD_CHUNK)
+            stats = [self._payoff_stats(self._stream_payoff(functional_factory(), rands, end - start, spot, dt))
+                     for (start, end), rands in zip(bounds, self._randoms_chunk_generator(shape, bounds, offsets))]
+        self.mc_value = self._estimate(stats, None, self.n_path)
+        self.n_path_used = self.n_path
+        return self.mc_value
+
+    def _stream_payoff(self, functional, rands_rows, n_col, spot, dt):
+        """逐个时间步演化一块路径，并更新路径泛函的状态
+        Args:
+            functional: PathFunctional，路径泛函
+            rands_rows: Iterable[np.ndarray]，逐行的标准正态随机数，每行的布局与_randoms_layout的一行相同，列数为n_col乘以组数
+            n_col: int，每组随机数的列数，使用对立变量时路径数为2 * n_col
+            spot: float，标的期初价格
+            dt: float，年化时间步长
+        Returns: np.ndarray，逐路径payoff
+        """
+        n_path = 2 * n_col if self.antithetic_variate else n_col
+        s_row = np.full(n_path, spot, dtype=self._dtype)
+        heston = self.process() == ProcessType.Heston
+        if heston:
+            var_row = np.full(n_path, float(self.process.v0))  # 未截断的方差，与evolve_paths相同
+        functional.start(s_row)
+        for step, row in enumerate(rands_rows, 1):
+            row = np.asarray(row, dtype=self._dtype)
+            dw = np.concatenate((row[:n_col], -row[:n_col])) if self.antithetic_variate else row[:n_col]
+            if heston:
+                dw_v = row[n_col:2 * n_col]
+                dw_v = np.concatenate((dw_v, -dw_v)) if self.antithetic_variate else dw_v
+                s_row, var_row = self.process.evolve_step(step * dt, s_row, var_row, dt, dw, dw_v)
             else:
-                self.rands = self._randoms_generator(shape=(n_step, n_path))
-                rand_s = self.rands.copy()
+                s_row = self.process.evolve(step * dt, s_row, dt, dw)
+            s_row = np.asarray(s_row, dtype=self._dtype)
+            functional.update(step, s_row)
+        return functional.payoff()
 
-            self.s_paths[0] = spot
-            for step in range(1, n_step + 1):
-                self.s_paths[step] = self.process.evolve(dt * step, self.s_paths[step - 1], dt, rand_s[step - 1])
+    @staticmethod
+    def _bridge_steps(n_step, bridge_step, obs_points=None):
+        """布朗桥模式下需要模拟的时间步：离散观察时只模拟观察日，连续观察时每bridge_step个交易日模拟一次，都包含到期日
+        Args:
+            n_step: int，到期日的时间步序号
+            bridge_step: int，连续观察时相邻模拟时点间隔的交易日数
+            obs_points: np.ndarray，离散观察日的时间步序号，默认None为连续观察
+        Returns: np.ndarray，升序的时间步序号，见_evolve_paths
+        """
+        if obs_points is None:
+            obs_points = np.arange(bridge_step, n_step, bridge_step)
+        return np.union1d(obs_points[obs_points > 0], [n_step]).astype(int)
 
-        elif self.process() == ProcessType.Heston:
-            self.var_paths = np.empty(shape=(n_step + 1, n_path))
-            if self.antithetic_variate:
-                self.rands = self._randoms_generator(shape=(n_step, n_path))
-                rand_s = self.rands[:, :self.rands.shape[1] // 2].copy()
-                rand_v = self.rands[:, self.rands.shape[1] // 2:].copy()
-                rand_v = self.process.var_rho * rand_s + np.sqrt(1 - self.process.var_rho ** 2) * rand_v
-                rand_s = np.concatenate((rand_s, -rand_s), axis=1)
-                rand_v = np.concatenate((rand_v, -rand_v), axis=1)
+    def _bridge_hit_prob(self, paths, steps, barrier, t_step_per_year, updown=UpDown.Down):
+        """只在部分时间步上模拟时，用布朗桥估计每条路径在逐日观察下触碰障碍的概率，见_bridge_first_hit
+        Args:
+            paths: np.ndarray，(len(steps) + 1, n)的价格路径矩阵，第0行是期初价格
+            steps: np.ndarray，升序的时间步序号，见_evolve_paths
+            barrier: float或np.ndarray，障碍价格；数组时每个元素对应路径矩阵的一行，第k行的障碍价格同时适用于第k-1行与第k行之间的交易日
+            t_step_per_year: int，每年的时间步数，即每年的观察次数
+            updown: UpDown枚举类，向上/向下障碍
+        Returns: np.ndarray，长度为n的触碰障碍的概率
+        """
+        if updown == UpDown.Up:
+            hit_lower, hit_upper = self._bridge_first_hit(paths, steps, t_step_per_year, upper=barrier, obs_step=1)
+        else:
+            hit_lower, hit_upper = self._bridge_first_hit(paths, steps, t_step_per_year, lower=barrier, obs_step=1)
+        return np.sum(hit_lower + hit_upper, axis=0)
+
+    def _bridge_first_hit(self, paths, steps, t_step_per_year, lower=None, upper=None, obs_step=None):
+        """用布朗桥估计每条路径在相邻两个模拟时点之间首次触碰下/上障碍的概率
+        模拟时点上的价格直接与障碍价格比较；相邻模拟时点之间按对数价格的布朗桥计算穿越概率，双边障碍使用镜像法的级数解。
+        连续观察时直接使用连续穿越概率；每obs_step个交易日离散观察时，障碍价格按Broadie-Glasserman-Kou修正
+        向远离标的价格的方向平移exp(0.5826 * vol * sqrt(obs_step * dt))，间隔不超过obs_step个交易日的区间不做修正
+        Args:
+            paths: np.ndarray，(len(steps) + 1, n)的价格路径矩阵，第0行是期初价格
+            steps: np.ndarray，升序的时间步序号，见_evolve_paths
+            t_step_per_year: int，每年的时间步数
+            lower: float或np.ndarray，下障碍价格，默认None为没有下障碍；数组时每个元素对应路径矩阵的一行，
+                   第k行的障碍价格同时适用于第k-1行与第k行之间的时间段
+            upper: float或np.ndarray，上障碍价格，默认None为没有上障碍；格式同lower
+            obs_step: int，离散观察的间隔交易日数，默认None为连续观察
+        Returns: (hit_lower, hit_upper)，两个(len(steps) + 1, n)的np.ndarray，第k行是在第k-1行与第k行之间首次触碰下/上障碍的概率，
+                 第0行是期初已经触碰的情形；按行求和为触碰障碍的概率
+        """
+        dt = 1 / t_step_per_year
+        n_row = paths.shape[0]
+        days = np.concatenate(([0], steps))
+        lower = np.broadcast_to(np.asarray(0. if lower is None else lower, dtype=np.float64), (n_row,))
+        upper = np.broadcast_to(np.asarray(np.inf if upper is None else upper, dtype=np.float64), (n_row,))
+        hit_lower, hit_upper = np.zeros(paths.shape), np.zeros(paths.shape)
+        survival = np.ones(paths.shape[1])
+        for k in range(n_row):
+            below, above = paths[k] <= lower[k], paths[k] >= upper[k]
+            cross_lower, cross_upper = np.where(below, 1., 0.), np.where(above & ~below, 1., 0.)
+            n_days = days[k] - days[k - 1] if k > 0 else 0
+            has_lower, has_upper = 0 < lower[k] < np.inf, 0 < upper[k] < np.inf
+            if n_days > 0 and (obs_step is None or n_days > obs_step) and (has_lower or has_upper):
+                vol = self.process.diffusion(days[k - 1] * dt, paths[k - 1])
+                variance = vol ** 2 * n_days * dt
+                shift = 0 if obs_step is None else _BGK_BETA * vol * np.sqrt(obs_step * dt)
+                x, y = np.log(paths[k - 1]), np.log(paths[k])
+                inside = ~(below | above)
+                if has_lower:
+                    log_lower = np.log(lower[k]) - shift
+                    single_lower = np.exp(-2 * np.maximum(x - log_lower, 0) * np.maximum(y - log_lower, 0) / variance)
+                if has_upper:
+                    log_upper = np.log(upper[k]) + shift
+                    single_upper = np.exp(-2 * np.maximum(log_upper - x, 0) * np.maximum(log_upper - y, 0) / variance)
+                if has_lower and has_upper:
+                    width = log_upper - log_lower
+                    stay = np.zeros(paths.shape[1])
+                    for j in range(-3, 4):
+                        stay += (np.exp(-2 * j * width * (j * width - (y - x)) / variance)
+                                 - np.exp(-2 * (log_upper - x + j * width) * (log_upper - y + j * width) / variance))
+                    total = 1 - np.clip(stay, 0, 1)
+                    share = np.divide(single_lower, single_lower + single_upper,
+                                      out=np.full(paths.shape[1], 0.5), where=single_lower + single_upper > 0)
+                    cross_lower[inside], cross_upper[inside] = (total * share)[inside], (total * (1 - share))[inside]
+                elif has_lower:
+                    cross_lower[inside] = single_lower[inside]
+                else:
+                    cross_upper[inside] = single_upper[inside]
+            hit_lower[k], hit_upper[k] = survival * cross_lower, survival * cross_upper
+            survival = survival * (1 - cross_lower - cross_upper)
+        return hit_lower, hit_upper
+
+    def _mc_expectation(self, payoff_fn, n_step, spot, t_step_per_year, steps=None, controls=None):
+        """蒙特卡洛期望，对payoff_fn返回的逐路径payoff求均值，并将标准误差记录在self.std_error中
+        chunk_size与n_workers均为None时一次性生成(或复用)全部价格路径；设置chunk_size时分块生成价格路径，逐块累加payoff；
+        n_workers大于1时由线程池并行计算各块，最后按块的顺序归约，chunk_size固定时结果与线程数无关
+        设置control_variates=True且传入controls时使用控制变量法: 在同一组路径上计算payoff与控制变量X，回归得到最优系数
+        beta = Cov(X)^-1 Cov(X, payoff)，估计值为 mean(payoff) - beta · (mean(X) - E[X])，标准误差由回归残差的方差计算；
+        回归系数与方差缩减倍数记录在self.cv_beta与self.variance_reduction中。单次模拟希腊字母时不使用控制变量
+        设置target_rel_error或time_budget时为自适应模拟，见_adaptive_payoff_stats；设置importance_shift时为重要性抽样，
+        见_importance_theta，单次模拟希腊字母时不使用重要性抽样
+        Args:
+            payoff_fn: Callable，输入(n_step + 1, n)的价格路径矩阵，返回长度为n的逐路径payoff(已折现)向量，
+                       不能原地修改价格路径矩阵
+            n_step: int，价格路径的时间步数
+            spot: float，标的期初价格
+            t_step_per_year: int，每年的时间步数
+            steps: np.ndarray，只在这些时间步上模拟，此时payoff_fn输入(len(steps) + 1, n)的价格路径矩阵，默认None为逐步模拟
+            controls: List[tuple]，控制变量列表[(control_fn, expectation)]，control_fn输入价格路径矩阵，返回长度为n的向量
+                      或(k, n)的矩阵，expectation是其期望(float或长度为k的数组)；None元素会被忽略
+        Returns: float，payoff的均值
+        """
+        self.cv_beta, self.variance_reduction = None, None
+        controls = [control for control in controls or [] if control is not None]
+        if controls and self.control_variates and self._greeks_record is None:
+            payoff_fn = self._stack_controls(payoff_fn, [control_fn for control_fn, _ in controls])
+            expectation = np.concatenate([np.atleast_1d(np.asarray(expected, dtype=np.float64))
+                                          for _, expected in controls])
+        else:
+            expectation = None
+        n_simulated = self.n_path
+        self.importance_shift_used = None
+        theta = None
+        if self.importance_shift is not None and self._greeks_record is None:
+            theta = self._importance_theta(payoff_fn, n_step, spot, t_step_per_year, steps)
+        if self._greeks_record is not None:
+            stats = self._greeks_payoff_stats(payoff_fn, n_step, spot, t_step_per_year, steps)
+        elif self.target_rel_error is not None or self.time_budget is not None:
+            stats, n_simulated = self._adaptive_payoff_stats(payoff_fn, n_step, spot, t_step_per_year, steps,
+                                                             expectation, theta)
+        elif self.n_workers is not None and self.n_workers > 1:
+            stats = self._parallel_payoff_stats(payoff_fn, n_step, spot, t_step_per_year, steps, theta)
+        elif theta is not None:
+            stats = self._importance_payoff_stats(payoff_fn, n_step, spot, t_step_per_year, steps, theta)
+        elif self.chunk_size is None:
+            paths = self.path_generator(n_step=n_step, spot=spot, t_step_per_year=t_step_per_year, steps=steps)
+            stats = [self._payoff_stats(payoff_fn(paths))]
+        else:
+            stats = [self._payoff_stats(payoff_fn(paths))
+                     for paths in self.path_chunk_generator(n_step=n_step, spot=spot, t_step_per_year=t_step_per_year,
+                                                            steps=steps)]
+        self.mc_value = self._estimate(stats, expectation, n_simulated)
+        self.n_path_used = n_simulated
+        return self.mc_value
+
+    def _estimate(self, stats, expectation, n_simulated):
+        """由各块的payoff统计量计算payoff均值，并记录标准误差；expectation不为None时使用控制变量法
+        Args:
+            stats: List[tuple]，_payoff_stats返回的各块统计量
+            expectation: np.ndarray，各控制变量的期望，None为不使用控制变量
+            n_simulated: int，已模拟的路径数
+        Returns: float，payoff的均值
+        """
+        if expectation is not None:
+            return self._control_variate_estimate(stats, expectation, n_simulated)
+        payoff_sum, self.std_error = self._reduce_payoff_stats(stats)
+        return payoff_sum / n_simulated
+
+    def _adaptive_payoff_stats(self, payoff_fn, n_step, spot, t_step_per_year, steps=None, expectation=None,
+                               theta=None):
+        """自适应模拟: 逐块模拟并更新标准误差，标准误差不超过target_rel_error * |均值|、用时超过time_budget
+        或已模拟n_path条路径时停止。各块的随机数与n_workers并行模拟时相同块大小的对应块相同，可以复现
+        Args:
+            payoff_fn: Callable，逐路径payoff函数，见_mc_expectation
+            n_step: int，价格路径的时间步数
+            spot: float，标的期初价格
+            t_step_per_year: int，每年的时间步数
+            steps: np.ndarray，只在这些时间步上模拟，默认None为逐步模拟
+            expectation: np.ndarray，各控制变量的期望，None为不使用控制变量
+            theta: np.ndarray，重要性抽样各时间步的平移量，None为不使用重要性抽样
+        Returns: tuple，(各块统计量, 实际模拟的路径数)
+        """
+        start_time = time.perf_counter()
+        shape, offsets = self._randoms_layout(n_step if steps is None else len(steps), self.n_path)
+        n_col = shape[1] // len(offsets)
+        chunk_size = self.chunk_size if self.chunk_size is not None else max(self.n_path // 16, 2)
+        bounds = self._chunk_bounds(n_col, chunk_size)
+        seed_seqs = np.random.SeedSequence(self.seed).spawn(len(bounds))
+        stats, n_simulated = [], 0
+        for bound, seed_seq in zip(bounds, seed_seqs):
+            rands = self._randoms_chunk(shape, bound, offsets, seed_seq)
+            s_paths, weights = self._evolve_weighted(rands, spot, 1 / t_step_per_year, steps, theta)
+            del rands
+            stats.append(self._payoff_stats(self._weighted(payoff_fn(s_paths), weights)))
+            n_simulated += s_paths.shape[1]
+            if self.time_budget is not None and time.perf_counter() - start_time >= self.time_budget:
+                break
+            if self.target_rel_error is not None:
+                value = self._estimate(stats, expectation, n_simulated)
+                if self.std_error <= self.target_rel_error * abs(value):
+                    break
+        return stats, n_simulated
+
+    def confidence_interval(self, level=0.95):
+        """最近一次蒙特卡洛估值的置信区间，按中心极限定理取均值±分位数×标准误差
+        Args:
+            level: float，置信水平，默认0.95
+        Returns: tuple，(置信下限, 置信上限)
+        """
+        if self.mc_value is None:
+            raise ValueError("尚未进行蒙特卡洛估值，无法计算置信区间")
+        half_width = norm.ppf(0.5 + level / 2) * self.std_error
+        return self.mc_value - half_width, self.mc_value + half_width
+
+    @staticmethod
+    def _stack_controls(payoff_fn, control_fns):
+        """将payoff与控制变量合并为一个函数，返回(1 + k, n)的矩阵，第0行是payoff，其余各行是控制变量"""
+
+        def stacked_fn(paths):
+            rows = [np.asarray(payoff_fn(paths), dtype=np.float64)]
+            for control_fn in control_fns:
+                rows.append(np.asarray(control_fn(paths), dtype=np.float64).reshape(-1, paths.shape[1]))
+            return np.vstack(rows)
+
+        return stacked_fn
+
+    def _control_variate_estimate(self, stats, expectation, n_simulated):
+        """由payoff与控制变量的统计量回归最优系数，返回控制变量法的估计值，并记录标准误差、回归系数与方差缩减倍数
+        Args:
+            stats: List[tuple]，_payoff_stats返回的各块统计量，第0行是payoff，其余各行是控制变量
+            expectation: np.ndarray，各控制变量的期望
+            n_simulated: int，已模拟的路径数
+        Returns: float，控制变量法的payoff均值估计
+        """
+        payoff_sum, n_total, _, m2 = self._reduce_payoff_moments(stats)
+        cov = m2 / max(n_total - 1, 1)
+        beta = np.linalg.lstsq(cov[1:, 1:], cov[0, 1:], rcond=None)[0]  # 控制变量共线或为常数时取最小范数解
+        residual_var = max(cov[0, 0] - cov[0, 1:] @ beta, 0.)
+        self.cv_beta = beta
+        self.variance_reduction = cov[0, 0] / residual_var if residual_var > 0 else (1. if cov[0, 0] == 0 else np.inf)
+        self.std_error = np.sqrt(residual_var / n_total) if n_total > 1 else np.nan
+        return (payoff_sum[0] - beta @ (payoff_sum[1:] - n_simulated * expectation)) / n_simulated
+
+    def _terminal_control(self, n_step, spot, t_step_per_year, steps=None):
+        """以到期日的标的价格为控制变量，适用于所有随机过程。期望按模拟格式计算: 欧拉格式每步的增长因子为1 + drift * dt，
+        期望为spot * ∏(1 + drift * dt)；对数欧拉格式的期望为远期价格
+        Args:
+            n_step: int，价格路径的时间步数
+            spot: float，标的期初价格
+            t_step_per_year: int，每年的时间步数
+            steps: np.ndarray，只在这些时间步上模拟，见_evolve_paths
+        Returns: tuple，(control_fn, expectation)，见_mc_expectation
+        """
+        if steps is None:
+            dt = 1 / t_step_per_year
+            drift = np.broadcast_to(np.asarray(self.process.drift(dt * np.arange(1, n_step + 1)), dtype=np.float64),
+                                    (n_step,))
+            expectation = spot * np.prod(1 + drift * dt)
+        else:
+            maturity = steps[-1] / t_step_per_year
+            expectation = spot * self.process.div.disc_factor(maturity) / self.process.interest.disc_factor(maturity)
+        return (lambda paths: paths[-1]), expectation
+
+    def _gbm_control_fn(self, n_step, spot, t_step_per_year, steps=None):
+        """由价格路径还原驱动它的布朗运动W(t)，构造同一布朗运动驱动的几何布朗运动 G(t) = spot * exp((r - q - vol²/2)t + vol * W(t))，
+        r、q取到期日的零息利率。G的到期价格、几何平均、连续障碍等泛函的期望都有闭式解，且与价格路径高度相关，可以构造控制变量；
+        欧拉格式下两者只相差离散化误差，对数欧拉格式、常数利率时两者相同。仅适用于常数波动率的BSM过程，其余情形返回None
+        Args:
+            n_step: int，价格路径的时间步数
+            spot: float，标的期初价格
+            t_step_per_year: int，每年的时间步数
+            steps: np.ndarray，只在这些时间步上模拟，见_evolve_paths
+        Returns: Callable，输入价格路径矩阵，返回同形状的float64几何布朗运动路径矩阵，第0行为spot；不适用时返回None
+        """
+        if self.process() != ProcessType.BSProcess1D or getattr(self.process.vol, "vol_type", None) != VolType.CV:
+            return None
+        euler = steps is None
+        t_grid = (np.arange(1, n_step + 1) if euler else np.asarray(steps)) / t_step_per_year
+        t_start = np.append(0., t_grid[:-1])
+        dt = t_grid - t_start
+        if euler:  # 欧拉格式每步的增长因子为 1 + drift * dt + vol * dW
+            vol = np.broadcast_to(np.asarray(self.process.vol(t_grid, spot), dtype=np.float64), t_grid.shape)
+            step_mean = 1 + np.broadcast_to(np.asarray(self.process.drift(t_grid), dtype=np.float64), t_grid.shape) * dt
+        else:  # 对数欧拉格式每步的对数收益率为 log_drift - vol²dt/2 + vol * dW
+            vol = np.broadcast_to(np.asarray(self.process.vol(t_start, spot), dtype=np.float64), t_grid.shape)
+            step_mean = (np.log(self.process.div.disc_factor(t_grid, t_start)
+                                / self.process.interest.disc_factor(t_grid, t_start)) - 0.5 * vol ** 2 * dt)
+        maturity = t_grid[-1] if t_grid.size > 0 else 0.
+        sigma = float(vol[-1]) if t_grid.size > 0 else 0.
+        log_growth = (self.process.interest(maturity) - self.process.div(maturity) - 0.5 * sigma ** 2) * t_grid
+
+        def gbm_fn(paths):
+            paths = np.asarray(paths, dtype=np.float64)
+            step_return = paths[1:] / paths[:-1]
+            if not euler:
+                step_return = np.log(step_return)
+            d_w = (step_return - step_mean[:, np.newaxis]) / vol[:, np.newaxis]
+            log_gbm = np.zeros(paths.shape)
+            np.cumsum(d_w, axis=0, out=log_gbm[1:])
+            log_gbm[1:] *= sigma
+            log_gbm[1:] += log_growth[:, np.newaxis]
+            return spot * np.exp(log_gbm)
+
+        return gbm_fn
+
+    def _importance_payoff_stats(self, payoff_fn, n_step, spot, t_step_per_year, steps, theta):
+        """重要性抽样的单线程模拟，随机数与不使用重要性抽样时相同(一次性生成或按chunk_size分块)，返回各块的payoff统计量
+        平移量为0时与普通模拟的结果逐位相同"""
+        shape, offsets = self._randoms_layout(n_step if steps is None else len(steps), self.n_path)
+        if self.chunk_size is None:
+            blocks = [self._randoms_generator(shape=shape)]
+        else:
+            blocks = self._randoms_chunk_generator(shape, self._chunk_bounds(shape[1] // len(offsets)), offsets)
+        stats = []
+        for rands in blocks:
+            s_paths, weights = self._evolve_weighted(rands, spot, 1 / t_step_per_year, steps, theta)
+            stats.append(self._payoff_stats(self._weighted(payoff_fn(s_paths), weights)))
+        return stats
+
+    def _importance_theta(self, payoff_fn, n_step, spot, t_step_per_year, steps=None):
+        """重要性抽样各时间步标准正态随机数的平移量theta，使驱动标的价格的布朗运动在到期日的均值平移importance_shift个标准差，
+        平移量按各步时长的平方根分配，满足sum(theta²) = importance_shift²；importance_shift='auto'时先试算选择平移量
+        Returns: np.ndarray，(n_row,)的各时间步平移量
+        """
+        n_row = n_step if steps is None else len(steps)
+        dt = np.ones(n_row) if steps is None else np.diff(np.concatenate(([0], steps))).astype(float)
+        direction = np.sqrt(dt / np.sum(dt)) if n_row > 0 else dt
+        shift = self.importance_shift
+        if shift == 'auto':
+            shift = self._tune_importance_shift(payoff_fn, direction, spot, t_step_per_year, steps)
+        self.importance_shift_used = shift
+        return shift * direction
+
+    def _tune_importance_shift(self, payoff_fn, direction, spot, t_step_per_year, steps=None, n_grid=13):
+        """试算选择重要性抽样的平移量: 用同一组伪随机数(约n_path/64条路径，至少256条)在到期日-3~3个标准差的候选平移量下模拟，
+        选择加权payoff相对方差(样本方差/样本均值²)最小的平移量。稀有事件在试算路径中可能一次也未发生，此时样本方差为0，
+        但估计值也为0，用相对方差可以排除这类候选；各候选下payoff均值都为0时返回0
+        Args:
+            payoff_fn: Callable，逐路径payoff函数，见_mc_expectation
+            direction: np.ndarray，(n_row,)的单位平移方向，见_importance_theta
+            spot: float，标的期初价格
+            t_step_per_year: int，每年的时间步数
+            steps: np.ndarray，只在这些时间步上模拟，默认None为逐步模拟
+            n_grid: int，候选平移量的个数
+        Returns: float，平移量
+        """
+        shape, _ = self._randoms_layout(direction.size, 2 * max(self.n_path // 128, 128))
+        rands = np.random.default_rng(self.seed).standard_normal(shape, dtype=self._dtype)
+        best_shift, best_rel_var = 0., np.inf
+        for shift in np.linspace(-3, 3, n_grid):
+            s_paths, weights = self._evolve_weighted(rands, spot, 1 / t_step_per_year, steps, shift * direction)
+            payoff = np.atleast_2d(self._weighted(payoff_fn(s_paths), weights))[0]  # 使用控制变量时第0行是payoff
+            _, n, mean, m2 = self._payoff_stats(payoff)
+            if mean != 0 and m2 / n / mean ** 2 < best_rel_var:
+                best_shift, best_rel_var = float(shift), m2 / n / mean ** 2
+        return best_shift
+
+    def _evolve_weighted(self, rands, spot, dt, steps=None, theta=None):
+        """由一块随机数演化价格路径；theta不为None时为重要性抽样，先平移随机数，同时返回各路径的似然比
+        Returns: tuple，(价格路径矩阵, (n_path,)的似然比；不使用重要性抽样时为None)
+        """
+        if theta is None:
+            return self._evolve_paths(rands, spot, dt, steps)[0], None
+        rands, weights = self._shift_randoms(rands, theta)
+        return self._evolve_paths(rands, spot, dt, steps, antithetic=False)[0], weights
+
+    def _shift_randoms(self, rands, theta):
+        """重要性抽样的Girsanov变换: 驱动标的价格的标准正态随机数z平移为z + theta，似然比为exp(-theta·z - |theta|²/2)
+        使用对立变量时先展开为z与-z两组，再分别平移，两组路径都在平移后的测度下抽样；Heston过程只平移价格的随机数
+        Args:
+            rands: np.ndarray，一块随机数，布局见_randoms_layout
+            theta: np.ndarray，(n_row,)的各时间步平移量
+        Returns: tuple，(平移后的随机数，布局为不使用对立变量时的布局, (n_path,)的似然比)
+        """
+        groups = np.split(rands, 1 if self.process() == ProcessType.BSProcess1D else 2, axis=1)
+        if self.antithetic_variate:
+            groups = [np.hstack((group, -group)) for group in groups]
+        weights = np.exp(-(theta @ groups[0]) - 0.5 * (theta @ theta))
+        groups[0] = groups[0] + theta.astype(rands.dtype)[:, np.newaxis]
+        return np.hstack(groups), weights
+
+    @staticmethod
+    def _weighted(payoff, weights):
+        """重要性抽样时payoff乘以似然比，使用控制变量时控制变量也乘以似然比，期望不变"""
+        return payoff if weights is None else np.asarray(payoff, dtype=np.float64) * weights
+
+    def _use_mlmc(self, n_step):
+        """是否使用多层蒙特卡洛: 设置了mlmc_levels，不在单次模拟希腊字母，且估值日距到期日至少一个时间步"""
+        if self.mlmc_levels is None or self._greeks_record is not None or n_step <= 0:
+            return False
+        if self.process() != ProcessType.BSProcess1D:
+            raise ValueError(f'多层蒙特卡洛(MLMC)仅支持ProcessType.BSProcess1D，当前输入为{self.process()}')
+        return True
+
+    def _mlmc_expectation(self, payoff_factory, n_step, spot, t_step_per_year, fixed_steps=()):
+        """多层蒙特卡洛(MLMC)期望: E[P_L] = E[P_0] + Σ_{l=1}^{L} E[P_l - P_{l-1}]，P_l是第l层网格上的payoff，
+        最细层P_L逐日模拟，与逐日模拟的估计量期望相同；粗网格只模拟少数时点，用布朗桥、插值等近似逐日观察，计算量小。
+        第l层(l≥1)的样本在同一组布朗运动下分别计算细网格与粗网格的payoff之差，粗网格每一步的布朗运动增量等于其包含的细网格各步增量之和，
+        两者高度相关，差的方差很小，只需少量样本。各层先模拟试算样本估计方差V_l，计算量C_l取两层网格的时点数之和，
+        再按N_l ∝ sqrt(V_l / C_l)分配样本数: 设置mlmc_rmse时使 ΣV_l/N_l = mlmc_rmse²，否则总计算量与n_path条逐日路径相同。
+        使用对数欧拉格式与伪随机数，各层按块生成独立且可复现的随机数流；不使用对立变量、控制变量与重要性抽样。
+        各层样本数与方差记录在self.mlmc_n_paths与self.mlmc_level_var中
+        Args:
+            payoff_factory: Callable，输入升序的模拟时间步steps，返回该网格上的逐路径payoff函数，
+                            payoff函数输入(len(steps) + 1, n)的价格路径矩阵，见_mc_expectation
+            n_step: int，到期日的时间步序号
+            spot: float，标的期初价格
+            t_step_per_year: int，每年的时间步数
+            fixed_steps: np.ndarray，每一层都要模拟的时间步，例如观察日
+        Returns: float，payoff的均值
+        """
+        grids = self._mlmc_grids(n_step, fixed_steps)
+        payoff_fns = [payoff_factory(grid) for grid in grids]
+        costs = np.array([grid.size + (grids[level - 1].size if level > 0 else 0)
+                          for level, grid in enumerate(grids)], dtype=float)
+        batch = self.chunk_size if self.chunk_size is not None else 2 ** 14
+        level_seqs = np.random.SeedSequence(self.seed).spawn(len(grids))
+        n_pilot = max(self.n_path // (16 * len(grids)), 256)
+
+        def simulate(level, n):
+            bounds = [(start, min(start + batch, n)) for start in range(0, n, batch)]
+            return [self._mlmc_level_stats(payoff_fns, grids, level, stop - start, seed_seq, spot, 1 / t_step_per_year)
+                    for (start, stop), seed_seq in zip(bounds, level_seqs[level].spawn(len(bounds)))]
+
+        stats = [simulate(level, n_pilot) for level in range(len(grids))]
+        variances = np.array([m2 / (n - 1) for _, n, _, m2 in map(self._reduce_payoff_moments, stats)])
+        total_weight = np.sum(np.sqrt(variances * costs))
+        if total_weight > 0:
+            if self.mlmc_rmse is not None:
+                n_optimal = np.sqrt(variances / costs) * total_weight / self.mlmc_rmse ** 2
+            else:
+                n_optimal = np.sqrt(variances / costs) * self.n_path * grids[-1].size / total_weight
+            for level, n_level in enumerate(np.ceil(n_optimal).astype(int)):
+                if n_level > n_pilot:
+                    stats[level] += simulate(level, n_level - n_pilot)
+        moments = [self._reduce_payoff_moments(level_stats) for level_stats in stats]
+        self.mlmc_n_paths = [n for _, n, _, _ in moments]
+        self.mlmc_level_var = np.array([m2 / (n - 1) for _, n, _, m2 in moments])
+        self.std_error = np.sqrt(np.sum(self.mlmc_level_var / self.mlmc_n_paths))
+        self.cv_beta, self.variance_reduction, self.importance_shift_used = None, None, None
+        self.mc_value = sum(payoff_sum / n for payoff_sum, n, _, _ in moments)
+        self.n_path_used = sum(self.mlmc_n_paths)
+        return self.mc_value
+
+    def _mlmc_grids(self, n_step, fixed_steps=()):
+        """MLMC各层的模拟时间步，第l层每2^(mlmc_levels-1-l)个交易日模拟一次，并包含fixed_steps与到期日；
+        粗网格是细网格的子集，最细层为1~n_step的全部交易日，相邻两层网格相同时只保留一层
+        Returns: List[np.ndarray]，由粗到细的各层时间步
+        """
+        fixed_steps = np.asarray(fixed_steps, dtype=int)
+        fixed_steps = fixed_steps[(fixed_steps > 0) & (fixed_steps < n_step)]
+        grids = []
+        for level in range(self.mlmc_levels):
+            stride = 2 ** (self.mlmc_levels - 1 - level)
+            grid = np.union1d(np.union1d(fixed_steps, np.arange(stride, n_step, stride)), [n_step]).astype(int)
+            if not grids or grid.size != grids[-1].size:
+                grids.append(grid)
+        return grids
+
+    def _mlmc_level_stats(self, payoff_fns, grids, level, n, seed_seq, spot, dt):
+        """模拟MLMC第level层的n个样本: 第0层为最粗网格上的payoff，其余各层为同一组布朗运动下细网格与粗网格的payoff之差
+        Returns: tuple，样本的统计量，见_payoff_stats
+        """
+        rands = np.random.default_rng(seed_seq).standard_normal((grids[level].size, n), dtype=self._dtype)
+        s_paths, _ = self._evolve_paths(rands, spot, dt, grids[level], antithetic=False)
+        samples = np.asarray(payoff_fns[level](s_paths), dtype=np.float64)
+        if level > 0:
+            coarse_rands = self._coarsen_randoms(rands, grids[level], grids[level - 1])
+            coarse_paths, _ = self._evolve_paths(coarse_rands, spot, dt, grids[level - 1], antithetic=False)
+            samples = samples - payoff_fns[level - 1](coarse_paths)
+        return self._payoff_stats(samples, antithetic=False)
+
+    @staticmethod
+    def _coarsen_randoms(rands, fine_steps, coarse_steps):
+        """由细网格的标准正态随机数合成粗网格的标准正态随机数，粗网格每一步的布朗运动增量等于其包含的细网格各步增量之和
+        Args:
+            rands: np.ndarray，(len(fine_steps), n)的标准正态随机数矩阵
+            fine_steps: np.ndarray，细网格的时间步
+            coarse_steps: np.ndarray，粗网格的时间步，是fine_steps的子集
+        Returns: np.ndarray，(len(coarse_steps), n)的标准正态随机数矩阵
+        """
+        fine_dt = np.diff(np.concatenate(([0], fine_steps)))
+        coarse_dt = np.diff(np.concatenate(([0], coarse_steps)))
+        starts = np.searchsorted(fine_steps, np.concatenate(([0], coarse_steps[:-1])), side='right')
+        dw = np.add.reduceat(rands * np.sqrt(fine_dt)[:, np.newaxis], starts, axis=0)
+        return (dw / np.sqrt(coarse_dt)[:, np.newaxis]).astype(rands.dtype, copy=False)
+
+    def _parallel_payoff_stats(self, payoff_fn, n_step, spot, t_step_per_year, steps=None, theta=None):
+        """多线程并行模拟，返回按块顺序排列的payoff统计量
+        numpy的数组运算会释放GIL，各块的payoff计算可以并行；路径演化调用的numba并行函数本身已经使用全部核心，由锁串行进入
+        """
+        shape, offsets = self._randoms_layout(n_step if steps is None else len(steps), self.n_path)
+        n_col = shape[1] // len(offsets)
+        chunk_size = self.chunk_size if self.chunk_size is not None else -(-self.n_path // self.n_workers)
+        bounds = self._chunk_bounds(n_col, chunk_size)
+        seed_seqs = np.random.SeedSequence(self.seed).spawn(len(bounds))
+        dt = 1 / t_step_per_year
+
+        def chunk_stats(bound, seed_seq):
+            rands = self._randoms_chunk(shape, bound, offsets, seed_seq)
+            with _EVOLVE_LOCK:
+                s_paths, weights = self._evolve_weighted(rands, spot, dt, steps, theta)
+            del rands
+            return self._payoff_stats(self._weighted(payoff_fn(s_paths), weights))
+
+        with ThreadPoolExecutor(max_workers=self.n_workers) as executor:
+            return list(executor.map(chunk_stats, bounds, seed_seqs))
+
+    def _payoff_stats(self, payoff, antithetic=None):
+        """计算一块逐路径payoff的统计量，使用对立变量时，以每对对立路径的均值作为一个独立样本
+        Args:
+            payoff: np.ndarray，逐路径payoff向量，使用对立变量时前后两半互为对立路径；
+                    使用控制变量时为(1 + k, n)的矩阵，各行分别是payoff与控制变量
+            antithetic: bool，payoff是否为对立路径的布局，默认None为self.antithetic_variate
+        Returns: tuple，(payoff之和, 样本数, 样本均值, 样本离差平方和)，矩阵输入时为各行之和、均值向量与离差叉积矩阵
+        """
+        payoff = np.asarray(payoff, dtype=np.float64)
+        n = payoff.shape[-1]
+        antithetic = self.antithetic_variate if antithetic is None else antithetic
+        if antithetic and n % 2 == 0:
+            samples = (payoff[..., :n // 2] + payoff[..., n // 2:]) / 2
+        else:
+            samples = payoff
+        if payoff.ndim == 2:
+            sample_mean = np.mean(samples, axis=1) if samples.shape[1] > 0 else np.zeros(samples.shape[0])
+            centered = samples - sample_mean[:, np.newaxis]
+            return np.sum(payoff, axis=1), samples.shape[1], sample_mean, centered @ centered.T
+        sample_mean = np.mean(samples) if samples.size > 0 else 0.
+        return np.sum(payoff), samples.size, sample_mean, np.sum((samples - sample_mean) ** 2)
+
+    @classmethod
+    def _reduce_payoff_stats(cls, stats):
+        """按顺序合并各块的payoff统计量
+        Args:
+            stats: List[tuple]，_payoff_stats返回的各块统计量
+        Returns:
+            payoff_sum: float，所有路径payoff之和
+            std_error: float，payoff均值的标准误差
+        """
+        payoff_sum, n_total, _, m2 = cls._reduce_payoff_moments(stats)
+        std_error = np.sqrt(m2 / (n_total - 1) / n_total) if n_total > 1 else np.nan
+        return payoff_sum, std_error
+
+    @staticmethod
+    def _reduce_payoff_moments(stats):
+        """按顺序合并各块的payoff统计量(Chan等人的并行方差合并公式)，payoff与控制变量合并时均值为向量、离差平方和为矩阵
+        Args:
+            stats: List[tuple]，_payoff_stats返回的各块统计量
+        Returns: tuple，(payoff之和, 样本数, 样本均值, 样本离差平方和)
+        """
+        payoff_sum, n_total, mean, m2 = 0, 0, 0., 0.
+        for chunk_sum, n, chunk_mean, chunk_m2 in stats:
+            payoff_sum += chunk_sum
+            if n == 0:
+                continue
+            delta = chunk_mean - mean
+            delta_sq = delta ** 2 if np.ndim(delta) == 0 else np.outer(delta, delta)
+            m2 += chunk_m2 + delta_sq * n_total * n / (n_total + n)
+            mean += delta * n / (n_total + n)
+            n_total += n
+        return payoff_sum, n_total, mean, m2
+
+    @property
+    def pv_and_greeks(self):
+        """一次性计算pv和希腊字母
+        设置one_pass_greeks=True时在同一组模拟路径上估计，见_pv_and_greeks；否则为共同随机数的差分法，见_bump_pv_and_greeks"""
+        if self.one_pass_greeks:
+            return self._pv_and_greeks
+        return self._bump_pv_and_greeks
+
+    def calc_bumped_value(self, prod, t=None, spot=None, vol_bump=0., r_bump=0.):
+        """共同随机数的参数扰动定价: 波动率上升vol_bump、无风险利率上升r_bump后重新定价，复用已有的标准正态随机数
+        标的价格的扰动直接传入spot，价格路径关于期初价格线性时将已有价格路径缩放，不重新演化(见path_generator)；
+        波动率、无风险利率的扰动用已有随机数重新演化价格路径，定价后恢复参数与扰动前的价格路径，之后的基准情景定价不必重新演化。
+        目前只支持常数波动率与常数无风险利率的扰动
+        Args:
+            prod: Product产品对象
+            t: datetime.date，估值日; 如果是None，则使用全局估值日globalEvaluationDate
+            spot: float，标的价格，如果是None，则使用随机过程的当前价格
+            vol_bump: float，波动率的扰动量
+            r_bump: float，无风险利率的扰动量
+        Returns: float，扰动情景下的现值
+        """
+        if vol_bump == 0 and r_bump == 0:
+            return prod.price(t=t, spot=spot)
+        saved_paths = (self.rands, self.s_paths, self.var_paths, self._path_steps, self._path_spot,
+                       self.__reset_paths, self.__rescale_paths)
+        last_vol = self.process.vol.volval if vol_bump != 0 else None
+        last_r = self.process.interest.data if r_bump != 0 else None
+        try:
+            if vol_bump != 0:
+                self.process.vol.volval = last_vol + vol_bump
+            if r_bump != 0:
+                self.process.interest.data = last_r + r_bump
+            return prod.price(t=t, spot=spot)
+        finally:
+            if vol_bump != 0:
+                self.process.vol.volval = last_vol
+            if r_bump != 0:
+                self.process.interest.data = last_r
+            if self.rands is saved_paths[0] and not self.__reset_rands:  # 随机数未变，扰动前的价格路径仍然有效
+                (_, self.s_paths, self.var_paths, self._path_steps, self._path_spot,
+                 self.__reset_paths, self.__rescale_paths) = saved_paths
+
+    def _bump_pv_and_greeks(self, prod, t=None, spot=None):
+        """共同随机数的差分法计算pv和希腊字母，与产品通用的差分法相同，各扰动情景复用同一组标准正态随机数(见calc_bumped_value)，
+        整组希腊字母只生成一次随机数；标的价格的扰动缩放已有价格路径，波动率、无风险利率的扰动各重新演化一次价格路径
+        Args:
+            prod: Product产品对象
+            t: datetime.date，估值日; 如果是None，则使用全局估值日globalEvaluationDate
+            spot: float，估值日标的价格，如果是None，则使用随机过程的当前价格
+        Returns:
+            Dict[str:float]: {'pv': pv, 'delta': delta, 'gamma': gamma, 'vega': vega, 'theta': theta, 'rho': rho}
+        """
+        calculate_date = global_evaluation_date() if t is None else t
+        spot = self.process.spot() if spot is None else spot
+        pv = np.float64(prod.price(t=t, spot=spot))
+        pv_std_error = self.std_error
+        s_step = spot * 0.01
+        up_price = self.calc_bumped_value(prod, t=t, spot=spot + s_step)
+        down_price = self.calc_bumped_value(prod, t=t, spot=spot - s_step)
+        delta = (up_price - down_price) / (2 * s_step)
+        gamma = (up_price - 2 * pv + down_price) / (s_step ** 2)
+        vega = self.calc_bumped_value(prod, t=t, spot=spot, vol_bump=0.01) - pv
+        rho = self.calc_bumped_value(prod, t=t, spot=spot, r_bump=0.01) - pv
+        try:  # 可能遇到到期日估值，无法计算theta
+            next_date = prod.trade_calendar.advance(calculate_date, datetime.timedelta(days=1))
+            theta = prod.price(t=next_date, spot=spot) - pv
+        except Exception:
+            theta = np.nan
+        self.std_error = pv_std_error
+        return {'pv': pv, 'delta': delta, 'gamma': gamma, 'vega': vega, 'theta': theta, 'rho': rho}
+
+    def _pv_and_greeks(self, prod, t=None, spot=None):
+        """在同一组正态随机数与价格路径上计算pv、delta、gamma、vega、rho，标准误差记录在self.greeks_std_error中
+        对参数θ(标的价格、波动率、无风险利率)的导数分为两部分:
+            payoff函数对θ的直接依赖(折现因子、布朗桥穿越概率等): 在θ±h下重新构造payoff函数，作用于同一组价格路径，中心差分;
+            价格路径对θ的依赖: pathwise_greeks为True的引擎(payoff关于路径连续，如香草、亚式)使用路径导数，
+                将同一组正态随机数的价格路径按θ±h重新缩放，与直接依赖合并为同一个中心差分；
+                其他引擎(数字、障碍、自动赎回等payoff不连续)使用似然比，payoff乘以对数价格转移密度关于θ的得分函数。
+        只支持常数波动率、常数无风险利率的BSM过程，价格路径使用对数欧拉格式，与逐日欧拉格式的price()相差离散化误差；
+        theta为估值日后移一天，用同一组正态随机数在下一交易日的时间网格上重新定价
+        Args:
+            prod: Product产品对象
+            t: datetime.date，估值日; 如果是None，则使用全局估值日globalEvaluationDate
+            spot: float，估值日标的价格，如果是None，则使用随机过程的当前价格
+        Returns:
+            Dict[str:float]: {'pv': pv, 'delta': delta, 'gamma': gamma, 'vega': vega, 'theta': theta, 'rho': rho}
+                             vega和rho为波动率、无风险利率上升1%的价值变化
+        """
+        if self.process() != ProcessType.BSProcess1D or getattr(self.process.vol, "vol_type", None) != VolType.CV:
+            raise ValueError("单次模拟的希腊字母只支持常数波动率的BSM过程")
+        calculate_date = global_evaluation_date() if t is None else t
+        spot = self.process.spot() if spot is None else spot
+        vol, r = self.process.vol.volval, self.process.interest.data
+        s_step, vol_step, r_step = spot * 0.01, 0.01, 0.01
+        bumps = {'spot_up': (spot + s_step, vol, r), 'spot_down': (spot - s_step, vol, r),
+                 'vol_up': (spot, vol + vol_step, r), 'vol_down': (spot, vol - vol_step, r),
+                 'r_up': (spot, vol, r + r_step), 'r_down': (spot, vol, r - r_step)}
+        try:
+            self._greeks_record = {}
+            pv = self.calc_present_value(prod=prod, t=t, spot=spot)
+            record = self._greeks_record
+            if 'pv' not in record or not np.isclose(pv, record['pv'], rtol=1e-12, atol=0):
+                raise ValueError("单次模拟的希腊字母要求现值等于蒙特卡洛期望")
+            record.update(vol=vol, r=r)
+            pv_std_error = self.std_error
+            for key, (bump_spot, bump_vol, bump_r) in bumps.items():
+                self.process.vol.volval, self.process.interest.data = bump_vol, bump_r
+                record['key'] = key
+                self.calc_present_value(prod=prod, t=t, spot=bump_spot)
+            self.process.vol.volval, self.process.interest.data = vol, r
+            greeks = self._combine_greeks(record, spot, vol, s_step, vol_step, r_step)
+            try:  # 可能遇到到期日估值，无法计算theta
+                record['key'] = 'theta'
+                next_date = prod.trade_calendar.advance(calculate_date, datetime.timedelta(days=1))
+                theta = self.calc_present_value(prod=prod, t=next_date, spot=spot) - pv
+            except Exception:
+                theta = np.nan
+        finally:
+            self._greeks_record = None
+            self.process.vol.volval, self.process.interest.data = vol, r
+        self.std_error = pv_std_error
+        self.greeks_std_error = {'pv': pv_std_error, **{key: value[1] for key, value in greeks.items()}}
+        return {'pv': np.float64(pv), 'delta': greeks['delta'][0], 'gamma': greeks['gamma'][0],
+                'vega': greeks['vega'][0], 'theta': theta, 'rho': greeks['rho'][0]}
+
+    def _greeks_payoff_stats(self, payoff_fn, n_step, spot, t_step_per_year, steps=None):
+        """单次模拟希腊字母时的payoff统计量
+        基准情形: 用对数欧拉格式生成价格路径，逐块记录正态随机数、价格路径与payoff；
+        参数扰动情形: 不再生成随机数，payoff_fn作用于记录的价格路径(路径导数引擎先换成扰动后参数下的价格路径)；
+        theta: 用记录的正态随机数在下一交易日的时间网格上重新演化价格路径
+        """
+        steps = np.arange(1, n_step + 1) if steps is None else np.asarray(steps)
+        dt = 1 / t_step_per_year
+        record = self._greeks_record
+        if 'chunks' not in record:  # 基准情形
+            shape, offsets = self._randoms_layout(len(steps), self.n_path)
+            if self.chunk_size is None:
+                randoms = [self._randoms_generator(shape)]
             else:
-                self.rands = self._randoms_generator(shape=(n_step, n_path * 2))
-                rand_s = self.rands[:, :self.rands.shape[1] // 2].copy()
-                rand_v = self.rands[:, self.rands.shape[1] // 2:].copy()
-                rand_v = self.process.var_rho * rand_s + np.sqrt(1 - self.process.var_rho ** 2) * rand_v
-            self.s_paths[0] = spot
-            self.var_paths[0] = self.process.v0
-
-            for step in range(1, n_step + 1):
-                [self.s_paths[step], self.var_paths[step]] = self.process.evolve(dt * step, [self.s_paths[step - 1],
-                                                                                             self.var_paths[step - 1]],
-                                                                                 dt,
-                                                                                 [rand_s[step - 1], rand_v[step - 1]])
-            self.var_paths = np.maximum(self.var_paths, 0)  # heston方差非负修正：部分截断形式
+                randoms = self._randoms_chunk_generator(shape, self._chunk_bounds(shape[1]), offsets)
+            chunks = []
+            for rands in randoms:
+                s_paths, _ = self._evolve_paths(rands, spot, dt, steps)
+                chunks.append({'rands': rands, 'paths': s_paths, 'payoff': payoff_fn(s_paths)})
+            record.update(chunks=chunks, steps=steps, t_step_per_year=t_step_per_year)
+            payoffs = [chunk['payoff'] for chunk in chunks]
         else:
-            raise ValueError(f'随机过程类型输入错误，应为（ProcessType.BSProcess1D, ProcessType.Heston）二者之一，'
-                             f'当前输入为{self.process()}')
+            key = record.get('key')
+            if key == 'theta':
+                if len(steps) > len(record['steps']):
+                    raise ValueError("下一交易日的时间步多于估值日，无法复用正态随机数")
+                payoffs = [payoff_fn(self._evolve_paths(chunk['rands'][:len(steps)], spot, dt, steps)[0])
+                           for chunk in record['chunks']]
+            else:
+                if key is None or key in record or not np.array_equal(steps, record['steps']):
+                    raise ValueError("单次模拟的希腊字母只支持调用一次_mc_expectation、且扰动前后时间步相同的定价引擎")
+                payoffs = [payoff_fn(self._greeks_paths(record, chunk, spot)) for chunk in record['chunks']]
+            record[key] = payoffs
+        stats = [self._payoff_stats(payoff) for payoff in payoffs]
+        record.setdefault('pv', self._reduce_payoff_stats(stats)[0] / self.n_path)
+        return stats
 
-        self.__reset_paths = False  # 重置路径标志位
-        return self.s_paths
+    def _greeks_paths(self, record, chunk, spot):
+        """参数扰动情形下payoff_fn作用的价格路径
+        似然比引擎使用基准价格路径；路径导数引擎使用同一组正态随机数在扰动后参数下的价格路径，对数欧拉格式下:
+            标的价格S→S+h: 整条路径乘以(S+h)/S
+            无风险利率r→r+h: t时刻的价格乘以exp(h*t)
+            波动率σ→σ+h: 用扰动后的随机过程重新演化
+        Args:
+            record: dict，_greeks_payoff_stats记录的基准情形
+            chunk: dict，记录的一块随机数、价格路径与payoff
+            spot: float，扰动后的标的价格
+        Returns: np.ndarray，价格路径矩阵
+        """
+        if not self.pathwise_greeks:
+            return chunk['paths']
+        key = record['key']
+        if key.startswith('spot'):
+            return chunk['paths'] * (spot / chunk['paths'][0, 0])
+        if key.startswith('r'):
+            t_grid = np.concatenate(([0], record['steps'])) / record['t_step_per_year']
+            return chunk['paths'] * np.exp((self.process.interest.data - record['r']) * t_grid)[:, np.newaxis]
+        return self._evolve_paths(chunk['rands'], spot, 1 / record['t_step_per_year'], record['steps'])[0]
+
+    def _combine_greeks(self, record, spot, vol, s_step, vol_step, r_step):
+        """由基准情形与各参数扰动情形的逐路径payoff，合成delta、gamma、vega、rho的逐路径估计量
+        似然比的得分函数(对数欧拉格式，第k步的正态随机数为Z_k，时间步长为dt_k):
+            delta: Z_1 / (S σ sqrt(dt_1))
+            gamma: (Z_1² - 1) / (S² σ² dt_1) - Z_1 / (S² σ sqrt(dt_1))
+            vega: Σ_k [(Z_k² - 1) / σ - Z_k sqrt(dt_k)]
+            rho: Σ_k Z_k sqrt(dt_k) / σ
+        Args:
+            record: dict，_greeks_payoff_stats记录的基准情形与扰动情形
+            spot: float，标的价格
+            vol: float，波动率
+            s_step: float，标的价格的扰动步长
+            vol_step: float，波动率的扰动步长
+            r_step: float，无风险利率的扰动步长
+        Returns: Dict[str:tuple]，各希腊字母的(估计值, 标准误差)，vega和rho为参数上升1%的价值变化
+        """
+        dt = np.diff(np.concatenate(([0], record['steps']))) / record['t_step_per_year']
+        stats = {'delta': [], 'gamma': [], 'vega': [], 'rho': []}
+        for i, chunk in enumerate(record['chunks']):
+            payoff = chunk['payoff']
+            spot_up, spot_down = record['spot_up'][i], record['spot_down'][i]
+            delta = (spot_up - spot_down) / (2 * s_step)
+            gamma = (spot_up - 2 * payoff + spot_down) / s_step ** 2
+            vega = (record['vol_up'][i] - record['vol_down'][i]) / (2 * vol_step) * 0.01
+            rho = (record['r_up'][i] - record['r_down'][i]) / (2 * r_step) * 0.01
+            if not self.pathwise_greeks:
+                rands = np.hstack((chunk['rands'], -chunk['rands'])) if self.antithetic_variate else chunk['rands']
+                score_spot = rands[0] / (spot * vol * np.sqrt(dt[0]))
+                gamma = gamma + 2 * delta * score_spot + payoff * (
+                        (rands[0] ** 2 - 1) / (spot * vol) ** 2 / dt[0] - rands[0] / (spot ** 2 * vol * np.sqrt(dt[0])))
+                delta = delta + payoff * score_spot
+                sqrt_dt = np.sqrt(dt)[:, np.newaxis]
+                vega = vega + payoff * np.sum((rands ** 2 - 1) / vol - rands * sqrt_dt, axis=0) * 0.01
+                rho = rho + payoff * np.sum(rands * sqrt_dt, axis=0) / vol * 0.01
+            for key, value in zip(stats, (delta, gamma, vega, rho)):
+                stats[key].append(self._payoff_stats(value))
+        greeks = {}
+        for key, value in stats.items():
+            value_sum, std_error = self._reduce_payoff_stats(value)
+            greeks[key] = (value_sum / self.n_path, std_error)
+        return greeks
@@ -0,0 +1,35 @@
+#!/user/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2024 Galaxy Technologies
+Licensed under the Apache License, Version 2.0
+"""
+from abc import ABCMeta, abstractmethod
+
+
+class PathFunctional(metaclass=ABCMeta):
+    """路径泛函基类，在路径演化的过程中逐步更新每条路径的少量状态，不保存价格路径矩阵
+    定价引擎设置stream_paths=True时，McEngine._functional_expectation逐个时间步演化全部路径的当前价格向量，
+    依次调用start(第0行)、update(第1~n_step行)，最后由payoff返回逐路径的折现payoff，峰值内存为O(n_path × 状态数)。
+    子类只需声明并维护payoff所需的状态，例如敲入次数、观察日的价格、平均价的累加值、落在区间内的天数等"""
+
+    @abstractmethod
+    def start(self, spot):
+        """分配状态，并用期初价格初始化
+        Args:
+            spot: np.ndarray，(n,)的期初价格向量，即价格路径矩阵的第0行
+        """
+
+    @abstractmethod
+    def update(self, step, s):
+        """用第step个时间步的价格更新状态
+        Args:
+            step: int，时间步序号(1~n_step)，即价格路径矩阵的行号
+            s: np.ndarray，(n,)的第step步的价格向量，只读，下一步演化时会被替换
+        """
+
+    @abstractmethod
+    def payoff(self):
+        """逐路径的payoff
+        Returns: np.ndarray，(n,)的逐路径payoff(已折现)，使用对立变量时前后两半互为对立路径
+        """
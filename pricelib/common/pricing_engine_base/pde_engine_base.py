@@ -5,30 +5,152 @@ Copyright (C) 2024 Galaxy Technologies
 Licensed under the Apache License, Version 2.0
 """
 from abc import ABCMeta
-from functools import lru_cache
 import numpy as np
-from scipy import sparse
+from numba import njit
 from scipy.interpolate import interp1d
 from ..processes import StochProcessBase
-from ..utilities.numerical import LinearFlat, CubicSplineFlat, TDMA_ldu_jit
-from ..utilities.patterns import HashableArray
-from ..utilities.enums import ProcessType, EngineType
+from ..utilities.numerical import LinearFlat, CubicSplineFlat, tridiag_lu_factor, tridiag_lu_solve, tridiag_dot
+from ..utilities.enums import ProcessType, EngineType, FdmGridType
 from .engine_base import PricingEngineBase
 
 
+def fdm_price_grid(smin, smax, s_step, critical_points=(), concentration=None):
+    """生成包含上下界的非均匀价格格点，关键价格(障碍价、行权价、标的价格等)恰好落在格点上
+    concentration为None时，关键价格之间是均匀网格(分段均匀)；
+    否则按密度 Σ_k 1/sqrt(1 + ((S - c_k)/α)²)，α = concentration × (smax - smin) 等分布格点，即Tavella-Randall的sinh网格，
+    在关键价格c_k附近加密，concentration越小越密集。
+    先按密度的累积分布求出每个关键价格最近的格点序号，再在相邻关键价格之间按累积分布等分，所以关键价格恰好是格点
+    Args:
+        smin: float，价格网格下界
+        smax: float，价格网格上界
+        s_step: int，价格步数，返回s_step + 1个格点
+        critical_points: Iterable[float]，需要对齐的关键价格，(smin, smax)之外的价格会被忽略
+        concentration: float，加密程度，None表示不加密
+    Returns:
+        np.ndarray，(s_step + 1,)的严格递增的价格格点，首尾分别是smin和smax
+    """
+    points = np.unique([p for p in np.ravel(np.asarray(critical_points, dtype=float)) if smin < p < smax])
+    x = np.linspace(smin, smax, 20 * s_step + 1)
+    if concentration is None or points.size == 0:
+        density = np.ones_like(x)
+    else:
+        alpha = concentration * (smax - smin)
+        density = np.sum(1 / np.sqrt(1 + ((x[:, np.newaxis] - points) / alpha) ** 2), axis=1)
+    cdf = np.concatenate(([0.], np.cumsum(0.5 * (density[1:] + density[:-1]) * np.diff(x))))
+    cdf /= cdf[-1]
+    u_points = np.interp(points, x, cdf)
+    # 关键价格对应的格点序号，保持严格递增，且不占用首尾的边界格点
+    idx = np.round(u_points * s_step).astype(int)
+    for k in range(idx.size):
+        idx[k] = max(idx[k], 1 if k == 0 else idx[k - 1] + 1)
+    for k in range(idx.size - 1, -1, -1):
+        idx[k] = min(idx[k], s_step - 1 if k == idx.size - 1 else idx[k + 1] - 1)
+    if idx.size and idx[0] < 1:
+        raise ValueError(f"价格步数{s_step}太少，无法使{points.size}个关键价格都落在格点上")
+    u_nodes = np.interp(np.arange(s_step + 1), np.concatenate(([0], idx, [s_step])),
+                        np.concatenate(([0.], u_points, [1.])))
+    nodes = np.interp(u_nodes, cdf, x)
+    nodes[idx] = points
+    nodes[0], nodes[-1] = smin, smax
+    return nodes
+
+
+@njit(cache=True, fastmath=True)
+def fdm_theta_step(v_grid, j, multipliers, pivots, upper, explicit_lower, explicit_diag, explicit_upper,
+                   theta, dt, lower0, upper_last):
+    """编译版的FdmGrid.evolve，用FdmGrid.constant_operator返回的算子，由v_grid的第j+1列递推第j列(不含上下边界行)
+    Args:
+        v_grid: np.ndarray，(n_s + 2, n_t)的期权价值矩阵，第0行和最后一行是边界条件，原地写入第j列
+        j: int，第j个时间点(j的顺序是从后向前)
+        multipliers, pivots, upper: M1的LU分解
+        explicit_lower, explicit_diag, explicit_upper: M2的三条对角线，隐式方法时为长度0的数组
+        theta: float，时间方向有限差分theta
+        dt: float，格点的时间步长
+        lower0: float，第一个内部格点的下对角线系数，乘以下边界条件
+        upper_last: float，最后一个内部格点的上对角线系数，乘以上边界条件
+    Returns: None
+    """
+    n = pivots.size
+    rhs = np.empty(n)
+    if explicit_diag.size == 0:
+        for i in range(n):
+            rhs[i] = v_grid[i + 1, j + 1]
+    else:
+        for i in range(n):
+            rhs[i] = explicit_diag[i] * v_grid[i + 1, j + 1]
+        for i in range(n - 1):
+            rhs[i] += explicit_upper[i] * v_grid[i + 2, j + 1]
+            rhs[i + 1] += explicit_lower[i] * v_grid[i + 1, j + 1]
+    rhs[0] += (theta * v_grid[0, j] + (1 - theta) * v_grid[0, j + 1]) * lower0 * dt
+    rhs[n - 1] += (theta * v_grid[n + 1, j] + (1 - theta) * v_grid[n + 1, j + 1]) * upper_last * dt
+    for i in range(1, n):
+        rhs[i] -= multipliers[i - 1] * rhs[i - 1]
+    rhs[n - 1] /= pivots[n - 1]
+    for i in range(n - 2, -1, -1):
+        rhs[i] = (rhs[i] - upper[i] * rhs[i + 1]) / pivots[i]
+    for i in range(n):
+        v_grid[i + 1, j] = rhs[i]
+
+
+@njit(cache=True, fastmath=True)
+def fdm_rannacher_step(v_grid, j, multipliers, pivots, upper, dt, lower0, upper_last):
+    """编译版的Rannacher平滑步，用两个步长dt/2的隐式半步代替一个theta步，由v_grid的第j+1列递推第j列(不含上下边界行)
+    第一个半步的边界条件取前后两个时间点边界值的平均，第二个半步取第j列的边界值
+    Args:
+        v_grid: np.ndarray，(n_s + 2, n_t)的期权价值矩阵，第0行和最后一行是边界条件，原地写入第j列
+        j: int，第j个时间点(j的顺序是从后向前)
+        multipliers, pivots, upper: 半步隐式算子I - A dt/2的LU分解，见FdmGrid.rannacher_operator
+        dt: float，格点的时间步长(两个半步之和)
+        lower0: float，第一个内部格点的下对角线系数，乘以下边界条件
+        upper_last: float，最后一个内部格点的上对角线系数，乘以上边界条件
+    Returns: None
+    """
+    n = pivots.size
+    half = 0.5 * dt
+    rhs = np.empty(n)
+    for i in range(n):
+        rhs[i] = v_grid[i + 1, j + 1]
+    for k in range(2):
+        if k == 0:
+            lower_bc = 0.5 * (v_grid[0, j] + v_grid[0, j + 1])
+            upper_bc = 0.5 * (v_grid[n + 1, j] + v_grid[n + 1, j + 1])
+        else:
+            lower_bc, upper_bc = v_grid[0, j], v_grid[n + 1, j]
+        rhs[0] += lower_bc * lower0 * half
+        rhs[n - 1] += upper_bc * upper_last * half
+        for i in range(1, n):
+            rhs[i] -= multipliers[i - 1] * rhs[i - 1]
+        rhs[n - 1] /= pivots[n - 1]
+        for i in range(n - 2, -1, -1):
+            rhs[i] = (rhs[i] - upper[i] * rhs[i + 1]) / pivots[i]
+    for i in range(n):
+        v_grid[i + 1, j] = rhs[i]
+
+
 # pylint: disable=invalid-name
 class FdmEngine(PricingEngineBase, metaclass=ABCMeta):
     """障碍期权PDE有限差分法定价引擎，适用于连续观察障碍期权价值"""
     engine_type = EngineType.PdeEngine
 
     def __init__(self, stoch_process: StochProcessBase = None, s_step=800, n_smax=2, fdm_theta=1, *,
-                 s=None, r=None, q=None, vol=None):
+                 grid_type=FdmGridType.Uniform, concentration=0.1, log_space=False, rannacher_steps=0,
+                 t_step_per_year=None, s=None, r=None, q=None, vol=None):
         """初始化有限差分法定价引擎
         Args:
             stoch_process: StochProcessBase随机过程
             s_step: int，价格步数
             n_smax: int，价格网格上界，设为n_smax倍初始价格
             fdm_theta: float，时间方向有限差分theta，0：explicit, 1: implicit, 0.5: Crank-Nicolson
+            grid_type: FdmGridType，价格网格类型。默认为均匀网格；非均匀网格使障碍价、行权价、标的价格恰好落在格点上，
+                       sinh网格还在这些价格附近加密，用150~250个价格步数即可达到均匀网格800步的精度
+            concentration: float，sinh网格的加密程度，见fdm_price_grid
+            log_space: bool，是否在对数价格ln S上离散PDE。对数网格的系数不随价格变化，格点在低价区更密、高价区更疏
+            rannacher_steps: int，Crank-Nicolson(fdm_theta < 1)在到期payoff和每个观察日的不连续处之后，
+                             用几个时间步的两个隐式半步(Rannacher平滑)代替theta步，抑制不连续处的虚假振荡，
+                             保持二阶收敛，可以大幅减少每年的时间步数，一般取2。默认0为不平滑，与原有结果一致；
+                             隐式方法(fdm_theta=1)不受影响
+            t_step_per_year: int，时间离散不受观察日约束的网格(欧式、美式行权与连续观察障碍)每年的时间步数，
+                             默认None与产品的t_step_per_year相同，即每个交易日一步；离散观察的网格总是每个交易日一步
         在未设置stoch_process时，(stoch_process=None)，会默认创建BSMprocess，需要输入以下变量进行初始化
             s: float，标的价格
             r: float，无风险利率
@@ -39,6 +161,11 @@ class FdmEngine(PricingEngineBase, metaclass=ABCMeta):
         self.s_step = max(s_step, 50)  # 价格步数
         self.n_smax = n_smax  # 价格网格上界s0倍数, 设为n_smax倍初始价格
         self.fdm_theta = fdm_theta  # 时间方向有限差分theta，0：explicit, 1: implicit, 0.5: Crank-Nicolson
+        self.grid_type = grid_type  # 价格网格类型
+        self.concentration = concentration  # sinh网格的加密程度
+        self.log_space = log_space  # 是否在对数价格上离散PDE
+        self.rannacher_steps = rannacher_steps  # 每个不连续处之后的Rannacher平滑步数
+        self.t_step_per_year = t_step_per_year  # 不受观察日约束的网格每年的时间步数
         # 以下为计算过程的中间变量
         self.fdm = None  # 有限差分网格FdmGrid对象
         self.smax = None  # 价格网格上界
@@ -47,6 +174,25 @@ class FdmEngine(PricingEngineBase, metaclass=ABCMeta):
         assert stoch_process.process_type == ProcessType.BSProcess1D, 'Error: PDE有限差分法目前只能使用1维BSM动态过程'
         self.process = stoch_process
 
+    def _grid_kwargs(self, *critical_points):
+        """创建FdmGrid时的网格参数
+        Args:
+            critical_points: float或Iterable[float]，非均匀网格需要对齐的关键价格，None会被忽略
+        Returns: dict，FdmGrid的grid_type、critical_points、concentration、log_space、rannacher_steps参数
+        """
+        points = [p for p in critical_points if p is not None]
+        points = np.concatenate([np.ravel(np.asarray(p, dtype=float)) for p in points]) if points else ()
+        return {"grid_type": self.grid_type, "critical_points": points, "concentration": self.concentration,
+                "log_space": self.log_space, "rannacher_steps": self.rannacher_steps}
+
+    def _time_steps(self, prod):
+        """时间离散不受观察日约束的网格每年的时间步数，默认与产品相同
+        Args:
+            prod: Product，产品对象
+        Returns: int，每年的时间步数
+        """
+        return prod.t_step_per_year if self.t_step_per_year is None else self.t_step_per_year
+
     def delta(self, prod, t=0, spot=None, step=None):
         """求t时刻，价格spot处的delta值
         Args:
@@ -191,8 +337,8 @@ class FdmEngine(PricingEngineBase, metaclass=ABCMeta):
         """计算S-t矩阵中，每个t时刻所有s格点的delta
             step: 标的价步长，默认为0，即选择PDE有限差分网格的价格步长"""
         if step == 0:
-            # 默认PDE模拟时的步长 step = fdm_grid.ds
-            delta_s_t = (self.fdm.v_grid[2:] - self.fdm.v_grid[:-2]) / (2 * self.fdm.ds)
+            # 默认PDE模拟时的步长 step = fdm_grid.ds，非均匀网格使用网格的差分格式
+            delta_s_t = self.fdm.derivative(self.fdm.v_grid, order=1)
             return delta_s_t, self.fdm.s_vec  # 中心差分，价格向量掐头0去尾smax，正好是fdm_grid.s_vec
         else:
             # 重新定义步长，在模拟矩阵的基础上插值
@@ -216,7 +362,7 @@ class FdmEngine(PricingEngineBase, metaclass=ABCMeta):
             step: 标的价步长，默认为0，即选择PDE有限差分网格的价格步长"""
         if step == 0:
             # 默认PDE模拟时的步长 step = fdm_grid.ds
-            gamma_s_t = np.diff(self.fdm.v_grid, n=2, axis=0) / self.fdm.ds ** 2
+            gamma_s_t = self.fdm.derivative(self.fdm.v_grid, order=2)
             return gamma_s_t, self.fdm.s_vec
         else:
             # 重新定义步长，在模拟矩阵的基础上插值
@@ -252,7 +398,9 @@ class FdmGrid:
     网格的边界是[0, smax]；演化方法是逐天evolve，便于处理敲入覆盖未敲入的值
     适用于离散观察障碍PDE有限差分法定价，这样求得的是离散观察障碍期权的价值"""
 
-    def __init__(self, smax, maturity, t_step_per_year=243, s_step=400, fn_pde_coef=None, fdm_theta=1, smin=0):
+    def __init__(self, smax, maturity, t_step_per_year=243, s_step=400, fn_pde_coef=None, fdm_theta=1, smin=0, *,
+                 grid_type=FdmGridType.Uniform, critical_points=(), concentration=0.1, log_space=False,
+                 rannacher_steps=0):
         """初始化有限差分网格
         注意stdev、fwd、fn_abc以及bound的量纲必须一致，要么都是绝对值，要么都是除以F标准化的相对值
         Args:
@@ -264,36 +412,111 @@ class FdmGrid:
                         对于BSM而言，a是 vol^2, b是r-q, c是r
             fdm_theta: float，有限差分时间方向的theta方法，theta=0.5是Crank-Nicolson方法，theta=0是显式方法，theta=1是隐式方法
             smin: float，价格网格下界，默认为0
+            grid_type: FdmGridType，价格网格类型，默认为均匀网格
+            critical_points: Iterable[float]，非均匀网格需要对齐的关键价格，如障碍价、行权价、标的价格
+            concentration: float，sinh网格在关键价格附近的加密程度，见fdm_price_grid
+            log_space: bool，是否在对数价格ln S上离散PDE，见_init_s_vec
+            rannacher_steps: int，evolve_with_interval每个区间开始的Rannacher平滑步数；逐步调用evolve时由调用方指定
         """
         self._theta = fdm_theta
         self.t_step_per_year = t_step_per_year  # 每年的时间步数
+        self.rannacher_steps = rannacher_steps  # Rannacher平滑步数
         self.s_min = smin  # 价格向量下界
         self.s_max = smax  # 价格向量上界
-        self.s_vec = np.linspace(self.s_min, self.s_max, int(max(s_step, 50)) + 1)[1:-1]  # s_vec 标的价格向量
-        self.ds = (self.s_vec[-1] - self.s_vec[0]) / (self.s_vec.size - 1)  # 价格步长
+        self._init_s_vec(s_step, grid_type, critical_points, concentration, log_space)
         num = round(maturity * self.t_step_per_year)  # 时间格点数
         self.tv = np.linspace(0, maturity, num + 1)  # 时间向量
         self.dt = (self.tv[-1] - self.tv[0]) / (self.tv.size - 1) if self.tv.size > 1 else 0  # 时间步长
-        if self.ds == 0:
-            self.i_vec = None
-        else:
-            self.i_vec = np.round(self.s_vec / self.ds).astype(int)  # s_vec 对应的索引向量 (1,2,...,s_step) 不含边界0和s_step
         self.fn_pde_coef = fn_pde_coef  # PDE系数函数，如果是倒向PDE，a是BSM的(sigma*S)^2, b是BSM的(r-q)*S,c是r
-        self.eye = sparse.eye(self.s_vec.size)  # 单位矩阵
         self.v_grid = np.zeros((self.s_vec.size + 2, self.tv.size))  # 初始化一个零矩阵，用于记录每个时间t对应的期权价值向量
         # 以下为计算过程的中间变量
         self.lower = None  # 下对角线
         self.diag = None  # 主对角线
         self.upper = None  # 上对角线
-        self.A = None
-        self.M1 = None
-        self.M2 = None
+        self._reset_operator()
+
+    def _init_s_vec(self, s_step, grid_type, critical_points, concentration, log_space=False):
+        """生成不含上下界的价格向量s_vec
+        均匀网格用索引向量i_vec表示二阶中心差分；非均匀网格由相邻格点的间距h-、h+预计算三点差分的权重:
+            ∂V/∂S ≈ -h+/(h-(h- + h+)) V{i-1} + (h+ - h-)/(h- h+) V{i} + h-/(h+(h- + h+)) V{i+1}
+            ∂2V/∂S2 ≈ 2/(h-(h- + h+)) V{i-1} - 2/(h- h+) V{i} + 2/(h+(h- + h+)) V{i+1}
+        间距相等时与均匀网格的差分格式相同
+        对数网格在y = ln S上按grid_type生成格点，差分权重也是对y的；ln 0无定义，下界为0时改为smax的1%，
+        仍使用S=0处的边界条件，距离标的价格数个标准差以上，误差可以忽略
+        Args:
+            s_step: int，价格步数
+            grid_type: FdmGridType，价格网格类型
+            critical_points: Iterable[float]，需要对齐的关键价格
+            concentration: float，sinh网格的加密程度
+            log_space: bool，是否使用对数网格
+        Returns: None
+        """
+        s_step = int(max(s_step, 50))
+        self.grid_type = FdmGridType.Uniform if self.s_max <= self.s_min else grid_type
+        self.log_space = log_space and self.s_max > self.s_min  # 是否在对数价格上离散PDE
+        self._stencil = None  # 非均匀网格(及对数网格)的一阶、二阶差分权重，各为(下, 中, 上)三个向量
+        if not self.log_space and self.grid_type == FdmGridType.Uniform:
+            self.s_vec = np.linspace(self.s_min, self.s_max, s_step + 1)[1:-1]  # s_vec 标的价格向量
+            self.ds = (self.s_vec[-1] - self.s_vec[0]) / (self.s_vec.size - 1)  # 价格步长
+            if self.ds == 0:
+                self.i_vec = None
+            else:
+                self.i_vec = np.round(self.s_vec / self.ds).astype(int)  # s_vec 对应的索引向量 (1,2,...,s_step) 不含边界0和s_step
+            return
+        if self.log_space:
+            smin = self.s_min if self.s_min > 0 else 0.01 * self.s_max
+            points = np.unique([p for p in np.ravel(np.asarray(critical_points, dtype=float)) if smin < p < self.s_max])
+            if self.grid_type == FdmGridType.Uniform:
+                nodes = np.linspace(np.log(smin), np.log(self.s_max), s_step + 1)
+            else:
+                nodes = fdm_price_grid(np.log(smin), np.log(self.s_max), s_step, np.log(points),
+                                       concentration=concentration if grid_type == FdmGridType.Concentrated else None)
+            self.s_vec = np.exp(nodes[1:-1])
+            on_point = np.isin(nodes[1:-1], np.log(points))  # 对齐的格点恢复为精确的关键价格，不受exp舍入误差影响
+            self.s_vec[on_point] = points[np.searchsorted(np.log(points), nodes[1:-1][on_point])]
+        else:
+            nodes = fdm_price_grid(self.s_min, self.s_max, s_step, critical_points,
+                                   concentration=concentration if grid_type == FdmGridType.Concentrated else None)
+            self.s_vec = nodes[1:-1]
+        self.ds = None  # 非均匀网格、对数网格没有统一的价格步长
+        self.i_vec = None
+        h_minus, h_plus = np.diff(nodes)[:-1], np.diff(nodes)[1:]
+        h_sum = h_minus + h_plus
+        self._stencil = ((-h_plus / (h_minus * h_sum), (h_plus - h_minus) / (h_minus * h_plus),
+                          h_minus / (h_plus * h_sum)),
+                         (2 / (h_minus * h_sum), -2 / (h_minus * h_plus), 2 / (h_plus * h_sum)))
+
+    def derivative(self, v_grid, order=1):
+        """用网格的差分格式计算期权价值矩阵在内部价格格点上的一阶或二阶偏导数
+        Args:
+            v_grid: np.ndarray，(n_s + 2, n_t)的期权价值矩阵，第0行和最后一行是边界条件
+            order: int，1为delta，2为gamma
+        Returns: np.ndarray，(n_s, n_t)的偏导数矩阵
+        """
+        if self._stencil is None:
+            if order == 1:
+                return (v_grid[2:] - v_grid[:-2]) / (2 * self.ds)
+            return np.diff(v_grid, n=2, axis=0) / self.ds ** 2
+        d1, d2 = ((lower[:, np.newaxis] * v_grid[:-2] + diag[:, np.newaxis] * v_grid[1:-1]
+                   + upper[:, np.newaxis] * v_grid[2:]) for lower, diag, upper in self._stencil)
+        if not self.log_space:
+            return d1 if order == 1 else d2
+        # 对数网格: ∂V/∂S = (∂V/∂y) / S, ∂2V/∂S2 = (∂2V/∂y2 - ∂V/∂y) / S^2
+        s_vec = self.s_vec[:, np.newaxis]
+        return d1 / s_vec if order == 1 else (d2 - d1) / s_vec ** 2
+
+    def _reset_operator(self):
+        """清空算子缓存。每个网格对象各自缓存最近一次的系数与三对角算子，同一引擎的多个网格互不干扰"""
+        self._op_key = None  # 缓存的算子对应的(a, b, c, dt)
+        self._op_lu = None  # M1的LU分解: (消元乘数, 主元, 上对角线)
+        self._op_explicit = None  # M2的(下对角线, 主对角线, 上对角线)，隐式方法(theta=1)的M2是单位阵，为None
+        self._smooth_lu = None  # Rannacher平滑步的(半步长, 半步隐式算子的LU分解)
 
-    @lru_cache(maxsize=1)  # 缓存函数结果，避免重复计算。(常数波动率、无风险利率、分红率时，每个时间点的系数矩阵都是一样的)
     def _set_matrix(self, a, b, c, dt):
-        """设置线性方程组的系数矩阵，t是时间，yv是上一时间点的期权价值向量
+        """设置线性方程组的系数矩阵，并对M1做LU分解
         M1 yv{j} = M2 yv{j-1} - g{j-1} - g{j}，其中g{j}和g{j-1}是边界条件。注意如果是从后向前递推，j的时间比j-1的时间靠前
         fn_pde_coef返回预计算系数，a是需要乘以i_vec^2的系数，b是需要乘以i_vec的系数，c是不需要乘以i_vec的系数
+        系数不变时evolve不再调用本方法，每一步只需O(n)的前代、回代
         Args:
             a: np.ndarray，需要乘以i_vec^2的系数
             b: np.ndarray，需要乘以i_vec的系数
@@ -301,19 +524,99 @@ class FdmGrid:
             dt: float，格点的时间步长
         Returns: None
         """
-        # [1:-1]去掉最上面和最下面的边界条件点，因为这两个点的边界条件是已知的，不需要计算
-        diffusion_square = a * self.i_vec ** 2  # 对于BSM而言，a是 vol^2
-        drift = b * self.i_vec  # 对于BSM而言，b是 r-q
-        #  系数矩阵预计算, l、d、u分别是对角线下方lower、主对角线diagonal和对角线上方upper的系数数组
-        self.lower = 0.5 * (diffusion_square - drift)
-        self.diag = -diffusion_square - c
-        self.upper = 0.5 * (diffusion_square + drift)
-        # 创建三对角矩阵A，用来构造半隐式矩阵M1，M2。M1是隐式部分，M2是显式部分
-        self.A = sparse.diags((self.lower[1:], self.diag, self.upper[:-1]), (-1, 0, 1), format='csc') * dt  # csc格式的稀疏矩阵
-        # j 时点的期权价值向量（未知量）的系数矩阵M1
-        self.M1 = self.eye - self._theta * self.A
-        # j - 1 时点的期权价值向量（已知量）的系数矩阵M2（对于隐式imp，M2是单位阵）
-        self.M2 = self.eye + (1 - self._theta) * self.A
+        if self._stencil is None:
+            # [1:-1]去掉最上面和最下面的边界条件点，因为这两个点的边界条件是已知的，不需要计算
+            diffusion_square = a * self.i_vec ** 2  # 对于BSM而言，a是 vol^2
+            drift = b * self.i_vec  # 对于BSM而言，b是 r-q
+            #  系数矩阵预计算, l、d、u分别是对角线下方lower、主对角线diagonal和对角线上方upper的系数数组
+            self.lower = 0.5 * (diffusion_square - drift)
+            self.diag = -diffusion_square - c
+            self.upper = 0.5 * (diffusion_square + drift)
+        else:  # 非均匀网格: 0.5 a S^2 ∂2V/∂S2 + b S ∂V/∂S - c V 的三点差分
+            (d1_lower, d1_diag, d1_upper), (d2_lower, d2_diag, d2_upper) = self._stencil
+            if self.log_space:  # 对数网格y = ln S: 0.5 a ∂2V/∂y2 + (b - 0.5 a) ∂V/∂y - c V，系数与价格无关
+                diffusion = 0.5 * a
+                drift = b - 0.5 * a
+            else:
+                diffusion = 0.5 * a * self.s_vec ** 2
+                drift = b * self.s_vec
+            self.lower = diffusion * d2_lower + drift * d1_lower
+            self.diag = diffusion * d2_diag + drift * d1_diag - c
+            self.upper = diffusion * d2_upper + drift * d1_upper
+        # 三对角矩阵A = tridiag(lower, diag, upper) * dt，M1 = I - theta * A是隐式部分，M2 = I + (1 - theta) * A是显式部分
+        implicit = self._theta * dt
+        upper = np.ascontiguousarray(-implicit * self.upper[:-1], dtype=np.float64)
+        multipliers, pivots = tridiag_lu_factor(np.ascontiguousarray(-implicit * self.lower[1:], dtype=np.float64),
+                                                np.ascontiguousarray(1 - implicit * self.diag, dtype=np.float64),
+                                                upper)
+        self._op_lu = (multipliers, pivots, upper)
+        explicit = (1 - self._theta) * dt
+        if explicit == 0:
+            self._op_explicit = None
+        else:
+            self._op_explicit = (np.ascontiguousarray(explicit * self.lower[1:], dtype=np.float64),
+                                 np.ascontiguousarray(1 + explicit * self.diag, dtype=np.float64),
+                                 np.ascontiguousarray(explicit * self.upper[:-1], dtype=np.float64))
+        self._op_key = (a, b, c, dt)
+        self._smooth_lu = None
+
+    def _update_operator(self, t, dt):
+        """t时刻的系数与缓存的算子不同时，重新设置系数矩阵
+        fn_pde_coef带有time_homogeneous=True属性(常数波动率、常数利率)时，系数与时间无关，只在步长dt变化时重新分解
+        Args:
+            t: float，时间
+            dt: float，格点的时间步长
+        Returns: None
+        """
+        if (self._op_key is not None and self._op_key[3] == dt
+                and getattr(self.fn_pde_coef, "time_homogeneous", False)):
+            return
+        a, b, c = self.fn_pde_coef(t, self.s_vec)
+        key = self._op_key
+        if (key is None or key[3] != dt or not np.array_equal(key[0], a) or not np.array_equal(key[1], b)
+                or not np.array_equal(key[2], c)):
+            self._set_matrix(a, b, c, dt)
+
+    def constant_operator(self, dt):
+        """PDE系数与时间无关时，返回编译内核fdm_theta_step所需的算子数组，否则返回None
+        Args:
+            dt: float，格点的时间步长
+        Returns: None或tuple，(M1的LU分解, M2的三条对角线, 下边界系数, 上边界系数)，依次对应fdm_theta_step的参数
+        """
+        if not getattr(self.fn_pde_coef, "time_homogeneous", False):
+            return None
+        self._update_operator(self.tv[0], dt)
+        explicit = (np.empty(0),) * 3 if self._op_explicit is None else self._op_explicit
+        return (*self._op_lu, *explicit, float(self._theta), float(dt), float(self.lower[0]), float(self.upper[-1]))
+
+    def rannacher_operator(self, dt):
+        """Rannacher平滑步的半步隐式算子I - A dt/2的LU分解，与当前的系数矩阵一起缓存，须在_update_operator之后调用
+        Args:
+            dt: float，格点的时间步长(两个半步之和)
+        Returns: tuple，(消元乘数, 主元, 上对角线)，见tridiag_lu_solve
+        """
+        half = 0.5 * dt
+        if self._smooth_lu is None or self._smooth_lu[0] != half:
+            upper = np.ascontiguousarray(-half * self.upper[:-1], dtype=np.float64)
+            multipliers, pivots = tridiag_lu_factor(np.ascontiguousarray(-half * self.lower[1:], dtype=np.float64),
+                                                    np.ascontiguousarray(1 - half * self.diag, dtype=np.float64),
+                                                    upper)
+            self._smooth_lu = (half, (multipliers, pivots, upper))
+        return self._smooth_lu[1]
+
+    def _explicit_dot(self, yv):
+        """M2乘以j - 1 时点的期权价值向量，返回新数组"""
+        if self._op_explicit is None:
+            return np.array(yv, dtype=np.float64)
+        return tridiag_dot(*self._op_explicit, np.ascontiguousarray(yv, dtype=np.float64))
+
+    def _boundary_values(self, j):
+        """第j个时间点和上一个时间点(已知量)的上下边界条件
+        Args:
+            j: int，第j个时间点(j的顺序是从后向前)
+        Returns: ((下边界当前值, 下边界上一时点值), (上边界当前值, 上边界上一时点值))
+        """
+        return (self.v_grid[0, j], self.v_grid[0, j + 1]), (self.v_grid[-1, j], self.v_grid[-1, j + 1])
 
     def _set_vector(self, j, yv, dt):
         """设置矩阵方程等号右侧的 V
@@ -324,30 +627,48 @@ class FdmGrid:
             dt: float，格点的时间步长
         Returns: V，矩阵方程右侧，系数M2乘以j - 1 时点的期权价值向量（已知量）
         """
-        v_vec = self.M2.dot(yv)
+        v_vec = self._explicit_dot(yv)
+        (lower_new, lower_old), (upper_new, upper_old) = self._boundary_values(j)
         # V的最上面和最下面，分别减去矩阵第一行的lower*yv[0]和最后一行的upper*yv[-1]，这两个值是已知的边界条件，不需要计算
-        v_vec[0] += (self._theta * self.v_grid[0, j]
-                     + (1 - self._theta) * self.v_grid[0, j + 1]) * self.lower[0] * dt
-        v_vec[-1] += (self._theta * self.v_grid[-1, j]
-                      + (1 - self._theta) * self.v_grid[-1, j + 1]) * self.upper[-1] * dt
+        v_vec[0] += (self._theta * lower_new + (1 - self._theta) * lower_old) * self.lower[0] * dt
+        v_vec[-1] += (self._theta * upper_new + (1 - self._theta) * upper_old) * self.upper[-1] * dt
         return v_vec  # 生成三对角矩阵及对应的向量
 
-    def evolve(self, j, yv, dt):
+    def evolve(self, j, yv, dt, rannacher=False):
         """根据时间 t 和 j - 1 时间点的期权价值向量yv，返回当前时间点的期权价值向量
         Args:
             j: int，第j个时间点(j的顺序是从后向前)
             yv: np.ndarray，j - 1 时间点的期权价值向量yv
             dt: float，格点的时间步长
+            rannacher: bool，是否做Rannacher平滑，即用两个步长dt/2的隐式半步代替theta步。
+                       Crank-Nicolson在payoff、观察日覆盖等不连续处之后的前几步使用，衰减高频误差；隐式方法(theta=1)时忽略
         Returns: 当前时间点的期权价值向量
         """
-        a, b, c = self.fn_pde_coef(self.tv[j], self.s_vec)
-        a = HashableArray(a)
         # yv = self._step_condition(j, yv)  # 步骤条件
-        self._set_matrix(a, b, c, dt)  # 设置线性方程组的系数矩阵
+        self._update_operator(self.tv[j], dt)  # 系数变化时重新设置线性方程组的系数矩阵
+        if rannacher and self._theta != 1:
+            return self._rannacher_evolve(j, yv, dt)
         v_vec = self._set_vector(j, yv, dt)  # 设置线性方程组的向量
-        # yv = TDMA(self.M1, v_vec)  # 三对角矩阵Thomas算法求解
-        # 三对角矩阵Thomas算法求解,jit加速
-        yv = TDMA_ldu_jit(self.M1.diagonal(-1), self.M1.diagonal(0), self.M1.diagonal(1), v_vec)
+        # 用缓存的LU分解求解三对角方程组，jit加速
+        return tridiag_lu_solve(*self._op_lu, v_vec)
+
+    def _rannacher_evolve(self, j, yv, dt):
+        """Rannacher平滑步: 两个步长dt/2的隐式半步，第一个半步的边界条件取前后两个时间点边界值的平均，与fdm_rannacher_step相同
+        Args:
+            j: int，第j个时间点(j的顺序是从后向前)
+            yv: np.ndarray，j - 1 时间点的期权价值向量yv
+            dt: float，格点的时间步长
+        Returns: 当前时间点的期权价值向量
+        """
+        half = 0.5 * dt
+        operator = self.rannacher_operator(dt)
+        (lower_new, lower_old), (upper_new, upper_old) = self._boundary_values(j)
+        for lower_bc, upper_bc in ((0.5 * (lower_new + lower_old), 0.5 * (upper_new + upper_old)),
+                                   (lower_new, upper_new)):
+            v_vec = np.array(yv, dtype=np.float64)
+            v_vec[0] += lower_bc * self.lower[0] * half
+            v_vec[-1] += upper_bc * self.upper[-1] * half
+            yv = tridiag_lu_solve(*operator, v_vec)
         return yv
 
     def functionize(self, yv, kind="linear"):
@@ -369,7 +690,9 @@ class FdmGridwithBound(FdmGrid):
     这样求得的期权价值是连续观察障碍期权的价值"""
 
     def __init__(self, smax, t_step_per_year=243, s_step=400,
-                 fn_pde_coef=None, bound=(-np.inf, np.inf), fdm_theta=1):
+                 fn_pde_coef=None, bound=(-np.inf, np.inf), fdm_theta=1, *,
+                 grid_type=FdmGridType.Uniform, critical_points=(), concentration=0.1, log_space=False,
+                 rannacher_steps=0):
         """初始化有限差分网格
         注意stdev、fwd、fn_abc以及bound的量纲必须一致，要么都是绝对值，要么都是除以F标准化的相对值
         Args:
@@ -380,21 +703,27 @@ class FdmGridwithBound(FdmGrid):
                         a是需要乘以i_vec^2的系数，b是需要乘以i_vec的系数，c是不需要乘以i_vec的系数
                         对于BSM而言，a是 vol^2, b是r-q, c是r
             fdm_theta: float，有限差分时间方向的theta方法，theta=0.5是Crank-Nicolson方法，theta=0是显式Euler方法，theta=1是隐式Euler方法
+            grid_type: FdmGridType，价格网格类型，默认为均匀网格
+            critical_points: Iterable[float]，非均匀网格需要对齐的关键价格，上下界已是障碍价，无需重复
+            concentration: float，sinh网格在关键价格附近的加密程度，见fdm_price_grid
+            log_space: bool，是否在对数价格ln S上离散PDE
+            rannacher_steps: int，evolve_with_interval每个区间开始的Rannacher平滑步数
         """
         self._theta = fdm_theta
         self.t_step_per_year = t_step_per_year  # 每年的时间步数
+        self.rannacher_steps = rannacher_steps  # Rannacher平滑步数
         self.bound = bound  # 长度为2的元组，高低障碍价格
         self.s_min = max(bound[0], 0)  # 价格向量下界
         self.s_max = min(bound[1], smax)  # 价格向量上界
         # [1:-1]去掉最上面和最下面的边界条件点，因为这两个点的边界条件是已知的，不需要计算
-        self.s_vec = np.linspace(self.s_min, self.s_max, int(max(s_step, 50)) + 1)[1:-1]  # s_vec 标的价格向量
-        self.ds = (self.s_vec[-1] - self.s_vec[0]) / (self.s_vec.size - 1)  # 价格步长
-        # self.i_vec = np.linspace(1, s_step - 1, self.s_vec.size)
-        self.i_vec = np.round(self.s_vec / self.ds).astype(int)  # s_vec 对应的索引向量 (1,2,...,s_step) 不含边界0和s_step
+        self._init_s_vec(s_step, grid_type, critical_points, concentration, log_space)
         self.fn_pde_coef = fn_pde_coef  # PDE系数函数，如果是倒向PDE，a是BSM的(sigma*S)^2, b是BSM的(r-q)*S,c是r
-        self.eye = sparse.eye(self.s_vec.size)  # 单位矩阵
         # 中间变量
         self.fn_bound = None  # 边界条件函数
+        self.lower = None  # 下对角线
+        self.diag = None  # 主对角线
+        self.upper = None  # 上对角线
+        self._reset_operator()
 
     def set_boundary_condition(self, fn_bound):
         """设置边界条件
@@ -404,26 +733,19 @@ class FdmGridwithBound(FdmGrid):
         """
         self.fn_bound = fn_bound
 
-    def _set_vector(self, j, yv, dt):
-        """设置矩阵方程等号右侧的 V
-        V = 矩阵方程右侧，系数M2乘以j - 1 时点的期权价值向量（已知量）
+    def _boundary_values(self, j):
+        """第j个时间点和上一个时间点(已知量)的上下边界条件，由边界条件函数计算
         Args:
-            j: int，第j个时间点(j的顺序是从后向前)
-            yv: np.ndarray，j - 1 时点的期权价值向量（已知量）
-            dt: float，格点的时间步长
-        Returns: V，矩阵方程右侧，系数M2乘以j - 1 时点的期权价值向量（已知量）
+            j: int，第j个时间点
+        Returns: ((下边界当前值, 下边界上一时点值), (上边界当前值, 上边界上一时点值))
         """
-        V = self.M2.dot(yv)
-        # V的最上面和最下面，分别减去矩阵第一行的lower*yv[0]和最后一行的upper*yv[-1]，这两个值是已知的边界条件，不需要计算
-        V[0] += (self._theta * self.fn_bound[0](self.tv[j])
-                 + (1 - self._theta) * self.fn_bound[0](self.tv[j - 1])) * self.lower[0] * dt
-        V[-1] += (self._theta * self.fn_bound[1](self.tv[j])
-                  + (1 - self._theta) * self.fn_bound[1](self.tv[j - 1])) * self.upper[-1] * dt
-        return V  # 生成三对角矩阵及对应的向量
+        return ((self.fn_bound[0](self.tv[j]), self.fn_bound[0](self.tv[j - 1])),
+                (self.fn_bound[1](self.tv[j]), self.fn_bound[1](self.tv[j - 1])))
 
     def evolve_with_interval(self, start, end, yv, x=None):
         """从start时间点递推到end时间点，更新yv
         若dt>0, 从前向后递推，local_vol校准; dt<0, 从后向前递推，有限差分法定价
+        区间开始的rannacher_steps步做Rannacher平滑，见evolve
         Args:
             start: float，起始时间点，距离估值日的年化期限
             end: float，结束时间点，距离估值日的年化期限
@@ -441,7 +763,7 @@ class FdmGridwithBound(FdmGrid):
 
         if x is None:
             for j in range(1, len(self.tv)):  # 从tv[1:]开始递推，因为tv[0]是已知的
-                yv = self.evolve(j, yv, -self.dt)
+                yv = self.evolve(j, yv, -self.dt, rannacher=j <= self.rannacher_steps)
                 # self.v_grid[1:-1, j] = yv  # 记录每个时间t对应的期权价值向量
             return yv
         else:  # 如果需要将每个时间t对应的指定的x对应的y值记录下来return，则需传入x
@@ -449,7 +771,7 @@ class FdmGridwithBound(FdmGrid):
             fv = np.empty((self.tv.size, x.size))  # 初始化一个空向量，用于记录每个时间t对应的指定的x对应的y值
             fv[0, :] = self.functionize(yv)(x)
             for j, f in zip(range(1, len(self.tv)), fv[1:]):
-                yv = self.evolve(j, yv, -self.dt)
+                yv = self.evolve(j, yv, -self.dt, rannacher=j <= self.rannacher_steps)
                 # self.v_grid[1:-1, j] = yv  # 记录每个时间t对应的期权价值向量
                 f[:] = self.functionize(yv)(x)
             return yv, [LinearFlat(self.tv, f) for f in fv.T]  # 返回边界条件函数bc_bound，input时间t，output边界条件函数值
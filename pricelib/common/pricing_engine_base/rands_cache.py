@@ -0,0 +1,168 @@
+#!/user/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2024 Galaxy Technologies
+Licensed under the Apache License, Version 2.0
+"""
+import os
+import threading
+from collections import OrderedDict
+from contextlib import suppress
+import numpy as np
+from ..utilities.utility import logging
+
+
+class RandsCache:
+    """进程内共享的标准正态随机数矩阵缓存，最近最少使用(LRU)淘汰，可选用磁盘上的.npy文件作为后备存储
+    键为随机数发生器的参数(生成方法, 低差异序列方法, 维数(行数), 随机数种子, 浮点类型)，相同参数的蒙特卡洛引擎共享同一个随机数矩阵。
+    低差异序列的前n列与列数无关，列数不小于所需列数的缓存矩阵可以截取前n列复用；伪随机数按行优先生成，只能复用列数相同的矩阵。
+    缓存的矩阵是只读的，磁盘上的矩阵以内存映射方式只读加载"""
+
+    def __init__(self, max_bytes=2 ** 29, cache_dir=None):
+        """构造函数
+        Args:
+            max_bytes: int，内存中缓存矩阵的总字节数上限，超过时淘汰最近最少使用的矩阵；为0时不使用内存缓存
+            cache_dir: str，磁盘后备存储的目录，默认None为不使用磁盘缓存；设置后新生成的矩阵保存为.npy文件，进程重启后仍可复用
+        """
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self._blocks = OrderedDict()  # {(键, 列数): 随机数矩阵}，按最近使用的顺序排列
+        self._n_bytes = 0  # 内存中缓存矩阵的总字节数
+        self._lock = threading.Lock()
+
+    def get(self, key, n_col, prefix=False):
+        """查找随机数矩阵，依次查找内存缓存与磁盘缓存
+        Args:
+            key: tuple，(生成方法, 低差异序列方法, 维数, 随机数种子, 浮点类型)
+            n_col: int，所需的列数
+            prefix: bool，是否可以截取列数更多的矩阵的前n_col列
+        Returns: np.ndarray，(维数, n_col)的只读随机数矩阵，未命中时返回None
+        """
+        with self._lock:
+            for (cached_key, cached_n_col), block in self._blocks.items():
+                if cached_key == key and (cached_n_col == n_col or (prefix and cached_n_col > n_col)):
+                    self._blocks.move_to_end((cached_key, cached_n_col))
+                    return block[:, :n_col]
+        if self.cache_dir is None:
+            return None
+        for file_n_col, path in self._disk_files(key):
+            if file_n_col == n_col or (prefix and file_n_col > n_col):
+                try:
+                    block = np.asarray(np.load(path, mmap_mode='r'))  # 以内存映射方式只读加载，按需读入内存
+                except (OSError, ValueError):
+                    logging.warning(f"随机数缓存文件{path}无法读取，重新生成随机数")
+                    continue
+                self._remember(key, file_n_col, block)
+                return block[:, :n_col]
+        return None
+
+    def put(self, key, block):
+        """缓存新生成的随机数矩阵，设置了磁盘缓存时同时保存为.npy文件
+        Args:
+            key: tuple，(生成方法, 低差异序列方法, 维数, 随机数种子, 浮点类型)
+            block: np.ndarray，(维数, 列数)的随机数矩阵，缓存后变为只读
+        Returns: np.ndarray，只读的随机数矩阵
+        """
+        block.flags.writeable = False
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            path = os.path.join(self.cache_dir, f"{self._file_prefix(key)}_{block.shape[1]}.npy")
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            try:
+                with open(tmp_path, 'wb') as f:
+                    np.save(f, block)
+                os.replace(tmp_path, path)  # 先写临时文件再改名，其他进程不会读到写了一半的文件
+            except OSError:
+                logging.warning(f"随机数缓存文件{path}无法写入")
+                with suppress(OSError):
+                    os.remove(tmp_path)
+        self._remember(key, block.shape[1], block)
+        return block
+
+    def clear(self, disk=False):
+        """清空内存缓存
+        Args:
+            disk: bool，是否同时删除磁盘上的缓存文件
+        """
+        with self._lock:
+            self._blocks.clear()
+            self._n_bytes = 0
+        if disk and self.cache_dir is not None and os.path.isdir(self.cache_dir):
+            for name in os.listdir(self.cache_dir):
+                if name.startswith("rands_") and name.endswith(".npy"):
+                    os.remove(os.path.join(self.cache_dir, name))
+
+    def resize(self, max_bytes):
+        """更改内存缓存的总字节数上限，立即淘汰超出上限的矩阵"""
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    @property
+    def n_bytes(self):
+        """内存中缓存矩阵的总字节数"""
+        return self._n_bytes
+
+    def _remember(self, key, n_col, block):
+        """将矩阵放入内存缓存，淘汰最近最少使用的矩阵直至总字节数不超过上限；单个矩阵超过上限时不缓存"""
+        if block.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old_block = self._blocks.pop((key, n_col), None)
+            if old_block is not None:
+                self._n_bytes -= old_block.nbytes
+            self._blocks[(key, n_col)] = block
+            self._n_bytes += block.nbytes
+            self._evict()
+
+    def _evict(self):
+        """淘汰最近最少使用的矩阵，直至总字节数不超过上限，调用时需持有锁"""
+        while self._n_bytes > self.max_bytes:
+            _, evicted = self._blocks.popitem(last=False)
+            self._n_bytes -= evicted.nbytes
+
+    @staticmethod
+    def _file_prefix(key):
+        """磁盘缓存文件名的前缀，由键的各个参数拼接而成"""
+        rands_method, ld_method, dim, seed, dtype = key
+        ld_name = "none" if ld_method is None else ld_method.name
+        return f"rands_{rands_method.name}_{ld_name}_{dim}_{seed}_{np.dtype(dtype).name}"
+
+    def _disk_files(self, key):
+        """磁盘上与键匹配的缓存文件，按列数升序返回[(列数, 路径)]"""
+        if not os.path.isdir(self.cache_dir):
+            return []
+        prefix = f"{self._file_prefix(key)}_"
+        files = []
+        for name in os.listdir(self.cache_dir):
+            if name.startswith(prefix) and name.endswith(".npy") and name[len(prefix):-4].isdigit():
+                files.append((int(name[len(prefix):-4]), os.path.join(self.cache_dir, name)))
+        return sorted(files)
+
+
+__RandsCache = RandsCache()  # 进程内共享的随机数缓存
+
+
+def global_rands_cache():
+    """获取进程内共享的随机数缓存"""
+    return __RandsCache
+
+
+def set_rands_cache(max_bytes=2 ** 29, cache_dir=None):
+    """设置进程内共享的随机数缓存
+    例如，缓存最多2GB随机数，并保存到磁盘以便进程重启后复用: set_rands_cache(max_bytes=2 ** 31, cache_dir='./rands_cache')
+         不缓存随机数: set_rands_cache(max_bytes=0)
+    Args:
+        max_bytes: int，内存中缓存矩阵的总字节数上限，默认512MB
+        cache_dir: str，磁盘后备存储的目录，默认None为不使用磁盘缓存
+    """
+    __RandsCache.cache_dir = cache_dir
+    __RandsCache.resize(max_bytes)
+
+
+def clear_rands_cache(disk=False):
+    """清空进程内共享的随机数缓存
+    Args:
+        disk: bool，是否同时删除磁盘上的缓存文件
+    """
+    __RandsCache.clear(disk=disk)
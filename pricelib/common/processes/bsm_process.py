@@ -5,9 +5,10 @@ Copyright (C) 2024 Galaxy Technologies
 Licensed under the Apache License, Version 2.0
 """
 import numpy as np
-from numba import njit
-from ..utilities.enums import ProcessType
+from numba import njit, prange
+from ..utilities.enums import ProcessType, VolType
 from ..utilities.patterns import Observable, Observer
+from ..term_structures import ConstantRate
 from .stoch_process import StochProcessBase
 
 
@@ -28,6 +29,96 @@ def evolve_bs(t0, x0, dt, dw, drift, diffusion):
     return x0 * (1 + drift * dt + diffusion * dw * np.sqrt(dt))
 
 
+@njit(fastmath=True, cache=True)
+def _nearest_index(grid, x):
+    """升序格点grid中距离x最近的格点索引，距离相等时取较小的格点，与np.argmin(np.abs(grid - x))一致"""
+    k = np.searchsorted(grid, x)
+    if k == grid.size:
+        return k - 1
+    if k > 0 and x - grid[k - 1] <= grid[k] - x:
+        return k - 1
+    return k
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def evolve_bs_paths(spot, dt, dw, drift, vol_table, vol_t_idx, vol_strikes, antithetic):
+    """Black-Scholes-Merton SDE整条路径的演化函数，jit加速，时间循环全部在编译代码中完成，每一步对路径prange并行
+    每一步的演化公式与evolve_bs相同，波动率按(时间格点, 最近的价格格点)从波动率表中查找，常数波动率是只有一个价格格点的特例
+    Args:
+        spot: float, 标的期初价格
+        dt: float, 年化时间增量
+        dw: np.ndarray, (n_step, n_col)的标准正态随机数矩阵
+        drift: np.ndarray, (n_step,)的每一步漂移率
+        vol_table: np.ndarray, (n_t, n_k)的波动率表
+        vol_t_idx: np.ndarray, (n_step,)的每一步在波动率表中的时间索引
+        vol_strikes: np.ndarray, (n_k,)的升序价格格点
+        antithetic: bool, 是否使用对立变量，是则后n_col条路径使用-dw
+    Returns:
+        np.ndarray, (n_step + 1, n_path)的价格路径矩阵，浮点类型与dw相同
+    """
+    n_step, n_col = dw.shape
+    n_path = 2 * n_col if antithetic else n_col
+    sqrt_dt = np.sqrt(dt)
+    paths = np.empty((n_step + 1, n_path), dw.dtype)
+    paths[0] = spot
+    for i in range(n_step):
+        growth = 1 + drift[i] * dt
+        vol_row = vol_table[vol_t_idx[i]]
+        if vol_strikes.size == 1:
+            diffusion = vol_row[0] * sqrt_dt
+            for j in prange(n_col):
+                paths[i + 1, j] = paths[i, j] * (growth + diffusion * dw[i, j])
+            if antithetic:
+                for j in prange(n_col):
+                    paths[i + 1, n_col + j] = paths[i, n_col + j] * (growth - diffusion * dw[i, j])
+        else:
+            for j in prange(n_path):
+                x0 = paths[i, j]
+                w = dw[i, j] if j < n_col else -dw[i, j - n_col]  # 后n_col条是对立路径
+                paths[i + 1, j] = x0 * (growth + vol_row[_nearest_index(vol_strikes, x0)] * sqrt_dt * w)
+    return paths
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def evolve_bs_log_paths(spot, dt, dw, log_drift, vol_table, vol_t_idx, vol_strikes, antithetic):
+    """Black-Scholes-Merton SDE对数欧拉格式的整条路径演化函数，jit加速，时间步长可以不等
+    ln S(t+dt) = ln S(t) + log_drift - 0.5 * vol^2 * dt + vol * sqrt(dt) * dW，常数波动率时是精确解，没有离散化误差
+    Args:
+        spot: float, 标的期初价格
+        dt: np.ndarray, (n_step,)的每一步年化时间增量
+        dw: np.ndarray, (n_step, n_col)的标准正态随机数矩阵
+        log_drift: np.ndarray, (n_step,)的每一步漂移率在该步上的积分
+        vol_table: np.ndarray, (n_t, n_k)的波动率表
+        vol_t_idx: np.ndarray, (n_step,)的每一步在波动率表中的时间索引
+        vol_strikes: np.ndarray, (n_k,)的升序价格格点
+        antithetic: bool, 是否使用对立变量，是则后n_col条路径使用-dw
+    Returns:
+        np.ndarray, (n_step + 1, n_path)的价格路径矩阵，浮点类型与dw相同
+    """
+    n_step, n_col = dw.shape
+    n_path = 2 * n_col if antithetic else n_col
+    paths = np.empty((n_step + 1, n_path), dw.dtype)
+    paths[0] = spot
+    for i in range(n_step):
+        sqrt_dt = np.sqrt(dt[i])
+        vol_row = vol_table[vol_t_idx[i]]
+        if vol_strikes.size == 1:
+            diffusion = vol_row[0] * sqrt_dt
+            growth = np.exp(log_drift[i] - 0.5 * diffusion ** 2)
+            for j in prange(n_col):
+                paths[i + 1, j] = paths[i, j] * growth * np.exp(diffusion * dw[i, j])
+            if antithetic:
+                for j in prange(n_col):
+                    paths[i + 1, n_col + j] = paths[i, n_col + j] * growth * np.exp(-diffusion * dw[i, j])
+        else:
+            for j in prange(n_path):
+                x0 = paths[i, j]
+                w = dw[i, j] if j < n_col else -dw[i, j - n_col]  # 后n_col条是对立路径
+                diffusion = vol_row[_nearest_index(vol_strikes, x0)] * sqrt_dt
+                paths[i + 1, j] = x0 * np.exp(log_drift[i] - 0.5 * diffusion ** 2 + diffusion * w)
+    return paths
+
+
 class GeneralizedBSMProcess(StochProcessBase, Observer, Observable):
     """BS风险中性 SDE: dS/S = (r-q)dt + vol dW
     既是观察者又是被观察者，观察者模式的中介者。观察S、r、q、sigma的变化，被定价引擎engine观察。
@@ -93,6 +184,69 @@ class GeneralizedBSMProcess(StochProcessBase, Observer, Observable):
         """
         return evolve_bs(t, x, dt, dw, self.drift(t), self.diffusion(t, x))
 
+    def evolve_paths(self, spot, dt, dw, antithetic=False):
+        """一次演化出整条价格路径，第step步使用t = step * dt时刻的漂移项和扩散项，与逐步调用evolve的结果相同
+        常数波动率与局部波动率预先计算漂移率和波动率网格，由evolve_bs_paths在编译代码中完成全部时间步；
+        其他波动率模型退回逐步调用evolve
+        Args:
+            spot: float, 标的期初价格
+            dt: float, 年化时间增量
+            dw: np.ndarray, (n_step, n_col)的标准正态随机数矩阵
+            antithetic: bool, 是否使用对立变量，是则返回的后n_col条路径使用-dw
+        Returns:
+            np.ndarray, (n_step + 1, n_path)的价格路径矩阵，浮点类型与dw相同
+        """
+        n_step = dw.shape[0]
+        t = dt * np.arange(1, n_step + 1)
+        vol_type = getattr(self.vol, "vol_type", None)
+        if vol_type == VolType.CV:
+            drift = np.broadcast_to(np.asarray(self.drift(t), dtype=np.float64), t.shape)
+            vol_table = np.broadcast_to(np.asarray(self.vol(t, spot), dtype=np.float64), t.shape).reshape(-1, 1)
+            return evolve_bs_paths(float(spot), dt, dw, np.ascontiguousarray(drift), np.ascontiguousarray(vol_table),
+                                   np.arange(n_step), np.zeros(1), antithetic)
+        if vol_type == VolType.LV:
+            drift = np.broadcast_to(np.asarray(self.drift(t), dtype=np.float64), t.shape)
+            vol_t_idx = np.searchsorted(self.vol.expirations[:-1], t)
+            return evolve_bs_paths(float(spot), dt, dw, np.ascontiguousarray(drift),
+                                   np.ascontiguousarray(self.vol.volval, dtype=np.float64), vol_t_idx,
+                                   np.ascontiguousarray(self.vol.strikes, dtype=np.float64), antithetic)
+        rand_s = np.concatenate((dw, -dw), axis=1) if antithetic else dw
+        s_paths = np.empty(shape=(n_step + 1, rand_s.shape[1]), dtype=dw.dtype)
+        s_paths[0] = spot
+        for step in range(1, n_step + 1):
+            s_paths[step] = self.evolve(dt * step, s_paths[step - 1], dt, rand_s[step - 1])
+        return s_paths
+
+    def evolve_log_paths(self, spot, t_grid, dw, antithetic=False):
+        """对数欧拉格式，在任意升序的时间网格上一次演化出整条价格路径
+        漂移项取无风险利率与分红融券率折现因子之比的对数，与折现曲线一致；常数波动率时是精确解，可以只在观察日上模拟。
+        局部波动率取每一步起点的波动率，步长较大时有离散化误差
+        Args:
+            spot: float, 标的期初价格
+            t_grid: np.ndarray, (n_step,)的各步终点距离起始日的年化时间，起点为0
+            dw: np.ndarray, (n_step, n_col)的标准正态随机数矩阵
+            antithetic: bool, 是否使用对立变量，是则返回的后n_col条路径使用-dw
+        Returns:
+            np.ndarray, (n_step + 1, n_path)的价格路径矩阵，第0行为期初价格，浮点类型与dw相同
+        """
+        t_grid = np.asarray(t_grid, dtype=np.float64)
+        t_start = np.append(0., t_grid[:-1])
+        dt = t_grid - t_start
+        log_drift = np.broadcast_to(np.log(self.div.disc_factor(t_grid, t_start)
+                                           / self.interest.disc_factor(t_grid, t_start)), t_grid.shape)
+        vol_type = getattr(self.vol, "vol_type", None)
+        if vol_type == VolType.CV:
+            vol_table = np.broadcast_to(np.asarray(self.vol(t_start, spot), dtype=np.float64), t_grid.shape)
+            return evolve_bs_log_paths(float(spot), dt, dw, np.ascontiguousarray(log_drift, dtype=np.float64),
+                                       np.ascontiguousarray(vol_table).reshape(-1, 1), np.arange(t_grid.size),
+                                       np.zeros(1), antithetic)
+        if vol_type == VolType.LV:
+            vol_t_idx = np.searchsorted(self.vol.expirations[:-1], t_start)
+            return evolve_bs_log_paths(float(spot), dt, dw, np.ascontiguousarray(log_drift, dtype=np.float64),
+                                       np.ascontiguousarray(self.vol.volval, dtype=np.float64), vol_t_idx,
+                                       np.ascontiguousarray(self.vol.strikes, dtype=np.float64), antithetic)
+        raise ValueError(f"对数欧拉格式只支持常数波动率和局部波动率，当前波动率类型为{vol_type}")
+
     def get_fn_pde_coef(self, maturity, spot):
         """获取返回pde系数的函数
         Args:
@@ -128,4 +282,8 @@ class GeneralizedBSMProcess(StochProcessBase, Observer, Observable):
             a, b, c = lv ** 2, r_t - q_t, r_t
             return a, b, c
 
+        # 常数波动率、常数利率与分红率时PDE系数与时间无关，FdmGrid只需分解一次三对角算子
+        fn_pde_coef.time_homogeneous = (getattr(self.vol, "vol_type", None) == VolType.CV
+                                        and isinstance(self.interest, ConstantRate)
+                                        and isinstance(self.div, ConstantRate))
         return fn_pde_coef
@@ -4,14 +4,15 @@
 Copyright (C) 2024 Galaxy Technologies
 Licensed under the Apache License, Version 2.0
 """
+import math
 import numpy as np
-from numba import njit
-from ..utilities.enums import ProcessType
+from numba import njit, prange
+from ..utilities.enums import ProcessType, HestonScheme
 from ..utilities.patterns import Observable, Observer
 from .stoch_process import StochProcessBase
 
 
-@njit(parallel=True, fastmath=True, cache=False)
+@njit(parallel=True, fastmath=True, cache=True)
 def evolve_jit(x0, dt, dw, var_kappa, var_theta, var_vol, drift):
     """Heston SDE演化函数，jit加速
     Heston方差非负修正 - 采用部分截断模式
@@ -32,6 +33,175 @@ def evolve_jit(x0, dt, dw, var_kappa, var_theta, var_vol, drift):
     return [s1, v1]
 
 
+@njit(fastmath=True, cache=True)
+def _heston_step(s0, v0, growth, dt, dw_s, dw_v, var_kappa, var_theta, var_vol):
+    """单条路径的一步Heston演化，与evolve_jit相同，v0是未截断的方差，返回(s1, v1)"""
+    sqrt_v_dt = np.sqrt(max(v0, 0.) * dt)
+    return s0 * (growth + dw_s * sqrt_v_dt), v0 + var_kappa * (var_theta - v0) * dt + var_vol * sqrt_v_dt * dw_v
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def evolve_heston_paths(spot, v0, dt, dw_s, dw_v, drift, var_kappa, var_theta, var_vol, var_rho, antithetic):
+    """Heston SDE整条路径的演化函数，jit加速，时间循环全部在编译代码中完成，每一步对路径prange并行
+    每一步的演化公式与evolve_jit相同，方差采用部分截断模式，返回的方差路径已做非负修正
+    Args:
+        spot: float, 标的期初价格
+        v0: float, 方差初始值
+        dt: float, 年化时间增量
+        dw_s: np.ndarray, (n_step, n_col)的标准正态随机数矩阵，驱动价格
+        dw_v: np.ndarray, (n_step, n_col)的标准正态随机数矩阵，与dw_s按var_rho相关后驱动方差
+        drift: np.ndarray, (n_step,)的每一步漂移率
+        var_kappa: float，Heston参数，方差回归速度
+        var_theta: float，Heston参数，方差均值
+        var_vol: float，Heston参数，方差的波动率
+        var_rho: float，Heston参数，方差与标的资产布朗运动的相关系数
+        antithetic: bool, 是否使用对立变量，是则后n_col条路径使用-dw
+    Returns:
+        s_paths: np.ndarray, (n_step + 1, n_path)的价格路径矩阵，浮点类型与dw_s相同
+        var_paths: np.ndarray, (n_step + 1, n_path)的方差路径矩阵
+    """
+    n_step, n_col = dw_s.shape
+    n_path = 2 * n_col if antithetic else n_col
+    rho_c = np.sqrt(1 - var_rho ** 2)
+    s_paths = np.empty((n_step + 1, n_path), dw_s.dtype)
+    var_paths = np.empty((n_step + 1, n_path), dw_s.dtype)
+    v = np.full(n_path, v0)  # 未截断的方差
+    s_paths[0] = spot
+    var_paths[0] = max(v0, 0.)
+    for i in range(n_step):
+        growth = 1 + drift[i] * dt
+        for j in prange(n_col):
+            w_v = var_rho * dw_s[i, j] + rho_c * dw_v[i, j]
+            s_paths[i + 1, j], v[j] = _heston_step(s_paths[i, j], v[j], growth, dt, dw_s[i, j], w_v,
+                                                   var_kappa, var_theta, var_vol)
+            var_paths[i + 1, j] = max(v[j], 0.)
+        if antithetic:  # 后n_col条是对立路径
+            for j in prange(n_col):
+                k = n_col + j
+                w_v = var_rho * dw_s[i, j] + rho_c * dw_v[i, j]
+                s_paths[i + 1, k], v[k] = _heston_step(s_paths[i, k], v[k], growth, dt, -dw_s[i, j], -w_v,
+                                                       var_kappa, var_theta, var_vol)
+                var_paths[i + 1, k] = max(v[k], 0.)
+    return s_paths, var_paths
+
+
+# Andersen QE格式在二次分支与指数分支之间切换的临界值psi_c
+_QE_PSI_CRITICAL = 1.5
+
+
+@njit(fastmath=True, cache=True)
+def _full_truncation_step(s0, v0, dt, log_drift, z_s, z_v, var_kappa, var_theta, var_vol, var_rho):
+    """单条路径的一步完全截断对数欧拉演化，漂移项与扩散项都使用截断后的方差max(v0, 0)，返回(s1, v1)，v1未截断
+    ln S1 = ln S0 + log_drift - 0.5 * v0+ * dt + sqrt(v0+ * dt) * z_s，给定方差时价格的条件期望与漂移一致(鞅性质)"""
+    sqrt_v_dt = np.sqrt(max(v0, 0.) * dt)
+    w_v = var_rho * z_s + np.sqrt(1 - var_rho ** 2) * z_v
+    v1 = v0 + var_kappa * (var_theta - max(v0, 0.)) * dt + var_vol * sqrt_v_dt * w_v
+    return s0 * np.exp(log_drift - 0.5 * sqrt_v_dt ** 2 + sqrt_v_dt * z_s), v1
+
+
+@njit(fastmath=True, cache=True)
+def _qe_step(s0, v0, dt, log_drift, z_s, z_v, var_kappa, var_theta, var_vol, var_rho):
+    """单条路径的一步Andersen(2008)二次指数(QE)演化，返回(s1, v1)
+    方差: 按下一时刻方差的条件均值m与方差s2匹配矩，psi = s2 / m^2不超过1.5时取非中心卡方的二次近似a(b + z_v)^2，
+          否则取在0处有质量的指数分布近似，由均匀随机数U = Phi(z_v)反函数抽样
+    价格: 对数价格由方差积分的梯形近似(gamma1 = gamma2 = 0.5)演化，独立的z_s驱动与方差无关的部分；
+          K0按鞅修正取值，使给定v0时E[S1] = S0 * exp(log_drift)，修正条件不满足时退回未修正的K0"""
+    ekt = np.exp(-var_kappa * dt)
+    m = var_theta + (v0 - var_theta) * ekt
+    s2 = (v0 * var_vol ** 2 * ekt * (1 - ekt) / var_kappa
+          + var_theta * var_vol ** 2 * (1 - ekt) ** 2 / (2 * var_kappa))
+    psi = s2 / (m * m)
+    k1 = 0.5 * dt * (var_kappa * var_rho / var_vol - 0.5) - var_rho / var_vol
+    k2 = 0.5 * dt * (var_kappa * var_rho / var_vol - 0.5) + var_rho / var_vol
+    k3 = 0.5 * dt * (1 - var_rho ** 2)  # K3 = K4
+    a_coef = k2 + 0.5 * k3  # 鞅修正中 E[exp(A * v1)] 的系数A
+    k0 = -var_rho * var_kappa * var_theta * dt / var_vol  # 未修正的K0
+    if psi <= _QE_PSI_CRITICAL:
+        b2 = 2 / psi - 1 + np.sqrt(2 / psi) * np.sqrt(2 / psi - 1)
+        a = m / (1 + b2)
+        v1 = a * (np.sqrt(b2) + z_v) ** 2
+        if 1 - 2 * a_coef * a > 0:
+            k0 = -(a_coef * b2 * a / (1 - 2 * a_coef * a) - 0.5 * np.log(1 - 2 * a_coef * a)) - (k1 + 0.5 * k3) * v0
+    else:
+        p = (psi - 1) / (psi + 1)
+        beta = (1 - p) / m
+        u = 0.5 * math.erfc(-z_v / np.sqrt(2.))
+        v1 = 0. if u <= p else np.log((1 - p) / (1 - u)) / beta
+        if beta > a_coef:
+            k0 = -np.log(p + beta * (1 - p) / (beta - a_coef)) - (k1 + 0.5 * k3) * v0
+    return s0 * np.exp(log_drift + k0 + k1 * v0 + k2 * v1 + np.sqrt(k3 * (v0 + v1)) * z_s), v1
+
+
+@njit(fastmath=True, cache=True)
+def _heston_log_step(s0, v0, dt, log_drift, z_s, z_v, var_kappa, var_theta, var_vol, var_rho, qe):
+    """单条路径的一步演化，qe为True时使用QE格式，否则使用完全截断对数欧拉格式"""
+    if qe:
+        return _qe_step(s0, v0, dt, log_drift, z_s, z_v, var_kappa, var_theta, var_vol, var_rho)
+    return _full_truncation_step(s0, v0, dt, log_drift, z_s, z_v, var_kappa, var_theta, var_vol, var_rho)
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def evolve_heston_log_paths(spot, v0, dt, log_drift, dw_s, dw_v, var_kappa, var_theta, var_vol, var_rho, antithetic,
+                            qe):
+    """Heston SDE对数价格格式(完全截断对数欧拉或QE)的整条路径演化函数，jit加速，时间步长可以不等，每一步对路径prange并行
+    Args:
+        spot: float, 标的期初价格
+        v0: float, 方差初始值
+        dt: np.ndarray, (n_step,)的每一步年化时间增量
+        log_drift: np.ndarray, (n_step,)的每一步漂移率在该步上的积分
+        dw_s: np.ndarray, (n_step, n_col)的标准正态随机数矩阵，驱动价格
+        dw_v: np.ndarray, (n_step, n_col)的标准正态随机数矩阵，驱动方差，与dw_s独立
+        var_kappa: float，Heston参数，方差回归速度
+        var_theta: float，Heston参数，方差均值
+        var_vol: float，Heston参数，方差的波动率
+        var_rho: float，Heston参数，方差与标的资产布朗运动的相关系数
+        antithetic: bool, 是否使用对立变量，是则后n_col条路径使用-dw
+        qe: bool, True为QE格式，False为完全截断对数欧拉格式
+    Returns:
+        s_paths: np.ndarray, (n_step + 1, n_path)的价格路径矩阵，浮点类型与dw_s相同
+        var_paths: np.ndarray, (n_step + 1, n_path)的方差路径矩阵，已做非负修正
+    """
+    n_step, n_col = dw_s.shape
+    n_path = 2 * n_col if antithetic else n_col
+    s_paths = np.empty((n_step + 1, n_path), dw_s.dtype)
+    var_paths = np.empty((n_step + 1, n_path), dw_s.dtype)
+    v = np.full(n_path, v0)  # 未截断的方差
+    s_paths[0] = spot
+    var_paths[0] = max(v0, 0.)
+    for i in range(n_step):
+        for j in prange(n_col):
+            s_paths[i + 1, j], v[j] = _heston_log_step(s_paths[i, j], v[j], dt[i], log_drift[i], dw_s[i, j],
+                                                       dw_v[i, j], var_kappa, var_theta, var_vol, var_rho, qe)
+            var_paths[i + 1, j] = max(v[j], 0.)
+            if antithetic:  # 后n_col条是对立路径
+                k = j + n_col
+                s_paths[i + 1, k], v[k] = _heston_log_step(s_paths[i, k], v[k], dt[i], log_drift[i], -dw_s[i, j],
+                                                           -dw_v[i, j], var_kappa, var_theta, var_vol, var_rho, qe)
+                var_paths[i + 1, k] = max(v[k], 0.)
+    return s_paths, var_paths
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def evolve_heston_log_step(s0, v0, dt, log_drift, dw_s, dw_v, var_kappa, var_theta, var_vol, var_rho, qe):
+    """Heston SDE对数价格格式的一步演化，jit加速，与evolve_heston_log_paths的一步相同，用于不保存路径矩阵的逐步模拟
+    Args:
+        s0: np.ndarray, (n,)的价格向量
+        v0: np.ndarray, (n,)的未截断的方差向量
+        dt: float, 年化时间增量
+        log_drift: float, 漂移率在该步上的积分
+        dw_s: np.ndarray, (n,)的标准正态随机数，驱动价格
+        dw_v: np.ndarray, (n,)的标准正态随机数，驱动方差
+        其余参数见evolve_heston_log_paths
+    Returns: (s1, v1)，下一时刻的价格向量与未截断的方差向量
+    """
+    s1 = np.empty_like(s0)
+    v1 = np.empty(s0.size)
+    for j in prange(s0.size):
+        s1[j], v1[j] = _heston_log_step(s0[j], v0[j], dt, log_drift, dw_s[j], dw_v[j], var_kappa, var_theta, var_vol,
+                                        var_rho, qe)
+    return s1, v1
+
+
 class HestonProcess(StochProcessBase, Observer, Observable):
     """Heston SDE:
         dS/S = (r-q)dt + sqrt(v) dW
@@ -42,7 +212,8 @@ class HestonProcess(StochProcessBase, Observer, Observable):
     process_type = ProcessType.Heston
 
     def __init__(self, spot: Observable, interest: Observable, div: Observable, *,
-                 v0: float, var_theta: float, var_kappa: float, var_vol: float, var_rho: float):
+                 v0: float, var_theta: float, var_kappa: float, var_vol: float, var_rho: float,
+                 scheme=HestonScheme.PartialTruncation):
         """初始化HestonProcess实例
         Args:
             spot: 市场行情实例，标的价格
@@ -53,6 +224,9 @@ class HestonProcess(StochProcessBase, Observer, Observable):
             var_kappa: float, 方差均值回归速率
             var_vol: float, 方差的波动率
             var_rho: float, 方差与标的资产布朗运动的相关系数
+            scheme: HestonScheme枚举类，蒙特卡洛模拟的离散格式。PartialTruncation(默认)为部分截断欧拉格式，需要逐日模拟；
+                    FullTruncation为完全截断对数欧拉格式；QE为Andersen二次指数格式(含鞅修正)，周度、月度等较大步长下偏差仍较小。
+                    后两种格式支持不等距的时间网格，见evolve_log_paths
         """
         self.spot = spot  # 标的价格
         self.interest = interest  # 无风险利率
@@ -65,6 +239,7 @@ class HestonProcess(StochProcessBase, Observer, Observable):
         self._var_theta = var_theta  # 方差均值
         self._var_vol = var_vol  # 方差的波动率
         self._var_rho = var_rho  # 方差与标的资产布朗运动的相关系数
+        self._scheme = self._check_scheme(scheme)  # 蒙特卡洛模拟的离散格式
         super().__init__()  # 调用被观察者Observable的构造函数
 
     def remove_self(self):
@@ -91,8 +266,17 @@ class HestonProcess(StochProcessBase, Observer, Observable):
         """
         return self.interest(t) - self.div(t)
 
-    def diffusion(self):
-        """heston的扩散项是sqrt(v), 此处方差v是evolve方法的参数，从外界传入，todo: process暂时未存储s和v路径。"""
+    def diffusion(self, t=0., spot=None):
+        """heston的扩散项是sqrt(v), 此处方差v是evolve方法的参数，从外界传入，todo: process暂时未存储s和v路径。
+        这里返回方差期望值的平方根sqrt(E[v_t])，E[v_t] = theta + (v0 - theta) * exp(-kappa * t)，
+        用作只在部分时间步上模拟时布朗桥穿越概率的近似波动率
+        Args:
+            t: float，距离起始日的年化时间
+            spot: float或np.ndarray，标的价格，不影响结果，只用于确定返回值的形状
+        Returns: float或np.ndarray，波动率
+        """
+        vol = np.sqrt(max(self.var_theta + (self.v0 - self.var_theta) * np.exp(-self.var_kappa * t), 0.))
+        return vol if spot is None else np.full(np.shape(spot), vol)
 
     def evolve(self, t, x, dt, dw):
         """演化函数，根据Heston SDE进行演化
@@ -106,6 +290,89 @@ class HestonProcess(StochProcessBase, Observer, Observable):
         """
         return evolve_jit(np.array(x), dt, np.array(dw), self.var_kappa, self.var_theta, self.var_vol, self.drift(t))
 
+    def evolve_paths(self, spot, dt, dw_s, dw_v, antithetic=False):
+        """一次演化出整条价格路径和方差路径，第step步使用t = step * dt时刻的漂移项，与逐步调用evolve的结果相同
+        预先计算漂移率网格，由evolve_heston_paths在编译代码中完成全部时间步，不再逐步构造[s, v]临时数组；
+        离散格式不是部分截断欧拉格式时，在等距时间网格上调用evolve_log_paths
+        Args:
+            spot: float, 标的期初价格
+            dt: float, 年化时间增量
+            dw_s: np.ndarray, (n_step, n_col)的标准正态随机数矩阵，驱动价格
+            dw_v: np.ndarray, (n_step, n_col)的标准正态随机数矩阵，与dw_s按var_rho相关后驱动方差
+            antithetic: bool, 是否使用对立变量，是则返回的后n_col条路径使用-dw
+        Returns:
+            s_paths: np.ndarray, (n_step + 1, n_path)的价格路径矩阵，浮点类型与dw_s相同
+            var_paths: np.ndarray, (n_step + 1, n_path)的方差路径矩阵，已做非负修正
+        """
+        t = dt * np.arange(1, dw_s.shape[0] + 1)
+        if self._scheme != HestonScheme.PartialTruncation:
+            return self.evolve_log_paths(spot, t, dw_s, dw_v, antithetic)
+        drift = np.broadcast_to(np.asarray(self.drift(t), dtype=np.float64), t.shape)
+        return evolve_heston_paths(float(spot), float(self.v0), dt, dw_s, dw_v, np.ascontiguousarray(drift),
+                                   float(self.var_kappa), float(self.var_theta), float(self.var_vol),
+                                   float(self.var_rho), antithetic)
+
+    def evolve_log_paths(self, spot, t_grid, dw_s, dw_v, antithetic=False):
+        """完全截断对数欧拉格式或QE格式，在任意升序的时间网格上一次演化出整条价格路径和方差路径
+        漂移项取无风险利率与分红融券率折现因子之比的对数，与折现曲线一致
+        Args:
+            spot: float, 标的期初价格
+            t_grid: np.ndarray, (n_step,)的各步终点距离起始日的年化时间，起点为0
+            dw_s: np.ndarray, (n_step, n_col)的标准正态随机数矩阵，驱动价格
+            dw_v: np.ndarray, (n_step, n_col)的标准正态随机数矩阵，驱动方差
+            antithetic: bool, 是否使用对立变量，是则返回的后n_col条路径使用-dw
+        Returns:
+            s_paths: np.ndarray, (n_step + 1, n_path)的价格路径矩阵，第0行为期初价格，浮点类型与dw_s相同
+            var_paths: np.ndarray, (n_step + 1, n_path)的方差路径矩阵，已做非负修正
+        """
+        if self._scheme == HestonScheme.PartialTruncation:
+            raise ValueError("部分截断欧拉格式只支持逐日等距模拟，不等距的时间网格请使用HestonScheme.FullTruncation或HestonScheme.QE")
+        t_grid = np.asarray(t_grid, dtype=np.float64)
+        t_start = np.append(0., t_grid[:-1])
+        log_drift = np.broadcast_to(np.log(self.div.disc_factor(t_grid, t_start)
+                                           / self.interest.disc_factor(t_grid, t_start)), t_grid.shape)
+        return evolve_heston_log_paths(float(spot), float(self.v0), t_grid - t_start,
+                                       np.ascontiguousarray(log_drift, dtype=np.float64), dw_s, dw_v,
+                                       float(self.var_kappa), float(self.var_theta), float(self.var_vol),
+                                       float(self.var_rho), antithetic, self._scheme == HestonScheme.QE)
+
+    def evolve_step(self, t, s, v, dt, dw_s, dw_v):
+        """按离散格式演化一步，用于不保存路径矩阵的逐步模拟，与整条路径演化(evolve_paths)的对应一步相同
+        Args:
+            t: float，该步终点距离起始日的年化时间
+            s: np.ndarray，(n,)的价格向量
+            v: np.ndarray，(n,)的未截断的方差向量
+            dt: float，年化时间增量
+            dw_s: np.ndarray，(n,)的标准正态随机数，驱动价格
+            dw_v: np.ndarray，(n,)的标准正态随机数，与dw_s独立，驱动方差
+        Returns: (s1, v1)，下一时刻的价格向量与未截断的方差向量
+        """
+        if self._scheme == HestonScheme.PartialTruncation:
+            s1, v1 = self.evolve(t, [s, v], dt, [dw_s, self.var_rho * dw_s + np.sqrt(1 - self.var_rho ** 2) * dw_v])
+            return s1, v1
+        log_drift = float(np.log(self.div.disc_factor(t, t - dt) / self.interest.disc_factor(t, t - dt)))
+        return evolve_heston_log_step(np.ascontiguousarray(s), np.ascontiguousarray(v, dtype=np.float64), dt,
+                                      log_drift, np.ascontiguousarray(dw_s), np.ascontiguousarray(dw_v),
+                                      float(self.var_kappa), float(self.var_theta), float(self.var_vol),
+                                      float(self.var_rho), self._scheme == HestonScheme.QE)
+
+    @staticmethod
+    def _check_scheme(scheme):
+        """检查离散格式"""
+        if scheme not in (HestonScheme.PartialTruncation, HestonScheme.FullTruncation, HestonScheme.QE):
+            raise ValueError(f"Heston过程的离散格式应为HestonScheme枚举类，当前输入为{scheme}")
+        return scheme
+
+    @property
+    def scheme(self):
+        return self._scheme
+
+    @scheme.setter
+    def scheme(self, new_value):
+        """覆写给对象的属性赋值的方法，当属性值变化时，自动向观察者发送通知"""
+        self._scheme = self._check_scheme(new_value)  # 属性变化
+        self.notify_observers()  # 自动向观察者发送通知, 参数已改变
+
     def get_fn_pde_coef(self):
         raise NotImplementedError("TODO: Heston PDE数值解法 - ADI 交替隐式迭代法")
 
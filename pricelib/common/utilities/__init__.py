@@ -6,12 +6,14 @@ Licensed under the Apache License, Version 2.0
 """
 from .patterns import Observer, Observable, SimpleQuote, HashableArray
 from .utility import time_this, logging, set_logging_handlers, ascending_pairs, descending_pairs
-from .numerical import LinearFlat, CubicSplineFlat, FlatCubicSpline, TDMA_ldu_jit
+from .numerical import (LinearFlat, CubicSplineFlat, FlatCubicSpline, TDMA_ldu_jit, tridiag_lu_factor,
+                        tridiag_lu_solve, tridiag_lu_solve_batch, tridiag_dot)
 from .enums import *
 
 
 __all__ = ['Observer', 'Observable', 'SimpleQuote', 'HashableArray', 'time_this', 'logging', 'set_logging_handlers',
            'ascending_pairs', 'descending_pairs',
-           'LinearFlat', 'CubicSplineFlat', 'FlatCubicSpline', 'TDMA_ldu_jit',
+           'LinearFlat', 'CubicSplineFlat', 'FlatCubicSpline', 'TDMA_ldu_jit', 'tridiag_lu_factor', 'tridiag_lu_solve',
+           'tridiag_lu_solve_batch', 'tridiag_dot',
            'CallPut', 'BuySell', 'RandsMethod', 'LdMethod', 'VolType', 'ProcessType', 'EngineType', 'QuadMethod',
            'BarrierType', 'UpDown', 'InOut', 'TouchType']
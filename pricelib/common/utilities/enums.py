@@ -101,6 +101,13 @@ class ProcessType(Enum):  # 目前支持的随机过程类型
     Heston = "Heston随机过程"
 
 
+@unique
+class HestonScheme(Enum):  # Heston过程蒙特卡洛模拟的离散格式
+    PartialTruncation = "部分截断欧拉格式"
+    FullTruncation = "完全截断对数欧拉格式"
+    QE = "Andersen二次指数格式"
+
+
 @unique
 class EngineType(Enum):  # 定价引擎类型
     AnEngine = "解析法定价引擎"
@@ -116,6 +123,13 @@ class QuadMethod(Enum):  # 数值积分方法
     Simpson = "Simpson法则"
 
 
+@unique
+class FdmGridType(Enum):  # PDE有限差分法的价格网格类型
+    Uniform = "均匀网格"
+    Aligned = "关键价格对齐的分段均匀网格"
+    Concentrated = "关键价格对齐、在关键价格附近加密的sinh网格"
+
+
 @unique
 class ExerciseType(Enum):  # 行权方式
     European = "欧式"
@@ -124,6 +138,18 @@ class ExerciseType(Enum):  # 行权方式
     Bermudan = "百慕大"
 
 
+@unique
+class LsmcBasis(Enum):  # 最小二乘蒙特卡洛(LSMC)回归的基函数
+    Polynomial = "幂函数多项式"
+    Laguerre = "加权Laguerre多项式"
+
+
+@unique
+class FourierMethod(Enum):  # Heston等特征函数已知的模型的傅里叶定价方法
+    COS = "COS余弦展开法"
+    FFT = "Carr-Madan快速傅里叶变换"
+
+
 @unique
 class PaymentType(Enum):  # 支付方式
     Expire = "到期支付"
@@ -100,6 +100,90 @@ def TDMA_ldu_jit(a, b, c, d):
     return p
 
 
+@njit(cache=True, fastmath=True)
+def tridiag_lu_factor(a, b, c):
+    """三对角矩阵的LU分解，即Thomas算法的消元部分，系数矩阵不变时只需分解一次
+    Args:
+        a: np.adarray，三对角系数矩阵的下对角线元素向量，长度n-1
+        b: np.adarray，三对角系数矩阵的主对角线元素向量，长度n
+        c: np.adarray，三对角系数矩阵的上对角线元素向量，长度n-1
+    Returns:
+        multipliers: np.adarray，长度n-1，L的下对角线(消元乘数)
+        pivots: np.adarray，长度n，U的主对角线(主元)，U的上对角线就是c
+    """
+    n = b.size
+    multipliers = np.empty(n - 1)
+    pivots = np.empty(n)
+    pivots[0] = b[0]
+    for i in range(1, n):
+        multipliers[i - 1] = a[i - 1] / pivots[i - 1]
+        pivots[i] = b[i] - multipliers[i - 1] * c[i - 1]
+    return multipliers, pivots
+
+
+@njit(cache=True, fastmath=True)
+def tridiag_lu_solve(multipliers, pivots, c, d):
+    """用tridiag_lu_factor的分解结果求解三对角方程组，只需O(n)的前代和回代，不修改输入
+    Args:
+        multipliers: np.adarray，L的下对角线
+        pivots: np.adarray，U的主对角线
+        c: np.adarray，三对角系数矩阵的上对角线元素向量
+        d: np.adarray，方程右端向量
+    Returns:
+        p: np.adarray，方程的解向量
+    """
+    n = d.size
+    p = np.empty(n)
+    p[0] = d[0]
+    for i in range(1, n):
+        p[i] = d[i] - multipliers[i - 1] * p[i - 1]
+    p[n - 1] /= pivots[n - 1]
+    for i in range(n - 2, -1, -1):
+        p[i] = (p[i] - c[i] * p[i + 1]) / pivots[i]
+    return p
+
+
+@njit(cache=True, fastmath=True)
+def tridiag_lu_solve_batch(multipliers, pivots, c, d):
+    """多右端项的tridiag_lu_solve，d的每一列是一个右端向量，原地写入解
+    逐行消元时内层循环遍历各列，访问的是连续内存，系数只读取一次
+    Args:
+        multipliers: np.adarray，L的下对角线
+        pivots: np.adarray，U的主对角线
+        c: np.adarray，三对角系数矩阵的上对角线元素向量
+        d: np.adarray，(n, m)的右端矩阵，原地写入(n, m)的解矩阵
+    Returns: None
+    """
+    n, m = d.shape
+    for i in range(1, n):
+        for k in range(m):
+            d[i, k] -= multipliers[i - 1] * d[i - 1, k]
+    for k in range(m):
+        d[n - 1, k] /= pivots[n - 1]
+    for i in range(n - 2, -1, -1):
+        for k in range(m):
+            d[i, k] = (d[i, k] - c[i] * d[i + 1, k]) / pivots[i]
+
+
+@njit(cache=True, fastmath=True)
+def tridiag_dot(a, b, c, x):
+    """三对角矩阵与向量的乘积
+    Args:
+        a: np.adarray，下对角线元素向量，长度n-1
+        b: np.adarray，主对角线元素向量，长度n
+        c: np.adarray，上对角线元素向量，长度n-1
+        x: np.adarray，长度n的向量
+    Returns:
+        np.adarray，长度n的乘积向量
+    """
+    n = x.size
+    y = b * x
+    for i in range(n - 1):
+        y[i] += c[i] * x[i + 1]
+        y[i + 1] += a[i] * x[i]
+    return y
+
+
 class LinearFlat(interp1d):
     """自定义以最边缘点的值水平外推的线性插值，两侧外推时，使用边界值y[0], y[-1]"""
 
@@ -17,8 +17,13 @@ from .analytic_double_shark_engine import *
 from .analytic_airbag_engine import *
 from .cashflow_engine import *
 from .analytic_heston_vanilla_engine import *
+from .analytic_heston_fourier_engine import *
+from .heston_calibration import *
+from .bs_ufuncs import *
 
 __all__ = ['AnalyticVanillaEuEngine', 'AnalyticBarrierEngine', 'AnalyticCashOrNothingEngine',
            'AnalyticDoubleDigitalEngine', 'AnalyticVanillaAmEngine', 'AnalyticAsianEngine', 'AnalyticPortfolioEngine',
            'AnalyticDoubleBarrierEngine', 'AnalyticDoubleSharkEngine', 'AnalyticAirbagEngine',
-           'AnalyticAssetOrNothingEngine', 'CashFlowEngine', 'AnalyticHestonVanillaEngine', ]
+           'AnalyticAssetOrNothingEngine', 'CashFlowEngine', 'AnalyticHestonVanillaEngine',
+           'AnalyticHestonFourierEngine', 'HestonFourierPricer', 'HestonCalibrator', 'HestonCalibrationResult',
+           'bs_price', 'bs_delta', 'bs_gamma', 'bs_vega', 'bs_theta', 'bs_rho', 'bs_implied_vol', ]
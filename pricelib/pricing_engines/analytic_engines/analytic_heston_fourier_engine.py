@@ -0,0 +1,335 @@
+#!/user/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2024 Galaxy Technologies
+Licensed under the Apache License, Version 2.0
+"""
+import threading
+from collections import OrderedDict
+import numpy as np
+from scipy.interpolate import CubicSpline
+from pricelib.common.utilities.enums import CallPut, ProcessType, ExerciseType, FourierMethod
+from pricelib.common.processes import StochProcessBase
+from pricelib.common.pricing_engine_base import AnalyticEngine
+from pricelib.common.time import global_evaluation_date
+
+
+# pylint: disable=invalid-name, too-many-arguments, too-many-locals
+def heston_log_char_fn(u, tau, v0, var_theta, var_kappa, var_vol, var_rho):
+    """Heston模型对数远期收益率X = ln(S_T / F_T)的特征函数E[exp(iuX)]，F_T为到期日的远期价格
+    使用Albrecher等(2007)的"little trap"形式，复对数不会跨越分支切割，到期时间较长时仍然连续；
+    特征函数与标的价格、无风险利率、分红率无关，只取决于到期时间与Heston参数
+    Args:
+        u: complex或np.ndarray，特征函数的自变量，可以是复数
+        tau: float，到期时间(年化)
+        v0, var_theta, var_kappa, var_vol, var_rho: float，Heston参数，见HestonProcess
+    Returns: np.ndarray，与u形状相同的复数特征函数值
+    """
+    u = np.asarray(u, dtype=np.complex128)
+    beta = var_kappa - var_rho * var_vol * 1j * u
+    d = np.sqrt(beta ** 2 + var_vol ** 2 * (1j * u + u ** 2))
+    g = (beta - d) / (beta + d)
+    exp_dt = np.exp(-d * tau)
+    capitalC = var_kappa * var_theta / var_vol ** 2 * ((beta - d) * tau - 2 * np.log((1 - g * exp_dt) / (1 - g)))
+    capitalD = (beta - d) / var_vol ** 2 * (1 - exp_dt) / (1 - g * exp_dt)
+    return np.exp(capitalC + capitalD * v0)
+
+
+def heston_log_char_fn_grad(u, tau, v0, var_theta, var_kappa, var_vol, var_rho):
+    """heston_log_char_fn及其对Heston参数的解析导数，按"little trap"形式逐项链式求导，用于校准时的解析雅可比矩阵
+    Args: 见heston_log_char_fn
+    Returns: (phi, grad)，phi与u形状相同；grad为(5,) + u.shape的复数数组，依次为对v0, var_theta, var_kappa, var_vol, var_rho的导数
+    """
+    u = np.asarray(u, dtype=np.complex128)
+    iu = 1j * u
+    beta = var_kappa - var_rho * var_vol * iu
+    d = np.sqrt(beta ** 2 + var_vol ** 2 * (iu + u ** 2))
+    g = (beta - d) / (beta + d)
+    exp_dt = np.exp(-d * tau)
+    log_term = np.log((1 - g * exp_dt) / (1 - g))
+    scale_c = var_kappa * var_theta / var_vol ** 2
+    capitalC = scale_c * ((beta - d) * tau - 2 * log_term)
+    capitalD = (beta - d) / var_vol ** 2 * (1 - exp_dt) / (1 - g * exp_dt)
+    phi = np.exp(capitalC + capitalD * v0)
+    grad = np.empty((5,) + u.shape, dtype=np.complex128)
+    grad[0] = capitalD * phi
+    grad[1] = capitalC / var_theta * phi
+    # 依次对var_kappa, var_vol, var_rho求导: beta、d、g、exp(-d tau)、C、D的导数
+    zero = np.zeros_like(u)
+    for k, (d_beta, d_scale_c, d_inv_vol2, d_d2_extra) in enumerate((
+            (np.ones_like(u), var_theta / var_vol ** 2, 0., zero),
+            (-var_rho * iu, -2 * scale_c / var_vol, -2 / var_vol ** 3, 2 * var_vol * (iu + u ** 2)),
+            (-var_vol * iu, 0., 0., zero)), 2):
+        d_d = (2 * beta * d_beta + d_d2_extra) / (2 * d)
+        d_g = 2 * (d * d_beta - beta * d_d) / (beta + d) ** 2
+        d_exp = -tau * exp_dt * d_d
+        d_log = -(d_g * exp_dt + g * d_exp) / (1 - g * exp_dt) + d_g / (1 - g)
+        d_c = d_scale_c * ((beta - d) * tau - 2 * log_term) + scale_c * ((d_beta - d_d) * tau - 2 * d_log)
+        d_ratio = (-d_exp * (1 - g * exp_dt) + (1 - exp_dt) * (d_g * exp_dt + g * d_exp)) / (1 - g * exp_dt) ** 2
+        d_capital_d = (((d_beta - d_d) / var_vol ** 2 + (beta - d) * d_inv_vol2) * (1 - exp_dt) / (1 - g * exp_dt)
+                       + (beta - d) / var_vol ** 2 * d_ratio)
+        grad[k] = (d_c + d_capital_d * v0) * phi
+    return phi, grad
+
+
+def heston_log_cumulants(tau, v0, var_theta, var_kappa, var_vol, var_rho):
+    """Heston模型对数远期收益率X = ln(S_T / F_T)的一阶、二阶累积量(均值、方差)，用于确定COS方法的截断区间，见Fang & Oosterlee(2008)
+    Returns: (c1, c2)
+    """
+    ekt = np.exp(-var_kappa * tau)
+    c1 = (1 - ekt) * (var_theta - v0) / (2 * var_kappa) - 0.5 * var_theta * tau
+    c2 = 1 / (8 * var_kappa ** 3) * (
+            var_vol * tau * var_kappa * ekt * (v0 - var_theta) * (8 * var_kappa * var_rho - 4 * var_vol)
+            + var_kappa * var_rho * var_vol * (1 - ekt) * (16 * var_theta - 8 * v0)
+            + 2 * var_theta * var_kappa * tau * (-4 * var_kappa * var_rho * var_vol + var_vol ** 2 + 4 * var_kappa ** 2)
+            + var_vol ** 2 * ((var_theta - 2 * v0) * ekt ** 2 + var_theta * (6 * ekt - 7) + 2 * v0)
+            + 8 * var_kappa ** 2 * (v0 - var_theta) * (1 - ekt))
+    return c1, abs(c2)
+
+
+class HestonFourierPricer:
+    """Heston模型欧式期权的傅里叶批量定价器，一次向量化计算整个行权价×到期日网格的价格，可用于参数校准
+    特征函数只取决于到期时间与Heston参数，每个(到期时间, 参数)的特征函数计算结果按最近最少使用(LRU)缓存:
+        COS: 缓存截断区间与展开项上的特征函数值，不同行权价、看涨看跌、标的价格、利率只需重新计算payoff系数，
+             一个到期日的全部行权价由(行权价数 × 展开项数)的矩阵运算一次得到
+        FFT: 缓存Carr-Madan快速傅里叶变换得到的对数行权价网格上的远期看涨价格的三次样条，各行权价由样条插值得到
+    校准循环中每次迭代的参数不同，每个到期日只计算一次特征函数；相同参数重复定价(如标的价格、利率变动)时直接命中缓存"""
+
+    def __init__(self, method=FourierMethod.COS, n_terms=256, truncation=12., fft_n=4096, fft_eta=0.25,
+                 fft_alpha=1.5, cache_size=256):
+        """构造函数
+        Args:
+            method: FourierMethod枚举类，COS(默认)为Fang-Oosterlee余弦展开法；FFT为Carr-Madan快速傅里叶变换
+            n_terms: int，COS方法的余弦展开项数
+            truncation: float，COS方法截断区间的宽度，为累积量标准差的倍数
+            fft_n: int，FFT的点数，应为2的幂
+            fft_eta: float，FFT积分网格的步长，对数行权价网格的步长为2π / (fft_n × fft_eta)
+            fft_alpha: float，Carr-Madan方法的阻尼系数
+            cache_size: int，缓存的(到期时间, 参数)组合数上限，为0时不缓存
+        """
+        if method not in (FourierMethod.COS, FourierMethod.FFT):
+            raise ValueError(f"傅里叶定价方法应为FourierMethod.COS或FourierMethod.FFT，当前输入为{method}")
+        self.method = method
+        self.n_terms = n_terms
+        self.truncation = truncation
+        self.fft_n = fft_n
+        self.fft_eta = fft_eta
+        self.fft_alpha = fft_alpha
+        self.cache_size = cache_size
+        self._cache = OrderedDict()  # {(到期时间, Heston参数): COS的(a, b, 加权特征函数值)或FFT的远期看涨价格样条}
+        self._lock = threading.Lock()
+        self.cache_hits = 0  # 缓存命中次数
+        self.cache_misses = 0  # 缓存未命中次数
+
+    def prices(self, strikes, maturities, spot, r, q, v0, var_theta, var_kappa, var_vol, var_rho,
+               callput=CallPut.Call):
+        """批量计算欧式期权价格，各输入按numpy规则广播为相同形状
+        Args:
+            strikes: float或np.ndarray，行权价
+            maturities: float或np.ndarray，到期时间(年化)
+            spot: float，标的价格
+            r: float或np.ndarray，无风险利率(连续复利，与maturities对应)
+            q: float或np.ndarray，分红融券率(连续复利，与maturities对应)
+            v0, var_theta, var_kappa, var_vol, var_rho: float，Heston参数，见HestonProcess
+            callput: CallPut枚举类或其数组，看涨/看跌
+        Returns: np.ndarray，与广播后的输入形状相同的期权价格
+        """
+        strikes, maturities, disc_r, disc_q, is_call = self._broadcast_inputs(strikes, maturities, r, q, callput)
+        params = (float(v0), float(var_theta), float(var_kappa), float(var_vol), float(var_rho))
+        forward = spot * disc_q / disc_r
+        undiscounted_put = np.empty(strikes.shape)
+        for tau in np.unique(maturities):
+            mask = maturities == tau
+            undiscounted_put[mask] = self._forward_put(strikes[mask] / forward[mask], tau, params) * forward[mask]
+        put = undiscounted_put * disc_r
+        # 看涨价格由看跌-看涨平价得到，避免深度实值看涨期权的截断误差
+        return np.where(is_call, put + spot * disc_q - strikes * disc_r, put)
+
+    def prices_and_jacobian(self, strikes, maturities, spot, r, q, v0, var_theta, var_kappa, var_vol, var_rho,
+                            callput=CallPut.Call):
+        """COS方法的批量价格及其对Heston参数的雅可比矩阵，用于参数校准，参数见prices
+        雅可比矩阵由特征函数的解析导数heston_log_char_fn_grad得到，截断区间[a, b]视为常数(只影响截断误差量级的项)；
+        看涨看跌平价中的其余项与Heston参数无关，看涨与看跌期权的导数相同
+        Returns: (prices, jacobian)，jacobian的形状为prices.shape + (5,)，依次为对v0, var_theta, var_kappa, var_vol, var_rho的导数
+        """
+        if self.method != FourierMethod.COS:
+            raise ValueError(f"解析雅可比矩阵只支持FourierMethod.COS，当前为{self.method}")
+        strikes, maturities, disc_r, disc_q, is_call = self._broadcast_inputs(strikes, maturities, r, q, callput)
+        params = (float(v0), float(var_theta), float(var_kappa), float(var_vol), float(var_rho))
+        forward = spot * disc_q / disc_r
+        put, jacobian = np.zeros(strikes.shape), np.zeros(strikes.shape + (5,))
+        for tau in np.unique(maturities[maturities > 0]):
+            mask = maturities == tau
+            a, b, weighted_phi = self._cached(tau, params)
+            coef, valid = self._cos_put_coef(strikes[mask] / forward[mask], a, b, weighted_phi.size)
+            u = np.arange(weighted_phi.size) * np.pi / (b - a)
+            shift = np.exp(-1j * u * a)
+            shift[0] *= 0.5
+            _, grad = heston_log_char_fn_grad(u, tau, *params)
+            scale = (forward * disc_r)[mask]
+            forward_put = (coef @ weighted_phi).real
+            positive = valid & (forward_put > 0)
+            put[mask] = np.where(positive, forward_put, 0.) * scale
+            jacobian[mask] = (np.where(positive[:, np.newaxis], (coef @ (grad * shift).T).real, 0.)
+                              * scale[:, np.newaxis])
+        expired = maturities <= 0
+        put[expired] = np.maximum(strikes - spot, 0)[expired]
+        return np.where(is_call, put + spot * disc_q - strikes * disc_r, put), jacobian
+
+    @staticmethod
+    def _broadcast_inputs(strikes, maturities, r, q, callput):
+        """将批量定价的输入广播为相同形状，返回(行权价, 到期时间, 无风险折现因子, 分红折现因子, 是否看涨)"""
+        is_call = np.vectorize(lambda cp: cp == CallPut.Call, otypes=[bool])(np.asarray(callput, dtype=object))
+        strikes, maturities, r, q, is_call = np.broadcast_arrays(np.asarray(strikes, dtype=np.float64),
+                                                                 np.asarray(maturities, dtype=np.float64),
+                                                                 np.asarray(r, dtype=np.float64),
+                                                                 np.asarray(q, dtype=np.float64), is_call)
+        return strikes, maturities, np.exp(-r * maturities), np.exp(-q * maturities), is_call
+
+    def _forward_put(self, moneyness, tau, params):
+        """以远期价格为单位的未折现看跌期权价格E[(K/F - X)^+]，X = S_T / F_T
+        Args:
+            moneyness: np.ndarray，K / F
+            tau: float，到期时间
+            params: tuple，(v0, var_theta, var_kappa, var_vol, var_rho)
+        Returns: np.ndarray，与moneyness形状相同
+        """
+        if tau <= 0:
+            return np.maximum(moneyness - 1, 0)
+        cached = self._cached(tau, params)
+        if self.method == FourierMethod.COS:
+            return self._cos_put(moneyness, *cached)
+        return np.maximum(cached[0](np.log(moneyness)) - 1 + moneyness, 0)
+
+    def _cached(self, tau, params):
+        """查找或计算一个(到期时间, 参数)组合的特征函数结果，最近最少使用淘汰"""
+        key = (float(tau), params)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self.cache_hits += 1
+                return self._cache[key]
+        if self.method == FourierMethod.COS:
+            value = self._cos_coefficients(tau, params)
+        else:
+            value = self._fft_calls(tau, params)
+        with self._lock:
+            self.cache_misses += 1
+            if self.cache_size > 0:
+                self._cache[key] = value
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return value
+
+    def clear_cache(self):
+        """清空特征函数缓存"""
+        with self._lock:
+            self._cache.clear()
+            self.cache_hits, self.cache_misses = 0, 0
+
+    def _cos_coefficients(self, tau, params):
+        """COS方法与行权价无关的部分: X = ln(S_T / F_T)的截断区间[a, b]，以及展开项上的特征函数值φ(u_k)exp(-i u_k a)，首项权重为1/2"""
+        c1, c2 = heston_log_cumulants(tau, *params)
+        a, b = c1 - self.truncation * np.sqrt(c2), c1 + self.truncation * np.sqrt(c2)
+        u = np.arange(self.n_terms) * np.pi / (b - a)
+        weighted_phi = heston_log_char_fn(u, tau, *params) * np.exp(-1j * u * a)
+        weighted_phi[0] *= 0.5
+        return a, b, weighted_phi
+
+    @classmethod
+    def _cos_put(cls, moneyness, a, b, weighted_phi):
+        """COS方法的看跌期权价格，以远期价格为单位"""
+        coef, valid = cls._cos_put_coef(moneyness, a, b, weighted_phi.size)
+        put = (coef @ weighted_phi).real
+        return np.where(valid, np.maximum(put, 0), 0.)
+
+    @staticmethod
+    def _cos_put_coef(moneyness, a, b, n_terms):
+        """COS方法看跌期权的payoff系数矩阵。y = ln(S_T / K) = X - ln(K / F)的截断区间为[a - ln(K/F), b - ln(K/F)]，
+        区间平移不改变特征函数部分φ(u_k)exp(-i u_k a)，每个行权价只需计算payoff (1 - e^y)^+在[a', min(0, b')]上的余弦系数
+        Args:
+            moneyness: np.ndarray，(n,)的K / F
+            a, b: float，X的截断区间
+            n_terms: int，余弦展开项数
+        Returns: (coef, valid)，(n, n_terms)的系数矩阵(已乘K/F)，以远期价格为单位的看跌价格为Re(coef @ 加权特征函数值)；
+                 valid为(n,)的bool数组，行权价低于截断区间时看跌价格为0
+        """
+        log_m = np.log(moneyness)[:, np.newaxis]
+        lower = a - log_m  # 每个行权价的截断区间下限a'
+        upper = np.minimum(0., b - log_m)
+        u = np.arange(n_terms) * np.pi / (b - a)
+        # chi_k = ∫ e^y cos(u_k (y - a')) dy，psi_k = ∫ cos(u_k (y - a')) dy，积分区间为[a', upper]
+        angle = u * (upper - lower)
+        chi = (np.cos(angle) * np.exp(upper) - np.exp(lower) + u * np.sin(angle) * np.exp(upper)) / (1 + u ** 2)
+        psi = np.empty_like(chi)
+        psi[:, 0] = (upper - lower)[:, 0]
+        psi[:, 1:] = np.sin(angle[:, 1:]) / u[1:]
+        coef = 2 / (b - a) * (psi - chi) * moneyness[:, np.newaxis]  # 以远期价格为单位: K/F × E[(1 - e^y)^+]
+        return coef, upper[:, 0] > lower[:, 0]
+
+    def _fft_calls(self, tau, params):
+        """Carr-Madan快速傅里叶变换，计算对数行权价网格k_j上以远期价格为单位的未折现看涨价格E[(X - e^k)^+]，Simpson积分权重
+        Returns: tuple，(对数行权价的三次样条,)，网格步长为2π / (fft_n × fft_eta)，线性插值的误差与步长的平方同阶，三次样条可忽略"""
+        n, eta, alpha = self.fft_n, self.fft_eta, self.fft_alpha
+        lam = 2 * np.pi / (n * eta)
+        v = np.arange(n) * eta
+        log_strikes = -0.5 * n * lam + lam * np.arange(n)
+        psi = (heston_log_char_fn(v - (alpha + 1) * 1j, tau, *params)
+               / (alpha ** 2 + alpha - v ** 2 + 1j * (2 * alpha + 1) * v))
+        simpson = (3 + (-1) ** np.arange(1, n + 1)) / 3
+        simpson[0] = 1 / 3
+        integrand = np.exp(1j * v * 0.5 * n * lam) * psi * eta * simpson
+        calls = np.exp(-alpha * log_strikes) / np.pi * np.fft.fft(integrand).real
+        return (CubicSpline(log_strikes, calls),)
+
+
+class AnalyticHestonFourierEngine(AnalyticEngine):
+    """Heston模型傅里叶定价引擎(COS或Carr-Madan FFT)，与半闭式解AnalyticHestonVanillaEngine结果一致，
+    可由price_grid一次计算整个行权价×到期日网格的价格，特征函数按到期时间与参数缓存，见HestonFourierPricer"""
+
+    def __init__(self, stoch_process: StochProcessBase, *, method=FourierMethod.COS, n_terms=256, truncation=12.,
+                 fft_n=4096, fft_eta=0.25, fft_alpha=1.5, cache_size=256):
+        """
+        初始化Heston傅里叶定价引擎
+        Args:
+            stoch_process: HestonProcess随机过程
+            method: FourierMethod枚举类，COS(默认)为余弦展开法；FFT为Carr-Madan快速傅里叶变换
+            其余参数见HestonFourierPricer
+        """
+        assert stoch_process.process_type == ProcessType.Heston, "Error: Heston傅里叶定价引擎只能使用HestonProcess随机过程"
+        super().__init__(stoch_process)
+        self.pricer = HestonFourierPricer(method=method, n_terms=n_terms, truncation=truncation, fft_n=fft_n,
+                                          fft_eta=fft_eta, fft_alpha=fft_alpha, cache_size=cache_size)
+        # 以下属性指向需要定价的产品，由calc_present_value方法设置
+        self.prod = None
+
+    def calc_present_value(self, prod, t=None, spot=None):
+        """计算现值
+        Args:
+            prod: Product产品对象
+            t: datetime.date，估值日; 如果是None，则使用全局估值日globalEvaluationDate
+            spot: float，估值日标的价格，如果是None，则使用随机过程的当前价格
+        Returns: float，现值
+        """
+        assert prod.exercise_type == ExerciseType.European, "Error: 欧式期权的行权类型只能是European"
+        self.prod = prod
+        calculate_date = global_evaluation_date() if t is None else t
+        tau = (prod.end_date - calculate_date).days / prod.annual_days.value
+        return float(self.price_grid(prod.strike, tau, prod.callput, spot))
+
+    def price_grid(self, strikes, maturities, callput=CallPut.Call, spot=None):
+        """批量计算欧式期权价格，用随机过程当前的利率、分红率与Heston参数
+        Args:
+            strikes: float或np.ndarray，行权价
+            maturities: float或np.ndarray，到期时间(年化)，与strikes广播
+            callput: CallPut枚举类或其数组，看涨/看跌
+            spot: float，标的价格，如果是None，则使用随机过程的当前价格
+        Returns: np.ndarray，期权价格
+        """
+        if spot is None:
+            spot = self.process.spot()
+        maturities = np.asarray(maturities, dtype=np.float64)
+        process = self.process
+        return self.pricer.prices(strikes, maturities, spot, process.interest(maturities), process.div(maturities),
+                                  process.v0, process.var_theta, process.var_kappa, process.var_vol, process.var_rho,
+                                  callput)
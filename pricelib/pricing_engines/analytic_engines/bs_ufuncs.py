@@ -0,0 +1,191 @@
+#!/user/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2024 Galaxy Technologies
+Licensed under the Apache License, Version 2.0
+"""
+import sys
+import math
+from numba import njit, vectorize
+
+# BSM公式的numpy通用函数(ufunc)，输入可以是任意形状、可相互广播的数组，逐元素在编译代码中计算，适合批量处理大量报价。
+# 参数顺序与bs_formula一致: spot标的价格, strike行权价, tau到期时间(年化), r无风险利率, q分红融券率, vol波动率,
+# sign认购为1、认沽为-1。希腊字母均为未缩放的偏导数(vega、rho未除以100)。
+_SIGNATURE = ["float64(float64, float64, float64, float64, float64, float64, float64)"]
+_SQRT2 = math.sqrt(2.)
+_SQRT2PI = math.sqrt(2 * math.pi)
+_TINY = sys.float_info.min  # 最小的规格化浮点数
+
+
+@njit(cache=True, fastmath=False)
+def _norm_cdf(x):
+    """标准正态分布的累积分布函数，由erfc计算，左尾无相消误差"""
+    return 0.5 * math.erfc(-x / _SQRT2)
+
+
+@njit(cache=True, fastmath=False)
+def _norm_pdf(x):
+    """标准正态分布的概率密度函数"""
+    return math.exp(-0.5 * x * x) / _SQRT2PI
+
+
+@njit(cache=True, fastmath=False)
+def _d1(spot, strike, tau, r, q, vol):
+    """BSM公式中的d1"""
+    return (math.log(spot / strike) + (r - q + 0.5 * vol * vol) * tau) / (vol * math.sqrt(tau))
+
+
+@vectorize(_SIGNATURE, cache=True)
+def bs_price(spot, strike, tau, r, q, vol, sign):
+    """欧式期权BSM价格，到期(tau <= 0)或波动率为0时返回(远期)内在价值的折现"""
+    if tau <= 0:
+        return max(sign * (spot - strike), 0.)
+    if vol <= 0:
+        return max(sign * (spot * math.exp(-q * tau) - strike * math.exp(-r * tau)), 0.)
+    d1 = _d1(spot, strike, tau, r, q, vol)
+    d2 = d1 - vol * math.sqrt(tau)
+    return sign * (spot * math.exp(-q * tau) * _norm_cdf(sign * d1)
+                   - strike * math.exp(-r * tau) * _norm_cdf(sign * d2))
+
+
+@vectorize(_SIGNATURE, cache=True)
+def bs_delta(spot, strike, tau, r, q, vol, sign):
+    """∂V/∂S"""
+    if tau <= 0 or vol <= 0:
+        return 0.
+    return sign * math.exp(-q * tau) * _norm_cdf(sign * _d1(spot, strike, tau, r, q, vol))
+
+
+@vectorize(_SIGNATURE, cache=True)
+def bs_gamma(spot, strike, tau, r, q, vol, sign):
+    """∂2V/∂S2，与认购认沽无关"""
+    if tau <= 0 or vol <= 0:
+        return 0.
+    return math.exp(-q * tau) * _norm_pdf(_d1(spot, strike, tau, r, q, vol)) / (spot * vol * math.sqrt(tau))
+
+
+@vectorize(_SIGNATURE, cache=True)
+def bs_vega(spot, strike, tau, r, q, vol, sign):
+    """∂V/∂σ，与认购认沽无关"""
+    if tau <= 0 or vol <= 0:
+        return 0.
+    return spot * math.exp(-q * tau) * _norm_pdf(_d1(spot, strike, tau, r, q, vol)) * math.sqrt(tau)
+
+
+@vectorize(_SIGNATURE, cache=True)
+def bs_theta(spot, strike, tau, r, q, vol, sign):
+    """∂V/∂t = -∂V/∂tau，每年的时间价值变化"""
+    if tau <= 0 or vol <= 0:
+        return 0.
+    d1 = _d1(spot, strike, tau, r, q, vol)
+    d2 = d1 - vol * math.sqrt(tau)
+    return (-spot * math.exp(-q * tau) * _norm_pdf(d1) * vol / (2 * math.sqrt(tau))
+            + sign * q * spot * math.exp(-q * tau) * _norm_cdf(sign * d1)
+            - sign * r * strike * math.exp(-r * tau) * _norm_cdf(sign * d2))
+
+
+@vectorize(_SIGNATURE, cache=True)
+def bs_rho(spot, strike, tau, r, q, vol, sign):
+    """∂V/∂r"""
+    if tau <= 0 or vol <= 0:
+        return 0.
+    d2 = _d1(spot, strike, tau, r, q, vol) - vol * math.sqrt(tau)
+    return sign * strike * tau * math.exp(-r * tau) * _norm_cdf(sign * d2)
+
+
+@njit(cache=True, fastmath=False)
+def _normalized_call(x, s):
+    """标准化的虚值认购期权价格 b(x, s) = e^{x/2} Φ(x/s + s/2) - e^{-x/2} Φ(x/s - s/2)，x = ln(F/K) <= 0，s = σ√τ"""
+    return math.exp(0.5 * x) * _norm_cdf(x / s + 0.5 * s) - math.exp(-0.5 * x) * _norm_cdf(x / s - 0.5 * s)
+
+
+@njit(cache=True, fastmath=False)
+def _normalized_call_complement(x, s):
+    """e^{x/2} - b(x, s) = e^{x/2} Φ(-x/s - s/2) + e^{-x/2} Φ(x/s - s/2)，两项都为正，波动率很大时没有相消误差"""
+    return math.exp(0.5 * x) * _norm_cdf(-x / s - 0.5 * s) + math.exp(-0.5 * x) * _norm_cdf(x / s - 0.5 * s)
+
+
+@njit(cache=True, fastmath=False)
+def _normalized_implied_vol(beta, x):
+    """由标准化的虚值认购期权价格beta反解总波动率s = σ√τ，x = ln(F/K) <= 0，0 < beta < e^{x/2}
+    参照Jäckel(2015) "Let's Be Rational"的分段思路: 以拐点s_c = sqrt(2|x|)为界，
+        低价区间(beta <= b(x, s_c))的目标函数为1/ln beta - 1/ln b(s)，s较小时ln b ≈ -x²/(2s²)，目标函数近似为s的二次函数，
+        深度虚值、价格极小时仍然光滑，初值取渐近解|x| / sqrt(-2 ln beta)；
+        高价区间的目标函数为ln(e^{x/2} - b(s)) - ln(e^{x/2} - beta)，波动率很大、价格接近上限时仍接近线性；
+    从拐点出发做Halley迭代(∂²b/∂s² = ∂b/∂s × (x²/s³ - s/4)，三阶收敛)，并维护包含根的区间，迭代步越界时改为二分，保证收敛"""
+    s_c = math.sqrt(2 * abs(x))
+    b_c = _normalized_call(x, s_c) if s_c > 0 else 0.
+    low = beta <= b_c
+    if low:
+        lo, hi, target = 0., s_c, math.log(beta)
+    else:
+        lo, hi, target = s_c, math.inf, math.log(math.exp(0.5 * x) - beta)
+    if low:
+        s = min(s_c, abs(x) / math.sqrt(-2 * target))
+    else:
+        s = s_c if s_c > 0 else beta * _SQRT2PI  # 平值期权从Brenner-Subrahmanyam近似出发
+    for _ in range(100):
+        vega = math.exp(0.5 * x) * _norm_pdf(x / s + 0.5 * s)  # ∂b/∂s
+        volga = vega * (x * x / (s * s * s) - 0.25 * s)  # ∂²b/∂s²
+        newton = True  # 导数是否可靠
+        if low:  # f = 1/ln beta - 1/ln b，ln b < 0
+            b = _normalized_call(x, s)
+            # 先截断到最小的规格化数再取对数、做除法，编译器提前计算未选中的分支时也不会产生inf、nan
+            b_safe = max(b, _TINY)
+            log_b, dlog_b = math.log(b_safe), vega / b_safe
+            d2log_b = volga / b_safe - dlog_b * dlog_b
+            f, df = 1 / target - 1 / log_b, dlog_b / log_b ** 2
+            d2f = d2log_b / log_b ** 2 - 2 * dlog_b ** 2 / log_b ** 3
+            if b < _TINY:  # b下溢为非规格化数时导数不可靠，只用于维护区间
+                f, df, d2f, newton = -1. if b < beta else 1., 1., 0., False
+        else:  # f = ln(e^{x/2} - beta) - ln(e^{x/2} - b)
+            c = max(_normalized_call_complement(x, s), _TINY)
+            f, df = target - math.log(c), vega / c
+            d2f = volga / c + df * df
+        if f < 0:
+            lo = s
+        else:
+            hi = s
+        if newton and df > 0:
+            step = f / df
+            if abs(step * d2f / (2 * df)) < 0.5:  # Halley修正，修正量过大时保留牛顿步
+                step /= 1 - step * d2f / (2 * df)
+            if abs(step) <= 1e-14 * s:
+                return s - step
+            s_new = s - step
+        else:
+            s_new = lo
+        if not lo < s_new < hi:  # 牛顿步越界，改为二分；上界为无穷时向右倍增
+            s_new = 0.5 * (lo + hi) if math.isfinite(hi) else 2 * max(s, lo, 1e-3)
+            if s_new == s:
+                return s
+        s = s_new
+    return s
+
+
+@vectorize(_SIGNATURE, cache=True)
+def bs_implied_vol(price, spot, strike, tau, r, q, sign):
+    """由欧式期权价格反解BSM隐含波动率
+    先转化为标准化的虚值认购期权价格: F = S e^{(r-q)τ}，x = ln(F/K)，beta = 价格 / (e^{-rτ} sqrt(FK))，
+    实值期权减去内在价值后由看涨看跌平价化为虚值期权，认沽期权由对称性b_put(x) = b_call(-x)化为认购期权，
+    见_normalized_implied_vol。
+    价格低于内在价值或不低于价格上限时(无套利区间之外)返回nan；等于内在价值(相差浮点舍入误差以内)时时间价值为0，返回0
+    Args:
+        price: 期权价格
+        其余参数见bs_price
+    Returns: 隐含波动率
+    """
+    if tau <= 0 or spot <= 0 or strike <= 0 or not math.isfinite(price):
+        return math.nan
+    disc = math.exp(-r * tau)
+    forward = spot * math.exp((r - q) * tau)
+    x = math.log(forward / strike)
+    beta = price / (disc * math.sqrt(forward * strike))
+    intrinsic = max(sign * (math.exp(0.5 * x) - math.exp(-0.5 * x)), 0.)
+    upper = math.exp(0.5 * sign * x)
+    if beta < intrinsic - 1e-13 * max(intrinsic, 1.) or beta >= upper:
+        return math.nan
+    beta -= intrinsic  # 化为虚值期权
+    if beta <= 0:
+        return 0.
+    return _normalized_implied_vol(beta, -abs(x)) / math.sqrt(tau)
@@ -0,0 +1,128 @@
+#!/user/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2024 Galaxy Technologies
+Licensed under the Apache License, Version 2.0
+"""
+import time
+import numpy as np
+from scipy.optimize import least_squares
+from pricelib.common.utilities.enums import CallPut, ProcessType, FourierMethod
+from pricelib.common.processes import StochProcessBase
+from .analytic_heston_fourier_engine import HestonFourierPricer
+
+
+class HestonCalibrationResult:
+    """Heston参数校准结果，包括参数、拟合诊断与耗时"""
+
+    def __init__(self, params, initial, success, message, quotes, model_prices, n_fev, n_jev, elapsed, pricing_time):
+        """构造函数
+        Args:
+            params: dict，校准得到的Heston参数{v0, var_theta, var_kappa, var_vol, var_rho}
+            initial: dict，优化的初始参数
+            success: bool，优化是否收敛
+            message: str，优化器的终止信息
+            quotes: pd.DataFrame，参与校准的报价
+            model_prices: np.ndarray，校准参数下各报价的模型价格
+            n_fev: int，残差函数的计算次数
+            n_jev: int，雅可比矩阵的计算次数
+            elapsed: float，校准总耗时(秒)
+            pricing_time: float，其中批量定价与雅可比矩阵的耗时(秒)
+        """
+        self.params = params
+        self.initial = initial
+        self.success = success
+        self.message = message
+        self.n_fev = n_fev
+        self.n_jev = n_jev
+        self.elapsed = elapsed
+        self.pricing_time = pricing_time
+        self.fit = quotes.assign(model=model_prices, error=model_prices - quotes['close'].values)
+        self.rmse = float(np.sqrt(np.mean(self.fit['error'].values ** 2)))  # 价格误差的均方根
+        self.max_abs_error = float(np.max(np.abs(self.fit['error'].values)))  # 价格误差绝对值的最大值
+        self.feller = 2 * params['var_kappa'] * params['var_theta'] >= params['var_vol'] ** 2  # 是否满足Feller条件
+
+    def __repr__(self):
+        params = ", ".join(f"{name}={value:.6g}" for name, value in self.params.items())
+        return (f"HestonCalibrationResult({params}, rmse={self.rmse:.6g}, max_abs_error={self.max_abs_error:.6g}, "
+                f"success={self.success}, n_fev={self.n_fev}, elapsed={self.elapsed:.3f}s)")
+
+
+class HestonCalibrator:
+    """Heston模型参数校准，用COS方法批量计算全部报价的模型价格，最小化加权价格误差的平方和
+    优化器为scipy.optimize.least_squares(信赖域反射法，支持参数上下界)，雅可比矩阵由特征函数对参数的解析导数得到，
+    同一组参数的残差与雅可比矩阵只计算一次；初始参数默认取随机过程当前的参数，逐日校准时即为前一日的校准结果(热启动)，
+    校准成功后写回随机过程，随机过程的观察者(定价引擎)自动收到参数变化的通知"""
+    param_names = ("v0", "var_theta", "var_kappa", "var_vol", "var_rho")
+    default_bounds = ((1e-4, 1e-4, 1e-2, 1e-2, -0.999), (1., 1., 20., 5., 0.999))
+
+    def __init__(self, stoch_process: StochProcessBase, *, pricer=None, bounds=None):
+        """构造函数
+        Args:
+            stoch_process: HestonProcess随机过程，提供标的价格、无风险利率、分红率与初始参数
+            pricer: HestonFourierPricer，批量定价器，需为COS方法，默认None为新建一个
+            bounds: tuple，(下界, 上界)，各为长度5的参数上下界，顺序同param_names，默认None为default_bounds
+        """
+        assert stoch_process.process_type == ProcessType.Heston, "Error: Heston参数校准只能使用HestonProcess随机过程"
+        if pricer is None:
+            pricer = HestonFourierPricer(method=FourierMethod.COS, n_terms=128, cache_size=64)
+        elif pricer.method != FourierMethod.COS:
+            raise ValueError(f"Heston参数校准的批量定价器应为FourierMethod.COS，当前为{pricer.method}")
+        self.process = stoch_process
+        self.pricer = pricer
+        self.bounds = self.default_bounds if bounds is None else bounds
+        self._last = None  # 最近一次计算的(参数, 价格, 雅可比矩阵)
+        self._pricing_time = 0.
+
+    def calibrate(self, quotes, weights=None, initial=None, update_process=True, max_nfev=200, tol=1e-10):
+        """校准Heston参数
+        Args:
+            quotes: pd.DataFrame，期权报价，列为type('call'/'put')、maturity(年化到期时间)、strike、close(价格)，
+                    格式同tests/resources/mkt_vanilla_price.csv
+            weights: np.ndarray，各报价残差的权重，默认None为等权
+            initial: dict，初始参数，默认None为随机过程当前的参数(热启动)；初始参数超出上下界时截断到边界内
+            update_process: bool，校准成功后是否将参数写回随机过程
+            max_nfev: int，残差函数的最大计算次数
+            tol: float，least_squares的ftol、xtol、gtol
+        Returns: HestonCalibrationResult，校准结果
+        """
+        start = time.perf_counter()
+        quotes = quotes.reset_index(drop=True)
+        option_type = quotes['type'].str.lower()
+        if not option_type.isin(['call', 'put']).all():
+            raise ValueError("报价的type列只能是'call'或'put'")
+        callput = np.where(option_type == 'call', CallPut.Call, CallPut.Put)
+        maturities = quotes['maturity'].values.astype(np.float64)
+        strikes = quotes['strike'].values.astype(np.float64)
+        market = quotes['close'].values.astype(np.float64)
+        weights = np.ones(market.size) if weights is None else np.asarray(weights, dtype=np.float64)
+        spot = self.process.spot()
+        r, q = self.process.interest(maturities), self.process.div(maturities)
+        lower, upper = np.asarray(self.bounds[0], dtype=np.float64), np.asarray(self.bounds[1], dtype=np.float64)
+        if initial is None:
+            initial = {name: getattr(self.process, name) for name in self.param_names}
+        x0 = np.array([initial[name] for name in self.param_names], dtype=np.float64)
+        x0 = np.clip(x0, lower + 1e-12 * (upper - lower), upper - 1e-12 * (upper - lower))
+        self._last, self._pricing_time = None, 0.
+
+        def evaluate(x):
+            """同一组参数的价格与雅可比矩阵只计算一次"""
+            if self._last is None or not np.array_equal(self._last[0], x):
+                tick = time.perf_counter()
+                prices, jacobian = self.pricer.prices_and_jacobian(strikes, maturities, spot, r, q, *x,
+                                                                   callput=callput)
+                self._pricing_time += time.perf_counter() - tick
+                self._last = (x.copy(), prices, jacobian)
+            return self._last[1], self._last[2]
+
+        solution = least_squares(lambda x: weights * (evaluate(x)[0] - market),
+                                 x0, jac=lambda x: weights[:, np.newaxis] * evaluate(x)[1], bounds=(lower, upper),
+                                 method='trf', x_scale='jac', ftol=tol, xtol=tol, gtol=tol, max_nfev=max_nfev)
+        params = dict(zip(self.param_names, (float(value) for value in solution.x)))
+        if update_process and solution.success:
+            for name, value in params.items():
+                setattr(self.process, name, value)
+        model_prices = evaluate(solution.x)[0]
+        return HestonCalibrationResult(params, dict(zip(self.param_names, (float(value) for value in x0))),
+                                       solution.success, solution.message, quotes, model_prices, solution.nfev,
+                                       solution.njev, time.perf_counter() - start, self._pricing_time)
@@ -6,17 +6,181 @@ Licensed under the Apache License, Version 2.0
 """
 from abc import abstractmethod
 import numpy as np
+from numba import njit
 from scipy.interpolate import interp1d
-from pricelib.common.utilities.enums import StatusType, ExerciseType
+from pricelib.common.utilities.enums import StatusType, ExerciseType, FdmGridType
+from pricelib.common.utilities.numerical import tridiag_lu_solve_batch
 from pricelib.common.pricing_engine_base import FdmEngine, FdmGrid
+from pricelib.common.pricing_engine_base.pde_engine_base import fdm_theta_step, fdm_rannacher_step
 from pricelib.common.time import global_evaluation_date
 
 
+@njit(cache=True, fastmath=True)
+def autocallable_observation(v_knockin, v_not_in, j, out_start, out_itm, out_cash, out_disc, out_weight, itm,
+                             yld_start, yld_add, yld_weight):
+    """敲出(派息)观察日覆盖两个网格的第j列
+        [yld_start, out_start)行: 加上派息yld_add(凤凰)；
+        out_start行及以上(不含上边界行): 替换为敲出payoff (out_itm * itm + out_cash) * out_disc
+        起始行的格点恰好是障碍价时(非均匀网格)，权重为0.5，即取障碍两侧的平均，否则权重为1
+    Args:
+        v_knockin: np.ndarray，已敲入网格的期权价值矩阵
+        v_not_in: np.ndarray，未敲入网格的期权价值矩阵
+        j: int，时间格点
+        out_start: int，敲出的起始行，即大于等于敲出价的第一个价格格点的行号
+        out_itm: float，敲出时虚值call在值部分的系数，雪球为1，凤凰为0
+        out_cash: float，敲出时的本金与票息
+        out_disc: float，敲出payoff从付息日到观察日的折现因子
+        out_weight: float，敲出起始行的敲出payoff权重
+        itm: np.ndarray，虚值call在值部分，长度为内部价格格点数
+        yld_start: int，派息的起始行，即大于等于派息价的第一个价格格点的行号
+        yld_add: float，派息金额
+        yld_weight: float，派息起始行的派息权重
+    Returns: None
+    """
+    for k in range(yld_start, out_start):
+        add = yld_add * yld_weight if k == yld_start else yld_add
+        v_knockin[k, j] += add
+        v_not_in[k, j] += add
+    for k in range(out_start, v_knockin.shape[0] - 1):
+        payoff = (out_itm * itm[k - 1] + out_cash) * out_disc
+        if k == out_start:
+            v_knockin[k, j] = out_weight * payoff + (1 - out_weight) * v_knockin[k, j]
+            v_not_in[k, j] = out_weight * payoff + (1 - out_weight) * v_not_in[k, j]
+        else:
+            v_knockin[k, j] = payoff
+            v_not_in[k, j] = payoff
+
+
+@njit(cache=True, fastmath=True)
+def autocallable_backward_induction(v_knockin, v_not_in, multipliers, pivots, upper, explicit_lower, explicit_diag,
+                                    explicit_upper, theta, dt, lower0, upper_last, smooth_multipliers, smooth_pivots,
+                                    smooth_upper, smooth, obs, out_start, out_itm, out_cash, out_disc, out_weight, itm,
+                                    yld_start, yld_add, yld_weight, in_idx, in_weight):
+    """自动赎回结构已敲入、未敲入两个网格的逆向递推，全部时间步在编译代码中完成
+    每个时间步: 两个网格各递推一步(fdm_theta_step，或Rannacher平滑步fdm_rannacher_step)；
+    敲出观察日覆盖敲出、派息(autocallable_observation)；最后用已敲入网格覆盖未敲入网格敲入价及以下的行，第in_idx行按权重in_weight覆盖
+    Args:
+        v_knockin: np.ndarray，已敲入网格的期权价值矩阵，最后一列为到期payoff，上下边界行已设置，原地写入
+        v_not_in: np.ndarray，未敲入网格的期权价值矩阵，同上
+        multipliers ~ upper_last: FdmGrid.constant_operator返回的算子，见fdm_theta_step
+        smooth_multipliers, smooth_pivots, smooth_upper: FdmGrid.rannacher_operator返回的半步隐式算子
+        smooth: np.ndarray，(t_step,)的bool数组，是否做Rannacher平滑
+        obs: np.ndarray，(t_step,)的bool数组，是否为敲出观察日
+        out_start ~ yld_weight: np.ndarray，(t_step,)的逐时间步敲出、派息参数，见autocallable_observation
+        itm: np.ndarray，虚值call在值部分
+        in_idx: np.ndarray，(t_step,)的逐时间步敲入覆盖的行数-1，即小于等于敲入价的最大价格格点的行号
+        in_weight: np.ndarray，(t_step,)的第in_idx行的敲入权重，格点恰好是敲入价时为0.5
+    Returns: None
+    """
+    for j in range(v_knockin.shape[1] - 2, -1, -1):
+        if smooth[j]:
+            fdm_rannacher_step(v_knockin, j, smooth_multipliers, smooth_pivots, smooth_upper, dt, lower0, upper_last)
+            fdm_rannacher_step(v_not_in, j, smooth_multipliers, smooth_pivots, smooth_upper, dt, lower0, upper_last)
+        else:
+            fdm_theta_step(v_knockin, j, multipliers, pivots, upper, explicit_lower, explicit_diag, explicit_upper,
+                           theta, dt, lower0, upper_last)
+            fdm_theta_step(v_not_in, j, multipliers, pivots, upper, explicit_lower, explicit_diag, explicit_upper,
+                           theta, dt, lower0, upper_last)
+        if obs[j]:
+            autocallable_observation(v_knockin, v_not_in, j, out_start[j], out_itm[j], out_cash[j], out_disc[j],
+                                     out_weight[j], itm, yld_start[j], yld_add[j], yld_weight[j])
+        for k in range(in_idx[j]):
+            v_not_in[k, j] = v_knockin[k, j]
+        k = in_idx[j]
+        v_not_in[k, j] = in_weight[j] * v_knockin[k, j] + (1 - in_weight[j]) * v_not_in[k, j]
+
+
+@njit(cache=True, fastmath=True)
+def autocallable_batch_induction(values, lower, upper_bound, multipliers, pivots, upper, explicit_lower, explicit_diag,
+                                 explicit_upper, theta, dt, lower0, upper_last, smooth_multipliers, smooth_pivots,
+                                 smooth_upper, smooth, obs, out_start, out_itm, out_cash, out_disc, out_weight, itm,
+                                 yld_start, yld_add, yld_weight, in_idx, in_weight):
+    """多个产品共用网格和算子的autocallable_backward_induction，每个产品的已敲入、未敲入价值向量各占values的一列，
+    每个时间步用多右端项的Thomas算法(tridiag_lu_solve_batch)同时求解所有列，再逐列覆盖敲出、派息和敲入。
+    只保留当前时间点的价值向量，内存与时间步数无关
+    Args:
+        values: np.ndarray，(n_s + 2, 2m)的价值矩阵，前m列为m个产品的已敲入网格，后m列为未敲入网格，
+                输入为到期payoff，原地写入估值日的价值
+        lower: np.ndarray，(n_t, 2m)的逐时间点下边界条件，列的顺序与values相同
+        upper_bound: np.ndarray，(n_t, 2m)的逐时间点上边界条件
+        multipliers ~ upper_last: FdmGrid.constant_operator返回的算子，见fdm_theta_step
+        smooth_multipliers, smooth_pivots, smooth_upper: FdmGrid.rannacher_operator返回的半步隐式算子
+        smooth: np.ndarray，(n_t - 1, 2m)的bool数组，每列是否做Rannacher平滑
+        obs ~ in_weight: np.ndarray，(n_t - 1, m)的逐时间步、逐产品的参数，见autocallable_backward_induction
+        itm: np.ndarray，(n_s, m)的各产品的虚值call在值部分
+    Returns: None
+    """
+    n, n_col = pivots.size, values.shape[1]
+    m = n_col // 2
+    v_knockin, v_not_in = values[:, :m], values[:, m:]
+    rhs = np.empty((n, n_col))
+    for j in range(lower.shape[0] - 2, -1, -1):
+        n_smooth = 0
+        for col in range(n_col):
+            if smooth[j, col]:
+                n_smooth += 1
+        # 隐式部分的右端项: 显式算子M2乘以j + 1时点的价值，加上边界条件；Rannacher平滑列取第一个半步的右端项
+        if explicit_diag.size == 0:
+            for i in range(n):
+                for col in range(n_col):
+                    rhs[i, col] = values[i + 1, col]
+        else:
+            for i in range(n):
+                for col in range(n_col):
+                    rhs[i, col] = values[i + 1, col] if smooth[j, col] else explicit_diag[i] * values[i + 1, col]
+            for i in range(n - 1):
+                for col in range(n_col):
+                    if not smooth[j, col]:
+                        rhs[i, col] += explicit_upper[i] * values[i + 2, col]
+                        rhs[i + 1, col] += explicit_lower[i] * values[i + 1, col]
+        for col in range(n_col):
+            if smooth[j, col]:
+                rhs[0, col] += 0.5 * (lower[j, col] + lower[j + 1, col]) * lower0 * 0.5 * dt
+                rhs[n - 1, col] += 0.5 * (upper_bound[j, col] + upper_bound[j + 1, col]) * upper_last * 0.5 * dt
+            else:
+                rhs[0, col] += (theta * lower[j, col] + (1 - theta) * lower[j + 1, col]) * lower0 * dt
+                rhs[n - 1, col] += (theta * upper_bound[j, col] + (1 - theta) * upper_bound[j + 1, col]
+                                    ) * upper_last * dt
+        if n_smooth == 0:
+            tridiag_lu_solve_batch(multipliers, pivots, upper, rhs)
+        else:  # 平滑的列与其余列的算子不同，分别取出求解
+            cols = np.flatnonzero(smooth[j])
+            part = np.ascontiguousarray(rhs[:, cols])
+            for half in range(2):
+                tridiag_lu_solve_batch(smooth_multipliers, smooth_pivots, smooth_upper, part)
+                if half == 0:  # 第二个半步，边界条件取第j列的值
+                    for k in range(cols.size):
+                        part[0, k] += lower[j, cols[k]] * lower0 * 0.5 * dt
+                        part[n - 1, k] += upper_bound[j, cols[k]] * upper_last * 0.5 * dt
+            if n_smooth < n_col:
+                others = np.flatnonzero(~smooth[j])
+                rest = np.ascontiguousarray(rhs[:, others])
+                tridiag_lu_solve_batch(multipliers, pivots, upper, rest)
+                rhs[:, others] = rest
+            rhs[:, cols] = part
+        for col in range(n_col):
+            values[0, col] = lower[j, col]
+            values[n + 1, col] = upper_bound[j, col]
+        for i in range(n):
+            for col in range(n_col):
+                values[i + 1, col] = rhs[i, col]
+        for col in range(m):
+            if obs[j, col]:
+                autocallable_observation(v_knockin, v_not_in, col, out_start[j, col], out_itm[j, col],
+                                         out_cash[j, col], out_disc[j, col], out_weight[j, col], itm[:, col],
+                                         yld_start[j, col], yld_add[j, col], yld_weight[j, col])
+            for k in range(in_idx[j, col]):
+                v_not_in[k, col] = v_knockin[k, col]
+            k = in_idx[j, col]
+            v_not_in[k, col] = in_weight[j, col] * v_knockin[k, col] + (1 - in_weight[j, col]) * v_not_in[k, col]
+
+
 class FdmAutoCallableEngine(FdmEngine):
     """AutoCallable PDE有限差分法定价引擎基类
         雪球/凤凰/FCN/DCN, 支持变敲出、变敲入、变票息等要素可变型结构"""
 
     def __init__(self, stoch_process=None, s_step=800, n_smax=2, fdm_theta=1, *,
+                 grid_type=FdmGridType.Uniform, concentration=0.1, log_space=False, rannacher_steps=0,
                  s=None, r=None, q=None, vol=None):
         """初始化有限差分法定价引擎
         Args:
@@ -24,13 +188,20 @@ class FdmAutoCallableEngine(FdmEngine):
             s_step: int，价格步数
             n_smax: int，价格网格上界，设为n_smax倍初始价格
             fdm_theta: float，时间方向有限差分theta，0：explicit, 1: implicit, 0.5: Crank-Nicolson
+            grid_type: FdmGridType，价格网格类型，默认为均匀网格，见FdmEngine
+            concentration: float，sinh网格的加密程度
+            log_space: bool，是否在对数价格上离散PDE，见FdmEngine
+            rannacher_steps: int，Crank-Nicolson在到期payoff和每个敲出观察日之后的Rannacher平滑步数，见FdmEngine。
+                             每日敲入观察的覆盖不做平滑，否则全部时间步都退化为隐式方法
         在未设置stoch_process时，(stoch_process=None)，会默认创建BSMprocess，需要输入以下变量进行初始化
             s: float，标的价格
             r: float，无风险利率
             q: float，分红/融券率
             vol: float，波动率
         """
-        super().__init__(stoch_process, s_step=s_step, n_smax=n_smax, fdm_theta=fdm_theta, s=s, r=r, q=q, vol=vol)
+        super().__init__(stoch_process, s_step=s_step, n_smax=n_smax, fdm_theta=fdm_theta, grid_type=grid_type,
+                         concentration=concentration, log_space=log_space, rannacher_steps=rannacher_steps,
+                         s=s, r=r, q=q, vol=vol)
         # 计算过程的中间变量
         self.prod = None  # Product产品对象
         self.out_dates = None  # 根据估值日，将敲出观察日转化为List[int]，交易日期限
@@ -42,6 +213,7 @@ class FdmAutoCallableEngine(FdmEngine):
         self.j_vec = None  # 时间格点，List[int]
         self.fd_not_in = None  # 未敲入的有限差分网格FdmGrid对象
         self.fd_knockin = None  # 已敲入的有限差分网格FdmGrid对象
+        self._critical_points = None  # 非均匀网格对齐的关键价格
         self._barrier_in = None  # 是经过估值日截断之后的列表，例如prod.barrier_in有22个，存续一年时估值，self._barrier_in只有12个
         self._barrier_out = None  # 是经过估值日截断之后的列表，例如prod.barrier_out有22个，存续一年时估值，self._barrier_out只有12个
         self.next_paydate = None
@@ -76,22 +248,96 @@ class FdmAutoCallableEngine(FdmEngine):
             spot: float，估值日标的价格，如果是None，则使用随机过程的当前价格
         Returns: float，现值
         """
-        self.prod = prod
         calculate_date = global_evaluation_date() if t is None else t
-        _maturity = (prod.end_date - calculate_date).days / prod.annual_days.value
-        _maturity_business_days = prod.trade_calendar.business_days_between(calculate_date,
-                                                                            prod.end_date) / prod.t_step_per_year
-        obs_dates = prod.obs_dates.count_business_days(calculate_date)
-        obs_dates = np.array([num for num in obs_dates if num >= 0])
-        calculate_start_diff = (calculate_date - prod.start_date).days
-        pay_dates = prod.pay_dates.count_calendar_days(prod.start_date)
-        self.pay_dates = np.array([num / prod.annual_days.value for num in pay_dates if num >= calculate_start_diff])
-        assert len(obs_dates) == len(self.pay_dates), f"Error: {prod}的观察日和付息日长度不一致"
-        self.diff_obs_pay_dates = np.array([(prod.pay_dates.date_schedule[i] - prod.obs_dates.date_schedule[i]).days
-                                            for i in range(len(obs_dates))]) / prod.annual_days.value
         if spot is None:
             spot = self.process.spot()
+        _maturity = self._init_grid(prod, calculate_date, spot, [prod])
+        # 初始化观察日、付息日和到期日payoff价值
+        self._init_product(prod, calculate_date, _maturity)
+
+        if self.t_step == 0:  # 如果估值日是到期日
+            # 直接返回到期日payoff
+            if prod.status == StatusType.DownTouch:
+                result = self.fd_knockin.v_grid[1, 0]
+            else:
+                result = self.fd_not_in.v_grid[1, 0]
+            return np.float64(result)
+
+        # 初始化已敲入、未敲入的边界条件
+        self._init_boundary_condition(self.smax, _maturity)
+
+        # N为时间步数，从倒数第二天向第一天反向递推
+        self._backward_induction()
+
+        if prod.status == StatusType.DownTouch:
+            result = self.fd_knockin.functionize(self.fd_knockin.v_grid[1:-1, 0], kind="cubic")(spot)
+        else:
+            result = self.fd_not_in.functionize(self.fd_not_in.v_grid[1:-1, 0], kind="cubic")(spot)
+        return np.float64(result)
+
+    def calc_batch_present_value(self, prods, t=None, spot=None):
+        """批量计算同一标的、同一期限的多个产品(如票息、敲入敲出价不同的一批雪球)的现值
+        所有产品共用一套价格网格、时间网格和差分算子，只需构建网格、分解系数矩阵一次；
+        各产品的已敲入、未敲入价值向量作为矩阵的列，每个时间步用多右端项的Thomas算法同时求解，再逐列覆盖敲出、派息和敲入，
+        见autocallable_batch_induction。非均匀网格对齐所有产品的关键价格，因此与逐个定价的结果略有差异；
+        均匀网格的结果与逐个调用calc_present_value相同。
+        PDE系数与时间有关或估值日是到期日时，逐个调用calc_present_value
+        Args:
+            prods: List[Product]，产品对象列表，期初价格、到期日、每年交易日数须相同
+            t: datetime.date，估值日; 如果是None，则使用全局估值日globalEvaluationDate
+            spot: float，估值日标的价格，如果是None，则使用随机过程的当前价格
+        Returns: np.ndarray，(len(prods),)的现值
+        """
+        calculate_date = global_evaluation_date() if t is None else t
+        if spot is None:
+            spot = self.process.spot()
+        prod = prods[0]
+        for other in prods[1:]:
+            if (other.s0 != prod.s0 or other.end_date != prod.end_date
+                    or other.t_step_per_year != prod.t_step_per_year or other.annual_days != prod.annual_days):
+                raise ValueError(f'批量定价的产品须有相同的期初价格、到期日和每年交易日数，{other}与{prod}不一致')
+        _maturity = self._init_grid(prod, calculate_date, spot, prods)
+        operator = self.fd_not_in.constant_operator(self.dt)
+        if self.t_step == 0 or operator is None:
+            return np.array([self.calc_present_value(prod, calculate_date, spot) for prod in prods])
+
+        n_prod, n_t = len(prods), self.t_step + 1
+        values = np.empty((self.fd_not_in.v_grid.shape[0], 2 * n_prod))
+        lower, upper = np.empty((n_t, 2 * n_prod)), np.empty((n_t, 2 * n_prod))
+        itm = np.empty((self.fd_not_in.s_vec.size, n_prod))
+        smooth = np.empty((self.t_step, 2 * n_prod), dtype=np.bool_)
+        schedules = []
+        for k, prod in enumerate(prods):
+            self._init_product(prod, calculate_date, _maturity)
+            self._init_boundary_condition(self.smax, _maturity)
+            schedule, itm[:, k] = self._induction_schedule()
+            schedules.append(schedule)
+            smooth[:, k] = smooth[:, n_prod + k] = self._rannacher_schedule(schedule["obs"])
+            for col, fdm_grid in ((k, self.fd_knockin), (n_prod + k, self.fd_not_in)):
+                values[:, col] = fdm_grid.v_grid[:, self.t_step]
+                lower[:, col], upper[:, col] = fdm_grid.v_grid[0, :], fdm_grid.v_grid[-1, :]
+        schedules = {key: np.stack([schedule[key] for schedule in schedules], axis=1) for key in schedules[0]}
+        autocallable_batch_induction(values, lower, upper, *operator, *self.fd_not_in.rannacher_operator(self.dt),
+                                     smooth, **schedules, itm=itm)
+
+        result = np.empty(n_prod)
+        for k, prod in enumerate(prods):
+            col = k if prod.status == StatusType.DownTouch else n_prod + k
+            result[k] = self.fd_not_in.functionize(values[1:-1, col], kind="cubic")(spot)
+        return result
 
+    def _init_grid(self, prod, calculate_date, spot, prods):
+        """初始化时间步数、时间步长，以及已敲入、未敲入两个FdmGrid网格，两个网格的格点相同
+        Args:
+            prod: Product产品对象，确定网格的期限和价格上界
+            calculate_date: datetime.date，估值日
+            spot: float，估值日标的价格
+            prods: List[Product]，非均匀网格对齐这些产品的标的价格、敲入敲出价、派息价和行权价
+        Returns: float，到期时间，年化自然日期限
+        """
+        _maturity = (prod.end_date - calculate_date).days / prod.annual_days.value
+        _maturity_business_days = prod.trade_calendar.business_days_between(calculate_date,
+                                                                            prod.end_date) / prod.t_step_per_year
         # 返回PDE系数组件abc的函数
         fn_pde_coef = self.process.get_fn_pde_coef(_maturity, spot)
 
@@ -106,13 +352,36 @@ class FdmAutoCallableEngine(FdmEngine):
             smin = 0
             self.smax = self.n_smax * prod.s0  # 价格网格上界, 默认为n_smax倍初始价格
 
-        # 初始化已敲入、未敲入的FdmGrid对象
+        # 初始化已敲入、未敲入的FdmGrid对象，两个网格的格点相同。非均匀网格对齐标的价格、敲入敲出价、派息价和行权价
+        grid_kwargs = self._grid_kwargs(spot, *[point for p in prods for point in (
+            p.s0, p.barrier_in, p.barrier_out, p.strike_upper, p.strike_lower, getattr(p, "strike_call", None),
+            getattr(p, "barrier_yield", None))])
+        self._critical_points = grid_kwargs["critical_points"]
         self.fd_not_in = FdmGrid(smax=self.smax, maturity=_maturity_business_days,
                                  t_step_per_year=prod.t_step_per_year, s_step=self.s_step,
-                                 fn_pde_coef=fn_pde_coef, fdm_theta=self.fdm_theta, smin=smin)  # 未敲入
+                                 fn_pde_coef=fn_pde_coef, fdm_theta=self.fdm_theta, smin=smin, **grid_kwargs)  # 未敲入
         self.fd_knockin = FdmGrid(smax=self.smax, maturity=_maturity_business_days,
                                   t_step_per_year=prod.t_step_per_year, s_step=self.s_step,
-                                  fn_pde_coef=fn_pde_coef, fdm_theta=self.fdm_theta, smin=smin)  # 已敲入
+                                  fn_pde_coef=fn_pde_coef, fdm_theta=self.fdm_theta, smin=smin, **grid_kwargs)  # 已敲入
+        return _maturity
+
+    def _init_product(self, prod, calculate_date, maturity):
+        """初始化产品的敲出观察日、付息日，并在两个网格的最后一列写入到期payoff
+        Args:
+            prod: Product产品对象
+            calculate_date: datetime.date，估值日
+            maturity: float, 到期时间，年化自然日期限
+        Returns: None
+        """
+        self.prod = prod
+        obs_dates = prod.obs_dates.count_business_days(calculate_date)
+        obs_dates = np.array([num for num in obs_dates if num >= 0])
+        calculate_start_diff = (calculate_date - prod.start_date).days
+        pay_dates = prod.pay_dates.count_calendar_days(prod.start_date)
+        self.pay_dates = np.array([num / prod.annual_days.value for num in pay_dates if num >= calculate_start_diff])
+        assert len(obs_dates) == len(self.pay_dates), f"Error: {prod}的观察日和付息日长度不一致"
+        self.diff_obs_pay_dates = np.array([(prod.pay_dates.date_schedule[i] - prod.obs_dates.date_schedule[i]).days
+                                            for i in range(len(obs_dates))]) / prod.annual_days.value
 
         # 初始化逆序敲出观察日
         if isinstance(obs_dates, (list, np.ndarray)):  # 敲出观察日是具体第n天数的列表，如[11,22,32,43,53,64]
@@ -125,39 +394,109 @@ class FdmAutoCallableEngine(FdmEngine):
         self.out_dates = out_dates
 
         # 初始化到期日payoff价值
-        self._init_terminal_condition(self.fd_not_in.s_vec, _maturity)
-
-        if self.t_step == 0:  # 如果估值日是到期日
-            # 直接返回到期日payoff
-            if prod.status == StatusType.DownTouch:
-                result = self.fd_knockin.v_grid[1, 0]
-            else:
-                result = self.fd_not_in.v_grid[1, 0]
-            return np.float64(result)
-
-        # 初始化已敲入、未敲入的边界条件
-        self._init_boundary_condition(self.smax, _maturity)
-
-        # N为时间步数，从倒数第二天向第一天反向递推
-        self._backward_induction()
-
-        if prod.status == StatusType.DownTouch:
-            result = self.fd_knockin.functionize(self.fd_knockin.v_grid[1:-1, 0], kind="cubic")(spot)
-        else:
-            result = self.fd_not_in.functionize(self.fd_not_in.v_grid[1:-1, 0], kind="cubic")(spot)
-        return np.float64(result)
+        self._init_terminal_condition(self.fd_not_in.s_vec, maturity)
+        if self.fd_not_in.grid_type != FdmGridType.Uniform:
+            self._average_terminal_condition(maturity, self._critical_points)
 
     @abstractmethod
     def _init_terminal_condition(self, *args, **kwargs):
         """初始化终止条件"""
 
+    def _average_terminal_condition(self, maturity, critical_points):
+        """非均匀网格上恰好是关键价格(敲入价、敲出价、派息价等)的格点，到期payoff取左右极限的平均，与观察日的覆盖方式一致
+        Args:
+            maturity: float, 到期时间，年化自然日期限
+            critical_points: np.ndarray，网格对齐的关键价格
+        Returns: None
+        """
+        s_vec = self.fd_not_in.s_vec
+        on_point = np.isin(s_vec, critical_points)
+        limits = []
+        for side in (-1, 1):  # 价格格点分别向左、向右偏移1e-12(相对值)，得到左、右极限
+            self._init_terminal_condition(s_vec * (1 + side * 1e-12), maturity)
+            limits.append((self.fd_knockin.v_grid[1:-1, self.t_step].copy(),
+                           self.fd_not_in.v_grid[1:-1, self.t_step].copy()))
+        self._init_terminal_condition(s_vec, maturity)  # 恢复由价格格点计算的中间变量
+        for fdm_grid, left, right in zip((self.fd_knockin, self.fd_not_in), *limits):
+            fdm_grid.v_grid[1:-1, self.t_step][on_point] = 0.5 * (left + right)[on_point]
+
     @abstractmethod
     def _init_boundary_condition(self, *args, **kwargs):
         """初始化边界条件"""
 
     @abstractmethod
-    def _backward_induction(self, *args, **kwargs):
-        """反向递推"""
+    def _induction_schedule(self):
+        """逐时间步确定敲出、派息、敲入参数
+        Returns: tuple，(schedule, itm)，即_induction的参数
+        """
+
+    def _backward_induction(self):
+        """从倒数第二天向第一天逆向迭代"""
+        self._induction(*self._induction_schedule())
+
+    def _new_schedule(self):
+        """逐时间步的敲出、派息、敲入参数，默认不观察敲出、不派息、敲入覆盖第0行(边界行)，由子类的_induction_schedule填写
+        Returns: dict，键为_induction的参数名，值为(t_step,)的数组
+        """
+        n_row = self.fd_not_in.s_vec.size + 1
+        return {"obs": np.zeros(self.t_step, dtype=np.bool_), "out_start": np.full(self.t_step, n_row),
+                "out_itm": np.zeros(self.t_step), "out_cash": np.zeros(self.t_step), "out_disc": np.ones(self.t_step),
+                "out_weight": np.ones(self.t_step), "yld_start": np.full(self.t_step, n_row),
+                "yld_add": np.zeros(self.t_step), "yld_weight": np.ones(self.t_step),
+                "in_idx": np.zeros(self.t_step, dtype=np.int64), "in_weight": np.ones(self.t_step)}
+
+    def _row_weight(self, row, barrier):
+        """非均匀网格的障碍价恰好是第row行的格点时，障碍价处的值不连续，该行取障碍两侧的平均，返回权重0.5；否则返回1
+        均匀网格保持原有的覆盖方式
+        Args:
+            row: int，期权价值矩阵的行号，第0行是下边界
+            barrier: float，障碍价
+        Returns: float，权重
+        """
+        s_vec = self.fd_not_in.s_vec
+        if self.fd_not_in.grid_type != FdmGridType.Uniform and 0 < row <= s_vec.size and s_vec[row - 1] == barrier:
+            return 0.5
+        return 1.
+
+    def _rannacher_schedule(self, obs):
+        """逐时间步是否做Rannacher平滑: Crank-Nicolson(fdm_theta < 1)时，到期日和每个敲出观察日之后(逆向递推)的rannacher_steps步
+        Args:
+            obs: np.ndarray，(t_step,)的bool数组，是否为敲出观察日
+        Returns: np.ndarray，(t_step,)的bool数组
+        """
+        smooth = np.zeros(self.t_step, dtype=np.bool_)
+        if self.fdm_theta < 1:
+            for start in np.concatenate(([self.t_step], np.flatnonzero(obs))):
+                smooth[max(start - self.rannacher_steps, 0):start] = True
+        return smooth
+
+    def _induction(self, schedule, itm):
+        """按逐时间步的敲出、派息、敲入参数逆向递推两个网格
+        PDE系数与时间无关(常数波动率、常数利率)时，由autocallable_backward_induction在编译代码中完成全部时间步；
+        否则逐步调用FdmGrid.evolve，观察日覆盖与编译版本相同
+        Args:
+            schedule: dict，_new_schedule返回并由子类填写的逐时间步参数
+            itm: np.ndarray，虚值call在值部分，长度为内部价格格点数
+        Returns: None
+        """
+        v_knockin, v_not_in = self.fd_knockin.v_grid, self.fd_not_in.v_grid
+        itm = np.ascontiguousarray(itm, dtype=np.float64)
+        smooth = self._rannacher_schedule(schedule["obs"])
+        operator = self.fd_not_in.constant_operator(self.dt)
+        if operator is not None:
+            autocallable_backward_induction(v_knockin, v_not_in, *operator, *self.fd_not_in.rannacher_operator(self.dt),
+                                            smooth, **schedule, itm=itm)
+            return
+        for j in range(self.t_step - 1, -1, -1):
+            v_knockin[1:-1, j] = self.fd_knockin.evolve(j, v_knockin[1:-1, j + 1], self.dt, rannacher=smooth[j])
+            v_not_in[1:-1, j] = self.fd_not_in.evolve(j, v_not_in[1:-1, j + 1], self.dt, rannacher=smooth[j])
+            if schedule["obs"][j]:
+                autocallable_observation(v_knockin, v_not_in, j, *(schedule[key][j] for key in (
+                    "out_start", "out_itm", "out_cash", "out_disc", "out_weight")), itm,
+                                         *(schedule[key][j] for key in ("yld_start", "yld_add", "yld_weight")))
+            in_idx, in_weight = schedule["in_idx"][j], schedule["in_weight"][j]
+            v_not_in[:in_idx, j] = v_knockin[:in_idx, j]
+            v_not_in[in_idx, j] = in_weight * v_knockin[in_idx, j] + (1 - in_weight) * v_not_in[in_idx, j]
 
     def delta(self, prod, t=0, spot=None, step=None, status: StatusType = None):
         """求t时刻，价格spot的delta值,
@@ -293,8 +632,8 @@ class FdmAutoCallableEngine(FdmEngine):
         status = self.prod.status if status is None else status
         fdm_grid = self.fd_knockin if (status == StatusType.DownTouch) else self.fd_not_in
         if step == 0:
-            # 默认PDE模拟时的步长 step = fdm_grid.ds
-            delta_s_t = (fdm_grid.v_grid[2:] - fdm_grid.v_grid[:-2]) / (2 * fdm_grid.ds)
+            # 默认PDE模拟时的步长 step = fdm_grid.ds，非均匀网格使用网格的差分格式
+            delta_s_t = fdm_grid.derivative(fdm_grid.v_grid, order=1)
             return delta_s_t, fdm_grid.s_vec  # 中心差分，价格向量掐头0去尾smax，正好是fdm_grid.s_vec
         else:
             # 重新定义步长，在模拟矩阵的基础上插值
@@ -321,7 +660,7 @@ class FdmAutoCallableEngine(FdmEngine):
         fdm_grid = self.fd_knockin if (status == StatusType.DownTouch) else self.fd_not_in
         if step == 0:
             # 默认PDE模拟时的步长 step = fdm_grid.ds
-            gamma_s_t = np.diff(fdm_grid.v_grid, n=2, axis=0) / fdm_grid.ds ** 2
+            gamma_s_t = fdm_grid.derivative(fdm_grid.v_grid, order=2)
             return gamma_s_t, fdm_grid.s_vec
         else:
             # 重新定义步长，在模拟矩阵的基础上插值
@@ -494,8 +833,8 @@ class FdmSnowBallEngine(FdmAutoCallableEngine):
                                                           (prod.margin_lvl + self.next_coupon_out * coupon_t) * prod.s0,
                                                           (prod.margin_lvl + prod.coupon_div * coupon_t) * prod.s0)))
 
-    def _backward_induction(self):
-        """从倒数第二天向第一天逆向迭代"""
+    def _induction_schedule(self):
+        """逐时间步确定敲出、派息、敲入参数，见FdmAutoCallableEngine._induction_schedule"""
         prod = self.prod
         self.next_diff_obspaydate = self.diff_obs_pay_dates.repeat(
             np.diff(np.append(np.zeros((1,)), self.out_dates[::-1])).astype(int))  # 计息时间数
@@ -505,37 +844,41 @@ class FdmSnowBallEngine(FdmAutoCallableEngine):
         if prod.in_obs_type == ExerciseType.European:  # 敲入观察为欧式，仅到期观察敲入
             self.next_barrier_in = -1
             self.in_idx = 0
+        # 逐时间步确定敲出、敲入参数，由_induction逆向递推两个网格
+        s_vec = self.fd_not_in.s_vec
+        schedule = self._new_schedule()
+        out_dates = set(self.out_dates.tolist())
         for j in range(self.t_step - 1, -1, -1):
-            self.fd_knockin.v_grid[1:-1, j] = self.fd_knockin.evolve(j, self.fd_knockin.v_grid[1:-1, j + 1], self.dt)
-            self.fd_not_in.v_grid[1:-1, j] = self.fd_not_in.evolve(j, self.fd_not_in.v_grid[1:-1, j + 1], self.dt)
-
             # 考虑敲出的情况: 敲出观察日边界条件需更改
-            if j in self.out_dates:
+            if j in out_dates:
                 coupon_t = 1 if prod.trigger else self.next_paydate[j]
                 # 如果敲出价是浮动的，调整敲出价
                 self.next_barrier_out = (self.reversed_barrier_out[np.where(self.out_dates == j)[0][0]]
                                          if isinstance(prod.barrier_out, (list, np.ndarray)) else prod.barrier_out)
-                self.out_idxs = 1 + np.array(np.where(self.fd_not_in.s_vec >= self.next_barrier_out)[0])
+                self.out_idxs = 1 + np.array(np.where(s_vec >= self.next_barrier_out)[0])
                 # 如果敲出票息是浮动的，调整敲出票息
                 self.next_coupon_out = (self.reversed_coupon_out[np.where(self.out_dates == j)[0][0]]
                                         if isinstance(prod.coupon_out, (list, np.ndarray)) else prod.coupon_out)
-                # 发生敲出的payoff
-                knock_out_payoff = (self.itm[self.out_idxs - 1] + (
-                        prod.margin_lvl + self.next_coupon_out * coupon_t) * prod.s0
-                                    ) * self.process.interest.disc_factor(self.next_paydate[j], self.next_paydate[j] -
-                                                                          self.next_diff_obspaydate[j])
-                # 用knock_out_payoff覆盖敲出价上方的衍生品价值
-                self.fd_not_in.v_grid[self.out_idxs, j] = self.fd_knockin.v_grid[self.out_idxs, j] = knock_out_payoff
+                # 发生敲出的payoff = (虚值call在值部分 + 本金票息) * 折现，覆盖敲出价上方的衍生品价值
+                schedule["obs"][j] = True
+                schedule["out_start"][j] = 1 + np.searchsorted(s_vec, self.next_barrier_out, side='left')
+                schedule["out_weight"][j] = self._row_weight(schedule["out_start"][j], self.next_barrier_out)
+                schedule["out_itm"][j] = 1
+                schedule["out_cash"][j] = (prod.margin_lvl + self.next_coupon_out * coupon_t) * prod.s0
+                schedule["out_disc"][j] = self.process.interest.disc_factor(
+                    self.next_paydate[j], self.next_paydate[j] - self.next_diff_obspaydate[j])
 
                 if prod.in_obs_type != ExerciseType.European:
                     # 如果敲入价是浮动的，调整敲入价
                     self.next_barrier_in = self.reversed_barrier_in[np.where(self.out_dates == j)[0][0]] if isinstance(
                         prod.barrier_in, (list, np.ndarray)) else prod.barrier_in
-                    self.in_idx = 1 + np.where(self.fd_not_in.s_vec <= self.next_barrier_in)[0][
+                    self.in_idx = 1 + np.where(s_vec <= self.next_barrier_in)[0][
                         -1] if self.next_barrier_in > 0 else 0
 
             # 考虑敲入的情况: 向下越过敲入边界时，下一时间点敲入边界以上部分是标准autocall价格
-            self.fd_not_in.v_grid[:(self.in_idx + 1), j] = self.fd_knockin.v_grid[:(self.in_idx + 1), j]
+            schedule["in_idx"][j] = self.in_idx
+            schedule["in_weight"][j] = self._row_weight(self.in_idx, self.next_barrier_in)
+        return schedule, self.itm
 
 
 class FdmPhoenixEngine(FdmAutoCallableEngine):
@@ -681,46 +1024,51 @@ class FdmPhoenixEngine(FdmAutoCallableEngine):
                                                                       prod.strike_lower) - prod.strike_upper) *
                                                             prod.parti_in) + prod.margin_lvl * prod.s0
 
-    def _backward_induction(self):
-        """从倒数第二天向第一天逆向迭代"""
+    def _induction_schedule(self):
+        """逐时间步确定敲出、派息、敲入参数，见FdmAutoCallableEngine._induction_schedule"""
         prod = self.prod
         if prod.in_obs_type == ExerciseType.European:  # 敲入观察为欧式，仅到期观察敲入
             self.next_barrier_in = -1
             self.in_idx = 0
+        # 逐时间步确定敲出、派息、敲入参数，由_induction逆向递推两个网格
+        s_vec = self.fd_not_in.s_vec
+        schedule = self._new_schedule()
+        out_dates = set(self.out_dates.tolist())
         for j in range(self.t_step - 1, -1, -1):
-            self.fd_knockin.v_grid[1:-1, j] = self.fd_knockin.evolve(j, self.fd_knockin.v_grid[1:-1, j + 1], self.dt)
-            self.fd_not_in.v_grid[1:-1, j] = self.fd_not_in.evolve(j, self.fd_not_in.v_grid[1:-1, j + 1], self.dt)
-
             # 考虑敲出的情况: 敲出观察日边界条件需更改
-            if j in self.out_dates:
+            if j in out_dates:
 
                 # 如果敲出价是浮动的，调整敲出价
                 self.next_barrier_out = (self.reversed_barrier_out[np.where(self.out_dates == j)[0][0]]
                                          if isinstance(prod.barrier_out, (list, np.ndarray)) else prod.barrier_out)
-                self.out_idxs = 1 + np.array(np.where(self.fd_not_in.s_vec >= self.next_barrier_out)[0])
+                self.out_idxs = 1 + np.array(np.where(s_vec >= self.next_barrier_out)[0])
                 # 如果派息边界是浮动的，调整派息边界
                 self.next_barrier_yield = (self.reversed_barrier_yield[np.where(self.out_dates == j)[0][0]]
                                            if isinstance(prod.barrier_yield,
                                                          (list, np.ndarray)) else prod.barrier_yield)
-                self.yld_idxs = 1 + np.array(np.where(self.fd_not_in.s_vec >= self.next_barrier_yield)[0])
+                self.yld_idxs = 1 + np.array(np.where(s_vec >= self.next_barrier_yield)[0])
                 # 如果敲出票息是浮动的，调整敲出票息
                 self.next_coupon = (self.reversed_coupon[np.where(self.out_dates == j)[0][0]]
                                     if isinstance(prod.coupon, (list, np.ndarray)) else prod.coupon)
-                # 在票息边界和敲出边界之间，无敲入phoenix的价格为亏损贴现加上票息
-                margin_s = prod.margin_lvl * prod.s0
-                self.fd_knockin.v_grid[self.yld_idxs, j] = (self.next_coupon * prod.s0 + np.where(
-                    self.fd_not_in.s_vec[self.yld_idxs - 1] < self.next_barrier_out,
-                    self.fd_knockin.v_grid[self.yld_idxs, j], margin_s))
-                self.fd_not_in.v_grid[self.yld_idxs, j] = (self.next_coupon * prod.s0 + np.where(
-                    self.fd_not_in.s_vec[self.yld_idxs - 1] < self.next_barrier_out,
-                    self.fd_not_in.v_grid[self.yld_idxs, j], margin_s))
+                # 派息价上方: 在派息价和敲出价之间，价格加上票息；敲出价上方(且在派息价上方)，价格为预付金加票息
+                yld_start = 1 + np.searchsorted(s_vec, self.next_barrier_yield, side='left')
+                schedule["obs"][j] = True
+                schedule["yld_start"][j] = yld_start
+                schedule["yld_add"][j] = self.next_coupon * prod.s0
+                schedule["yld_weight"][j] = self._row_weight(yld_start, self.next_barrier_yield)
+                schedule["out_start"][j] = max(yld_start, 1 + np.searchsorted(s_vec, self.next_barrier_out,
+                                                                              side='left'))
+                schedule["out_weight"][j] = self._row_weight(schedule["out_start"][j], self.next_barrier_out)
+                schedule["out_cash"][j] = self.next_coupon * prod.s0 + prod.margin_lvl * prod.s0
 
                 if prod.in_obs_type != ExerciseType.European:
                     # 如果敲入价是浮动的，调整敲入价
                     self.next_barrier_in = self.reversed_barrier_in[np.where(self.out_dates == j)[0][0]] if isinstance(
                         prod.barrier_in, (list, np.ndarray)) else prod.barrier_in
-                    self.in_idx = 1 + np.where(self.fd_not_in.s_vec <= self.next_barrier_in)[0][
+                    self.in_idx = 1 + np.where(s_vec <= self.next_barrier_in)[0][
                         -1] if self.next_barrier_in > 0 else 0
 
             # 考虑敲入的情况: 向下越过敲入边界时，下一时间点敲入边界以上部分是标准autocall价格
-            self.fd_not_in.v_grid[:(self.in_idx + 1), j] = self.fd_knockin.v_grid[:(self.in_idx + 1), j]
+            schedule["in_idx"][j] = self.in_idx
+            schedule["in_weight"][j] = self._row_weight(self.in_idx, self.next_barrier_in)
+        return schedule, np.zeros(s_vec.size)
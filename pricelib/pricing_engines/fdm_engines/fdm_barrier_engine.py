@@ -7,7 +7,7 @@ Licensed under the Apache License, Version 2.0
 from contextlib import suppress
 import numpy as np
 from scipy.interpolate import interp1d
-from pricelib.common.utilities.enums import EngineType, CallPut, InOut, PaymentType, StatusType
+from pricelib.common.utilities.enums import EngineType, CallPut, InOut, PaymentType, StatusType, FdmGridType
 from pricelib.common.utilities.utility import descending_pairs_for_barrier
 from pricelib.common.pricing_engine_base import FdmEngine, FdmGridwithBound, FdmGrid
 from pricelib.common.time import global_evaluation_date
@@ -20,20 +20,28 @@ class FdmBarrierEngine(FdmEngine):
     engine_type = EngineType.PdeEngine
 
     def __init__(self, stoch_process=None, s_step=800, n_smax=2, fdm_theta=1, *,
-                 s=None, r=None, q=None, vol=None):
+                 grid_type=FdmGridType.Uniform, concentration=0.1, log_space=False, rannacher_steps=0,
+                 t_step_per_year=None, s=None, r=None, q=None, vol=None):
         """初始化有限差分法定价引擎
         Args:
             stoch_process: StochProcessBase随机过程
             s_step: int，价格步数
             n_smax: int，价格网格上界，设为n_smax倍初始价格
             fdm_theta: float，时间方向有限差分theta，0：explicit, 1: implicit, 0.5: Crank-Nicolson
+            grid_type: FdmGridType，价格网格类型，默认为均匀网格，见FdmEngine
+            concentration: float，sinh网格的加密程度
+            log_space: bool，是否在对数价格上离散PDE，见FdmEngine
+            rannacher_steps: int，Crank-Nicolson在到期payoff和每个观察日之后的Rannacher平滑步数，见FdmEngine
+            t_step_per_year: int，时间离散不受观察日约束的网格每年的时间步数，默认与产品相同，见FdmEngine
         在未设置stoch_process时，(stoch_process=None)，会默认创建BSMprocess，需要输入以下变量进行初始化
             s: float，标的价格
             r: float，无风险利率
             q: float，分红/融券率
             vol: float，波动率
         """
-        super().__init__(stoch_process, s_step=s_step, n_smax=n_smax, fdm_theta=fdm_theta, s=s, r=r, q=q, vol=vol)
+        super().__init__(stoch_process, s_step=s_step, n_smax=n_smax, fdm_theta=fdm_theta, grid_type=grid_type,
+                         concentration=concentration, log_space=log_space, rannacher_steps=rannacher_steps,
+                         t_step_per_year=t_step_per_year, s=s, r=r, q=q, vol=vol)
         # 计算过程的中间变量
         self.prod = None  # Product产品对象
         self.bound = None  # 障碍价格区间
@@ -151,12 +159,13 @@ class FdmBarrierEngine(FdmEngine):
         # 如果障碍是连续观察，网格上下界应该是障碍价格，如果障碍是离散观察，网格上下界应该是0~4倍初始价格
         if prod.discrete_obs_interval is None:  # 连续观察
             bound_rate = (min(self.smax, self.bound[1]) - max(0, self.bound[0])) / (self.smax - 0)  # 障碍价格占价格网格上下界的比例
-            fd_full = FdmGridwithBound(smax=self.smax, t_step_per_year=prod.t_step_per_year, s_step=self.s_step,
-                                       fn_pde_coef=fn_pde_coef, fdm_theta=self.fdm_theta)  # 无障碍价格，[0, smax]
-            fd_bound = FdmGridwithBound(smax=self.smax, t_step_per_year=prod.t_step_per_year,
+            fd_full = FdmGridwithBound(smax=self.smax, t_step_per_year=self._time_steps(prod), s_step=self.s_step,
+                                       fn_pde_coef=fn_pde_coef, fdm_theta=self.fdm_theta,
+                                       **self._grid_kwargs(spot, prod.strike, self.bound))  # 无障碍价格，[0, smax]
+            fd_bound = FdmGridwithBound(smax=self.smax, t_step_per_year=self._time_steps(prod),
                                         s_step=round(self.s_step * bound_rate),
-                                        fn_pde_coef=fn_pde_coef, bound=self.bound,
-                                        fdm_theta=self.fdm_theta)  # 有障碍价格, Dirichlet边界条件
+                                        fn_pde_coef=fn_pde_coef, bound=self.bound, fdm_theta=self.fdm_theta,
+                                        **self._grid_kwargs(spot, prod.strike))  # 有障碍价格, Dirichlet边界条件
             self._init_boundary_condition(self.smax, maturity)
             fd_full.set_boundary_condition(self.fn_callput)
 
@@ -220,9 +229,10 @@ class FdmBarrierEngine(FdmEngine):
             t_step = round(prod.t_step_per_year * maturity)  # 时间步数
             dt = 1 / prod.t_step_per_year
             fn_pde_coef = self.process.get_fn_pde_coef(maturity, spot)
+            grid_kwargs = self._grid_kwargs(spot, prod.strike, self.bound)  # 未敲入、已敲入网格的格点相同
             self.fd_not_in = FdmGrid(smax=self.smax, t_step_per_year=prod.t_step_per_year, s_step=self.s_step,
                                      fn_pde_coef=fn_pde_coef, fdm_theta=self.fdm_theta,
-                                     maturity=maturity)
+                                     maturity=maturity, **grid_kwargs)
             self._init_boundary_condition(smax=self.smax, maturity=maturity)
             self.fd_not_in.v_grid[0, :] = self.fn_bound[0](self.fd_not_in.tv)
             self.fd_not_in.v_grid[-1, :] = self.fn_bound[1](self.fd_not_in.tv)
@@ -238,7 +248,8 @@ class FdmBarrierEngine(FdmEngine):
 
             if prod.inout == InOut.In:  # 敲入障碍
                 self.fd_knockin = FdmGrid(smax=self.smax, t_step_per_year=prod.t_step_per_year, s_step=self.s_step,
-                                          fn_pde_coef=fn_pde_coef, fdm_theta=self.fdm_theta, maturity=maturity)
+                                          fn_pde_coef=fn_pde_coef, fdm_theta=self.fdm_theta, maturity=maturity,
+                                          **grid_kwargs)
                 self.fd_knockin.v_grid[-1, :] = self.fn_callput[1](self.fd_knockin.tv)
                 self.fd_knockin.v_grid[0, :] = self.fn_callput[0](self.fd_knockin.tv)
                 # 初始化到期日payoff价值
@@ -248,10 +259,13 @@ class FdmBarrierEngine(FdmEngine):
                 self.fd_not_in.v_grid[1:-1, -1] = yv
                 self.fd_knockin.v_grid[1:-1, -1] = yv_in
 
+                smooth = self.rannacher_steps  # 到期payoff与每个观察日覆盖之后，剩余的Rannacher平滑步数
                 for j in range(t_step - 1, -1, -1):
-                    yv = self.fd_not_in.evolve(j, yv, dt)  # 每组(p, q)更新。如果在障碍观察区间内，更新fd_bound；在观察区间外，更新fd_full
-                    yv_in = self.fd_knockin.evolve(j, yv_in, dt)
+                    yv = self.fd_not_in.evolve(j, yv, dt, rannacher=smooth > 0)
+                    yv_in = self.fd_knockin.evolve(j, yv_in, dt, rannacher=smooth > 0)
+                    smooth -= 1
                     if j in obs_points:
+                        smooth = self.rannacher_steps
                         yv[self.outer] = yv_in[self.outer]
                     self.fd_not_in.v_grid[1:-1, j] = yv
                     self.fd_knockin.v_grid[1:-1, j] = yv_in
@@ -259,9 +273,12 @@ class FdmBarrierEngine(FdmEngine):
                 # 初始化到期日payoff价值
                 yv = self._init_terminal_condition(self.fd_not_in.s_vec)
                 self.fd_not_in.v_grid[1:-1, -1] = yv
+                smooth = self.rannacher_steps  # 到期payoff与每个观察日覆盖之后，剩余的Rannacher平滑步数
                 for j in range(t_step - 1, -1, -1):
-                    yv = self.fd_not_in.evolve(j, yv, dt)  # 每组(p, q)更新。如果在障碍观察区间内，更新fd_bound；在观察区间外，更新fd_full
+                    yv = self.fd_not_in.evolve(j, yv, dt, rannacher=smooth > 0)
+                    smooth -= 1
                     if j in obs_points:
+                        smooth = self.rannacher_steps
                         if prod.payment_type == PaymentType.Expire:  # 到期支付现金补偿
                             yv[self.lower] = self.fn_bound[0](j / t_step * maturity)
                             yv[self.upper] = self.fn_bound[1](j / t_step * maturity)
@@ -448,8 +465,8 @@ class FdmBarrierEngine(FdmEngine):
         status = self.prod.status if status is None else status
         fdm_grid = self.fd_knockin if (status == StatusType.DownTouch) else self.fd_not_in
         if step == 0:
-            # 默认PDE模拟时的步长 step = fdm_grid.ds
-            delta_s_t = (fdm_grid.v_grid[2:] - fdm_grid.v_grid[:-2]) / (2 * fdm_grid.ds)
+            # 默认PDE模拟时的步长 step = fdm_grid.ds，非均匀网格使用网格的差分格式
+            delta_s_t = fdm_grid.derivative(fdm_grid.v_grid, order=1)
             return delta_s_t, fdm_grid.s_vec  # 中心差分，价格向量掐头0去尾smax，正好是fdm_grid.s_vec
         else:
             # 重新定义步长，在模拟矩阵的基础上插值
@@ -481,7 +498,7 @@ class FdmBarrierEngine(FdmEngine):
         fdm_grid = self.fd_knockin if (status == StatusType.DownTouch) else self.fd_not_in
         if step == 0:
             # 默认PDE模拟时的步长 step = fdm_grid.ds
-            gamma_s_t = np.diff(fdm_grid.v_grid, n=2, axis=0) / fdm_grid.ds ** 2
+            gamma_s_t = fdm_grid.derivative(fdm_grid.v_grid, order=2)
             return gamma_s_t, fdm_grid.s_vec
         else:
             # 重新定义步长，在模拟矩阵的基础上插值
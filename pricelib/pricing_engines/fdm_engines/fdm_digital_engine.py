@@ -5,7 +5,7 @@ Copyright (C) 2024 Galaxy Technologies
 Licensed under the Apache License, Version 2.0
 """
 import numpy as np
-from pricelib.common.utilities.enums import TouchType, PaymentType, ExerciseType
+from pricelib.common.utilities.enums import TouchType, PaymentType, ExerciseType, FdmGridType
 from pricelib.common.pricing_engine_base import FdmEngine, FdmGridwithBound, FdmGrid
 from pricelib.common.time import global_evaluation_date
 
@@ -20,20 +20,28 @@ class FdmDigitalEngine(FdmEngine):
     """
 
     def __init__(self, stoch_process=None, s_step=800, n_smax=2, fdm_theta=1, *,
-                 s=None, r=None, q=None, vol=None):
+                 grid_type=FdmGridType.Uniform, concentration=0.1, log_space=False, rannacher_steps=0,
+                 t_step_per_year=None, s=None, r=None, q=None, vol=None):
         """构造函数
         Args:
             stoch_process: StochProcessBase 随机过程
             s_step: int，价格步数
             n_smax: int，价格网格上界，设为n_smax倍初始价格
             fdm_theta: float，时间方向有限差分theta，0：explicit, 1: implicit, 0.5: Crank-Nicolson
+            grid_type: FdmGridType，价格网格类型，默认为均匀网格，见FdmEngine
+            concentration: float，sinh网格的加密程度
+            log_space: bool，是否在对数价格上离散PDE，见FdmEngine
+            rannacher_steps: int，Crank-Nicolson在到期payoff和每个观察日之后的Rannacher平滑步数，见FdmEngine
+            t_step_per_year: int，时间离散不受观察日约束的网格每年的时间步数，默认与产品相同，见FdmEngine
         在未设置stoch_process时，(stoch_process=None)，会默认创建BSMprocess，需要输入以下变量进行初始化
             s: float，标的价格
             r: float，无风险利率
             q: float，分红/融券率
             vol: float，波动率
         """
-        super().__init__(stoch_process, s_step=s_step, n_smax=n_smax, fdm_theta=fdm_theta, s=s, r=r, q=q, vol=vol)
+        super().__init__(stoch_process, s_step=s_step, n_smax=n_smax, fdm_theta=fdm_theta, grid_type=grid_type,
+                         concentration=concentration, log_space=log_space, rannacher_steps=rannacher_steps,
+                         t_step_per_year=t_step_per_year, s=s, r=r, q=q, vol=vol)
         # 以下为计算过程的中间变量
         self.prod = None  # Product产品对象
         self.fdm = None  # 有限差分网格对象，若连续观察，则为FdmGridwithBound；若离散观察则为FdmGrid
@@ -152,8 +160,9 @@ class FdmDigitalEngine(FdmEngine):
                     else:
                         raise ValueError(f"{prod.touch_type}必须是TouchType.Touch或TouchType.NoTouch")
 
-                self.fdm = FdmGridwithBound(smax=self.smax, t_step_per_year=prod.t_step_per_year, s_step=self.s_step,
-                                            fn_pde_coef=fn_pde_coef, bound=self.bound, fdm_theta=self.fdm_theta)
+                self.fdm = FdmGridwithBound(smax=self.smax, t_step_per_year=self._time_steps(prod), s_step=self.s_step,
+                                            fn_pde_coef=fn_pde_coef, bound=self.bound, fdm_theta=self.fdm_theta,
+                                            **self._grid_kwargs(spot))
                 self._init_boundary_condition(_maturity)
                 self.fdm.set_boundary_condition(self.fn_bound)
 
@@ -164,7 +173,8 @@ class FdmDigitalEngine(FdmEngine):
 
             else:  # 离散观察美式
                 self.fdm = FdmGrid(smax=self.smax, t_step_per_year=prod.t_step_per_year, s_step=self.s_step,
-                                   fn_pde_coef=fn_pde_coef, fdm_theta=self.fdm_theta, maturity=_maturity)
+                                   fn_pde_coef=fn_pde_coef, fdm_theta=self.fdm_theta, maturity=_maturity,
+                                   **self._grid_kwargs(spot, self.bound))
                 self._init_boundary_condition(_maturity)
                 self.fdm.v_grid[0, :] = self.fn_bound[0](self.fdm.tv)
                 self.fdm.v_grid[-1, :] = self.fn_bound[1](self.fdm.tv)
@@ -180,9 +190,12 @@ class FdmDigitalEngine(FdmEngine):
                 yv = self._init_terminal_condition(self.fdm.s_vec)
                 self.fdm.v_grid[1:-1, -1] = yv
 
+                smooth = self.rannacher_steps  # 到期payoff与每个观察日覆盖之后，剩余的Rannacher平滑步数
                 for j in range(t_step - 1, -1, -1):
-                    yv = self.fdm.evolve(j, yv, dt)
+                    yv = self.fdm.evolve(j, yv, dt, rannacher=smooth > 0)
+                    smooth -= 1
                     if j in obs_points:
+                        smooth = self.rannacher_steps
                         if prod.touch_type == TouchType.Touch:
                             if prod.payment_type == PaymentType.Expire:  # 到期支付
                                 discount = self.process.interest.disc_factor(_maturity, j / t_step * _maturity)
@@ -198,19 +211,21 @@ class FdmDigitalEngine(FdmEngine):
                             yv[upper] = 0
                     self.fdm.v_grid[1:-1, j] = yv
         elif prod.exercise_type == ExerciseType.European:  # 欧式
-            self.fdm = FdmGrid(smax=self.smax, t_step_per_year=prod.t_step_per_year, s_step=self.s_step,
-                               fn_pde_coef=fn_pde_coef, fdm_theta=self.fdm_theta, maturity=_maturity)
+            self.fdm = FdmGrid(smax=self.smax, t_step_per_year=self._time_steps(prod), s_step=self.s_step,
+                               fn_pde_coef=fn_pde_coef, fdm_theta=self.fdm_theta, maturity=_maturity,
+                               **self._grid_kwargs(spot, self.bound))
             self._init_boundary_condition(_maturity)
             self.fdm.v_grid[0, :] = self.fn_bound[0](self.fdm.tv)
             self.fdm.v_grid[-1, :] = self.fn_bound[1](self.fdm.tv)
 
-            t_step = round(prod.t_step_per_year * _maturity)  # 时间步数
-            dt = 1 / prod.t_step_per_year
+            t_step = self.fdm.tv.size - 1  # 时间步数
+            dt = self.fdm.dt
             yv = self._init_terminal_condition(self.fdm.s_vec)
             self.fdm.v_grid[1:-1, -1] = yv
 
             for j in range(t_step - 1, -1, -1):
-                yv = self.fdm.evolve(j, yv, dt)  # 每组(p, q)更新
+                # 到期payoff在障碍价处不连续，之后的rannacher_steps步做Rannacher平滑
+                yv = self.fdm.evolve(j, yv, dt, rannacher=j >= t_step - self.rannacher_steps)
                 self.fdm.v_grid[1:-1, j] = yv
         else:
             raise ValueError(f"{prod.exercise_type}必须是欧式或美式")
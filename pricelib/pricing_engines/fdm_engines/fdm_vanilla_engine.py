@@ -39,24 +39,27 @@ class FdmVanillaEngine(FdmEngine):
             fn_callput = [lambda u: prod.strike * self.process.interest.disc_factor(maturity, u),
                           lambda u: 0]
         if prod.exercise_type == ExerciseType.European:
-            fdm = FdmGridwithBound(smax=smax, t_step_per_year=prod.t_step_per_year, s_step=self.s_step,
-                                   fn_pde_coef=fn_pde_coef, fdm_theta=self.fdm_theta)
+            fdm = FdmGridwithBound(smax=smax, t_step_per_year=self._time_steps(prod), s_step=self.s_step,
+                                   fn_pde_coef=fn_pde_coef, fdm_theta=self.fdm_theta,
+                                   **self._grid_kwargs(spot, prod.strike))
             fdm.set_boundary_condition(fn_callput)
             # 初始化到期日payoff价值yv=max(callput * (F-K), 0)。fdm.xv是log(F)
             yv = np.maximum(prod.callput.value * (fdm.s_vec - prod.strike), 0)
             yv = fdm.evolve_with_interval(start=maturity, end=0, yv=yv)  # 时间逆向迭代求解
         elif prod.exercise_type == ExerciseType.American:
-            t_step = round(maturity * prod.t_step_per_year)  # 时间格点数
+            t_step_per_year = self._time_steps(prod)
+            t_step = round(maturity * t_step_per_year)  # 时间格点数
             t_vec = np.linspace(0, maturity, t_step + 1)  # 时间向量
             dt = (t_vec[-1] - t_vec[0]) / (t_vec.size - 1) if t_vec.size > 1 else 0  # 时间步长
-            fdm = FdmGrid(smax=smax, t_step_per_year=prod.t_step_per_year, s_step=self.s_step, fn_pde_coef=fn_pde_coef,
-                          fdm_theta=self.fdm_theta, maturity=maturity)
+            fdm = FdmGrid(smax=smax, t_step_per_year=t_step_per_year, s_step=self.s_step, fn_pde_coef=fn_pde_coef,
+                          fdm_theta=self.fdm_theta, maturity=maturity, **self._grid_kwargs(spot, prod.strike))
             fdm.v_grid[0] = fn_callput[0](t_vec)
             fdm.v_grid[-1] = fn_callput[1](t_vec)
             yv = np.maximum(prod.callput.value * (fdm.s_vec - prod.strike), 0)
             v_vec = prod.callput.value * (fdm.s_vec - prod.strike)
             for j in range(t_step - 1, -1, -1):
-                yv = fdm.evolve(j, yv, dt)  # 每组(p, q)更新。如果在障碍观察区间内，更新fd_bound；在观察区间外，更新fd_full
+                # 到期payoff在行权价处不可导，之后的rannacher_steps步做Rannacher平滑
+                yv = fdm.evolve(j, yv, dt, rannacher=j >= t_step - self.rannacher_steps)
                 yv = np.maximum(yv, v_vec)
         else:
             raise ValueError("不支持的期权类型，仅支持欧式或美式香草期权")
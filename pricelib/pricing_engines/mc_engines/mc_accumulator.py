@@ -31,32 +31,35 @@ class MCAccumulatorEngine(McEngine):
         else:
             self.reset_paths_flag()  # 重置路径标志位，重新生成路径
 
-        paths = self.path_generator(n_step=_maturity_business_days, spot=spot,
-                                    t_step_per_year=prod.t_step_per_year).copy()
-
-        # 敲出与行权日期
-        barrier_out = np.ones(_obs_dates.size) * prod.barrier_out
-        barrier_out = np.tile(barrier_out, (self.n_path, 1)).T
-        strike = np.ones(_obs_dates.size) * prod.strike
-        strike = np.tile(strike, (self.n_path, 1)).T
-        if prod.callput == CallPut.Call:  # 累购
-            knock_out_time_idx = np.argmax(paths[_obs_dates, :] >= barrier_out, axis=0)
-            knock_in_time_idx = paths[_obs_dates, :] < strike
-        else:  # 累沽
-            knock_out_time_idx = np.argmax(paths[_obs_dates, :] <= barrier_out, axis=0)
-            knock_in_time_idx = paths[_obs_dates, :] > strike
-
-        knock_out_scenario = np.where(knock_out_time_idx > 0, True, False)
-        knock_out_time_idx[~knock_out_scenario] = _obs_dates.size - 1
-        knock_in_bool = np.where(np.arange(knock_in_time_idx.shape[0])[:, np.newaxis] > knock_out_time_idx, False,
-                                 knock_in_time_idx)
-
         # 贴现因子
         discount_factor = np.empty(_obs_dates.size)
         for i, j in enumerate(_obs_dates):
             discount_factor[i] = self.process.interest.disc_factor(j / prod.t_step_per_year)
-        n_underlying = np.sum(knock_in_bool, axis=0) * (prod.leverage_ratio - 1) + knock_out_time_idx
-        exercise_price = paths[_obs_dates[knock_out_time_idx], np.arange(self.n_path)]
 
-        payoff = n_underlying * (exercise_price - prod.strike) * discount_factor[knock_out_time_idx]
-        return np.mean(payoff) * prod.callput.value
+        def path_payoff(paths):
+            """每条路径的折现payoff"""
+            n_path = paths.shape[1]
+            # 敲出与行权日期
+            barrier_out = np.ones(_obs_dates.size) * prod.barrier_out
+            barrier_out = np.tile(barrier_out, (n_path, 1)).T
+            strike = np.ones(_obs_dates.size) * prod.strike
+            strike = np.tile(strike, (n_path, 1)).T
+            if prod.callput == CallPut.Call:  # 累购
+                knock_out_time_idx = np.argmax(paths[_obs_dates, :] >= barrier_out, axis=0)
+                knock_in_time_idx = paths[_obs_dates, :] < strike
+            else:  # 累沽
+                knock_out_time_idx = np.argmax(paths[_obs_dates, :] <= barrier_out, axis=0)
+                knock_in_time_idx = paths[_obs_dates, :] > strike
+
+            knock_out_scenario = np.where(knock_out_time_idx > 0, True, False)
+            knock_out_time_idx[~knock_out_scenario] = _obs_dates.size - 1
+            knock_in_bool = np.where(np.arange(knock_in_time_idx.shape[0])[:, np.newaxis] > knock_out_time_idx, False,
+                                     knock_in_time_idx)
+
+            n_underlying = np.sum(knock_in_bool, axis=0) * (prod.leverage_ratio - 1) + knock_out_time_idx
+            exercise_price = paths[_obs_dates[knock_out_time_idx], np.arange(n_path)]
+            return n_underlying * (exercise_price - prod.strike) * discount_factor[knock_out_time_idx]
+
+        payoff = self._mc_expectation(path_payoff, n_step=_maturity_business_days, spot=spot,
+                                      t_step_per_year=prod.t_step_per_year)
+        return payoff * prod.callput.value
@@ -30,9 +30,6 @@ class MCAirbagEngine(McEngine):
             spot = self.process.spot()
         else:
             self.reset_paths_flag()  # 重置路径标志位，重新生成路径
-        paths = self.path_generator(n_step=_maturity_business_days, spot=spot,
-                                    t_step_per_year=prod.t_step_per_year).copy()
-
         if prod.discrete_obs_interval is None:  # 每日观察
             obs_points = np.arange(0, _maturity_business_days + 1, 1)
         else:  # 均匀离散观察
@@ -41,15 +38,18 @@ class MCAirbagEngine(McEngine):
             obs_points = np.concatenate((np.array([0]), obs_points))
             obs_points[obs_points > _maturity_business_days] = _maturity_business_days  # 防止闰年导致的下标越界
 
-        # 期末价值
-        payoff = paths[-1] - prod.strike
-
-        # 安全气囊，未敲入是call，已敲入是标的资产（上涨下跌可以设置不同的参与率）
-        knock_in_bool = np.any(paths[obs_points] <= prod.barrier, axis=0)
-        value = np.where(knock_in_bool,  # 敲入
-                         np.where(payoff < 0, payoff * prod.knockin_parti,  # 敲入下跌参与率
-                                  payoff * prod.reset_call_parti),  # 敲入重置后看涨参与率
-                         np.where(payoff < 0, 0, payoff * prod.call_parti))  # 看涨参与率
-        value = np.mean(value) * self.process.interest.disc_factor(_maturity)
+        def path_payoff(paths):
+            """每条路径的折现payoff"""
+            # 期末价值
+            payoff = paths[-1] - prod.strike
+            # 安全气囊，未敲入是call，已敲入是标的资产（上涨下跌可以设置不同的参与率）
+            knock_in_bool = np.any(paths[obs_points] <= prod.barrier, axis=0)
+            value = np.where(knock_in_bool,  # 敲入
+                             np.where(payoff < 0, payoff * prod.knockin_parti,  # 敲入下跌参与率
+                                      payoff * prod.reset_call_parti),  # 敲入重置后看涨参与率
+                             np.where(payoff < 0, 0, payoff * prod.call_parti))  # 看涨参与率
+            return value * self.process.interest.disc_factor(_maturity)
 
+        value = self._mc_expectation(path_payoff, n_step=_maturity_business_days, spot=spot,
+                                     t_step_per_year=prod.t_step_per_year)
         return value
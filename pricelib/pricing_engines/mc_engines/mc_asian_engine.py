@@ -6,12 +6,60 @@ Licensed under the Apache License, Version 2.0
 """
 import numpy as np
 from pricelib.common.utilities.enums import AverageMethod, AsianAveSubstitution
-from pricelib.common.pricing_engine_base import McEngine
+from pricelib.common.pricing_engine_base import McEngine, PathFunctional
 from pricelib.common.time import global_evaluation_date
+from pricelib.pricing_engines.analytic_engines.analytic_vanilla_european_engine import bs_formula
+
+
+class AsianFunctional(PathFunctional):
+    """亚式期权的路径泛函，状态为观察日价格(几何平均时为对数价格)的累加值与最新价格"""
+
+    def __init__(self, prod, obs_steps, n_step, discount):
+        """构造函数
+        Args:
+            prod: Product产品对象
+            obs_steps: np.ndarray，观察日在价格路径矩阵中的行号
+            n_step: int，到期日的时间步序号
+            discount: float，到期日的折现因子
+        """
+        self.prod = prod
+        self.is_obs = np.zeros(n_step + 1, dtype=bool)  # 每一行是否为观察日
+        self.is_obs[obs_steps] = True
+        self.n_obs = obs_steps.size
+        self.discount = discount
+        self.enhanced = prod.substitute == AsianAveSubstitution.Underlying and prod.enhanced
+        self.ave_sum, self.s_last = None, None
+
+    def start(self, spot):
+        self.ave_sum = np.zeros(spot.size)
+        self.update(0, spot)
+
+    def update(self, step, s):
+        self.s_last = s
+        if not self.is_obs[step]:
+            return
+        prod = self.prod
+        if self.enhanced:
+            s = s + prod.callput.value * np.maximum(prod.callput.value * (prod.limited_price - s), 0)
+        self.ave_sum += s if prod.ave_method == AverageMethod.Arithmetic else np.log(s)
+
+    def payoff(self):
+        prod = self.prod
+        ave_s = self.ave_sum / self.n_obs
+        if prod.ave_method == AverageMethod.Geometric:
+            ave_s = np.exp(ave_s)
+        if prod.substitute == AsianAveSubstitution.Underlying:
+            return np.maximum(prod.callput.value * (ave_s - prod.strike), 0) * self.discount
+        return np.maximum(prod.callput.value * (self.s_last - ave_s), 0) * self.discount
 
 
 class MCAsianEngine(McEngine):
-    """亚式期权 Monte Carlo 模拟定价引擎"""
+    """亚式期权 Monte Carlo 模拟定价引擎
+    控制变量为到期标的价格；常数波动率BSM过程下增加同一布朗运动驱动的几何布朗运动的离散几何平均，
+    平均价替代标的时为几何平均亚式期权，期望有闭式解
+    多层蒙特卡洛的粗网格上，观察日价格由相邻模拟时点的价格线性插值"""
+    pathwise_greeks = True  # payoff关于路径连续，单次模拟的希腊字母使用路径导数
+    supports_stream_paths = True  # 提供路径泛函AsianFunctional，可以不保存价格路径矩阵
 
     def calc_present_value(self, prod, t=None, spot=None):
         """计算现值
@@ -32,29 +80,104 @@ class MCAsianEngine(McEngine):
         else:
             self.reset_paths_flag()  # 重置路径标志位，重新生成路径
 
-        paths = self.path_generator(n_step=_maturity_business_days, spot=spot,
-                                    t_step_per_year=prod.t_step_per_year).copy()
         r = self.process.interest(_maturity)
         obs_steps = np.arange(obs_start, obs_end, 1, dtype=int)
-        if prod.substitute == AsianAveSubstitution.Underlying:
-            if prod.enhanced:
-                paths[obs_steps, :] = paths[obs_steps, :] + prod.callput.value * np.maximum(
-                    prod.callput.value * (prod.limited_price - paths[obs_steps, :]), 0)
-            if prod.ave_method == AverageMethod.Arithmetic:
-                ave_s = np.mean(paths[obs_steps, :], axis=0)
-            elif prod.ave_method == AverageMethod.Geometric:
-                ave_s = np.exp(np.mean(np.log(paths[obs_steps, :]), axis=0))
-            else:
-                raise ValueError("无效的平均价计算方法，只支持几何平均/算术平均")
-            price = np.mean(np.maximum(prod.callput.value * (ave_s - prod.strike), 0)) * np.exp(-r * _maturity)
-            return price
-        if prod.substitute == AsianAveSubstitution.Strike:
-            if prod.ave_method == AverageMethod.Arithmetic:
-                ave_s = np.mean(paths[obs_steps, :], axis=0)
-            elif prod.ave_method == AverageMethod.Geometric:
-                ave_s = np.exp(np.mean(np.log(paths[obs_steps, :]), axis=0))
-            else:
-                raise ValueError("无效的平均价计算方法，只支持几何平均/算术平均")
-            price = np.mean(np.maximum(prod.callput.value * (paths[-1] - ave_s), 0)) * np.exp(-r * _maturity)
-            return price
-        raise ValueError("无效的substitute类型，只支持替代标的资产到期价格/替代行权价")
+        if prod.substitute not in (AsianAveSubstitution.Underlying, AsianAveSubstitution.Strike):
+            raise ValueError("无效的substitute类型，只支持替代标的资产到期价格/替代行权价")
+        if prod.ave_method not in (AverageMethod.Arithmetic, AverageMethod.Geometric):
+            raise ValueError("无效的平均价计算方法，只支持几何平均/算术平均")
+
+        def payoff_factory(steps=None):
+            """模拟时间步为steps时的逐路径折现payoff函数，默认None为逐日模拟；只在部分时间步上模拟时，观察日价格线性插值"""
+            interp = None if steps is None or steps.size == _maturity_business_days else self._interp_matrix(
+                obs_steps, steps)
+            enhanced = prod.substitute == AsianAveSubstitution.Underlying and prod.enhanced
+            # 算术平均是插值价格的线性组合，直接由模拟时点的价格加权得到，不必插值出每个观察日的价格
+            ave_weights = interp.mean(axis=0) if interp is not None and obs_steps.size > 0 and not enhanced and (
+                prod.ave_method == AverageMethod.Arithmetic) else None
+
+            def path_payoff(paths):
+                """每条路径的折现payoff"""
+                if ave_weights is not None:
+                    ave_s = ave_weights @ paths
+                    return np.maximum(prod.callput.value * ((ave_s - prod.strike) if prod.substitute == (
+                        AsianAveSubstitution.Underlying) else (paths[-1] - ave_s)), 0) * np.exp(-r * _maturity)
+                obs_paths = paths[obs_steps, :] if interp is None else interp @ paths
+                if enhanced:
+                    obs_paths = obs_paths + prod.callput.value * np.maximum(
+                        prod.callput.value * (prod.limited_price - obs_paths), 0)
+                if prod.ave_method == AverageMethod.Arithmetic:
+                    ave_s = np.mean(obs_paths, axis=0)
+                else:  # prod.ave_method == AverageMethod.Geometric
+                    ave_s = np.exp(np.mean(np.log(obs_paths), axis=0))
+                if prod.substitute == AsianAveSubstitution.Underlying:
+                    return np.maximum(prod.callput.value * (ave_s - prod.strike), 0) * np.exp(-r * _maturity)
+                # prod.substitute == AsianAveSubstitution.Strike
+                return np.maximum(prod.callput.value * (paths[-1] - ave_s), 0) * np.exp(-r * _maturity)
+
+            return path_payoff
+
+        if self._use_mlmc(_maturity_business_days):
+            return self._mlmc_expectation(payoff_factory, n_step=_maturity_business_days, spot=spot,
+                                          t_step_per_year=prod.t_step_per_year)
+        if self.stream_paths:
+            return self._functional_expectation(
+                lambda: AsianFunctional(prod, obs_steps, _maturity_business_days, np.exp(-r * _maturity)),
+                _maturity_business_days, spot, prod.t_step_per_year)
+        controls = None
+        if self.control_variates:
+            controls = self._asian_controls(prod, obs_steps, _maturity_business_days, spot)
+        price = self._mc_expectation(payoff_factory(), n_step=_maturity_business_days, spot=spot,
+                                     t_step_per_year=prod.t_step_per_year, controls=controls)
+        return price
+
+    @staticmethod
+    def _interp_matrix(days, steps):
+        """由模拟时点上的价格线性插值各观察日价格的矩阵
+        Args:
+            days: np.ndarray，观察日的时间步序号
+            steps: np.ndarray，升序的模拟时间步，价格路径矩阵的第0行为估值日
+        Returns: np.ndarray，(len(days), len(steps) + 1)的插值矩阵，左乘价格路径矩阵得到观察日价格
+        """
+        grid = np.concatenate(([0], steps))
+        right = np.clip(np.searchsorted(grid, days), 1, grid.size - 1)
+        left = right - 1
+        weight = (days - grid[left]) / (grid[right] - grid[left])
+        interp = np.zeros((days.size, grid.size))
+        interp[np.arange(days.size), left] = 1 - weight
+        interp[np.arange(days.size), right] += weight
+        return interp
+
+    def _asian_controls(self, prod, obs_steps, n_step, spot):
+        """亚式期权的控制变量
+        几何布朗运动G在观察日上的几何平均服从对数正态分布: 对数均值m = ln(spot) + (r - q - vol²/2) * mean(t_i)，
+        对数方差v = vol² * ΣΣmin(t_i, t_j) / M²，几何平均亚式期权的期望为远期价格exp(m + v/2)、标准差sqrt(v)的Black公式
+        Args:
+            prod: Product产品对象
+            obs_steps: np.ndarray，观察日的时间步序号
+            n_step: int，价格路径的时间步数
+            spot: float，标的期初价格
+        Returns: List[tuple]，控制变量列表，见McEngine._mc_expectation
+        """
+        controls = [self._terminal_control(n_step, spot, prod.t_step_per_year)]
+        gbm_fn = self._gbm_control_fn(n_step, spot, prod.t_step_per_year)
+        if gbm_fn is None or n_step == 0 or obs_steps.size == 0:
+            return controls
+        maturity = n_step / prod.t_step_per_year
+        r, q = self.process.interest(maturity), self.process.div(maturity)
+        vol = self.process.vol(maturity, spot)
+        t_obs = obs_steps / prod.t_step_per_year
+        log_mean = np.log(spot) + (r - q - 0.5 * vol ** 2) * np.mean(t_obs)
+        log_var = vol ** 2 * np.sum(np.minimum.outer(t_obs, t_obs)) / t_obs.size ** 2
+        geo_forward = np.exp(log_mean + 0.5 * log_var)
+
+        def geometric_average(paths):
+            return np.exp(np.mean(np.log(gbm_fn(paths)[obs_steps, :]), axis=0))
+
+        if prod.substitute == AsianAveSubstitution.Underlying and log_var > 0:
+            sign = prod.callput.value
+            controls.append((lambda paths: np.maximum(sign * (geometric_average(paths) - prod.strike), 0),
+                             bs_formula(S=geo_forward, K=prod.strike, T=1, r=0, sigma=np.sqrt(log_var), sign=sign)))
+        else:  # 平均价替代执行价时，以几何平均价格为线性控制变量
+            controls.append((geometric_average, geo_forward))
+        return controls
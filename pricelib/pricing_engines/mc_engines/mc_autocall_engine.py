@@ -5,7 +5,7 @@ Copyright (C) 2024 Galaxy Technologies
 Licensed under the Apache License, Version 2.0
 """
 import numpy as np
-from pricelib.common.utilities.enums import CallPut
+from pricelib.common.utilities.enums import CallPut, RandsMethod, LdMethod
 from pricelib.common.pricing_engine_base import McEngine
 from pricelib.common.time import global_evaluation_date
 
@@ -13,6 +13,39 @@ from pricelib.common.time import global_evaluation_date
 class MCAutoCallEngine(McEngine):
     """AutoCall Note(小雪球) MonteCarlo 模拟定价引擎"""
 
+    def __init__(self, stoch_process=None, n_path=100000, rands_method=RandsMethod.LowDiscrepancy,
+                 antithetic_variate=True, ld_method=LdMethod.Sobol, seed=0, *, chunk_size=None, n_workers=None,
+                 obs_dates_only=False, one_pass_greeks=False, dtype=np.float64, target_rel_error=None,
+                 time_budget=None, importance_shift=None, s=None, r=None, q=None, vol=None):
+        """构造函数
+        Args:
+            stoch_process: 随机过程StochProcessBase对象
+            n_path: int，MC模拟路径数
+            rands_method: 生成随机数方法，RandsMethod枚举类，Pseudorandom伪随机数/LowDiscrepancy低差异序列
+            antithetic_variate: bool，是否使用对立变量法
+            ld_method: 若使用了低差异序列，指定低差异序列方法，LdMethod枚举类，Sobol序列/Halton序列
+            seed: int，随机数种子
+            chunk_size: int，分块模拟时每块的路径数，默认None为一次性生成全部路径
+            n_workers: int，并行模拟的线程数，默认None为单线程
+            obs_dates_only: bool，是否只在观察日(及到期日)模拟价格路径，默认False为逐日模拟。
+                            仅支持BSM过程，使用对数欧拉格式，常数波动率时没有离散化误差
+            one_pass_greeks: bool，pv_and_greeks是否在同一组模拟路径上用路径导数/似然比估计希腊字母，默认False为共同随机数的差分法重新定价
+            dtype: 随机数与价格路径的浮点类型，np.float64(默认)或np.float32
+            target_rel_error: float，自适应模拟的目标相对误差(标准误差/|现值|)，默认None为模拟全部n_path条路径
+            time_budget: float，自适应模拟的时间预算(秒)，默认None为不限时
+            importance_shift: float或'auto'，重要性抽样的漂移平移量，默认None为不使用，见McEngine
+        在未设置stoch_process时，(stoch_process=None)，会默认创建BSMprocess，需要输入以下变量进行初始化
+            s: float，标的价格
+            r: float，无风险利率
+            q: float，分红/融券率
+            vol: float，波动率
+        """
+        super().__init__(stoch_process, n_path, rands_method=rands_method, antithetic_variate=antithetic_variate,
+                         ld_method=ld_method, seed=seed, chunk_size=chunk_size, n_workers=n_workers,
+                         one_pass_greeks=one_pass_greeks, dtype=dtype, target_rel_error=target_rel_error,
+                         time_budget=time_budget, importance_shift=importance_shift, s=s, r=r, q=q, vol=vol)
+        self.obs_dates_only = obs_dates_only  # 是否只在观察日模拟价格路径
+
     def calc_present_value(self, prod, t=None, spot=None):
         """计算现值
         Args:
@@ -41,38 +74,43 @@ class MCAutoCallEngine(McEngine):
         else:
             self.reset_paths_flag()  # 重置路径标志位，重新生成路径
 
-        s_paths = self.path_generator(n_step=_maturity_business_days, spot=spot,
-                                      t_step_per_year=prod.t_step_per_year).copy()
+        if self.obs_dates_only:  # 只在敲出观察日和到期日模拟，价格路径矩阵的第k行对应第steps[k-1]个交易日
+            steps = np.unique(np.append(obs_dates[obs_dates > 0], _maturity_business_days))
+            obs_rows = np.where(obs_dates > 0, np.searchsorted(steps, obs_dates) + 1, 0)
+        else:
+            steps = None
+            obs_rows = obs_dates
 
-        barrier = np.tile(_barrier_out, (self.n_path, 1)).T
-        # 记录每条路径的具体敲出日，如果无敲出则保留inf
+        disc_hold = self.process.interest.disc_factor(pay_dates_tau[-1])
+        # 敲出对应计息时长、折现时长、票息
+        obs_to_pay = dict(zip(obs_dates, pay_dates))
+        obs_to_pay_tau = dict(zip(obs_dates, pay_dates_tau))
+        obs_to_coupon = dict(zip(obs_dates, _coupon_out))
 
-        knock_out_scenario = np.tile(obs_dates, (self.n_path, 1)).T
+        def path_payoff(s_paths):
+            """每条路径的折现payoff"""
+            barrier = np.tile(_barrier_out, (s_paths.shape[1], 1)).T
+            # 记录每条路径的具体敲出日，如果无敲出则保留inf
+            knock_out_scenario = np.tile(obs_dates, (s_paths.shape[1], 1)).T
+            if prod.callput == CallPut.Call:
+                knock_out_scenario = np.where(s_paths[obs_rows] >= barrier, knock_out_scenario, np.inf)
+            elif prod.callput == CallPut.Put:
+                knock_out_scenario = np.where(s_paths[obs_rows] <= barrier, knock_out_scenario, np.inf)
+            knock_out_date = np.min(knock_out_scenario, axis=0)
+            is_knock_out = knock_out_date != np.inf
+            # 红利票息
+            payoff = np.where(is_knock_out, 0., prod.s0 * (prod.coupon_div * pay_dates[-1] + prod.margin_lvl)
+                              * disc_hold)
+            # 敲出部分
+            if any(is_knock_out):
+                pay_dates_vec = np.vectorize(obs_to_pay.get)(knock_out_date[is_knock_out])
+                pay_dates_tau_vec = np.vectorize(obs_to_pay_tau.get)(knock_out_date[is_knock_out])
+                coupon_out = np.vectorize(obs_to_coupon.get)(knock_out_date[is_knock_out])
+                # 敲出部分的收益
+                payoff[is_knock_out] = (prod.s0 * (coupon_out * pay_dates_vec + prod.margin_lvl)
+                                        * self.process.interest.disc_factor(pay_dates_tau_vec))
+            return payoff
 
-        if prod.callput == CallPut.Call:
-            knock_out_scenario = np.where(s_paths[obs_dates] >= barrier, knock_out_scenario, np.inf)
-        elif prod.callput == CallPut.Put:
-            knock_out_scenario = np.where(s_paths[obs_dates] <= barrier, knock_out_scenario, np.inf)
-        knock_out_date = np.min(knock_out_scenario, axis=0)
-        is_knock_out = knock_out_date != np.inf
-        # 红利票息
-        hold_payoff = ((self.n_path - np.sum(is_knock_out)) * prod.s0 * (prod.coupon_div * pay_dates[-1]
-                       + prod.margin_lvl) * self.process.interest.disc_factor(pay_dates_tau[-1]))
-        # 敲出部分
-        # 敲出对应计息时长
-        obs_to_pay = dict(zip(obs_dates, pay_dates))
-        if any(is_knock_out):
-            pay_dates_vec = np.vectorize(obs_to_pay.get)(knock_out_date[is_knock_out])
-            # 敲出对应折现时长
-            obs_to_pay_tau = dict(zip(obs_dates, pay_dates_tau))
-            pay_dates_tau_vec = np.vectorize(obs_to_pay_tau.get)(knock_out_date[is_knock_out])
-            # 敲出对应票息
-            obs_to_coupon = dict(zip(obs_dates, _coupon_out))
-            coupon_out = np.vectorize(obs_to_coupon.get)(knock_out_date[is_knock_out])
-            # 敲出部分的收益
-            knock_out_payoff = np.sum(prod.s0 * (coupon_out * pay_dates_vec + prod.margin_lvl)
-                                      * self.process.interest.disc_factor(pay_dates_tau_vec))
-        else:
-            knock_out_payoff = 0
-        value = (hold_payoff + knock_out_payoff) / self.n_path
+        value = self._mc_expectation(path_payoff, n_step=_maturity_business_days, spot=spot,
+                                     t_step_per_year=prod.t_step_per_year, steps=steps)
         return value
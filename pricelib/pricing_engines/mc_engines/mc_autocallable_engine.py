@@ -5,18 +5,122 @@ Copyright (C) 2024 Galaxy Technologies
 Licensed under the Apache License, Version 2.0
 """
 import numpy as np
-from pricelib.common.utilities.enums import RandsMethod, LdMethod, StatusType
-from pricelib.common.pricing_engine_base import McEngine
+from numba import njit
+from pricelib.common.utilities.enums import RandsMethod, LdMethod, StatusType, ExerciseType
+from pricelib.common.pricing_engine_base import McEngine, PathFunctional
 from pricelib.common.time import global_evaluation_date
+from pricelib.pricing_engines.analytic_engines.analytic_vanilla_european_engine import bs_formula
+
+
+@njit(cache=True, nogil=True)  # 不使用fastmath，敲出线可能为inf；释放GIL，多线程分块模拟时各块可以同时计算
+def snowball_payoff(paths, obs_rows, barrier_out, out_value, out_parti, strike_call, in_rows, in_level, in_times,
+                    in_prob, hold_value, strike_upper, strike_lower, parti_in, in_base, disc_maturity):
+    """雪球类自动赎回结构的逐路径折现payoff，jit加速，按行顺序遍历路径矩阵(内存连续)，只维护长度为n_path的状态向量，
+    不生成路径规模的中间矩阵。依次检查敲出观察行，首次敲出时记录敲出收益；统计敲入观察行上的敲入次数；
+    未敲出的路径到期损益为持有到期收益或敲入后的看跌价差空头
+    Args:
+        paths: np.ndarray，(n_row, n_path)的价格路径矩阵，float64或float32
+        obs_rows: np.ndarray，(n_obs,)的敲出观察日在路径矩阵中的行号
+        barrier_out: np.ndarray，(n_obs,)的敲出线
+        out_value: np.ndarray，(n_obs,)的各观察日敲出时的固定收益(票息+保证金)，已折现
+        out_parti: np.ndarray，(n_obs,)的敲出上涨参与率，已乘以折现因子
+        strike_call: np.ndarray，(n_obs,)的敲出上涨参与的执行价
+        in_rows: np.ndarray，敲入观察的行号
+        in_level: np.ndarray，与in_rows等长的敲入线
+        in_times: int，敲入所需的次数，0为已敲入
+        in_prob: np.ndarray，每条路径的敲入概率，空数组时由in_rows、in_level与in_times判断是否敲入
+        hold_value: float，未敲出未敲入持有到期的收益，已折现
+        strike_upper: float，敲入后看跌价差的高执行价
+        strike_lower: float，敲入后看跌价差的低执行价
+        parti_in: float，敲入后的下跌参与率
+        in_base: float，敲入后到期返还的保证金
+        disc_maturity: float，到期日的折现因子
+    Returns: np.ndarray，(n_path,)的每条路径的折现payoff，float64
+    """
+    n_path = paths.shape[1]
+    payoff = np.empty(n_path)
+    alive = np.ones(n_path, dtype=np.bool_)  # 尚未敲出的路径
+    for k in range(obs_rows.size):
+        row = paths[obs_rows[k]]
+        for j in range(n_path):
+            if alive[j] and row[j] >= barrier_out[k]:
+                payoff[j] = out_value[k] + out_parti[k] * max(row[j] - strike_call[k], 0.)
+                alive[j] = False
+    knock_in = np.zeros(n_path) if in_prob.size == 0 else in_prob
+    if in_prob.size == 0:
+        count = np.zeros(n_path, dtype=np.int64)
+        for k in range(in_rows.size):
+            row = paths[in_rows[k]]
+            for j in range(n_path):
+                if row[j] <= in_level[k]:
+                    count[j] += 1
+        for j in range(n_path):
+            if count[j] >= in_times:
+                knock_in[j] = 1.
+    last_row = paths[paths.shape[0] - 1]
+    for j in range(n_path):
+        if alive[j]:
+            in_value = (max(min(last_row[j] - strike_upper, 0.), strike_lower - strike_upper) * parti_in
+                        + in_base) * disc_maturity
+            payoff[j] = (1 - knock_in[j]) * hold_value + knock_in[j] * in_value
+    return payoff
+
+
+class SnowballFunctional(PathFunctional):
+    """雪球类自动赎回结构的路径泛函，逐日模拟时使用，状态为是否已敲出、敲出收益、敲入次数与最新价格
+    各观察行的判断与snowball_payoff相同"""
+
+    def __init__(self, n_step, obs_rows, barrier_out, out_value, out_parti, strike_call, in_rows, in_level, in_times,
+                 hold_value, strike_upper, strike_lower, parti_in, in_base, disc_maturity):
+        """构造函数
+        Args:
+            n_step: int，到期日的时间步序号，价格路径矩阵共n_step + 1行
+            其余参数见snowball_payoff
+        """
+        self.obs_index = np.full(n_step + 1, -1)  # 每一行对应的敲出观察日序号，-1为非敲出观察日
+        self.obs_index[obs_rows] = np.arange(len(obs_rows))
+        self.in_level = np.full(n_step + 1, np.nan)  # 每一行的敲入线，nan为非敲入观察行
+        self.in_level[in_rows] = in_level
+        self.barrier_out, self.out_value, self.out_parti = barrier_out, out_value, out_parti
+        self.strike_call, self.in_times, self.hold_value = strike_call, in_times, hold_value
+        self.strike_upper, self.strike_lower, self.parti_in = strike_upper, strike_lower, parti_in
+        self.in_base, self.disc_maturity = in_base, disc_maturity
+        self.alive, self.knock_out_payoff, self.in_count, self.s_last = None, None, None, None
+
+    def start(self, spot):
+        self.alive = np.ones(spot.size, dtype=bool)  # 尚未敲出的路径
+        self.knock_out_payoff = np.zeros(spot.size)  # 敲出路径的折现收益
+        self.in_count = np.zeros(spot.size, dtype=np.int64)  # 敲入次数
+        self.update(0, spot)
+
+    def update(self, step, s):
+        k = self.obs_index[step]
+        if k >= 0:
+            hit = self.alive & (s >= self.barrier_out[k])
+            self.knock_out_payoff[hit] = self.out_value[k] + self.out_parti[k] * np.maximum(
+                s[hit] - self.strike_call[k], 0)
+            self.alive &= ~hit
+        if not np.isnan(self.in_level[step]):
+            self.in_count += s <= self.in_level[step]
+        self.s_last = s
+
+    def payoff(self):
+        in_value = (np.maximum(np.minimum(self.s_last - self.strike_upper, 0), self.strike_lower - self.strike_upper)
+                    * self.parti_in + self.in_base) * self.disc_maturity
+        hold_payoff = np.where(self.in_count >= self.in_times, in_value, self.hold_value)
+        return np.where(self.alive, hold_payoff, self.knock_out_payoff)
 
 
 class MCAutoCallableEngine(McEngine):
     """自动赎回结构(雪球类) Monte Carlo 模拟定价引擎
     支持变敲出、变敲入、变票息等要素可变型雪球结构"""
+    supports_stream_paths = True  # 提供路径泛函SnowballFunctional，可以不保存价格路径矩阵
 
     def __init__(self, stoch_process=None, n_path=100000, rands_method=RandsMethod.LowDiscrepancy,
-                 antithetic_variate=True, ld_method=LdMethod.Sobol, seed=0, *,
-                 s=None, r=None, q=None, vol=None):
+                 antithetic_variate=True, ld_method=LdMethod.Sobol, seed=0, *, chunk_size=None, n_workers=None,
+                 obs_dates_only=False, one_pass_greeks=False, dtype=np.float64, control_variates=False,
+                 target_rel_error=None, time_budget=None, importance_shift=None, mlmc_levels=None, mlmc_rmse=None,
+                 stream_paths=False, s=None, r=None, q=None, vol=None):
         """构造函数
         Args:
             stoch_process: 随机过程StochProcessBase对象
@@ -25,6 +129,22 @@ class MCAutoCallableEngine(McEngine):
             antithetic_variate: bool，是否使用对立变量法
             ld_method: 若使用了低差异序列，指定低差异序列方法，LdMethod枚举类，Sobol序列/Halton序列
             seed: int，随机数种子
+            chunk_size: int，分块模拟时每块的路径数，默认None为一次性生成全部路径
+            n_workers: int，并行模拟的线程数，默认None为单线程
+            obs_dates_only: bool，是否只在敲出观察日(及到期日)模拟价格路径，默认False为逐日模拟。
+                            BSM过程使用对数欧拉格式，常数波动率时没有离散化误差；Heston过程需要使用QE或完全截断格式，见HestonScheme。
+                            每日观察的敲入用布朗桥穿越概率计算，Heston过程以方差期望值的平方根作为近似波动率；欧式敲入只在到期日观察
+            one_pass_greeks: bool，pv_and_greeks是否在同一组模拟路径上用路径导数/似然比估计希腊字母，默认False为共同随机数的差分法重新定价
+            dtype: 随机数与价格路径的浮点类型，np.float64(默认)或np.float32
+            control_variates: bool，是否使用控制变量法，默认False，见_knock_in_controls
+            target_rel_error: float，自适应模拟的目标相对误差(标准误差/|现值|)，默认None为模拟全部n_path条路径
+            time_budget: float，自适应模拟的时间预算(秒)，默认None为不限时
+            importance_shift: float或'auto'，重要性抽样的漂移平移量，默认None为不使用，见McEngine
+            mlmc_levels: int，多层蒙特卡洛的层数，默认None为不使用；各层都模拟全部观察日，粗网格上每日观察的敲入用布朗桥计算，
+                         见McEngine
+            mlmc_rmse: float，多层蒙特卡洛的目标均方根误差，默认None为总计算量与n_path条逐日路径相同
+            stream_paths: bool，是否不保存价格路径矩阵，逐日演化时更新敲出、敲入状态，见SnowballFunctional与McEngine；
+                          不能与obs_dates_only同时使用
         在未设置stoch_process时，(stoch_process=None)，会默认创建BSMprocess，需要输入以下变量进行初始化
             s: float，标的价格
             r: float，无风险利率
@@ -32,23 +152,26 @@ class MCAutoCallableEngine(McEngine):
             vol: float，波动率
         """
         super().__init__(stoch_process, n_path, rands_method=rands_method, antithetic_variate=antithetic_variate,
-                         ld_method=ld_method, seed=seed, s=s, r=r, q=q, vol=vol)
+                         ld_method=ld_method, seed=seed, chunk_size=chunk_size, n_workers=n_workers,
+                         one_pass_greeks=one_pass_greeks, dtype=dtype, control_variates=control_variates,
+                         target_rel_error=target_rel_error, time_budget=time_budget, importance_shift=importance_shift,
+                         mlmc_levels=mlmc_levels, mlmc_rmse=mlmc_rmse, stream_paths=stream_paths,
+                         s=s, r=r, q=q, vol=vol)
+        if stream_paths and obs_dates_only:
+            raise ValueError("逐步更新路径泛函(stream_paths=True)时逐日模拟，不能同时设置obs_dates_only=True")
+        self.obs_dates_only = obs_dates_only  # 是否只在观察日模拟价格路径
         # 以下为计算过程的中间变量
         self.prod = None  # Product产品对象
         self.obs_dates = None  # 根据估值日，将敲出观察日转化为List[int]，交易日期限
         self.pay_dates = None  # 根据起始日，将支付日转化为List[float]，年化自然日期限，用于计算票息
         self.pay_dates_tau = None  # 根据估值日，将支付日转化为List[float]，年化自然日期限，用于折现
         self._maturity = None  # 年化到期时间
-        self.knock_out_date = None  # 每条路径的敲出时间
-        self.not_knock_out = None  # 每条路径是否未敲出
-        self.knock_in_scenario = None  # 每天路径是否敲入
-        self.knock_out_profit = None  # 敲出payoff加总
-        self.hold_to_maturity_profit = None  # 持有到期payoff加总
-        self.knock_in_loss = None  # 敲入payoff加总
         # 经过估值日截断的列表，例如prod.barrier_out有22个，存续一年时估值，_barrier_out只有12个
         self._barrier_out = None
         self._barrier_in = None
         self._coupon_out = None
+        self._sim_steps = None  # 只在观察日模拟时，模拟的时间步；逐日模拟时为None
+        self._obs_rows = None  # 敲出观察日在价格路径矩阵中的行号
 
     def calc_present_value(self, prod, t=None, spot=None):
         """计算现值
@@ -76,118 +199,170 @@ class MCAutoCallableEngine(McEngine):
         self._barrier_out = prod.barrier_out[-len(self.obs_dates):].copy()
         self._barrier_in = prod.barrier_in[-len(self.obs_dates):].copy()
         self._coupon_out = prod.coupon_out[-len(self.obs_dates):].copy()
+        self._set_sim_steps(_maturity_business_days)
         if spot is None:
             spot = self.process.spot()
         else:
             self.reset_paths_flag()  # 重置路径标志位，重新生成路径
 
-        self.s_paths = self.path_generator(n_step=_maturity_business_days, spot=spot,
-                                           t_step_per_year=prod.t_step_per_year).copy()
-        # 统计各个情景的payoff
-        self._cal_knock_out_date()
-        self._cal_knock_out_payoff()
-        self._cal_knock_in_scenario(calculate_date)
-        self._cal_hold_to_maturity_payoff()
-        self._cal_knock_in_payoff()
-        result = (self.knock_out_profit + self.hold_to_maturity_profit + self.knock_in_loss) / self.n_path
+        if self._use_mlmc(_maturity_business_days):
+            return self._mlmc_autocall(_maturity_business_days, spot)
+        if self.stream_paths:
+            return self._functional_expectation(lambda: self._snowball_functional(_maturity_business_days),
+                                                _maturity_business_days, spot, prod.t_step_per_year)
+        result = self._mc_expectation(self._path_payoff, n_step=_maturity_business_days, spot=spot,
+                                      t_step_per_year=prod.t_step_per_year, steps=self._sim_steps,
+                                      controls=self._knock_in_controls(_maturity_business_days, spot))
         return result
 
-    def _cal_knock_out_date(self):
-        """计算每条路径敲出时间"""
-        # 敲出部分
-        knock_out_scenario = np.tile(self.obs_dates, (self.n_path, 1)).T
-        barrier_out = np.array(self._barrier_out)
-        barrier_out = np.tile(barrier_out, (self.n_path, 1)).T
-        # 记录每条路径的具体敲出日，如果无敲出则保留inf      注意：路径矩阵包含了期初S0的行
-        knock_out_scenario = np.where(self.s_paths[self.obs_dates] >= barrier_out,
-                                      knock_out_scenario.astype(int), np.inf)
-        self.knock_out_date = np.min(knock_out_scenario, axis=0)
-        self.not_knock_out = self.knock_out_date == np.inf
-
-    def _cal_knock_out_payoff(self):
-        """计算敲出部分的payoff"""
+    def _knock_in_controls(self, n_step, spot):
+        """敲入部分的控制变量，未设置control_variates时返回None
+        敲入后到期损益是执行价strike_upper与strike_lower之间的看跌价差空头，以到期标的价格为控制变量；
+        常数波动率BSM过程下增加同一布朗运动驱动的几何布朗运动上执行价分别为strike_upper、strike_lower的欧式看跌期权，期望由BSM公式计算
+        Args:
+            n_step: int，到期日的时间步序号
+            spot: float，标的期初价格
+        Returns: List[tuple]，控制变量列表，见McEngine._mc_expectation
+        """
+        if not self.control_variates:
+            return None
+        prod = self.prod
+        controls = [self._terminal_control(n_step, spot, prod.t_step_per_year, self._sim_steps)]
+        gbm_fn = self._gbm_control_fn(n_step, spot, prod.t_step_per_year, self._sim_steps)
+        if gbm_fn is None or n_step == 0:
+            return controls
+        maturity = n_step / prod.t_step_per_year
+        r, q = self.process.interest(maturity), self.process.div(maturity)
+        vol = self.process.vol(maturity, spot)
+        strikes = np.array([strike for strike in (prod.strike_upper, prod.strike_lower) if strike > 0], dtype=float)
+        if strikes.size > 0:
+            put_values = [bs_formula(S=spot, K=strike, T=maturity, r=r, q=q, sigma=vol, sign=-1) for strike in strikes]
+            controls.append((lambda paths: np.maximum(strikes[:, np.newaxis] - gbm_fn(paths)[-1], 0),
+                             np.array(put_values) * np.exp(r * maturity)))
+        return controls
+
+    def _mlmc_autocall(self, n_step, spot, *other_obs_days):
+        """多层蒙特卡洛定价，各层网格都包含敲出观察日、other_obs_days与到期日，见McEngine._mlmc_expectation
+        Args:
+            n_step: int，估值日到到期日的交易日数
+            spot: float，标的期初价格
+            other_obs_days: np.ndarray，敲出观察日以外的其他观察日(距离估值日的交易日数)
+        Returns: float，现值
+        """
+
+        def payoff_factory(steps):
+            def path_payoff(paths):
+                self._use_sim_steps(steps)
+                return self._path_payoff(paths)
+
+            return path_payoff
+
+        fixed_steps = np.concatenate([self.obs_dates, *other_obs_days]).astype(int)
+        try:
+            return self._mlmc_expectation(payoff_factory, n_step, spot, self.prod.t_step_per_year, fixed_steps)
+        finally:
+            self._set_sim_steps(n_step, *other_obs_days)
+
+    def _set_sim_steps(self, maturity_business_days, *other_obs_days):
+        """设置模拟的时间步，以及敲出观察日在价格路径矩阵中的行号
+        逐日模拟时，价格路径矩阵的行号就是距离估值日的交易日数；只在观察日模拟时，只保留各类观察日和到期日
+        Args:
+            maturity_business_days: int，估值日到到期日的交易日数
+            other_obs_days: np.ndarray，敲出观察日以外的其他观察日(距离估值日的交易日数)
+        """
+        if self.obs_dates_only:
+            days = np.concatenate([self.obs_dates, *other_obs_days, [maturity_business_days]]).astype(int)
+            self._use_sim_steps(np.unique(days[days > 0]))
+        else:
+            self._use_sim_steps(None)
+
+    def _use_sim_steps(self, steps):
+        """切换模拟的时间步，并更新各类观察日在价格路径矩阵中的行号
+        Args:
+            steps: np.ndarray，升序的模拟时间步，None为逐日模拟
+        """
+        self._sim_steps = steps
+        self._obs_rows = self._step_rows(self.obs_dates)
+
+    def _step_rows(self, days):
+        """距离估值日的交易日数在价格路径矩阵中的行号，只在观察日模拟时days必须是模拟的时间步之一"""
+        if self._sim_steps is None:
+            return days
+        return np.where(days > 0, np.searchsorted(self._sim_steps, days) + 1, days)
+
+    def _path_payoff(self, paths):
+        """统计各个情景的payoff，返回每条路径的折现payoff
+        逐路径的计算由编译函数snowball_payoff完成，这里只准备长度为观察日数或路径矩阵行数的参数数组，不生成路径规模的中间矩阵
+        Args:
+            paths: np.ndarray，价格路径矩阵
+        Returns: np.ndarray，每条路径的折现payoff
+        """
+        params = self._payoff_params(paths.shape[0])
+        in_prob = np.empty(0)
+        if params[5] is None:  # 只在观察日模拟且每日观察敲入，由布朗桥计算敲入概率
+            in_prob = self._bridge_hit_prob(paths, self._sim_steps, params[6], self.prod.t_step_per_year)
+            params = params[:5] + (np.empty(0, np.int64), np.empty(0)) + params[7:]
+        return snowball_payoff(paths, *params[:8], np.ascontiguousarray(in_prob, dtype=np.float64), *params[8:])
+
+    def _snowball_functional(self, n_step):
+        """逐步更新路径泛函(stream_paths=True)时，每块路径使用的路径泛函，见SnowballFunctional
+        Args:
+            n_step: int，估值日到到期日的交易日数
+        Returns: SnowballFunctional，路径泛函
+        """
+        return SnowballFunctional(n_step, *self._payoff_params(n_step + 1))
+
+    def _payoff_params(self, n_row):
+        """snowball_payoff除价格路径与敲入概率以外的参数，见snowball_payoff
+        Args:
+            n_row: int，价格路径矩阵的行数
+        Returns: tuple，只在观察日模拟且每日观察敲入时，敲入观察的行号in_rows为None，敲入线in_level为各行的敲入线
+        """
         prod = self.prod
-        is_knock_out = self.knock_out_date != np.inf
-        # 每个交易日敲出票息
-        coupon_call_array = np.array(self._coupon_out).repeat(
-            np.diff(np.append(np.zeros((1,)), self.obs_dates)).astype(int))
-        coupon_call_array = np.append(self._coupon_out[0], coupon_call_array)
-        # 每条路径敲出交易日序列
-        knock_out_time = self.knock_out_date[is_knock_out].astype(int)
-        coupon_call = coupon_call_array[knock_out_time]
-        # 每个交易日对应的自然日的下一个敲出观察自然日
-        next_calendar_day = np.array(self.pay_dates).repeat(
-            np.diff(np.append(np.zeros((1,)), self.obs_dates)).astype(int))
-        next_calendar_day = np.append(self.pay_dates[0], next_calendar_day)
-        # 所有敲出路径的起息日到敲出支付日的时间，年化，计算支付票息用
-        knock_out_time_annual = next_calendar_day[knock_out_time]
-        # 所有敲出路径的估值日到敲出支付日的时间，年化，折现用
-        next_calendar_day_tau = np.array(self.pay_dates_tau).repeat(
-            np.diff(np.append(np.zeros((1,)), self.obs_dates)).astype(int))
-        next_calendar_day_tau = np.append(self.pay_dates_tau[0], next_calendar_day_tau)
-        knock_out_tau = next_calendar_day_tau[knock_out_time]
-        # 计算敲出价格，用于上涨参与payoff
+        disc_out = self.process.interest.disc_factor(np.asarray(self.pay_dates_tau))  # 敲出支付日的折现因子
+        accrual = 1 if prod.trigger else np.asarray(self.pay_dates)  # 起息日到敲出支付日的年化时间，计算票息用
+        out_value = prod.s0 * (np.asarray(self._coupon_out) * accrual + prod.margin_lvl) * disc_out
         if isinstance(prod.strike_call, (int, float)):
-            strike_call = prod.strike_call
+            strike_call = np.full(len(self.obs_dates), prod.strike_call, dtype=np.float64)
         elif isinstance(prod.strike_call, (list, np.ndarray)) and len(prod.strike_call) == len(self.obs_dates):
-            strike_call_array = (np.array(prod.strike_call)).repeat(
-                np.diff(np.append(np.zeros((1,)), self.obs_dates)).astype(int))
-            strike_call_array = np.append(prod.strike_call[0], strike_call_array)
-            strike_call = strike_call_array[knock_out_time]
+            strike_call = np.asarray(prod.strike_call, dtype=np.float64)
         else:
             raise ValueError("敲出看涨执行价设置错误")
-        # 把payoff先折现再求和,计算敲出总所入
-        value = np.sum((prod.s0 * (coupon_call * (knock_out_time_annual if not prod.trigger else 1) + prod.margin_lvl)
-                        + prod.parti_out * np.where(self.s_paths[knock_out_time, is_knock_out] > strike_call,
-                                                    self.s_paths[knock_out_time, is_knock_out] - strike_call, 0))
-                        * self.process.interest.disc_factor(knock_out_tau))
-        self.knock_out_profit = value
-
-    def _cal_knock_in_scenario(self, *args, **kwargs):
-        """统计敲入的路径"""
-        prod = self.prod
-        if prod.status == StatusType.DownTouch:
-            pass
+        disc_maturity = self.process.interest.disc_factor(self._maturity)
+        if prod.status == StatusType.DownTouch:  # 已敲入，未敲出的路径都按敲入计算
+            hold_value = 0.
+            in_rows, in_level, in_times = np.empty(0, np.int64), np.empty(0), 0
         else:
-            # 判断某一条路径是否有敲入
-            if isinstance(prod.barrier_in, (int, float)):
-                knock_in_level = prod.barrier_in
-            elif isinstance(prod.barrier_in, (list, np.ndarray)):
-                knock_in_level = np.array(self._barrier_in).repeat(
-                    np.diff(np.append(np.zeros((1,)), self.obs_dates)).astype(int))
-                knock_in_level = np.append(self._barrier_in[0], knock_in_level)
-            else:
-                raise ValueError("敲入线设置错误")
-            knock_in_level = np.tile(knock_in_level, (self.n_path, 1)).T
-            self.knock_in_scenario = np.any(self.s_paths <= knock_in_level, axis=0)
-
-    def _cal_hold_to_maturity_payoff(self):
-        """计算持有到期的payoff"""
-        # 到期红利部分
-        prod = self.prod
-        if prod.status == StatusType.DownTouch:  # 已敲入
-            self.hold_to_maturity_profit = 0
-        else:
-            # 持有到期，没有敲入也没有敲出
-            hold_to_maturity = (~self.knock_in_scenario) & self.not_knock_out
-            # 平稳持有到期路径条数
-            hold_to_maturity_count = np.count_nonzero(hold_to_maturity)
-            # 未敲出未敲入到期收入
-            value = (hold_to_maturity_count * (prod.coupon_div * (self.pay_dates[-1] if not prod.trigger else 1)
-                                               + prod.margin_lvl) * prod.s0 * self.process.interest.disc_factor(
-                self._maturity))
-            self.hold_to_maturity_profit = value
-
-    def _cal_knock_in_payoff(self):
-        """计算敲入部分的payoff"""
+            hold_value = ((prod.coupon_div * (self.pay_dates[-1] if not prod.trigger else 1) + prod.margin_lvl)
+                          * prod.s0 * disc_maturity)
+            in_rows, in_level, in_times = self._knock_in_rule(n_row)
+            if in_rows is not None:
+                in_rows = np.asarray(in_rows, dtype=np.int64)
+        return (np.asarray(self._obs_rows, dtype=np.int64), np.asarray(self._barrier_out, dtype=np.float64),
+                out_value, prod.parti_out * disc_out, strike_call, in_rows,
+                np.ascontiguousarray(in_level, dtype=np.float64), in_times, hold_value, float(prod.strike_upper),
+                float(prod.strike_lower), float(prod.parti_in), prod.margin_lvl * prod.s0, disc_maturity)
+
+    def _knock_in_rule(self, n_row):
+        """敲入规则: 在敲入观察行上低于等于敲入线的次数达到in_times次即为敲入
+        Args:
+            n_row: int，价格路径矩阵的行数
+        Returns: (in_rows, in_level, in_times)，敲入观察的行号、各行的敲入线、敲入所需次数；
+                 只在观察日模拟且每日观察敲入时in_rows为None，in_level为路径矩阵各行的敲入线，由布朗桥计算敲入概率
+        """
         prod = self.prod
-        if prod.status == StatusType.DownTouch:  # 已敲入
-            value = np.sum(np.maximum(np.minimum(self.s_paths[-1, self.not_knock_out] - prod.strike_upper, 0),
-                                      prod.strike_lower - prod.strike_upper) * prod.parti_in
-                           + prod.margin_lvl * prod.s0) * self.process.interest.disc_factor(self._maturity)
+        if isinstance(prod.barrier_in, (int, float)):
+            knock_in_level = prod.barrier_in
+        elif isinstance(prod.barrier_in, (list, np.ndarray)):
+            knock_in_level = np.array(self._barrier_in).repeat(
+                np.diff(np.append(np.zeros((1,)), self.obs_dates)).astype(int))
+            knock_in_level = np.append(self._barrier_in[0], knock_in_level)
         else:
-            value = np.sum(np.maximum(np.minimum(self.s_paths[-1, self.not_knock_out & self.knock_in_scenario]
-                                                 - prod.strike_upper, 0),
-                                      prod.strike_lower - prod.strike_upper) * prod.parti_in
-                           + prod.margin_lvl * prod.s0) * self.process.interest.disc_factor(self._maturity)
-        self.knock_in_loss = value
+            raise ValueError("敲入线设置错误")
+        if self._sim_steps is not None:
+            knock_in_level = np.broadcast_to(knock_in_level, (self._sim_steps[-1] + 1,))
+            knock_in_level = knock_in_level[np.append(0, self._sim_steps)]  # 模拟时点的敲入线
+            if prod.in_obs_type == ExerciseType.European:  # 敲入观察为欧式，仅到期观察敲入
+                return np.array([n_row - 1]), knock_in_level[-1:], 1
+            return None, knock_in_level, 1
+        return np.arange(n_row), np.broadcast_to(knock_in_level, (n_row,)), 1
@@ -4,15 +4,60 @@
 Copyright (C) 2024 Galaxy Technologies
 Licensed under the Apache License, Version 2.0
 """
+import copy
 import numpy as np
 from pricelib.common.time import global_evaluation_date
-from pricelib.common.utilities.enums import InOut, UpDown, PaymentType
+from pricelib.common.utilities.enums import InOut, UpDown, PaymentType, RandsMethod, LdMethod
 from pricelib.common.pricing_engine_base import McEngine
+from pricelib.pricing_engines.analytic_engines.analytic_vanilla_european_engine import bs_formula
+from pricelib.pricing_engines.analytic_engines.analytic_barrier_engine import AnalyticBarrierEngine
 
 
 class MCBarrierEngine(McEngine):
     """障碍期权 Monte Carlo 模拟定价引擎
-    只支持离散观察(默认为每日观察)；敲入现金返还为到期支付；敲出现金返还为到期支付"""
+    默认逐日模拟，只支持离散观察(连续观察按每日观察处理)；设置bridge_step时使用布朗桥模式，支持连续观察；
+    敲入现金返还为到期支付；敲出现金返还为到期支付
+    控制变量为到期标的价格；常数波动率BSM过程下增加同一布朗运动驱动的几何布朗运动上的欧式期权(BSM公式)与连续观察障碍期权
+    (AnalyticBarrierEngine闭式解)"""
+
+    def __init__(self, stoch_process=None, n_path=100000, rands_method=RandsMethod.LowDiscrepancy,
+                 antithetic_variate=True, ld_method=LdMethod.Sobol, seed=0, *, chunk_size=None, n_workers=None,
+                 bridge_step=None, one_pass_greeks=False, dtype=np.float64, control_variates=False,
+                 target_rel_error=None, time_budget=None, importance_shift=None, mlmc_levels=None, mlmc_rmse=None,
+                 s=None, r=None, q=None, vol=None):
+        """构造函数
+        Args:
+            stoch_process: 随机过程StochProcessBase对象
+            n_path: int，MC模拟路径数
+            rands_method: 生成随机数方法，RandsMethod枚举类，Pseudorandom伪随机数/LowDiscrepancy低差异序列
+            antithetic_variate: bool，是否使用对立变量法
+            ld_method: 若使用了低差异序列，指定低差异序列方法，LdMethod枚举类，Sobol序列/Halton序列
+            seed: int，随机数种子
+            chunk_size: int，分块模拟时每块的路径数，默认None为一次性生成全部路径
+            n_workers: int，并行模拟的线程数，默认None为单线程
+            bridge_step: int，布朗桥模式下连续观察时相邻模拟时点间隔的交易日数，默认None为逐日模拟、只在模拟时点上判断敲入敲出。
+                         布朗桥模式仅支持BSM过程：离散观察时只在观察日模拟；连续观察时每bridge_step个交易日模拟一次，
+                         用布朗桥计算相邻模拟时点之间触碰障碍的概率
+            one_pass_greeks: bool，pv_and_greeks是否在同一组模拟路径上用路径导数/似然比估计希腊字母，默认False为共同随机数的差分法重新定价
+            dtype: 随机数与价格路径的浮点类型，np.float64(默认)或np.float32
+            control_variates: bool，是否使用控制变量法，默认False，见_barrier_controls
+            target_rel_error: float，自适应模拟的目标相对误差(标准误差/|现值|)，默认None为模拟全部n_path条路径
+            time_budget: float，自适应模拟的时间预算(秒)，默认None为不限时
+            importance_shift: float或'auto'，重要性抽样的漂移平移量，默认None为不使用，见McEngine
+            mlmc_levels: int，多层蒙特卡洛的层数，默认None为不使用；粗网格上用布朗桥计算逐日观察触碰障碍的概率，见McEngine
+            mlmc_rmse: float，多层蒙特卡洛的目标均方根误差，默认None为总计算量与n_path条逐日路径相同
+        在未设置stoch_process时，(stoch_process=None)，会默认创建BSMprocess，需要输入以下变量进行初始化
+            s: float，标的价格
+            r: float，无风险利率
+            q: float，分红/融券率
+            vol: float，波动率
+        """
+        super().__init__(stoch_process, n_path, rands_method=rands_method, antithetic_variate=antithetic_variate,
+                         ld_method=ld_method, seed=seed, chunk_size=chunk_size, n_workers=n_workers,
+                         one_pass_greeks=one_pass_greeks, dtype=dtype, control_variates=control_variates,
+                         target_rel_error=target_rel_error, time_budget=time_budget, importance_shift=importance_shift,
+                         mlmc_levels=mlmc_levels, mlmc_rmse=mlmc_rmse, s=s, r=r, q=q, vol=vol)
+        self.bridge_step = bridge_step  # 布朗桥模式下相邻模拟时点间隔的交易日数
 
     def calc_present_value(self, prod, t=None, spot=None):
         """计算现值
@@ -30,9 +75,6 @@ class MCBarrierEngine(McEngine):
         else:
             self.reset_paths_flag()  # 重置路径标志位，重新生成路径
 
-        paths = self.path_generator(n_step=_maturity_business_days, spot=spot,
-                                    t_step_per_year=prod.t_step_per_year).copy()
-
         if prod.discrete_obs_interval is None:  # 每日观察
             obs_points = np.arange(0, _maturity_business_days + 1, 1)
         else:  # 均匀离散观察
@@ -40,38 +82,153 @@ class MCBarrierEngine(McEngine):
             obs_points = np.flip(np.round(np.arange(_maturity_business_days, 0, -dt_step)).astype(int))
             obs_points = np.concatenate((np.array([0]), obs_points))
             obs_points[obs_points > _maturity_business_days] = _maturity_business_days  # 防止闰年导致的下标越界
-
-        if prod.updown == UpDown.Up:
-            knock_inout = np.any(paths[obs_points] >= prod.barrier, axis=0)
-        elif prod.updown == UpDown.Down:
-            knock_inout = np.any(paths[obs_points] <= prod.barrier, axis=0)
-        else:
+        if prod.updown not in (UpDown.Up, UpDown.Down):
             raise ValueError("不支持的UpDown类型")
+        if prod.inout not in (InOut.In, InOut.Out):
+            raise ValueError("不支持的InOut类型")
+        if prod.inout == InOut.Out and prod.payment_type not in (PaymentType.Hit, PaymentType.Expire):
+            raise ValueError("PaymentType must be Hit or Expire")
+
+        if self._use_mlmc(_maturity_business_days):
+            return self._mlmc_expectation(self._mlmc_payoff_factory(prod, obs_points, _maturity),
+                                          n_step=_maturity_business_days, spot=spot,
+                                          t_step_per_year=prod.t_step_per_year,
+                                          fixed_steps=() if prod.discrete_obs_interval is None else obs_points)
+        if self.bridge_step is not None:
+            steps = self._bridge_steps(_maturity_business_days, self.bridge_step,
+                                       None if prod.discrete_obs_interval is None else obs_points)
+            obs_step = None if prod.discrete_obs_interval is None else int(np.max(np.diff(np.append(0, steps))))
+            controls = self._barrier_controls(prod, calculate_date, spot, _maturity_business_days, steps
+                                              ) if self.control_variates else None
+            return self._mc_expectation(self._bridge_payoff_fn(prod, steps, _maturity, obs_step, prod.barrier),
+                                        n_step=_maturity_business_days, spot=spot,
+                                        t_step_per_year=prod.t_step_per_year, steps=steps, controls=controls)
 
-        if prod.inout == InOut.In:
-            payoff = np.ones(paths[-1].size) * prod.rebate
-            payoff[knock_inout] = np.maximum(prod.callput.value * (paths[-1, knock_inout] - prod.strike),
-                                             0) * prod.parti
-            price = np.mean(payoff) * self.process.interest.disc_factor(_maturity)
-            return price
-        elif prod.inout == InOut.Out:
+        def path_payoff(paths):
+            """每条路径的折现payoff"""
+            if prod.updown == UpDown.Up:
+                hit_bool = paths[obs_points] >= prod.barrier
+            else:  # prod.updown == UpDown.Down
+                hit_bool = paths[obs_points] <= prod.barrier
+            knock_inout = np.any(hit_bool, axis=0)
+
+            if prod.inout == InOut.In:
+                payoff = np.ones(paths[-1].size) * prod.rebate
+                payoff[knock_inout] = np.maximum(prod.callput.value * (paths[-1, knock_inout] - prod.strike),
+                                                 0) * prod.parti
+                return payoff * self.process.interest.disc_factor(_maturity)
+            # prod.inout == InOut.Out
             payoff = np.maximum(prod.callput.value * (paths[-1] - prod.strike), 0
                                 ) * prod.parti * self.process.interest.disc_factor(_maturity)
             if prod.payment_type == PaymentType.Expire:  # 敲出时，到期再支付现金返还
                 payoff[knock_inout] = prod.rebate * self.process.interest.disc_factor(_maturity)
-            elif prod.payment_type == PaymentType.Hit:  # 敲出时，立即支付现金返还
-                step_index = np.tile(obs_points, (self.n_path, 1)).T.astype(int)
-                if prod.updown == UpDown.Up:
-                    hit_time = np.min(np.where(paths[obs_points] >= prod.barrier, step_index, np.inf), axis=0)
-                elif prod.updown == UpDown.Down:
-                    hit_time = np.min(np.where(paths[obs_points] <= prod.barrier, step_index, np.inf), axis=0)
-                else:
-                    raise ValueError("不支持的UpDown类型")
+            else:  # prod.payment_type == PaymentType.Hit，敲出时，立即支付现金返还
+                step_index = np.tile(obs_points, (paths.shape[1], 1)).T.astype(int)
+                hit_time = np.min(np.where(hit_bool, step_index, np.inf), axis=0)
                 payoff[knock_inout] = prod.rebate * self.process.interest.disc_factor(
                     hit_time[hit_time != np.inf] / prod.t_step_per_year)
-            else:
-                raise ValueError("PaymentType must be Hit or Expire")
-            price = np.mean(payoff)
-            return price
-        else:
-            raise ValueError("不支持的InOut类型")
+            return payoff
+
+        controls = self._barrier_controls(prod, calculate_date, spot, _maturity_business_days
+                                          ) if self.control_variates else None
+        price = self._mc_expectation(path_payoff, n_step=_maturity_business_days, spot=spot,
+                                     t_step_per_year=prod.t_step_per_year, controls=controls)
+        return price
+
+    def _barrier_controls(self, prod, calculate_date, spot, n_step, steps=None):
+        """障碍期权的控制变量: 到期标的价格；常数波动率BSM过程下增加同一布朗运动驱动的几何布朗运动G上的
+        同一执行价的欧式期权，期望由BSM公式计算；期初未触碰障碍时，再增加G上连续观察、无现金返还的同类障碍期权，
+        相邻模拟时点之间用布朗桥计算触碰障碍的条件概率，其期望等于AnalyticBarrierEngine的连续观察闭式解
+        Args:
+            prod: Product产品对象
+            calculate_date: datetime.date，估值日
+            spot: float，标的期初价格
+            n_step: int，到期日的时间步序号
+            steps: np.ndarray，只在这些时间步上模拟，默认None为逐日模拟
+        Returns: List[tuple]，控制变量列表，见McEngine._mc_expectation
+        """
+        controls = [self._terminal_control(n_step, spot, prod.t_step_per_year, steps)]
+        gbm_fn = self._gbm_control_fn(n_step, spot, prod.t_step_per_year, steps)
+        if gbm_fn is None or n_step == 0:
+            return controls
+        maturity = n_step / prod.t_step_per_year
+        r, q = self.process.interest(maturity), self.process.div(maturity)
+        vol = self.process.vol(maturity, spot)
+        sign = prod.callput.value
+        disc_factor = np.exp(-r * maturity)
+        controls.append((lambda paths: np.maximum(sign * (gbm_fn(paths)[-1] - prod.strike), 0) * disc_factor,
+                         bs_formula(S=spot, K=prod.strike, T=maturity, r=r, q=q, sigma=vol, sign=sign)))
+        if (prod.updown == UpDown.Up and spot >= prod.barrier) or (prod.updown == UpDown.Down and spot <= prod.barrier):
+            return controls
+        # 连续观察、无现金返还、参与率为1的同类障碍期权，期望为闭式解
+        continuous = copy.copy(prod)
+        continuous.discrete_obs_interval, continuous.rebate, continuous.parti = None, 0, 1
+        continuous.payment_type = PaymentType.Expire if prod.inout == InOut.In else PaymentType.Hit
+        barrier_value = AnalyticBarrierEngine(self.process).calc_present_value(continuous, t=calculate_date, spot=spot)
+        grid_steps = np.arange(1, n_step + 1) if steps is None else steps
+        barrier = {'upper' if prod.updown == UpDown.Up else 'lower': prod.barrier}
+
+        def barrier_payoff(paths):
+            gbm_paths = gbm_fn(paths)
+            hit_lower, hit_upper = self._bridge_first_hit(gbm_paths, grid_steps, prod.t_step_per_year, **barrier)
+            knock_inout = np.sum(hit_lower + hit_upper, axis=0)
+            vanilla = np.maximum(sign * (gbm_paths[-1] - prod.strike), 0) * disc_factor
+            return vanilla * (knock_inout if prod.inout == InOut.In else 1 - knock_inout)
+
+        controls.append((barrier_payoff, barrier_value))
+        return controls
+
+    def _mlmc_payoff_factory(self, prod, obs_points, _maturity):
+        """多层蒙特卡洛各层网格上的payoff函数，各层网格都包含全部观察日
+        每日观察时，相邻模拟时点之间用布朗桥计算逐日观察触碰障碍的概率(Broadie-Glasserman-Kou修正)，最细层逐日比较障碍价格；
+        离散观察时，只在观察日比较障碍价格，其余模拟时点不观察
+        Args:
+            prod: Product产品对象
+            obs_points: np.ndarray，观察日的时间步序号(含估值日0)
+            _maturity: float，到期时间(年化)
+        Returns: Callable，输入模拟的时间步，返回该网格上的逐路径折现payoff函数，见McEngine._mlmc_expectation
+        """
+        if prod.discrete_obs_interval is None:
+            return lambda steps: self._bridge_payoff_fn(prod, steps, _maturity, 1, prod.barrier)
+        obs_step = int(np.max(np.diff(obs_points))) if obs_points.size > 1 else 1
+        no_barrier = np.inf if prod.updown == UpDown.Up else 0.
+
+        def payoff_factory(steps):
+            is_obs = np.isin(np.concatenate(([0], steps)), obs_points)
+            return self._bridge_payoff_fn(prod, steps, _maturity, obs_step, np.where(is_obs, prod.barrier, no_barrier))
+
+        return payoff_factory
+
+    def _bridge_payoff_fn(self, prod, steps, _maturity, obs_step, barrier):
+        """布朗桥模式的逐路径折现payoff函数，payoff按首次触碰障碍的概率加权
+        Args:
+            prod: Product产品对象
+            steps: np.ndarray，模拟的时间步序号
+            _maturity: float，到期时间(年化)
+            obs_step: int，离散观察的间隔交易日数，None为连续观察，见McEngine._bridge_first_hit
+            barrier: float或np.ndarray，障碍价格；数组时每个元素对应价格路径矩阵的一行，见McEngine._bridge_first_hit
+        Returns: Callable，输入(len(steps) + 1, n)的价格路径矩阵，返回逐路径的折现payoff
+        """
+        disc_factor = self.process.interest.disc_factor(_maturity)
+        hit_disc_factor = self.process.interest.disc_factor(np.concatenate(([0], steps)) / prod.t_step_per_year)
+
+        def path_payoff(paths):
+            """每条路径的折现payoff"""
+            if prod.updown == UpDown.Up:
+                hit_lower, hit_upper = self._bridge_first_hit(paths, steps, prod.t_step_per_year, upper=barrier,
+                                                              obs_step=obs_step)
+            else:  # prod.updown == UpDown.Down
+                hit_lower, hit_upper = self._bridge_first_hit(paths, steps, prod.t_step_per_year, lower=barrier,
+                                                              obs_step=obs_step)
+            hit_prob = hit_lower + hit_upper
+            knock_inout = np.sum(hit_prob, axis=0)
+            vanilla = np.maximum(prod.callput.value * (paths[-1] - prod.strike), 0) * prod.parti * disc_factor
+            if prod.inout == InOut.In:
+                return vanilla * knock_inout + prod.rebate * disc_factor * (1 - knock_inout)
+            # prod.inout == InOut.Out
+            if prod.payment_type == PaymentType.Expire:  # 敲出时，到期再支付现金返还
+                return vanilla * (1 - knock_inout) + prod.rebate * disc_factor * knock_inout
+            # prod.payment_type == PaymentType.Hit，敲出时，在首次触碰障碍所在区间的期末支付现金返还
+            return vanilla * (1 - knock_inout) + prod.rebate * (hit_disc_factor @ hit_prob)
+
+        return path_payoff
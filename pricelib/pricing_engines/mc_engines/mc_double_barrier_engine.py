@@ -6,15 +6,50 @@ Licensed under the Apache License, Version 2.0
 """
 import math
 import numpy as np
-from pricelib.common.utilities.enums import InOut, ExerciseType, PaymentType
+from pricelib.common.utilities.enums import InOut, ExerciseType, PaymentType, RandsMethod, LdMethod
 from pricelib.common.time import global_evaluation_date
 from pricelib.common.pricing_engine_base import McEngine
 
 
 class MCDoubleBarrierEngine(McEngine):
     """双边障碍期权 Monte Carlo 模拟定价引擎
-    支持欧式观察(仅到期观察)/美式观察(整个有效期观察)；只支持离散观察(默认为每日观察)；
-    支持现金返还；敲入现金返还为到期支付；敲出现金返还支持 立即支付/到期支付"""
+    支持欧式观察(仅到期观察)/美式观察(整个有效期观察)；默认逐日模拟，只支持离散观察(默认为每日观察)；
+    支持现金返还；敲入现金返还为到期支付；敲出现金返还支持 立即支付/到期支付；
+    设置bridge_step时使用布朗桥模式，支持连续观察"""
+
+    def __init__(self, stoch_process=None, n_path=100000, rands_method=RandsMethod.LowDiscrepancy,
+                 antithetic_variate=True, ld_method=LdMethod.Sobol, seed=0, *, chunk_size=None, n_workers=None,
+                 bridge_step=None, one_pass_greeks=False, dtype=np.float64, target_rel_error=None,
+                 time_budget=None, importance_shift=None, s=None, r=None, q=None, vol=None):
+        """构造函数
+        Args:
+            stoch_process: 随机过程StochProcessBase对象
+            n_path: int，MC模拟路径数
+            rands_method: 生成随机数方法，RandsMethod枚举类，Pseudorandom伪随机数/LowDiscrepancy低差异序列
+            antithetic_variate: bool，是否使用对立变量法
+            ld_method: 若使用了低差异序列，指定低差异序列方法，LdMethod枚举类，Sobol序列/Halton序列
+            seed: int，随机数种子
+            chunk_size: int，分块模拟时每块的路径数，默认None为一次性生成全部路径
+            n_workers: int，并行模拟的线程数，默认None为单线程
+            bridge_step: int，布朗桥模式下连续观察时相邻模拟时点间隔的交易日数，默认None为逐日模拟、只在模拟时点上判断敲入敲出。
+                         布朗桥模式仅支持BSM过程：离散观察时只在观察日模拟；连续观察时每bridge_step个交易日模拟一次，
+                         用布朗桥计算相邻模拟时点之间触碰障碍的概率
+            one_pass_greeks: bool，pv_and_greeks是否在同一组模拟路径上用路径导数/似然比估计希腊字母，默认False为共同随机数的差分法重新定价
+            dtype: 随机数与价格路径的浮点类型，np.float64(默认)或np.float32
+            target_rel_error: float，自适应模拟的目标相对误差(标准误差/|现值|)，默认None为模拟全部n_path条路径
+            time_budget: float，自适应模拟的时间预算(秒)，默认None为不限时
+            importance_shift: float或'auto'，重要性抽样的漂移平移量，默认None为不使用，见McEngine
+        在未设置stoch_process时，(stoch_process=None)，会默认创建BSMprocess，需要输入以下变量进行初始化
+            s: float，标的价格
+            r: float，无风险利率
+            q: float，分红/融券率
+            vol: float，波动率
+        """
+        super().__init__(stoch_process, n_path, rands_method=rands_method, antithetic_variate=antithetic_variate,
+                         ld_method=ld_method, seed=seed, chunk_size=chunk_size, n_workers=n_workers,
+                         one_pass_greeks=one_pass_greeks, dtype=dtype, target_rel_error=target_rel_error,
+                         time_budget=time_budget, importance_shift=importance_shift, s=s, r=r, q=q, vol=vol)
+        self.bridge_step = bridge_step  # 布朗桥模式下相邻模拟时点间隔的交易日数
 
     def calc_present_value(self, prod, t=None, spot=None):
         """计算现值
@@ -37,26 +72,42 @@ class MCDoubleBarrierEngine(McEngine):
             return value
 
         r = self.process.interest(_maturity)
-        paths = self.path_generator(n_step=_maturity_business_days, spot=spot,
-                                    t_step_per_year=prod.t_step_per_year).copy()
+        if prod.exercise_type not in (ExerciseType.American, ExerciseType.European):
+            raise ValueError("ExerciseType must be American or European")
+        if prod.inout not in (InOut.In, InOut.Out):
+            raise ValueError("InOut must be In or Out")
+        if (prod.exercise_type == ExerciseType.American and prod.inout == InOut.Out
+                and prod.payment_type not in (PaymentType.Hit, PaymentType.Expire)):
+            raise ValueError("PaymentType must be Hit or Expire")
+        if prod.discrete_obs_interval is None:  # 每日观察
+            obs_points = np.arange(0, _maturity_business_days + 1, 1)
+        else:  # 均匀离散观察
+            dt_step = prod.discrete_obs_interval * prod.t_step_per_year
+            obs_points = np.flip(np.round(np.arange(_maturity_business_days, 0, -dt_step)).astype(int))
+            obs_points[obs_points > _maturity_business_days] = _maturity_business_days  # 防止闰年导致的下标越界
 
-        # 美式：
-        if prod.exercise_type == ExerciseType.American:
-            payoff = prod.callput.value * (paths[-1] - prod.strike) * prod.parti
-            if prod.discrete_obs_interval is None:  # 每日观察
-                obs_points = np.arange(0, _maturity_business_days + 1, 1)
-            else:  # 均匀离散观察
-                dt_step = prod.discrete_obs_interval * prod.t_step_per_year
-                obs_points = np.flip(np.round(np.arange(_maturity_business_days, 0, -dt_step)).astype(int))
-                obs_points[obs_points > _maturity_business_days] = _maturity_business_days  # 防止闰年导致的下标越界
+        steps = None
+        if self.bridge_step is not None:
+            if prod.exercise_type == ExerciseType.American:
+                steps = self._bridge_steps(_maturity_business_days, self.bridge_step,
+                                           None if prod.discrete_obs_interval is None else obs_points)
+                return self._mc_expectation(self._bridge_payoff_fn(prod, steps, r, _maturity),
+                                            n_step=_maturity_business_days, spot=spot,
+                                            t_step_per_year=prod.t_step_per_year, steps=steps)
+            steps = np.array([_maturity_business_days])  # 欧式只需要模拟到期日
 
-            if prod.inout == InOut.In:  # 美式双边敲入一定是到期支付
-                knock_in_bool = np.any((paths[obs_points] <= prod.bound[0]) | (paths[obs_points] >= prod.bound[1]),
-                                       axis=0)
-                value = np.where(knock_in_bool, np.where(payoff < 0, 0, payoff), prod.rebate[0])
-                value = np.mean(value) * math.exp(-r * _maturity)
-            elif prod.inout == InOut.Out:  # 美式双边敲出
-                step_index = np.tile(obs_points, (self.n_path, 1)).T
+        def path_payoff(paths):
+            """每条路径的折现payoff"""
+            # 美式：
+            if prod.exercise_type == ExerciseType.American:
+                payoff = prod.callput.value * (paths[-1] - prod.strike) * prod.parti
+                if prod.inout == InOut.In:  # 美式双边敲入一定是到期支付
+                    knock_in_bool = np.any((paths[obs_points] <= prod.bound[0]) | (paths[obs_points] >= prod.bound[1]),
+                                           axis=0)
+                    value = np.where(knock_in_bool, np.where(payoff < 0, 0, payoff), prod.rebate[0])
+                    return value * math.exp(-r * _maturity)
+                # prod.inout == InOut.Out，美式双边敲出
+                step_index = np.tile(obs_points, (paths.shape[1], 1)).T
                 hit_lower = np.min(
                     np.where(paths[1:] <= prod.bound[0], step_index.astype(int), _maturity_business_days + 1),
                     axis=0)
@@ -64,27 +115,53 @@ class MCDoubleBarrierEngine(McEngine):
                     np.where(paths[1:] >= prod.bound[1], step_index.astype(int), _maturity_business_days + 1),
                     axis=0)
                 if prod.payment_type == PaymentType.Hit:
-                    value = np.mean(
-                        np.where(hit_lower < hit_upper, prod.rebate[0] * np.exp(-r * hit_lower / prod.t_step_per_year),
-                                 np.where(hit_lower > hit_upper,
-                                          prod.rebate[1] * np.exp(-r * hit_upper / prod.t_step_per_year),
-                                          np.where(payoff < 0, 0, payoff) * math.exp(-r * _maturity))))
-                elif prod.payment_type == PaymentType.Expire:
-                    value = np.mean(np.where(hit_lower < hit_upper, prod.rebate[0],
-                                             np.where(hit_lower > hit_upper, prod.rebate[1],
-                                                      np.where(payoff < 0, 0, payoff)))) * math.exp(-r * _maturity)
-                else:
-                    raise ValueError("PaymentType must be Hit or Expire")
-            else:
-                raise ValueError("InOut must be In or Out")
-        # 欧式：
-        elif prod.exercise_type == ExerciseType.European:
-            value = self.calc_maturity_payoff(prod, paths[-1])
-            value = np.mean(value) * math.exp(-r * _maturity)
-        else:
-            raise ValueError("ExerciseType must be American or European")
+                    return np.where(hit_lower < hit_upper,
+                                    prod.rebate[0] * np.exp(-r * hit_lower / prod.t_step_per_year),
+                                    np.where(hit_lower > hit_upper,
+                                             prod.rebate[1] * np.exp(-r * hit_upper / prod.t_step_per_year),
+                                             np.where(payoff < 0, 0, payoff) * math.exp(-r * _maturity)))
+                # prod.payment_type == PaymentType.Expire
+                return np.where(hit_lower < hit_upper, prod.rebate[0],
+                                np.where(hit_lower > hit_upper, prod.rebate[1],
+                                         np.where(payoff < 0, 0, payoff))) * math.exp(-r * _maturity)
+            # 欧式：
+            return self.calc_maturity_payoff(prod, paths[-1]) * math.exp(-r * _maturity)
+
+        value = self._mc_expectation(path_payoff, n_step=_maturity_business_days, spot=spot,
+                                     t_step_per_year=prod.t_step_per_year, steps=steps)
         return value
 
+    def _bridge_payoff_fn(self, prod, steps, r, _maturity):
+        """布朗桥模式下美式观察的逐路径折现payoff函数，payoff按首次触碰下/上障碍的概率加权
+        Args:
+            prod: Product产品对象
+            steps: np.ndarray，模拟的时间步序号
+            r: float，无风险利率
+            _maturity: float，到期时间(年化)
+        Returns: Callable，输入(len(steps) + 1, n)的价格路径矩阵，返回逐路径的折现payoff
+        """
+        obs_step = None if prod.discrete_obs_interval is None else int(np.max(np.diff(np.concatenate(([0], steps)))))
+        hit_time = np.concatenate(([0], steps)) / prod.t_step_per_year
+
+        def path_payoff(paths):
+            """每条路径的折现payoff"""
+            payoff = np.maximum(prod.callput.value * (paths[-1] - prod.strike) * prod.parti, 0)
+            hit_lower, hit_upper = self._bridge_first_hit(paths, steps, prod.t_step_per_year, lower=prod.bound[0],
+                                                          upper=prod.bound[1], obs_step=obs_step)
+            survival = 1 - np.sum(hit_lower + hit_upper, axis=0)
+            if prod.inout == InOut.In:  # 美式双边敲入一定是到期支付
+                return (payoff * (1 - survival) + prod.rebate[0] * survival) * math.exp(-r * _maturity)
+            # prod.inout == InOut.Out，美式双边敲出
+            if prod.payment_type == PaymentType.Hit:
+                hit_disc_factor = np.exp(-r * hit_time)
+                return (prod.rebate[0] * (hit_disc_factor @ hit_lower) + prod.rebate[1] * (hit_disc_factor @ hit_upper)
+                        + payoff * survival * math.exp(-r * _maturity))
+            # prod.payment_type == PaymentType.Expire
+            return (prod.rebate[0] * np.sum(hit_lower, axis=0) + prod.rebate[1] * np.sum(hit_upper, axis=0)
+                    + payoff * survival) * math.exp(-r * _maturity)
+
+        return path_payoff
+
     @staticmethod
     def calc_maturity_payoff(prod, s_vec):
         """初始化终止时的期权价值，在障碍价格内侧，默认设定未敲入，未敲出
@@ -31,25 +31,31 @@ class MCDoubleDigitalEngine(McEngine):
         else:
             self.reset_paths_flag()  # 重置路径标志位，重新生成路径
         r = self.process.interest(_maturity)
-        paths = self.path_generator(n_step=_maturity_business_days, spot=spot,
-                                    t_step_per_year=prod.t_step_per_year).copy()
-
-        # 美式：美式双接触/美式双不接触
-        if prod.exercise_type == ExerciseType.American:
-            if prod.discrete_obs_interval is None:  # 每日观察
-                obs_points = np.arange(0, _maturity_business_days + 1, 1)
-            else:  # 均匀离散观察
-                dt_step = prod.discrete_obs_interval * prod.t_step_per_year
-                obs_points = np.flip(np.round(np.arange(_maturity_business_days, 0, -dt_step)).astype(int))
-                obs_points = np.concatenate((np.array([0]), obs_points))
-                obs_points[obs_points > _maturity_business_days] = _maturity_business_days  # 防止闰年导致的下标越界
+        if prod.exercise_type not in (ExerciseType.American, ExerciseType.European):
+            raise ValueError("ExerciseType must be American or European")
+        if prod.touch_type not in (TouchType.Touch, TouchType.NoTouch):
+            raise ValueError("TouchType must be Touch or NoTouch")
+        if (prod.exercise_type == ExerciseType.American and prod.touch_type == TouchType.Touch
+                and prod.payment_type not in (PaymentType.Hit, PaymentType.Expire)):
+            raise ValueError("PaymentType must be Hit or Expire")
+        if prod.discrete_obs_interval is None:  # 每日观察
+            obs_points = np.arange(0, _maturity_business_days + 1, 1)
+        else:  # 均匀离散观察
+            dt_step = prod.discrete_obs_interval * prod.t_step_per_year
+            obs_points = np.flip(np.round(np.arange(_maturity_business_days, 0, -dt_step)).astype(int))
+            obs_points = np.concatenate((np.array([0]), obs_points))
+            obs_points[obs_points > _maturity_business_days] = _maturity_business_days  # 防止闰年导致的下标越界
 
-            if prod.touch_type == TouchType.NoTouch:  # 美式双不接触一定是到期支付
-                strike_bool = np.where((paths[obs_points] <= prod.bound[0]) | (paths[obs_points] >= prod.bound[1]),
-                                       0, 1)
-                value = prod.rebate[0] * math.exp(-r * _maturity) * np.mean(np.min(strike_bool, axis=0))
-            elif prod.touch_type == TouchType.Touch:
-                step_index = np.tile(obs_points, (self.n_path, 1)).T
+        def path_payoff(paths):
+            """每条路径的折现payoff"""
+            # 美式：美式双接触/美式双不接触
+            if prod.exercise_type == ExerciseType.American:
+                if prod.touch_type == TouchType.NoTouch:  # 美式双不接触一定是到期支付
+                    strike_bool = np.where((paths[obs_points] <= prod.bound[0]) | (paths[obs_points] >= prod.bound[1]),
+                                           0, 1)
+                    return prod.rebate[0] * math.exp(-r * _maturity) * np.min(strike_bool, axis=0)
+                # prod.touch_type == TouchType.Touch
+                step_index = np.tile(obs_points, (paths.shape[1], 1)).T
                 hit_lower = np.min(
                     np.where(paths[obs_points] <= prod.bound[0], step_index.astype(int), _maturity_business_days + 1),
                     axis=0)
@@ -57,28 +63,21 @@ class MCDoubleDigitalEngine(McEngine):
                     np.where(paths[obs_points] >= prod.bound[1], step_index.astype(int), _maturity_business_days + 1),
                     axis=0)
                 if prod.payment_type == PaymentType.Hit:
-                    value = np.mean(
-                        np.where(hit_lower < hit_upper, prod.rebate[0] * np.exp(-r * hit_lower / prod.t_step_per_year),
-                                 np.where(hit_lower > hit_upper,
-                                          prod.rebate[1] * np.exp(-r * hit_upper / prod.t_step_per_year), 0)))
-                elif prod.payment_type == PaymentType.Expire:
-                    value = np.mean(np.where(hit_lower < hit_upper, prod.rebate[0],
-                                             np.where(hit_lower > hit_upper, prod.rebate[1],
-                                                      0))) * math.exp(-r * _maturity)
-                else:
-                    raise ValueError("PaymentType must be Hit or Expire")
-            else:
-                raise ValueError("TouchType must be Touch or NoTouch")
-        # 欧式：二元凹式/二元凸式
-        elif prod.exercise_type == ExerciseType.European:
+                    return np.where(hit_lower < hit_upper,
+                                    prod.rebate[0] * np.exp(-r * hit_lower / prod.t_step_per_year),
+                                    np.where(hit_lower > hit_upper,
+                                             prod.rebate[1] * np.exp(-r * hit_upper / prod.t_step_per_year), 0))
+                # prod.payment_type == PaymentType.Expire
+                return np.where(hit_lower < hit_upper, prod.rebate[0],
+                                np.where(hit_lower > hit_upper, prod.rebate[1], 0)) * math.exp(-r * _maturity)
+            # 欧式：二元凹式/二元凸式
             if prod.touch_type == TouchType.Touch:
                 payoff = np.where(paths[-1] <= prod.bound[0], prod.rebate[0],
                                   np.where(paths[-1] >= prod.bound[1], prod.rebate[1], 0))
-            elif prod.touch_type == TouchType.NoTouch:
+            else:  # prod.touch_type == TouchType.NoTouch
                 payoff = ((paths[-1] > prod.bound[0]) & (paths[-1] < prod.bound[1])) * prod.rebate[0]
-            else:
-                raise ValueError("TouchType must be Touch or NoTouch")
-            value = np.mean(payoff) * math.exp(-r * _maturity)
-        else:
-            raise ValueError("ExerciseType must be American or European")
+            return payoff * math.exp(-r * _maturity)
+
+        value = self._mc_expectation(path_payoff, n_step=_maturity_business_days, spot=spot,
+                                     t_step_per_year=prod.t_step_per_year)
         return value
@@ -5,7 +5,6 @@ Copyright (C) 2024 Galaxy Technologies
 Licensed under the Apache License, Version 2.0
 """
 import numpy as np
-from pricelib.common.utilities.enums import StatusType
 from .mc_autocallable_engine import MCAutoCallableEngine
 from pricelib.common.time import global_evaluation_date
 
@@ -43,31 +42,27 @@ class MCParisSnowballEngine(MCAutoCallableEngine):
         self._barrier_out = prod.barrier_out[-len(self.obs_dates):].copy()
         self._coupon_out = prod.coupon_out[-len(self.obs_dates):].copy()
         self._barrier_in = prod.barrier_in[-len(self.knock_in_obs_dates):].copy()
+        self._set_sim_steps(_maturity_business_days, self.knock_in_obs_dates - 1)
         if spot is None:
             spot = self.process.spot()
         else:
             self.reset_paths_flag()  # 重置路径标志位，重新生成路径
 
-        self.s_paths = self.path_generator(n_step=_maturity_business_days, spot=spot,
-                                           t_step_per_year=prod.t_step_per_year).copy()
-        # 统计各个情景的payoff
-        self._cal_knock_out_date()
-        self._cal_knock_out_payoff()
-        self._cal_knock_in_scenario(calculate_date)
-        self._cal_hold_to_maturity_payoff()
-        self._cal_knock_in_payoff()
-        result = (self.knock_out_profit + self.hold_to_maturity_profit + self.knock_in_loss) / self.n_path
+        if self._use_mlmc(_maturity_business_days):
+            return self._mlmc_autocall(_maturity_business_days, spot, self.knock_in_obs_dates - 1)
+        if self.stream_paths:
+            return self._functional_expectation(lambda: self._snowball_functional(_maturity_business_days),
+                                                _maturity_business_days, spot, prod.t_step_per_year)
+        result = self._mc_expectation(self._path_payoff, n_step=_maturity_business_days, spot=spot,
+                                      t_step_per_year=prod.t_step_per_year, steps=self._sim_steps,
+                                      controls=self._knock_in_controls(_maturity_business_days, spot))
         return result
 
-    def _cal_knock_in_scenario(self, calculate_date):
-        """计算每条路径敲入时间"""
-        prod = self.prod
-        if prod.status == StatusType.DownTouch:
-            pass
-        else:
-            # 判断某一条路径是否有敲入
-            knock_in_level = np.tile(self._barrier_in, (self.n_path, 1)).T  # 变敲入（与敲出观察日同长度的列表）
-            knock_in_bool = np.where(self.s_paths[self.knock_in_obs_dates - 1] <= knock_in_level, 1, 0)
-            knock_in_count = np.cumsum(knock_in_bool, axis=0)
-            knock_in_scenario = np.max(knock_in_count, axis=0) >= prod.knock_in_times
-            self.knock_in_scenario = knock_in_scenario & self.not_knock_out
+    def _use_sim_steps(self, steps):
+        """切换模拟的时间步，并更新敲出、敲入观察日在价格路径矩阵中的行号"""
+        super()._use_sim_steps(steps)
+        self._knock_in_rows = self._step_rows(self.knock_in_obs_dates - 1)
+
+    def _knock_in_rule(self, n_row):
+        """敲入规则: 在敲入观察日上低于等于敲入线的累计次数达到knock_in_times次即为敲入，见MCAutoCallableEngine._knock_in_rule"""
+        return self._knock_in_rows, self._barrier_in, self.prod.knock_in_times
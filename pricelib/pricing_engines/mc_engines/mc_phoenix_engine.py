@@ -5,6 +5,7 @@ Copyright (C) 2024 Galaxy Technologies
 Licensed under the Apache License, Version 2.0
 """
 import numpy as np
+from pricelib.common.utilities.enums import RandsMethod, LdMethod, ExerciseType
 from pricelib.common.pricing_engine_base import McEngine
 from pricelib.common.time import global_evaluation_date
 
@@ -16,6 +17,42 @@ class MCPhoenixEngine(McEngine):
             发生敲入后，派息方式不变，到期如果未敲出，结构为看跌空头
     """
 
+    def __init__(self, stoch_process=None, n_path=100000, rands_method=RandsMethod.LowDiscrepancy,
+                 antithetic_variate=True, ld_method=LdMethod.Sobol, seed=0, *, chunk_size=None, n_workers=None,
+                 obs_dates_only=False, one_pass_greeks=False, dtype=np.float64, target_rel_error=None,
+                 time_budget=None, importance_shift=None, s=None, r=None, q=None, vol=None):
+        """构造函数
+        Args:
+            stoch_process: 随机过程StochProcessBase对象
+            n_path: int，MC模拟路径数
+            rands_method: 生成随机数方法，RandsMethod枚举类，Pseudorandom伪随机数/LowDiscrepancy低差异序列
+            antithetic_variate: bool，是否使用对立变量法
+            ld_method: 若使用了低差异序列，指定低差异序列方法，LdMethod枚举类，Sobol序列/Halton序列
+            seed: int，随机数种子
+            chunk_size: int，分块模拟时每块的路径数，默认None为一次性生成全部路径
+            n_workers: int，并行模拟的线程数，默认None为单线程
+            obs_dates_only: bool，是否只在派息(敲出)观察日及到期日模拟价格路径，默认False为逐日模拟。
+                            仅支持BSM过程，使用对数欧拉格式，常数波动率时没有离散化误差；每日观察的敲入用布朗桥穿越概率计算，
+                            欧式敲入只在到期日观察
+            one_pass_greeks: bool，pv_and_greeks是否在同一组模拟路径上用路径导数/似然比估计希腊字母，默认False为共同随机数的差分法重新定价
+            dtype: 随机数与价格路径的浮点类型，np.float64(默认)或np.float32
+            target_rel_error: float，自适应模拟的目标相对误差(标准误差/|现值|)，默认None为模拟全部n_path条路径
+            time_budget: float，自适应模拟的时间预算(秒)，默认None为不限时
+            importance_shift: float或'auto'，重要性抽样的漂移平移量，默认None为不使用，见McEngine
+        在未设置stoch_process时，(stoch_process=None)，会默认创建BSMprocess，需要输入以下变量进行初始化
+            s: float，标的价格
+            r: float，无风险利率
+            q: float，分红/融券率
+            vol: float，波动率
+        """
+        super().__init__(stoch_process, n_path, rands_method=rands_method, antithetic_variate=antithetic_variate,
+                         ld_method=ld_method, seed=seed, chunk_size=chunk_size, n_workers=n_workers,
+                         one_pass_greeks=one_pass_greeks, dtype=dtype, target_rel_error=target_rel_error,
+                         time_budget=time_budget, importance_shift=importance_shift, s=s, r=r, q=q, vol=vol)
+        self.obs_dates_only = obs_dates_only  # 是否只在观察日模拟价格路径
+        self._sim_steps = None  # 只在观察日模拟时，模拟的时间步；逐日模拟时为None
+        self._obs_rows = None  # 观察日在价格路径矩阵中的行号
+
     # pylint: disable=too-many-locals
     def calc_present_value(self, prod, t=None, spot=None):
         """计算现值
@@ -37,78 +74,99 @@ class MCPhoenixEngine(McEngine):
         self._barrier_in = prod.barrier_in[-len(self._obs_dates):].copy()
         self._barrier_yield = prod.barrier_yield[-len(self._obs_dates):].copy()
         self._coupon = prod.coupon[-len(self._obs_dates):].copy()
+        if self.obs_dates_only:  # 只在观察日和到期日模拟，价格路径矩阵的第k行对应第steps[k-1]个交易日
+            self._sim_steps = np.unique(np.append(self._obs_dates[self._obs_dates > 0], _maturity_business_days))
+            self._obs_rows = np.where(self._obs_dates > 0, np.searchsorted(self._sim_steps, self._obs_dates) + 1, 0)
+        else:
+            self._sim_steps = None
+            self._obs_rows = self._obs_dates
         if spot is None:
             spot = self.process.spot()
         else:
             self.reset_paths_flag()  # 重置路径标志位，重新生成路径
 
-        self.s_paths = self.path_generator(n_step=_maturity_business_days, spot=spot,
-                                           t_step_per_year=prod.t_step_per_year).copy()
-        # 统计各个情景的payoff
-        self._cal_knock_out_date()
-        self._cal_yield_date()
-        self._cal_knock_in_scenario()
-        result = self._cal_payoff()
+        # 不同派息日的票息分别计算贴现因子
+        self._discount_factor = np.empty(self._pay_dates.size)
+        for i, pay_d in enumerate(self._pay_dates):
+            self._discount_factor[i] = self.process.interest.disc_factor(pay_d)
+        result = self._mc_expectation(self._path_payoff, n_step=_maturity_business_days, spot=spot,
+                                      t_step_per_year=prod.t_step_per_year, steps=self._sim_steps)
         return result
 
-    def _cal_knock_out_date(self):
+    def _path_payoff(self, paths):
+        """统计各个情景的payoff，返回每条路径的折现payoff
+        Args:
+            paths: np.ndarray，价格路径矩阵
+        Returns: np.ndarray，每条路径的折现payoff
+        """
+        knock_out_time_idx, knock_out_scenario, hold_time_idx = self._cal_knock_out_date(paths)
+        coupon_bool = self._cal_yield_date(paths, knock_out_time_idx)
+        knock_in_scenario = self._cal_knock_in_scenario(paths, knock_out_scenario)
+        return self._cal_payoff(paths, hold_time_idx, coupon_bool, knock_in_scenario)
+
+    def _cal_knock_out_date(self, paths):
         """统计每条路径敲出时间"""
         # 计算每条价格路径最小敲出时间
-        barrier_out = np.tile(self._barrier_out, (self.n_path, 1)).T
-        barrier_out_matrix = np.tile(np.arange(self._obs_dates.shape[0]), (self.n_path, 1)).T
-        barrier_out_matrix = np.where(self.s_paths[self._obs_dates, :] >= barrier_out,
+        n_path = paths.shape[1]
+        barrier_out = np.tile(self._barrier_out, (n_path, 1)).T
+        barrier_out_matrix = np.tile(np.arange(self._obs_dates.shape[0]), (n_path, 1)).T
+        barrier_out_matrix = np.where(paths[self._obs_rows, :] >= barrier_out,
                                       barrier_out_matrix.astype(int), np.inf)
         # 返回每一列的最小值，即为每条路径的敲出时间
-        self.knock_out_time_idx = np.min(barrier_out_matrix, axis=0)
+        knock_out_time_idx = np.min(barrier_out_matrix, axis=0)
         # 统计哪些路径属于发生了敲出的情景(布尔索引)
-        self.knock_out_scenario = (self.knock_out_time_idx != np.inf)
+        knock_out_scenario = (knock_out_time_idx != np.inf)
         # 每条路径持有时长
-        hold_time_idx = self.knock_out_time_idx.copy()
+        hold_time_idx = knock_out_time_idx.copy()
         # 对于未敲出情形，持有到期，因此将索引设置为最后一个观察日的索引，如24个观察日，则指定为23
-        hold_time_idx[~self.knock_out_scenario] = self._obs_dates.size - 1
+        hold_time_idx[~knock_out_scenario] = self._obs_dates.size - 1
         # 转成整数
-        self.hold_time_idx = hold_time_idx.astype(int)
+        return knock_out_time_idx, knock_out_scenario, hold_time_idx.astype(int)
 
-    def _cal_yield_date(self):
+    def _cal_yield_date(self, paths, knock_out_time_idx):
         """统计每条路径发生派息的时间"""
         # 统计哪些派息日，标的价格在派息线上方(即该派息日发生派息)
-        barrier_yield = np.tile(self._barrier_yield, (self.n_path, 1)).T
-        coupon_time_idx = (self.s_paths[self._obs_dates, :] > barrier_yield)
+        barrier_yield = np.tile(self._barrier_yield, (paths.shape[1], 1)).T
+        coupon_time_idx = (paths[self._obs_rows, :] > barrier_yield)
         # 将发生敲出之后的派息bool由True改为False
-        self.coupon_bool = np.where(np.arange(coupon_time_idx.shape[0])[:, np.newaxis] > self.knock_out_time_idx,
-                                    False, coupon_time_idx)
+        return np.where(np.arange(coupon_time_idx.shape[0])[:, np.newaxis] > knock_out_time_idx,
+                        False, coupon_time_idx)
 
-    def _cal_knock_in_scenario(self):
-        """统计哪些路径属于敲入未敲出的情景"""
+    def _cal_knock_in_scenario(self, paths, knock_out_scenario):
+        """统计哪些路径属于敲入未敲出的情景；只在观察日模拟且每日观察敲入时，返回每条路径敲入未敲出的概率"""
         # 排除发生了敲出的路径，统计哪些路径属于敲入未敲出
         knock_in_level = np.array(self._barrier_in).repeat(
             np.diff(np.append(np.zeros((1,)), self._obs_dates)).astype(int))
         knock_in_level = np.append(self._barrier_in[0], knock_in_level)
-        knock_in_level = np.tile(knock_in_level, (self.n_path, 1)).T
-        knock_in_time_idx = (self.s_paths <= knock_in_level)
+        if self._sim_steps is not None:
+            knock_in_level = knock_in_level[np.append(0, self._sim_steps)]  # 模拟时点的敲入线
+            if self.prod.in_obs_type == ExerciseType.European:  # 敲入观察为欧式，仅到期观察敲入
+                return np.where(knock_out_scenario, False, paths[-1] <= knock_in_level[-1])
+            knock_in_prob = self._bridge_hit_prob(paths, self._sim_steps, knock_in_level, self.prod.t_step_per_year)
+            return np.where(knock_out_scenario, 0., knock_in_prob)
+        knock_in_level = np.tile(knock_in_level, (paths.shape[1], 1)).T
+        knock_in_time_idx = (paths <= knock_in_level)
         # 统计哪些路径属于敲入未敲出
         knock_in_bool = np.any(knock_in_time_idx, axis=0)
-        self.knock_in_scenario = np.where(self.knock_out_scenario, False, knock_in_bool)  # 将发生敲出之后的敲入由True改为False
+        return np.where(knock_out_scenario, False, knock_in_bool)  # 将发生敲出之后的敲入由True改为False
 
-    def _cal_payoff(self):
-        """统计每条路径的收益加总"""
-        # 不同派息日的票息分别计算贴现因子，得到派息的现值
-        discount_factor = np.empty(self._pay_dates.size)
-        for i, pay_d in enumerate(self._pay_dates):
-            discount_factor[i] = self.process.interest.disc_factor(pay_d)
+    def _cal_payoff(self, paths, hold_time_idx, coupon_bool, knock_in_scenario):
+        """统计每条路径的收益，knock_in_scenario是敲入未敲出的布尔值或概率"""
+        discount_factor = self._discount_factor
+        # 不同派息日的票息的现值
         discounted_coupon = self._coupon * self.prod.s0 * discount_factor
 
         # payoff汇总
-        payoff = 0
+        payoff = np.zeros(paths.shape[1])
         # 1.未敲入的部分（敲出/未敲入未敲出），到期还本
-        payoff += np.sum(discount_factor[self.hold_time_idx[~self.knock_in_scenario]]
-                         ) * self.prod.margin_lvl * self.prod.s0
+        maybe_not_in = knock_in_scenario != 1
+        payoff[maybe_not_in] += (discount_factor[hold_time_idx[maybe_not_in]]
+                                 * self.prod.margin_lvl * self.prod.s0) * (1 - knock_in_scenario[maybe_not_in])
         # 2.派息payoff
-        payoff += np.sum(np.sum(self.coupon_bool, axis=1) * discounted_coupon)
+        payoff += np.sum(coupon_bool * discounted_coupon[:, np.newaxis], axis=0)
         # 3.敲入，承担跌幅损失
-        s_vec = self.s_paths[-1, self.knock_in_scenario].copy()
-        s_vec[np.where(s_vec < self.prod.strike_lower)] = self.prod.strike_lower
-        payoff += ((self.prod.margin_lvl * self.prod.s0 - self.prod.strike_upper
-                    ) * np.sum(self.knock_in_scenario) + np.sum(s_vec)) * discount_factor[-1]
-        payoff /= self.n_path
+        maybe_in = knock_in_scenario != 0
+        s_vec = np.maximum(paths[-1, maybe_in], self.prod.strike_lower)
+        payoff[maybe_in] += ((self.prod.margin_lvl * self.prod.s0 - self.prod.strike_upper
+                              + s_vec) * discount_factor[-1]) * knock_in_scenario[maybe_in]
         return payoff
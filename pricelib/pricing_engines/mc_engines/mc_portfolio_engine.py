@@ -26,10 +26,15 @@ class MCPortfolioEngine(McEngine):
             spot = self.process.spot()
         else:
             self.reset_paths_flag()  # 重置路径标志位，重新生成路径
-        price = 0
         n_step = round(_maturity * prod.t_step_per_year)
-        paths = self.path_generator(n_step=n_step, spot=spot, t_step_per_year=prod.t_step_per_year).copy()
-        for vanilla, position in prod.vanilla_list:
-            price += np.mean(np.maximum(vanilla.callput.value * (paths[-1, :] - vanilla.strike),
-                                        0)) * position * self.process.interest.disc_factor(_maturity)
+
+        def path_payoff(paths):
+            """每条路径的折现payoff"""
+            payoff = np.zeros(paths.shape[1])
+            for vanilla, position in prod.vanilla_list:
+                payoff += np.maximum(vanilla.callput.value * (paths[-1, :] - vanilla.strike),
+                                     0) * position * self.process.interest.disc_factor(_maturity)
+            return payoff
+
+        price = self._mc_expectation(path_payoff, n_step=n_step, spot=spot, t_step_per_year=prod.t_step_per_year)
         return price
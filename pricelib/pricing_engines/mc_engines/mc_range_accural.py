@@ -6,11 +6,37 @@ Licensed under the Apache License, Version 2.0
 """
 import numpy as np
 from pricelib.common.time import global_evaluation_date
-from pricelib.common.pricing_engine_base import McEngine
+from pricelib.common.pricing_engine_base import McEngine, PathFunctional
+
+
+class RangeAccuralFunctional(PathFunctional):
+    """区间累计的路径泛函，状态为每条路径落在区间内的天数"""
+
+    def __init__(self, prod, discount):
+        """构造函数
+        Args:
+            prod: Product产品对象
+            discount: float，到期日的折现因子
+        """
+        self.prod = prod
+        self.discount = discount
+        self.n_coupon = None
+
+    def start(self, spot):
+        self.n_coupon = np.zeros(spot.size, dtype=np.int64)
+        self.update(0, spot)
+
+    def update(self, step, s):
+        self.n_coupon += (s < self.prod.upper_strike) & (s > self.prod.lower_strike)
+
+    def payoff(self):
+        prod = self.prod
+        return self.discount * prod.payment * self.n_coupon / prod.t_step_per_year * prod.s0
 
 
 class MCRangeAccuralEngine(McEngine):
     """区间累计 Monte Carlo 模拟定价引擎"""
+    supports_stream_paths = True  # 提供路径泛函RangeAccuralFunctional，可以不保存价格路径矩阵
 
     def calc_present_value(self, prod, t=None, spot=None):
         """计算现值
@@ -28,11 +54,17 @@ class MCRangeAccuralEngine(McEngine):
         else:
             self.reset_paths_flag()  # 重置路径标志位，重新生成路径
 
-        paths = self.path_generator(n_step=_maturity_business_days, spot=spot,
-                                    t_step_per_year=prod.t_step_per_year).copy()
-
-        # 敲出与行权日期
-        n_coupon = np.sum((paths < prod.upper_strike) & (paths > prod.lower_strike))
+        def path_payoff(paths):
+            """每条路径的折现payoff"""
+            # 每条路径落在区间内的天数
+            n_coupon = np.sum((paths < prod.upper_strike) & (paths > prod.lower_strike), axis=0)
+            return (self.process.interest.disc_factor(_maturity) * prod.payment * n_coupon / prod.t_step_per_year
+                    * prod.s0)
 
-        payoff = self.process.interest.disc_factor(_maturity) * prod.payment * n_coupon / prod.t_step_per_year
-        return payoff * prod.s0 / self.n_path
+        if self.stream_paths:
+            return self._functional_expectation(
+                lambda: RangeAccuralFunctional(prod, self.process.interest.disc_factor(_maturity)),
+                _maturity_business_days, spot, prod.t_step_per_year)
+        payoff = self._mc_expectation(path_payoff, n_step=_maturity_business_days, spot=spot,
+                                      t_step_per_year=prod.t_step_per_year)
+        return payoff
@@ -5,28 +5,59 @@ Copyright (C) 2024 Galaxy Technologies
 Licensed under the Apache License, Version 2.0
 """
 import numpy as np
-from scipy.optimize import leastsq
-from pricelib.common.utilities.enums import ExerciseType
+from pricelib.common.utilities.enums import ExerciseType, ProcessType, RandsMethod, LdMethod
+from pricelib.common.utilities.utility import logging
 from pricelib.common.time import global_evaluation_date
-from pricelib.common.pricing_engine_base import McEngine
-
-
-# pylint: disable=invalid-name
-def quadratic_func(x, p):
-    """二次函数"""
-    a, b, c = p
-    return a * (x ** 2) + b * x + c
-
-
-# pylint: disable=invalid-name
-def residuals_func(p, y, x):
-    """残差函数"""
-    return y - quadratic_func(x, p)
+from pricelib.common.pricing_engine_base import McEngine, LsmcRegressor
+from pricelib.pricing_engines.analytic_engines.analytic_vanilla_european_engine import bs_formula
 
 
 class MCVanillaEngine(McEngine):
     """香草期权 Monte Carlo 模拟定价引擎
-        支持欧式期权和美式期权，美式期权为LSMC方法"""
+        支持欧式期权和美式期权，美式期权为LSMC方法，见LsmcRegressor
+        欧式期权的控制变量为到期标的价格，常数波动率BSM过程下增加同一布朗运动驱动的几何布朗运动上的欧式期权(BSM公式)"""
+    pathwise_greeks = True  # payoff关于路径连续，单次模拟的希腊字母使用路径导数
+
+    def __init__(self, stoch_process=None, n_path=100000, rands_method=RandsMethod.LowDiscrepancy,
+                 antithetic_variate=True, ld_method=LdMethod.Sobol, seed=0, *, chunk_size=None, n_workers=None,
+                 one_pass_greeks=False, dtype=np.float64, control_variates=False, target_rel_error=None,
+                 time_budget=None, importance_shift=None, lsmc=None, exercise_step=1,
+                 s=None, r=None, q=None, vol=None):
+        """构造函数
+        Args:
+            stoch_process: 随机过程StochProcessBase对象
+            n_path: int，MC模拟路径数
+            rands_method: 生成随机数方法，RandsMethod枚举类，Pseudorandom伪随机数/LowDiscrepancy低差异序列
+            antithetic_variate: bool，是否使用对立变量法
+            ld_method: 若使用了低差异序列，指定低差异序列方法，LdMethod枚举类，Sobol序列/Halton序列
+            seed: int，随机数种子
+            chunk_size: int，分块模拟时每块的路径数，默认None为一次性生成全部路径；美式期权不分块，设置时记录警告
+            n_workers: int，并行模拟的线程数，默认None为单线程
+            one_pass_greeks: bool，pv_and_greeks是否在同一组模拟路径上用路径导数/似然比估计希腊字母，默认False为共同随机数的差分法重新定价
+            dtype: 随机数与价格路径的浮点类型，np.float64(默认)或np.float32；LSMC回归总是使用float64
+            control_variates: bool，是否使用控制变量法，默认False，仅欧式期权有效，见_vanilla_controls
+            target_rel_error: float，自适应模拟的目标相对误差(标准误差/|现值|)，默认None为模拟全部n_path条路径；
+                              美式期权总是模拟全部路径，设置时记录警告
+            time_budget: float，自适应模拟的时间预算(秒)，默认None为不限时；美式期权同上
+            importance_shift: float或'auto'，重要性抽样的漂移平移量，默认None为不使用，见McEngine
+            lsmc: LsmcRegressor，美式期权的LSMC回归设置(基函数、次数、求解方法)，默认None为二次多项式、正规方程的Cholesky分解
+            exercise_step: int，美式期权每exercise_step个交易日可以行权一次(百慕大式行权日程)，默认1为每日行权；
+                           BSM过程只在行权日模拟价格路径，其他过程逐日模拟、只在行权日回归
+        在未设置stoch_process时，(stoch_process=None)，会默认创建BSMprocess，需要输入以下变量进行初始化
+            s: float，标的价格
+            r: float，无风险利率
+            q: float，分红/融券率
+            vol: float，波动率
+        """
+        super().__init__(stoch_process, n_path, rands_method=rands_method, antithetic_variate=antithetic_variate,
+                         ld_method=ld_method, seed=seed, chunk_size=chunk_size, n_workers=n_workers,
+                         one_pass_greeks=one_pass_greeks, dtype=dtype, control_variates=control_variates,
+                         target_rel_error=target_rel_error, time_budget=time_budget, importance_shift=importance_shift,
+                         s=s, r=r, q=q, vol=vol)
+        if int(exercise_step) != exercise_step or exercise_step < 1:
+            raise ValueError(f"行权间隔交易日数应为正整数，当前输入为{exercise_step}")
+        self.lsmc = LsmcRegressor() if lsmc is None else lsmc  # 美式期权的LSMC回归设置
+        self.exercise_step = int(exercise_step)  # 美式期权相邻行权日间隔的交易日数
 
     def calc_present_value(self, prod, t=None, spot=None):
         """计算现值
@@ -45,28 +76,47 @@ class MCVanillaEngine(McEngine):
             self.reset_paths_flag()  # 重置路径标志位，重新生成路径
 
         n_step = int(tau * prod.t_step_per_year)
-        paths = self.path_generator(n_step=n_step, spot=spot,
-                                    t_step_per_year=prod.t_step_per_year).copy()
         r = self.process.interest(tau)
         if prod.exercise_type == ExerciseType.European:
-            price = np.mean(np.maximum(prod.callput.value * (paths[-1, :] - prod.strike), 0)) * np.exp(-r * tau)
+            price = self._mc_expectation(
+                lambda paths: np.maximum(prod.callput.value * (paths[-1, :] - prod.strike), 0) * np.exp(-r * tau),
+                n_step=n_step, spot=spot, t_step_per_year=prod.t_step_per_year,
+                controls=self._vanilla_controls(prod, n_step, spot) if self.control_variates else None)
             return price
         if prod.exercise_type == ExerciseType.American:  # 美式期权，LSMC方法
-            v_grid = np.zeros(shape=paths.shape)
-            v_grid[-1, :] = np.maximum(prod.callput.value * (paths[-1, :] - prod.strike), 0)
-            if n_step == 0:  # 如果估值日就是到期日
-                return np.mean(v_grid[-1, :])
-            for i in range(n_step - 1, 0, -1):
-                v_grid[i, :] = v_grid[i + 1, :] * np.exp(-r * 1 / prod.t_step_per_year)
-                lsm_id = (prod.callput.value * (paths[i, :] - prod.strike) >= 0)
-                if np.array(lsm_id).size <= 2:  # 拟合曲线有三个参数，若实值点<3则无法拟合
-                    continue
-                xdata = np.squeeze(paths[i, lsm_id])
-                ydata = np.squeeze(v_grid[i, lsm_id])
-                lsm_params = leastsq(residuals_func, x0=np.array([0.01, -1.0, spot]), args=(ydata, xdata))
-                hold_value = quadratic_func(paths[i, lsm_id], lsm_params[0])  # 最小二乘拟合的持有价值
-                exercise_value = prod.callput.value * (paths[i, lsm_id] - prod.strike)
-                # v_grid[i, lsm_id] = np.where(exercise_value >= hold_value, exercise_value, v_grid[i, lsm_id])
-                v_grid[i, lsm_id] = np.maximum(hold_value, exercise_value)
-            return np.mean(v_grid[1, :] * np.exp(-r * 1 / prod.t_step_per_year))
+            # 最小二乘回归需要同一时刻的全部路径，不能分块模拟，也不能逐块自适应停止，总是模拟全部n_path条路径
+            ignored = [name for name in ("chunk_size", "target_rel_error", "time_budget")
+                       if getattr(self, name) is not None]
+            if ignored:
+                logging.warning(f"美式期权的LSMC回归需要全部路径，忽略{'、'.join(ignored)}设置，模拟全部{self.n_path}条路径")
+            steps, exercise_rows = None, None
+            if self.exercise_step > 1 and n_step > 0:
+                if self.process() == ProcessType.BSProcess1D:  # 只在行权日模拟，对数欧拉格式
+                    steps = self._bridge_steps(n_step, self.exercise_step)
+                else:
+                    exercise_rows = np.arange(self.exercise_step, n_step, self.exercise_step)
+            paths = self.path_generator(n_step=n_step, spot=spot, t_step_per_year=prod.t_step_per_year, steps=steps)
+            days = np.arange(n_step + 1) if steps is None else np.append(0, steps)
+            value = self.lsmc.backward_induction(paths, lambda row, s_row: prod.callput.value * (s_row - prod.strike),
+                                                 np.exp(-r * np.diff(days) / prod.t_step_per_year), exercise_rows,
+                                                 scale=prod.strike)
+            # 与欧式期权一致，记录估值、标准误差(对立路径取均值作为一个样本)与路径数，供confidence_interval使用
+            self.cv_beta, self.variance_reduction, self.importance_shift_used = None, None, None
+            self.mc_value = self._estimate([self._payoff_stats(value)], None, value.size)
+            self.n_path_used = value.size
+            return self.mc_value
         raise ValueError("不支持的行权方式, 香草mc定价引擎仅支持欧式期权和美式期权")
+
+    def _vanilla_controls(self, prod, n_step, spot):
+        """欧式期权的控制变量: 到期标的价格；常数波动率BSM过程下增加几何布朗运动上同一执行价的欧式期权，期望由BSM公式计算"""
+        controls = [self._terminal_control(n_step, spot, prod.t_step_per_year)]
+        gbm_fn = self._gbm_control_fn(n_step, spot, prod.t_step_per_year)
+        if gbm_fn is not None and n_step > 0:
+            maturity = n_step / prod.t_step_per_year
+            r, q = self.process.interest(maturity), self.process.div(maturity)
+            vol = self.process.vol(maturity, spot)
+            sign = prod.callput.value
+            controls.append((lambda paths: np.maximum(sign * (gbm_fn(paths)[-1] - prod.strike), 0),
+                             bs_formula(S=spot, K=prod.strike, T=maturity, r=r, q=q, sigma=vol, sign=sign)
+                             * np.exp(r * maturity)))
+        return controls
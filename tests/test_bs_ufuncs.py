@@ -0,0 +1,58 @@
+#!/user/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2024 Galaxy Technologies
+Licensed under the Apache License, Version 2.0
+"""
+import datetime
+import numpy as np
+import pytest
+from pricelib import *
+from pricelib.pricing_engines.analytic_engines.analytic_vanilla_european_engine import bs_formula
+from .conftest import init_bsm_process
+
+
+def test_bs_ufuncs_match_engine():
+    """BSM通用函数与bs_formula、解析引擎的希腊字母一致，可以广播"""
+    process = init_bsm_process(datetime.date(2022, 1, 5), s=100, r=0.02, q=0.04, vol=0.16)
+    engine = AnalyticVanillaEuEngine(process)
+    strikes = np.array([80., 100., 120.])
+    for callput in CallPut:
+        sign = callput.value
+        prices = bs_price(100, strikes, 1, 0.02, 0.04, 0.16, sign)
+        assert prices.shape == (3,)
+        for strike, price in zip(strikes, prices):
+            option = VanillaOption(strike=strike, maturity=1, callput=callput, start_date=datetime.date(2022, 1, 5),
+                                   annual_days=AnnualDays.N365, engine=engine)
+            tau = (option.end_date - datetime.date(2022, 1, 5)).days / 365
+            args = (100, strike, tau, 0.02, 0.04, 0.16, sign)
+            assert bs_price(*args) == pytest.approx(bs_formula(100, strike, tau, 0.02, 0.16, sign, 0.04), rel=1e-12)
+            assert bs_price(*args) == pytest.approx(option.price(), rel=1e-12)
+            assert bs_delta(*args) == pytest.approx(engine.delta(option), rel=1e-12)
+            assert bs_gamma(*args) == pytest.approx(engine.gamma(option), rel=1e-12)
+            assert bs_vega(*args) * 0.01 == pytest.approx(engine.vega(option), rel=1e-12)
+            assert bs_rho(*args) * 0.01 == pytest.approx(engine.rho(option), rel=1e-12)
+            bumped = [bs_price(100, strike, tau + h, 0.02, 0.04, 0.16, sign) for h in (1e-5, -1e-5)]
+            assert bs_theta(*args) == pytest.approx(-(bumped[0] - bumped[1]) / 2e-5, rel=1e-6)
+    assert bs_price(100, 90, 0, 0.02, 0.04, 0.16, 1) == 10
+
+
+def test_bs_implied_vol_round_trip():
+    """隐含波动率在大量随机报价上还原波动率，包括深度实值、虚值与很短、很长的期限；无套利区间之外返回nan"""
+    rng = np.random.default_rng(0)
+    n = 200000
+    strikes = 100 * np.exp(rng.uniform(-1.5, 1.5, n))
+    taus = rng.uniform(0.005, 10, n)
+    vols = rng.uniform(0.01, 3, n)
+    signs = rng.choice([-1., 1.], n)
+    prices = bs_price(100, strikes, taus, 0.02, 0.01, vols, signs)
+    implied = bs_implied_vol(prices, 100, strikes, taus, 0.02, 0.01, signs)
+    assert not np.isnan(implied).any()
+    identifiable = bs_vega(100, strikes, taus, 0.02, 0.01, vols, signs) > 1e-4  # 价格对波动率足够敏感
+    assert implied[identifiable] == pytest.approx(vols[identifiable], rel=1e-8)
+    assert bs_price(100, strikes, taus, 0.02, 0.01, implied, signs) == pytest.approx(prices, rel=1e-9, abs=1e-12)
+    assert bs_implied_vol(1e-200, 100, 300, 1, 0, 0, 1) == pytest.approx(0.0364, abs=1e-4)
+    with np.errstate(invalid='ignore'):
+        invalid = bs_implied_vol(np.array([-1., 5., 100.]), 100, np.array([100., 90., 100.]), 1, 0, 0, 1)
+    assert np.isnan(invalid).all()  # 价格为负、低于内在价值、不低于标的价格
+    assert bs_implied_vol(10., 100, 90, 1, 0, 0, 1) == 0
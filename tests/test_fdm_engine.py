@@ -0,0 +1,218 @@
+#!/user/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2024 Galaxy Technologies
+Licensed under the Apache License, Version 2.0
+"""
+import datetime
+import numpy as np
+import pytest
+from pricelib import *
+from pricelib.common.pricing_engine_base import FdmGrid, fdm_price_grid
+from .conftest import init_bsm_process
+
+
+def dense_evolve(grid, j, yv, dt, a, b, c):
+    """用稠密矩阵直接求解一步theta格式，作为FdmGrid.evolve的参照"""
+    theta = grid._theta
+    diffusion_square, drift = a * grid.i_vec ** 2, b * grid.i_vec
+    lower, diag, upper = 0.5 * (diffusion_square - drift), -diffusion_square - c, 0.5 * (diffusion_square + drift)
+    op = (np.diag(lower[1:], -1) + np.diag(diag) + np.diag(upper[:-1], 1)) * dt
+    eye = np.eye(yv.size)
+    rhs = (eye + (1 - theta) * op) @ yv
+    rhs[0] += (theta * grid.v_grid[0, j] + (1 - theta) * grid.v_grid[0, j + 1]) * lower[0] * dt
+    rhs[-1] += (theta * grid.v_grid[-1, j] + (1 - theta) * grid.v_grid[-1, j + 1]) * upper[-1] * dt
+    return np.linalg.solve(eye - theta * op, rhs)
+
+
+@pytest.mark.parametrize("fdm_theta", [1, 0.5])
+def test_fdm_operator_cache(fdm_theta):
+    """系数与时间无关时只分解一次三对角算子，系数随时间变化时逐步重新分解，结果与稠密矩阵直接求解一致"""
+    process = init_bsm_process(datetime.date(2022, 1, 5), s=100, r=0.03, q=0.01, vol=0.25)
+    fn_const = process.get_fn_pde_coef(1, 100)
+    assert fn_const.time_homogeneous
+    calls = []
+
+    def fn_time_dependent(t, spot):
+        calls.append(t)
+        return 0.04 + 0.02 * t, 0.02, 0.03
+
+    def fn_counted(t, spot):
+        calls.append(t)
+        return fn_const(t, spot)
+
+    fn_counted.time_homogeneous = True
+    for fn, n_calls in ((fn_counted, 1), (fn_time_dependent, 10)):
+        calls.clear()
+        grid = FdmGrid(smax=200, maturity=10 / 243, s_step=100, fn_pde_coef=fn, fdm_theta=fdm_theta)
+        grid.v_grid[1:-1, -1] = np.maximum(grid.s_vec - 100, 0)
+        grid.v_grid[-1, :] = 100
+        for j in range(9, -1, -1):
+            expected = dense_evolve(grid, j, grid.v_grid[1:-1, j + 1], grid.dt,
+                                    *fn(grid.tv[j], grid.s_vec)[:3])
+            calls.pop()
+            grid.v_grid[1:-1, j] = grid.evolve(j, grid.v_grid[1:-1, j + 1], grid.dt)
+            assert grid.v_grid[1:-1, j] == pytest.approx(expected, rel=1e-10, abs=1e-10)
+        assert len(calls) == n_calls
+
+
+def test_fdm_grids_cache_independently():
+    """自动赎回引擎的已敲入、未敲入两个网格各自缓存算子，改变参数后重新定价与新建引擎一致"""
+    process = init_bsm_process(datetime.date(2022, 1, 5), s=100, r=0.02, q=0.0, vol=0.16)
+    engine = FdmSnowBallEngine(process, s_step=400, n_smax=2, fdm_theta=1)
+    option = StandardSnowball(s0=100, barrier_out=103, barrier_in=80, coupon_out=0.15, lock_term=3, maturity=1,
+                              start_date=datetime.date(2022, 1, 5), trade_calendar=CN_CALENDAR, engine=engine)
+    option.price()
+    assert engine.fd_not_in._op_lu is not engine.fd_knockin._op_lu
+    process.vol.volval = 0.2
+    repriced = option.price()
+    option.set_pricing_engine(FdmSnowBallEngine(process, s_step=400, n_smax=2, fdm_theta=1))
+    assert repriced == pytest.approx(option.price(), rel=1e-12)
+
+
+@pytest.mark.parametrize("fdm_theta, log_space", [(1, False), (0.5, False), (0.5, True)])
+def test_compiled_autocallable_induction(monkeypatch, fdm_theta, log_space):
+    """雪球、凤凰系列的编译递推内核与逐步调用FdmGrid.evolve的结果一致，包括已敲入状态、降敲与到期观察敲入的FCN，
+    以及Crank-Nicolson的Rannacher平滑步与对数网格"""
+    process = init_bsm_process(datetime.date(2022, 1, 5), s=100, r=0.02, q=0.04, vol=0.16)
+    common = dict(maturity=1, lock_term=3, s0=100, start_date=datetime.date(2022, 1, 5))
+    products = [
+        (FdmSnowBallEngine, StandardSnowball(barrier_out=103, barrier_in=80, coupon_out=0.15, **common)),
+        (FdmSnowBallEngine, StepDownSnowball(barrier_out_start=103, barrier_out_step=0.5, barrier_in=80,
+                                             coupon_out=0.15, **common)),
+        (FdmSnowBallEngine, StandardSnowball(barrier_out=103, barrier_in=80, coupon_out=0.15,
+                                             status=StatusType.DownTouch, **common)),
+        (FdmPhoenixEngine, Phoenix(barrier_out=103, barrier_in=75, barrier_yield=75, coupon=0.0076, **common)),
+        (FdmPhoenixEngine, FCN(barrier_out=103, barrier_in=80, coupon=0.00314, **common)),
+    ]
+    get_fn_pde_coef = process.get_fn_pde_coef
+
+    def get_fn_without_flag(maturity, spot):
+        """去掉time_homogeneous标记，退回逐步调用FdmGrid.evolve"""
+        fn_pde_coef = get_fn_pde_coef(maturity, spot)
+        return lambda t, s: fn_pde_coef(t, s)
+
+    for engine_cls, option in products:
+        engine = engine_cls(process, s_step=400, n_smax=2, fdm_theta=fdm_theta, log_space=log_space,
+                            rannacher_steps=2)
+        option.set_pricing_engine(engine)
+        compiled = option.price(), engine.fd_knockin.v_grid.copy(), engine.fd_not_in.v_grid.copy()
+        monkeypatch.setattr(process, "get_fn_pde_coef", get_fn_without_flag)
+        assert option.price() == pytest.approx(compiled[0], rel=1e-12)
+        assert engine.fd_knockin.v_grid == pytest.approx(compiled[1], rel=1e-10, abs=1e-10)
+        assert engine.fd_not_in.v_grid == pytest.approx(compiled[2], rel=1e-10, abs=1e-10)
+        monkeypatch.undo()
+
+
+@pytest.mark.parametrize("fdm_theta, rannacher_steps", [(1, 0), (0.5, 2)])
+def test_batch_autocallable_present_value(fdm_theta, rannacher_steps):
+    """批量定价共用网格和算子，均匀网格上与逐个定价的结果一致，包括已敲入状态、锁定期不同(Rannacher平滑的时间步不同)的产品"""
+    process = init_bsm_process(datetime.date(2022, 1, 5), s=100, r=0.02, q=0.04, vol=0.16)
+    common = dict(maturity=1, s0=100, start_date=datetime.date(2022, 1, 5))
+    books = [
+        (FdmSnowBallEngine, [
+            StandardSnowball(barrier_out=103, barrier_in=80, coupon_out=0.15, lock_term=3, **common),
+            StepDownSnowball(barrier_out_start=103, barrier_out_step=0.5, barrier_in=80, coupon_out=0.15, lock_term=3,
+                             **common),
+            StandardSnowball(barrier_out=100, barrier_in=75, coupon_out=0.1, lock_term=1,
+                             status=StatusType.DownTouch, **common),
+            StandardSnowball(barrier_out=105, barrier_in=70, coupon_out=0.2, lock_term=6, **common)]),
+        (FdmPhoenixEngine, [
+            Phoenix(barrier_out=103, barrier_in=75, barrier_yield=75, coupon=0.0076, lock_term=3, **common),
+            FCN(barrier_out=103, barrier_in=80, coupon=0.00314, lock_term=2, **common)]),
+    ]
+    for engine_cls, prods in books:
+        engine = engine_cls(process, s_step=400, fdm_theta=fdm_theta, rannacher_steps=rannacher_steps)
+        single = [engine.calc_present_value(prod) for prod in prods]
+        assert engine.calc_batch_present_value(prods) == pytest.approx(single, rel=1e-12)
+    longer = StandardSnowball(barrier_out=103, barrier_in=80, coupon_out=0.15, maturity=2, s0=100,
+                              start_date=datetime.date(2022, 1, 5))
+    with pytest.raises(ValueError):
+        FdmSnowBallEngine(process, s_step=400).calc_batch_present_value([books[0][1][0], longer])
+
+
+def test_fdm_price_grid():
+    """非均匀网格的关键价格恰好是格点，分段均匀网格在关键价格之间等距，sinh网格在关键价格附近加密；非均匀差分格式对二次函数精确"""
+    points = [80, 100, 103, 230]
+    aligned = fdm_price_grid(0, 200, 200, points[:3] + [100.5, 100.7])
+    assert aligned[0] == 0 and aligned[-1] == 200 and aligned.size == 201 and np.all(np.diff(aligned) > 0)
+    assert np.isin([80, 100, 100.5, 100.7, 103], aligned).all()
+    assert np.allclose(np.diff(aligned[:np.searchsorted(aligned, 80) + 1]), aligned[1])
+    concentrated = fdm_price_grid(0, 200, 200, points, concentration=0.1)
+    assert np.isin(points[:3], concentrated).all() and np.all(np.diff(concentrated) > 0)
+    spacing = np.diff(concentrated)
+    assert spacing[np.searchsorted(concentrated, 100)] < 0.5 < 2 < spacing[-1]
+    with pytest.raises(ValueError):
+        fdm_price_grid(0, 200, 3, points)
+
+    grid = FdmGrid(smax=200, maturity=10 / 243, s_step=200, fn_pde_coef=None, grid_type=FdmGridType.Concentrated,
+                   critical_points=points)
+    nodes = np.concatenate(([0], grid.s_vec, [200]))
+    v_grid = np.tile((nodes ** 2)[:, np.newaxis], (1, 2))
+    assert grid.derivative(v_grid, order=1) == pytest.approx(2 * grid.s_vec[:, np.newaxis].repeat(2, axis=1))
+    assert grid.derivative(v_grid, order=2) == pytest.approx(np.full((grid.s_vec.size, 2), 2.))
+
+
+@pytest.mark.parametrize("engine_cls, option", [
+    (FdmSnowBallEngine, StandardSnowball(barrier_out=103, barrier_in=80, coupon_out=0.15, maturity=1, lock_term=3,
+                                         s0=100, start_date=datetime.date(2022, 1, 5))),
+    (FdmPhoenixEngine, Phoenix(barrier_out=103, barrier_in=75, barrier_yield=75, coupon=0.0076, maturity=1,
+                               lock_term=3, s0=100, start_date=datetime.date(2022, 1, 5))),
+])
+def test_concentrated_grid_accuracy(engine_cls, option):
+    """障碍价对齐、在关键价格附近加密的sinh网格，200个价格步数比800步的均匀网格更接近收敛值"""
+    process = init_bsm_process(datetime.date(2022, 1, 5), s=100, r=0.02, q=0.04, vol=0.16)
+    prices = {}
+    for grid_type, s_step in ((FdmGridType.Concentrated, 3200), (FdmGridType.Concentrated, 200),
+                              (FdmGridType.Uniform, 800)):
+        option.set_pricing_engine(engine_cls(process, s_step=s_step, n_smax=2, fdm_theta=1, grid_type=grid_type))
+        prices[grid_type, s_step] = option.price()
+    reference = prices[FdmGridType.Concentrated, 3200]
+    assert (abs(prices[FdmGridType.Concentrated, 200] - reference)
+            < abs(prices[FdmGridType.Uniform, 800] - reference))
+
+
+def test_rannacher_crank_nicolson():
+    """Rannacher平滑的Crank-Nicolson每年24步比每日一步的隐式方法更准确；不做平滑时二元期权在行权价处的振荡使价格偏离收敛值"""
+    process = init_bsm_process(datetime.date(2021, 1, 5), s=100, r=0.02, q=0.05, vol=0.16)
+    vanilla = VanillaOption(maturity=1, strike=105, callput=CallPut.Call, exercise_type=ExerciseType.European,
+                            start_date=datetime.date(2021, 1, 5), engine=AnalyticVanillaEuEngine(process))
+    reference = vanilla.price()
+    errors = {}
+    for fdm_theta, t_step_per_year in ((1, 243), (0.5, 24)):
+        vanilla.set_pricing_engine(FdmVanillaEngine(process, s_step=400, fdm_theta=fdm_theta, rannacher_steps=2,
+                                                    t_step_per_year=t_step_per_year))
+        errors[fdm_theta] = abs(vanilla.price() - reference)
+    assert errors[0.5] < 0.5 * errors[1]
+
+    digital = DigitalOption(maturity=1, strike=105, rebate=10, callput=CallPut.Call,
+                            exercise_type=ExerciseType.European, payment_type=PaymentType.Expire,
+                            discrete_obs_interval=1 / 243, start_date=datetime.date(2021, 1, 5))
+    prices = {}
+    for rannacher_steps, t_step_per_year in ((2, 243), (2, 12), (0, 12)):
+        digital.set_pricing_engine(FdmDigitalEngine(process, s_step=400, fdm_theta=0.5, rannacher_steps=rannacher_steps,
+                                                    t_step_per_year=t_step_per_year))
+        prices[rannacher_steps, t_step_per_year] = digital.price()
+    converged = prices[2, 243]
+    assert abs(prices[0, 12] - converged) > 5 * abs(prices[2, 12] - converged)
+
+
+def test_log_space_grid():
+    """对数网格的格点在ln S上生成，关键价格恰好是格点；差分格式换算为对S的偏导数；对数网格的香草期权价格接近解析解"""
+    points = [80, 100, 103]
+    grid = FdmGrid(smax=200, maturity=10 / 243, s_step=200, fn_pde_coef=None, grid_type=FdmGridType.Concentrated,
+                   critical_points=points, log_space=True)
+    assert grid.s_vec[0] > 2 and np.isin(points, grid.s_vec).all() and np.all(np.diff(grid.s_vec) > 0)
+    nodes = np.concatenate(([2], grid.s_vec, [200]))
+    v_grid = (nodes ** 2)[:, np.newaxis]
+    assert grid.derivative(v_grid, order=1)[:, 0] == pytest.approx(2 * grid.s_vec, rel=1e-2)
+    assert grid.derivative(v_grid, order=2)[:, 0] == pytest.approx(2, rel=1e-2)
+
+    process = init_bsm_process(datetime.date(2021, 1, 5), s=100, r=0.02, q=0.05, vol=0.16)
+    for callput in CallPut:
+        option = VanillaOption(maturity=1, strike=105, callput=callput, exercise_type=ExerciseType.European,
+                               start_date=datetime.date(2021, 1, 5), engine=AnalyticVanillaEuEngine(process))
+        reference = option.price()
+        option.set_pricing_engine(FdmVanillaEngine(process, s_step=400, fdm_theta=0.5, rannacher_steps=2,
+                                                   log_space=True, grid_type=FdmGridType.Concentrated))
+        assert option.price() == pytest.approx(reference, abs=5e-3)
@@ -0,0 +1,87 @@
+#!/user/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2024 Galaxy Technologies
+Licensed under the Apache License, Version 2.0
+"""
+import os
+import datetime
+import numpy as np
+import pandas as pd
+import pytest
+from pricelib import *
+
+
+def make_heston_process(**params):
+    set_evaluation_date(datetime.date(2022, 1, 5))
+    params = {"v0": 0.02519171, "var_theta": 0.0216701, "var_kappa": 4.010982, "var_vol": 0.1,
+              "var_rho": -0.29376858, **params}
+    return HestonProcess(SimpleQuote(value=100), ConstantRate(value=0.02), ConstantRate(value=0.04), **params)
+
+
+def semi_analytic_call(process, strike, tau):
+    """半闭式解AnalyticHestonVanillaEngine的看涨期权价格"""
+    engine = AnalyticHestonVanillaEngine(process)
+    args = (strike, tau, 100, 0.02, 0.04, process.v0, process.var_theta, process.var_rho, process.var_kappa,
+            process.var_vol)
+    return (100 * np.exp(-0.04 * tau) * engine.cal_p_value(*args, 1)
+            - strike * np.exp(-0.02 * tau) * engine.cal_p_value(*args, 2))
+
+
+@pytest.mark.parametrize("method, tol", [(FourierMethod.COS, 1e-7), (FourierMethod.FFT, 1e-5)])
+def test_fourier_grid_matches_semi_analytic(method, tol):
+    """COS与FFT批量定价的行权价×到期日网格与半闭式解一致，看涨看跌满足平价关系，特征函数按到期时间缓存；
+    期限较长、方差波动率较大时，半闭式解的特征函数跨越复对数的分支切割，傅里叶方法仍与QE格式的蒙特卡洛一致"""
+    process = make_heston_process()
+    strikes, maturities = np.meshgrid([70., 90., 100., 110., 130.], [0.1, 0.5, 1., 2.])
+    engine = AnalyticHestonFourierEngine(process, method=method)
+    calls = engine.price_grid(strikes, maturities, CallPut.Call)
+    puts = engine.price_grid(strikes, maturities, CallPut.Put)
+    assert (engine.pricer.cache_misses, engine.pricer.cache_hits) == (4, 4)
+    assert calls == pytest.approx(np.vectorize(lambda k, t: semi_analytic_call(process, k, t))(strikes, maturities),
+                                  abs=tol)
+    parity = 100 * np.exp(-0.04 * maturities) - strikes * np.exp(-0.02 * maturities)
+    assert calls - puts == pytest.approx(parity, abs=1e-10)
+    option = VanillaOption(strike=105, maturity=1, callput=CallPut.Put, start_date=datetime.date(2022, 1, 5),
+                           engine=AnalyticHestonVanillaEngine(process))
+    expected = option.price()
+    option.set_pricing_engine(engine)
+    assert option.price() == pytest.approx(expected, abs=tol)
+
+    process.var_vol, process.var_rho = 0.9, -0.7
+    process.scheme = HestonScheme.QE
+    dw = np.random.default_rng(0).standard_normal((60, 200000))
+    s_paths, _ = process.evolve_log_paths(100, np.arange(1, 61) / 12, dw[:, :100000], dw[:, 100000:], True)
+    payoff = np.maximum(s_paths[-1] - 100, 0) * np.exp(-0.02 * 5)
+    assert engine.price_grid(100., 5.) == pytest.approx(payoff.mean(), abs=4 * payoff.std() / np.sqrt(payoff.size))
+
+
+def test_heston_calibration():
+    """解析雅可比矩阵与差分一致；由模型价格生成的报价可以还原参数；市场报价的校准结果热启动时迭代次数很少"""
+    quotes = pd.read_csv(os.path.join(os.path.dirname(__file__), 'resources', 'mkt_vanilla_price.csv'))
+    div = pd.read_csv(os.path.join(os.path.dirname(__file__), 'resources', 'div.csv'))
+    process = HestonProcess(SimpleQuote(value=2.367), ConstantRate(value=0.02),
+                            RateTermStructure.from_array(div['maturity'].values, div['q'].values), v0=0.02519171,
+                            var_theta=0.0216701, var_kappa=4.010982, var_vol=0.1, var_rho=-0.29376858)
+    true_params = dict(v0=0.03, var_theta=0.05, var_kappa=2.5, var_vol=0.6, var_rho=-0.5)
+    pricer = HestonFourierPricer(n_terms=128)
+    callput = np.where(quotes['type'] == 'call', CallPut.Call, CallPut.Put)
+    args = (quotes['strike'].values, quotes['maturity'].values, 2.367, 0.02, process.div(quotes['maturity'].values))
+    prices, jacobian = pricer.prices_and_jacobian(*args, *true_params.values(), callput=callput)
+    for k, name in enumerate(HestonCalibrator.param_names):
+        bumped = [dict(true_params, **{name: true_params[name] + sign * 1e-6}) for sign in (1, -1)]
+        diff = (pricer.prices(*args, **bumped[0], callput=callput) - pricer.prices(*args, **bumped[1], callput=callput))
+        assert jacobian[:, k] == pytest.approx(diff / 2e-6, rel=1e-4, abs=1e-6)
+
+    result = HestonCalibrator(process).calibrate(quotes.assign(close=prices))
+    assert result.success and result.rmse < 1e-9
+    assert list(result.params.values()) == pytest.approx(list(true_params.values()), rel=1e-5)
+    assert process.var_rho == pytest.approx(true_params['var_rho'], rel=1e-5)
+
+    calibrator = HestonCalibrator(process)
+    result = calibrator.calibrate(quotes)
+    assert result.success and result.rmse < 3e-3 and len(result.fit) == len(quotes)
+    warm = calibrator.calibrate(quotes)
+    assert warm.n_fev < result.n_fev and warm.params == pytest.approx(result.params, rel=1e-4)
+    with pytest.raises(ValueError):
+        HestonCalibrator(process, pricer=HestonFourierPricer(method=FourierMethod.FFT))
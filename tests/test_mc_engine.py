@@ -0,0 +1,571 @@
+#!/user/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2024 Galaxy Technologies
+Licensed under the Apache License, Version 2.0
+"""
+import datetime
+import logging
+import tracemalloc
+import numpy as np
+import pytest
+from pricelib import *
+from pricelib.common.pricing_engine_base import RandsCache
+from .conftest import init_bsm_process
+
+
+def make_snowball(engine):
+    return StandardSnowball(maturity=1, lock_term=3, s0=100, barrier_out=103, barrier_in=80, coupon_out=0.1,
+                            start_date=datetime.date(2022, 1, 5), trade_calendar=CN_CALENDAR, engine=engine)
+
+
+def make_barrier(engine):
+    return BarrierOption(strike=100, barrier=110, rebate=1, callput=CallPut.Call, inout=InOut.Out,
+                         updown=UpDown.Up, maturity=1, start_date=datetime.date(2022, 1, 5), engine=engine)
+
+
+@pytest.mark.parametrize("rands_method", [RandsMethod.Pseudorandom, RandsMethod.LowDiscrepancy])
+@pytest.mark.parametrize("antithetic_variate", [True, False])
+def test_chunked_paths_match_full_paths(rands_method, antithetic_variate):
+    """分块模拟与一次性模拟的逐路径价格相同，现值只相差求和的舍入误差"""
+    process = init_bsm_process(datetime.date(2022, 1, 5), s=100, r=0.02, q=0.04, vol=0.16)
+    for make_product in (make_snowball, make_barrier):
+        prices = []
+        for chunk_size in (None, 3001):
+            engine = MCAutoCallableEngine if make_product is make_snowball else MCBarrierEngine
+            engine = engine(process, n_path=20000, rands_method=rands_method,
+                            antithetic_variate=antithetic_variate, seed=0, chunk_size=chunk_size)
+            prices.append(make_product(engine).price())
+        assert prices[1] == pytest.approx(prices[0], rel=1e-13)
+
+
+@pytest.mark.parametrize("rands_method", [RandsMethod.Pseudorandom, RandsMethod.LowDiscrepancy])
+def test_parallel_chunks_are_reproducible(rands_method):
+    """并行模拟的结果与线程数无关；低差异序列的并行结果与单线程相同"""
+    process = init_bsm_process(datetime.date(2022, 1, 5), s=100, r=0.02, q=0.04, vol=0.16)
+    prices, std_errors = [], []
+    for n_workers in (None, 2, 3):
+        engine = MCAutoCallableEngine(process, n_path=20000, rands_method=rands_method, seed=0, chunk_size=5000,
+                                      n_workers=n_workers)
+        prices.append(make_snowball(engine).price())
+        std_errors.append(engine.std_error)
+    assert prices[2] == prices[1]
+    assert std_errors[2] == std_errors[1]
+    if rands_method == RandsMethod.LowDiscrepancy:
+        assert prices[1] == pytest.approx(prices[0], rel=1e-13)
+    else:
+        assert prices[1] == pytest.approx(prices[0], abs=5 * std_errors[0])
+    assert 0 < std_errors[1] < 1
+
+
+@pytest.mark.parametrize("vol_model", ["const", "local", "heston"])
+@pytest.mark.parametrize("antithetic_variate", [True, False])
+def test_fused_paths_match_stepwise_evolve(vol_model, antithetic_variate):
+    """编译的整条路径演化与逐步调用evolve的结果相同"""
+    set_evaluation_date(datetime.date(2022, 1, 5))
+    spot = SimpleQuote(value=100)
+    riskfree = RateTermStructure.from_array(np.array([0, 0.5, 1]), np.array([0.01, 0.02, 0.03]))
+    dividend = ConstantRate(value=0.04)
+    rng = np.random.default_rng(0)
+    dt = 1 / 243
+    dw = rng.standard_normal((243, 2000))
+    if vol_model == "heston":
+        process = HestonProcess(spot, riskfree, dividend, v0=0.04, var_theta=0.05, var_kappa=1.5, var_vol=0.6,
+                                var_rho=-0.6)
+        dw_s, dw_v = dw[:, :1000], dw[:, 1000:]
+        s_paths, var_paths = process.evolve_paths(100, dt, dw_s, dw_v, antithetic_variate)
+        dw_v = process.var_rho * dw_s + np.sqrt(1 - process.var_rho ** 2) * dw_v
+        if antithetic_variate:
+            dw_s, dw_v = np.hstack((dw_s, -dw_s)), np.hstack((dw_v, -dw_v))
+        expected_s, expected_v = np.empty_like(s_paths), np.empty_like(var_paths)
+        expected_s[0], expected_v[0] = 100, process.v0
+        for step in range(1, dw.shape[0] + 1):
+            expected_s[step], expected_v[step] = process.evolve(dt * step, [expected_s[step - 1], expected_v[step - 1]],
+                                                                dt, [dw_s[step - 1], dw_v[step - 1]])
+        assert var_paths == pytest.approx(np.maximum(expected_v, 0), rel=1e-10, abs=1e-12)
+    else:
+        if vol_model == "const":
+            volatility = BlackConstVol(0.16)
+        else:
+            volatility = LocalVolSurface(expirations=np.array([0, 0.25, 0.5, 1]), strikes=np.linspace(50, 150, 41),
+                                         volval=0.1 + 0.2 * rng.random((4, 41)))
+        process = GeneralizedBSMProcess(spot, riskfree, dividend, volatility)
+        s_paths = process.evolve_paths(100, dt, dw, antithetic_variate)
+        dw_s = np.hstack((dw, -dw)) if antithetic_variate else dw
+        expected_s = np.empty_like(s_paths)
+        expected_s[0] = 100
+        for step in range(1, dw.shape[0] + 1):
+            expected_s[step] = process.evolve(dt * step, expected_s[step - 1], dt, dw_s[step - 1])
+    assert s_paths == pytest.approx(expected_s, rel=1e-10)
+
+
+def test_log_euler_paths_are_martingale():
+    """对数欧拉格式跨越多个交易日也没有离散化误差，各观察日的价格均值等于远期价格"""
+    process = init_bsm_process(datetime.date(2022, 1, 5), s=100, r=0.02, q=0.04, vol=0.16)
+    t_grid = np.array([21, 42, 243, 486]) / 243
+    dw = np.random.default_rng(0).standard_normal((4, 200000))
+    s_paths = process.evolve_log_paths(100, t_grid, dw, antithetic=True)
+    forward = 100 * np.exp((0.02 - 0.04) * t_grid)
+    assert s_paths[0] == pytest.approx(100)
+    assert np.mean(s_paths[1:], axis=1) == pytest.approx(forward, rel=2e-3)
+
+
+@pytest.mark.parametrize("engine, make_product", [
+    (MCAutoCallableEngine, make_snowball),
+    (MCAutoCallEngine, lambda engine: AutoCall(s0=100, barrier_out=100, coupon_out=0.05, coupon_div=0.01, maturity=1,
+                                               callput=CallPut.Call, start_date=datetime.date(2022, 1, 5),
+                                               trade_calendar=CN_CALENDAR, engine=engine)),
+    (MCPhoenixEngine, lambda engine: Phoenix(s0=100, barrier_out=103, barrier_in=80, barrier_yield=80, coupon=0.0065,
+                                             lock_term=3, maturity=2, start_date=datetime.date(2022, 1, 5),
+                                             trade_calendar=CN_CALENDAR, engine=engine)),
+])
+def test_obs_dates_only_matches_daily_simulation(engine, make_product):
+    """只在观察日模拟(对数欧拉格式+布朗桥敲入概率)与逐日模拟的现值在统计误差范围内一致"""
+    process = init_bsm_process(datetime.date(2022, 1, 5), s=100, r=0.02, q=0.04, vol=0.16)
+    prices, std_errors = [], []
+    for obs_dates_only in (False, True):
+        mc_engine = engine(process, n_path=100000, rands_method=RandsMethod.LowDiscrepancy, seed=0,
+                           obs_dates_only=obs_dates_only)
+        prices.append(make_product(mc_engine).price())
+        std_errors.append(mc_engine.std_error)
+    assert prices[1] == pytest.approx(prices[0], abs=4 * np.hypot(*std_errors))
+
+
+@pytest.mark.parametrize("engine, analytic_engine, make_product", [
+    (MCBarrierEngine, AnalyticBarrierEngine,
+     lambda engine: BarrierOption(strike=100, barrier=120, rebate=3, callput=CallPut.Call, inout=InOut.Out,
+                                  updown=UpDown.Up, maturity=1, start_date=datetime.date(2022, 1, 5),
+                                  discrete_obs_interval=None, payment_type=PaymentType.Hit, engine=engine)),
+    (MCBarrierEngine, AnalyticBarrierEngine,
+     lambda engine: BarrierOption(strike=100, barrier=85, rebate=3, callput=CallPut.Put, inout=InOut.In,
+                                  updown=UpDown.Down, maturity=1, start_date=datetime.date(2022, 1, 5),
+                                  discrete_obs_interval=None, engine=engine)),
+    (MCDoubleBarrierEngine,
+     lambda process: AnalyticDoubleBarrierEngine(process, formula_type="Ikeda&Kunitomo1992", series_num=10,
+                                                 delta1=0, delta2=0),
+     lambda engine: DoubleBarrierOption(maturity=1, start_date=datetime.date(2022, 1, 5), strike=100,
+                                        inout=InOut.In, callput=CallPut.Call, parti=0.5, bound=(80, 120),
+                                        rebate=(0, 0), window=(None, None), discrete_obs_interval=None,
+                                        exercise_type=ExerciseType.American, payment_type=PaymentType.Expire,
+                                        engine=engine)),
+    (MCDigitalEngine, AnalyticCashOrNothingEngine,
+     lambda engine: DigitalOption(maturity=1, start_date=datetime.date(2022, 1, 5), strike=80, rebate=10,
+                                  exercise_type=ExerciseType.American, payment_type=PaymentType.Hit,
+                                  callput=CallPut.Put, discrete_obs_interval=None, engine=engine)),
+])
+def test_brownian_bridge_matches_continuous_analytic(engine, analytic_engine, make_product):
+    """布朗桥模式按月模拟，连续观察障碍的现值与解析解在统计误差范围内一致"""
+    process = init_bsm_process(datetime.date(2022, 1, 5), s=100, r=0.02, q=0.04, vol=0.2)
+    expected = make_product(analytic_engine(process)).price()
+    mc_engine = engine(process, n_path=100000, seed=0, bridge_step=21)
+    assert make_product(mc_engine).price() == pytest.approx(expected, abs=4 * mc_engine.std_error)
+
+
+def test_brownian_bridge_discrete_barrier_matches_daily_simulation():
+    """布朗桥模式下离散观察只在观察日模拟，与逐日模拟的现值在统计误差范围内一致"""
+    process = init_bsm_process(datetime.date(2022, 1, 5), s=100, r=0.02, q=0.04, vol=0.2)
+    prices, std_errors = [], []
+    for bridge_step in (None, 21):
+        mc_engine = MCBarrierEngine(process, n_path=100000, seed=0, bridge_step=bridge_step)
+        option = BarrierOption(strike=100, barrier=110, rebate=1, callput=CallPut.Call, inout=InOut.Out,
+                               updown=UpDown.Up, maturity=1, start_date=datetime.date(2022, 1, 5),
+                               discrete_obs_interval=1 / 12, payment_type=PaymentType.Hit, engine=mc_engine)
+        prices.append(option.price())
+        std_errors.append(mc_engine.std_error)
+    assert prices[1] == pytest.approx(prices[0], abs=4 * np.hypot(*std_errors))
+
+
+@pytest.mark.parametrize("engine, analytic_engine, make_product", [
+    (MCVanillaEngine, AnalyticVanillaEuEngine,
+     lambda engine: VanillaOption(strike=100, maturity=1, callput=CallPut.Call, start_date=datetime.date(2022, 1, 5),
+                                  engine=engine)),
+    (MCDigitalEngine, AnalyticCashOrNothingEngine,
+     lambda engine: DigitalOption(maturity=1, start_date=datetime.date(2022, 1, 5), strike=105, rebate=10,
+                                  exercise_type=ExerciseType.European, payment_type=PaymentType.Expire,
+                                  callput=CallPut.Call, engine=engine)),
+])
+def test_one_pass_greeks_match_analytic(engine, analytic_engine, make_product):
+    """单次模拟的希腊字母(香草期权用路径导数，数字期权用似然比)与解析解在统计误差范围内一致"""
+    process = init_bsm_process(datetime.date(2022, 1, 5), s=100, r=0.02, q=0.04, vol=0.2)
+    expected = make_product(analytic_engine(process))
+    mc_engine = engine(process, n_path=100000, seed=0, one_pass_greeks=True)
+    greeks = make_product(mc_engine).pv_and_greeks()
+    assert greeks['pv'] == pytest.approx(expected.price(), abs=4 * mc_engine.greeks_std_error['pv'])
+    for key in ('delta', 'gamma', 'vega', 'rho'):
+        assert greeks[key] == pytest.approx(getattr(expected, key)(), abs=4 * mc_engine.greeks_std_error[key]), key
+    assert process.vol.volval == 0.2 and process.interest.data == 0.02
+
+
+def test_bump_greeks_reuse_common_random_numbers():
+    """未开启one_pass_greeks时为共同随机数的差分法: 各扰动情景复用同一组随机数，与每个情景新建引擎重新模拟的结果相同"""
+    def reprice(spot=100, vol=0.16, r=0.02):
+        process = init_bsm_process(datetime.date(2022, 1, 5), s=100, r=r, q=0.04, vol=vol)
+        return make_snowball(MCAutoCallableEngine(process, n_path=20000, seed=0)).price(spot=spot)
+
+    process = init_bsm_process(datetime.date(2022, 1, 5), s=100, r=0.02, q=0.04, vol=0.16)
+    engine = MCAutoCallableEngine(process, n_path=20000, seed=0)
+    option = make_snowball(engine)
+    pv = option.price()
+    rands = engine.rands
+    greeks = option.pv_and_greeks()
+    assert engine.rands is rands
+    assert greeks['pv'] == pytest.approx(pv, rel=1e-12)
+    up_price, down_price = reprice(spot=101), reprice(spot=99)
+    assert greeks['delta'] == pytest.approx((up_price - down_price) / 2, rel=1e-8)
+    assert greeks['gamma'] == pytest.approx(up_price - 2 * pv + down_price, rel=1e-6)
+    assert greeks['vega'] == pytest.approx(reprice(vol=0.17) - pv, rel=1e-8)
+    assert greeks['rho'] == pytest.approx(reprice(r=0.03) - pv, rel=1e-8)
+    assert process.vol.volval == 0.16 and process.interest.data == 0.02
+    assert option.price() == pv
+
+
+def test_rands_cache_shared_across_engines(tmp_path):
+    """相同参数的引擎共享缓存的随机数矩阵；设置磁盘缓存后，清空内存缓存仍可从.npy文件复用，结果不变"""
+    process = init_bsm_process(datetime.date(2022, 1, 5), s=100, r=0.02, q=0.04, vol=0.16)
+    clear_rands_cache()
+    try:
+        engines = [MCBarrierEngine(process, n_path=20000, seed=0) for _ in range(2)]
+        prices = [make_barrier(engine).price() for engine in engines]
+        assert np.shares_memory(engines[0].rands, engines[1].rands)
+        assert not engines[0].rands.flags.writeable
+        assert prices[1] == prices[0]
+        set_rands_cache(cache_dir=str(tmp_path))
+        clear_rands_cache()
+        make_barrier(MCBarrierEngine(process, n_path=20000, seed=1)).price()
+        assert len(list(tmp_path.glob("*.npy"))) == 1
+        clear_rands_cache()
+        engine = MCBarrierEngine(process, n_path=10000, seed=1)
+        price = make_barrier(engine).price()
+        set_rands_cache()
+        clear_rands_cache()
+        assert price == make_barrier(MCBarrierEngine(process, n_path=10000, seed=1)).price()
+    finally:
+        set_rands_cache()
+        clear_rands_cache()
+
+
+def test_rands_cache_lru_eviction():
+    """内存缓存超过字节数上限时淘汰最近最少使用的矩阵"""
+    cache = RandsCache(max_bytes=2 * 8 * 100)
+    keys = [(RandsMethod.LowDiscrepancy, LdMethod.Sobol, 10, seed, np.dtype(np.float64)) for seed in range(3)]
+    for key in keys[:2]:
+        cache.put(key, np.zeros((10, 10)))
+    assert cache.get(keys[0], 5, prefix=True).shape == (10, 5)
+    cache.put(keys[2], np.zeros((10, 10)))
+    assert cache.get(keys[1], 10) is None
+    assert cache.get(keys[0], 10) is not None and cache.n_bytes == 2 * 8 * 100
+
+
+@pytest.mark.parametrize("engine, make_product", [
+    (MCVanillaEngine, lambda engine: VanillaOption(strike=100, maturity=1, callput=CallPut.Put,
+                                                   exercise_type=ExerciseType.American,
+                                                   start_date=datetime.date(2022, 1, 5), engine=engine)),
+    (MCAsianEngine, lambda engine: AsianOption(strike=100, maturity=1, callput=CallPut.Call,
+                                               ave_method=AverageMethod.Arithmetic,
+                                               start_date=datetime.date(2022, 1, 5), engine=engine)),
+    (MCBarrierEngine, make_barrier),
+    (MCAutoCallableEngine, make_snowball),
+])
+def test_float32_paths_match_float64(engine, make_product):
+    """float32模式的随机数与价格路径为单精度，现值与float64模式的相对偏差在1e-5量级，远小于蒙特卡洛标准误差"""
+    process = init_bsm_process(datetime.date(2022, 1, 5), s=100, r=0.02, q=0.04, vol=0.16)
+    prices, n_bytes = [], []
+    for dtype in (np.float64, np.float32):
+        mc_engine = engine(process, n_path=20000, seed=0, dtype=dtype)
+        prices.append(make_product(mc_engine).price())
+        n_bytes.append(mc_engine.rands.nbytes + mc_engine.s_paths.nbytes)
+        assert mc_engine.rands.dtype == dtype and mc_engine.s_paths.dtype == dtype
+    assert prices[1] == pytest.approx(prices[0], rel=1e-4)
+    assert n_bytes[1] * 2 == n_bytes[0]
+
+
+@pytest.mark.parametrize("rands_method", [RandsMethod.Pseudorandom, RandsMethod.LowDiscrepancy])
+def test_float32_randoms_peak_memory(rands_method):
+    """float32模式直接生成单精度随机数(低差异序列逐块转换)，生成随机数矩阵的峰值内存约为float64模式的一半"""
+    process = init_bsm_process(datetime.date(2022, 1, 5), s=100, r=0.02, q=0.04, vol=0.16)
+    peaks = []
+    for dtype in (np.float64, np.float32):
+        mc_engine = MCVanillaEngine(process, n_path=20000, seed=None, dtype=dtype, rands_method=rands_method)
+        tracemalloc.start()
+        try:
+            rands = mc_engine._randoms_generator((243, 40000))
+            peaks.append(tracemalloc.get_traced_memory()[1])
+        finally:
+            tracemalloc.stop()
+        assert rands.dtype == dtype and peaks[-1] < 2 * rands.nbytes
+    assert peaks[1] < 0.7 * peaks[0]
+
+
+@pytest.mark.parametrize("engine, make_product, min_reduction", [
+    (MCVanillaEngine, lambda engine: VanillaOption(strike=100, maturity=1, callput=CallPut.Call,
+                                                   start_date=datetime.date(2022, 1, 5), engine=engine), 1000),
+    (MCAsianEngine, lambda engine: AsianOption(strike=100, callput=CallPut.Call, ave_method=AverageMethod.Arithmetic,
+                                               substitute=AsianAveSubstitution.Underlying, maturity=1,
+                                               start_date=datetime.date(2022, 1, 5), engine=engine), 500),
+    (lambda process, **kwargs: MCBarrierEngine(process, bridge_step=5, **kwargs),
+     lambda engine: BarrierOption(strike=100, barrier=120, rebate=0, callput=CallPut.Call, inout=InOut.Out,
+                                  updown=UpDown.Up, maturity=1, start_date=datetime.date(2022, 1, 5),
+                                  discrete_obs_interval=None, engine=engine), 50),
+    (MCAutoCallableEngine, make_snowball, 1.2),
+])
+def test_control_variates_reduce_variance(engine, make_product, min_reduction):
+    """控制变量法与普通蒙特卡洛的现值在统计误差范围内一致，标准误差按variance_reduction的平方根缩小"""
+    process = init_bsm_process(datetime.date(2022, 1, 5), s=100, r=0.02, q=0.04, vol=0.16)
+    prices, std_errors = [], []
+    for control_variates in (False, True):
+        mc_engine = engine(process, n_path=20000, rands_method=RandsMethod.Pseudorandom, seed=0,
+                           control_variates=control_variates)
+        prices.append(make_product(mc_engine).price())
+        std_errors.append(mc_engine.std_error)
+    assert prices[1] == pytest.approx(prices[0], abs=4 * np.hypot(*std_errors))
+    assert mc_engine.variance_reduction > min_reduction
+    assert std_errors[1] < std_errors[0]
+    assert mc_engine.cv_beta.ndim == 1
+
+
+def test_control_variates_match_continuous_barrier_analytic():
+    """布朗桥模式的连续观察障碍期权以同类连续障碍期权为控制变量，与解析解的偏差在控制后的标准误差范围内"""
+    process = init_bsm_process(datetime.date(2022, 1, 5), s=100, r=0.02, q=0.04, vol=0.2)
+
+    def make_product(engine):
+        return BarrierOption(strike=100, barrier=85, rebate=3, callput=CallPut.Put, inout=InOut.In, updown=UpDown.Down,
+                             maturity=1, start_date=datetime.date(2022, 1, 5), discrete_obs_interval=None,
+                             engine=engine)
+
+    expected = make_product(AnalyticBarrierEngine(process)).price()
+    mc_engine = MCBarrierEngine(process, n_path=20000, rands_method=RandsMethod.Pseudorandom, seed=0, bridge_step=5,
+                                control_variates=True)
+    assert make_product(mc_engine).price() == pytest.approx(expected, abs=4 * mc_engine.std_error)
+    assert mc_engine.variance_reduction > 100
+
+
+def test_adaptive_simulation_stops_at_target_error():
+    """自适应模拟在标准误差达到目标相对误差时提前停止，置信区间覆盖解析解；时间预算耗尽时只模拟一块"""
+    process = init_bsm_process(datetime.date(2022, 1, 5), s=100, r=0.02, q=0.04, vol=0.16)
+
+    def make_product(engine):
+        return VanillaOption(strike=100, maturity=1, callput=CallPut.Call, start_date=datetime.date(2022, 1, 5),
+                             engine=engine)
+
+    expected = make_product(AnalyticVanillaEuEngine(process)).price()
+    mc_engine = MCVanillaEngine(process, n_path=320000, rands_method=RandsMethod.Pseudorandom, seed=0,
+                                target_rel_error=0.01)
+    option = make_product(mc_engine)
+    price = option.price()
+    assert mc_engine.n_path_used < mc_engine.n_path
+    assert mc_engine.std_error <= 0.01 * price
+    lower, upper = mc_engine.confidence_interval(0.999)
+    assert lower < expected < upper
+    mc_engine.target_rel_error, mc_engine.time_budget = None, 0.
+    option.price()
+    assert mc_engine.n_path_used == 320000 // 16
+
+
+def test_importance_sampling_deep_otm_digital():
+    """重要性抽样: 平移量为0时与普通模拟逐位相同；深度虚值数字期权自动选择向下平移，标准误差显著降低且与解析解一致"""
+    process = init_bsm_process(datetime.date(2022, 1, 5), s=100, r=0.02, q=0.04, vol=0.16)
+
+    def make_product(engine):
+        return DigitalOption(strike=70, rebate=10, maturity=1, start_date=datetime.date(2022, 1, 5),
+                             exercise_type=ExerciseType.European, payment_type=PaymentType.Expire,
+                             callput=CallPut.Put, engine=engine)
+
+    expected = make_product(AnalyticCashOrNothingEngine(process)).price()
+    plain_engine = MCDigitalEngine(process, n_path=20000, rands_method=RandsMethod.Pseudorandom, seed=0)
+    plain_price = make_product(plain_engine).price()
+    zero_engine = MCDigitalEngine(process, n_path=20000, rands_method=RandsMethod.Pseudorandom, seed=0,
+                                  importance_shift=0.)
+    assert make_product(zero_engine).price() == pytest.approx(plain_price, rel=1e-12)
+    is_engine = MCDigitalEngine(process, n_path=20000, rands_method=RandsMethod.Pseudorandom, seed=0,
+                                importance_shift='auto')
+    assert make_product(is_engine).price() == pytest.approx(expected, abs=4 * is_engine.std_error)
+    assert is_engine.importance_shift_used < 0
+    assert is_engine.std_error < plain_engine.std_error / 3
+    with pytest.raises(ValueError):
+        MCDigitalEngine(process, importance_shift='up')
+
+
+@pytest.mark.parametrize("engine, make_product", [
+    (MCAsianEngine, lambda engine: AsianOption(strike=100, callput=CallPut.Call, ave_method=AverageMethod.Arithmetic,
+                                               substitute=AsianAveSubstitution.Underlying, maturity=1,
+                                               start_date=datetime.date(2022, 1, 5), engine=engine)),
+    (MCBarrierEngine, make_barrier),
+    (MCAutoCallableEngine, make_snowball),
+])
+def test_mlmc_matches_daily_simulation(engine, make_product):
+    """多层蒙特卡洛与逐日模拟的期望相同，相同计算量下标准误差更小；修正项的方差远小于最粗层payoff的方差"""
+    process = init_bsm_process(datetime.date(2022, 1, 5), s=100, r=0.02, q=0.04, vol=0.16)
+    daily_engine = engine(process, n_path=40000, rands_method=RandsMethod.Pseudorandom, seed=0)
+    daily_price = make_product(daily_engine).price()
+    mlmc_engine = engine(process, n_path=40000, rands_method=RandsMethod.Pseudorandom, seed=1, mlmc_levels=6)
+    mlmc_price = make_product(mlmc_engine).price()
+    assert mlmc_price == pytest.approx(daily_price, abs=4 * np.hypot(daily_engine.std_error, mlmc_engine.std_error))
+    assert mlmc_engine.std_error < daily_engine.std_error
+    assert len(mlmc_engine.mlmc_n_paths) == 6
+    assert mlmc_engine.mlmc_n_paths[0] > mlmc_engine.mlmc_n_paths[-1]
+    assert np.all(mlmc_engine.mlmc_level_var[1:] < mlmc_engine.mlmc_level_var[0] / 10)
+    mlmc_engine.mlmc_rmse = 0.02
+    make_product(mlmc_engine).price()
+    assert mlmc_engine.std_error < 0.03
+
+
+def test_lsmc_american_put():
+    """LSMC回归的两种求解方法结果一致，美式看跌期权的价格接近二叉树；稀疏行权网格与Laguerre基函数可用；参数非法时报错"""
+    process = init_bsm_process(datetime.date(2022, 1, 5), s=100, r=0.02, q=0.04, vol=0.16)
+    tree_price = VanillaOption(strike=100, maturity=1, callput=CallPut.Put, exercise_type=ExerciseType.American,
+                               start_date=datetime.date(2022, 1, 5),
+                               engine=BiTreeVanillaEngine(process, tree_branches=1000)).price()
+    prices = {}
+    for name, kwargs in {"qr": dict(lsmc=LsmcRegressor(solver="qr")), "normal": dict(lsmc=LsmcRegressor()),
+                         "laguerre": dict(lsmc=LsmcRegressor(basis=LsmcBasis.Laguerre, degree=3)),
+                         "weekly": dict(exercise_step=5)}.items():
+        mc_engine = MCVanillaEngine(process, n_path=20000, seed=0, **kwargs)
+        prices[name] = VanillaOption(strike=100, maturity=1, callput=CallPut.Put, exercise_type=ExerciseType.American,
+                                     start_date=datetime.date(2022, 1, 5), engine=mc_engine).price()
+    assert prices["normal"] == pytest.approx(prices["qr"], rel=1e-8)
+    for price in prices.values():
+        assert price == pytest.approx(tree_price, rel=0.03)
+    with pytest.raises(ValueError):
+        LsmcRegressor(degree=0)
+    with pytest.raises(ValueError):
+        LsmcRegressor(solver="svd")
+    with pytest.raises(ValueError):
+        MCVanillaEngine(process, exercise_step=0)
+
+
+def test_lsmc_records_standard_error():
+    """美式期权定价后记录估值、标准误差与路径数，同一引擎先为欧式期权定价时置信区间不会沿用欧式期权的结果"""
+    process = init_bsm_process(datetime.date(2022, 1, 5), s=100, r=0.02, q=0.04, vol=0.16)
+    mc_engine = MCVanillaEngine(process, n_path=20000, rands_method=RandsMethod.Pseudorandom, seed=0)
+    european = VanillaOption(strike=100, maturity=1, callput=CallPut.Put, start_date=datetime.date(2022, 1, 5),
+                             engine=mc_engine).price()
+    european_interval = mc_engine.confidence_interval()
+    american = VanillaOption(strike=100, maturity=1, callput=CallPut.Put, exercise_type=ExerciseType.American,
+                             start_date=datetime.date(2022, 1, 5), engine=mc_engine).price()
+    assert american > european
+    assert mc_engine.mc_value == american and mc_engine.n_path_used == 20000
+    lower, upper = mc_engine.confidence_interval()
+    assert lower < american < upper and (lower, upper) != european_interval
+    assert 0 < mc_engine.std_error < 0.02 * american
+
+
+def test_lsmc_warns_adaptive_options(monkeypatch):
+    """美式期权不支持分块与自适应模拟，设置时记录警告并模拟全部路径"""
+    process = init_bsm_process(datetime.date(2022, 1, 5), s=100, r=0.02, q=0.04, vol=0.16)
+    warnings = []
+    monkeypatch.setattr(logging, "warning", lambda msg, *args, **kwargs: warnings.append(msg))
+    mc_engine = MCVanillaEngine(process, n_path=20000, rands_method=RandsMethod.Pseudorandom, seed=0,
+                                target_rel_error=0.01)
+    VanillaOption(strike=100, maturity=1, callput=CallPut.Put, exercise_type=ExerciseType.American,
+                  start_date=datetime.date(2022, 1, 5), engine=mc_engine).price()
+    assert len(warnings) == 1 and "target_rel_error" in warnings[0]
+    assert mc_engine.n_path_used == 20000
+
+
+def test_snowball_payoff_kernel_scenarios():
+    """雪球payoff编译函数: 首次敲出、敲入、持有到期三类情景；敲入次数要求(巴黎雪球)、已敲入与布朗桥敲入概率"""
+    from pricelib.pricing_engines.mc_engines.mc_autocallable_engine import snowball_payoff
+    paths = np.array([[100., 100., 100., 100.],
+                      [101., 95., 99., 98.],
+                      [105., 85., 97., 99.],
+                      [99., 79., 96., 97.],
+                      [98., 90., 95., 104.]])
+    out_value, out_parti = np.array([1.05, 1.1]), np.array([0.5, 0.5])
+
+    def payoff(in_times, in_prob=np.empty(0)):
+        return snowball_payoff(paths, np.array([2, 4]), np.array([103., 103.]), out_value, out_parti,
+                               np.array([104., 104.]), np.arange(5), np.full(5, 80.), in_times, in_prob,
+                               1.08, 100., 0., 1., 0., 0.9)
+
+    knock_in_value = np.array([-10., -5.]) * 0.9  # 敲入后到期损益 (S_T - 100) * 折现因子
+    np.testing.assert_allclose(payoff(1), [1.05 + 0.5, knock_in_value[0], 1.08, 1.1])
+    np.testing.assert_allclose(payoff(2), [1.05 + 0.5, 1.08, 1.08, 1.1])
+    np.testing.assert_allclose(payoff(0), [1.05 + 0.5, knock_in_value[0], knock_in_value[1], 1.1])
+    np.testing.assert_allclose(payoff(1, np.array([0., 0.5, 0.25, 1.])),
+                               [1.05 + 0.5, 0.5 * 1.08 + 0.5 * knock_in_value[0],
+                                0.75 * 1.08 + 0.25 * knock_in_value[1], 1.1])
+    assert snowball_payoff(paths.astype(np.float32), np.array([2, 4]), np.array([103., 103.]), out_value,
+                           out_parti, np.array([104., 104.]), np.arange(5), np.full(5, 80.), 1, np.empty(0),
+                           1.08, 100., 0., 1., 0., 0.9).dtype == np.float64
+
+
+@pytest.mark.parametrize("rands_method, chunk_size", [
+    (RandsMethod.Pseudorandom, None), (RandsMethod.Pseudorandom, 7001), (RandsMethod.LowDiscrepancy, None)])
+@pytest.mark.parametrize("engine, make_product", [
+    (MCAutoCallableEngine, make_snowball),
+    (MCParisSnowballEngine, lambda engine: ParisSnowball(maturity=1, lock_term=3, s0=100, barrier_out=103,
+                                                         barrier_in=85, coupon_out=0.1, knock_in_times=2,
+                                                         start_date=datetime.date(2022, 1, 5),
+                                                         trade_calendar=CN_CALENDAR, engine=engine)),
+    (MCAsianEngine, lambda engine: AsianOption(strike=100, callput=CallPut.Put, ave_method=AverageMethod.Geometric,
+                                               substitute=AsianAveSubstitution.Strike, maturity=1,
+                                               start_date=datetime.date(2022, 1, 5), engine=engine)),
+    (MCRangeAccuralEngine, lambda engine: RangeAccural(s0=100, maturity=1, upper_strike=110, lower_strike=90,
+                                                       payment=0.1, start_date=datetime.date(2022, 1, 5),
+                                                       trade_calendar=CN_CALENDAR, engine=engine)),
+])
+def test_stream_paths_match_stored_paths(engine, make_product, rands_method, chunk_size):
+    """逐步更新路径泛函与保存价格路径矩阵的结果相同，只相差逐步演化与整条路径演化的浮点舍入误差"""
+    process = init_bsm_process(datetime.date(2022, 1, 5), s=100, r=0.02, q=0.04, vol=0.16)
+    results = []
+    for stream_paths in (False, True):
+        mc_engine = engine(process, n_path=20000, rands_method=rands_method, seed=0, chunk_size=chunk_size,
+                           stream_paths=stream_paths)
+        results.append((make_product(mc_engine).price(), mc_engine.std_error))
+    assert results[1] == pytest.approx(results[0], rel=1e-9)
+
+
+def test_stream_paths_heston_and_invalid_options():
+    """Heston过程逐步更新路径泛函的结果与保存路径相同；不支持路径泛函的引擎或不兼容的参数报错"""
+    set_evaluation_date(datetime.date(2022, 1, 5))
+    process = HestonProcess(SimpleQuote(value=100), ConstantRate(value=0.02), ConstantRate(value=0.04), v0=0.04,
+                            var_theta=0.05, var_kappa=1.5, var_vol=0.6, var_rho=-0.6)
+    prices = [make_snowball(MCAutoCallableEngine(process, n_path=20000, rands_method=RandsMethod.Pseudorandom,
+                                                 seed=0, stream_paths=stream_paths)).price()
+              for stream_paths in (False, True)]
+    assert prices[1] == pytest.approx(prices[0], rel=1e-9)
+    with pytest.raises(ValueError):
+        MCAccumulatorEngine(process, stream_paths=True)
+    with pytest.raises(ValueError):
+        MCAsianEngine(process, stream_paths=True, control_variates=True)
+    with pytest.raises(ValueError):
+        MCAutoCallableEngine(process, stream_paths=True, obs_dates_only=True)
+
+
+@pytest.mark.parametrize("scheme", [HestonScheme.QE, HestonScheme.FullTruncation])
+def test_heston_log_schemes(scheme):
+    """QE与完全截断格式的整条路径演化与逐步演化相同；QE格式按月模拟的欧式期权与半闭式解一致；
+    Heston雪球只在观察日模拟与逐日模拟一致"""
+    set_evaluation_date(datetime.date(2022, 1, 5))
+    process = HestonProcess(SimpleQuote(value=100), ConstantRate(value=0.02), ConstantRate(value=0.04), v0=0.04,
+                            var_theta=0.05, var_kappa=1.5, var_vol=0.9, var_rho=-0.7, scheme=scheme)
+    rng = np.random.default_rng(0)
+    t_grid = np.array([1, 5, 21, 63, 126, 243]) / 243
+    dw_s, dw_v = rng.standard_normal((6, 1000)), rng.standard_normal((6, 1000))
+    s_paths, var_paths = process.evolve_log_paths(100, t_grid, dw_s, dw_v, True)
+    s_row, v_row = np.full(2000, 100.), np.full(2000, process.v0)
+    for step, t in enumerate(t_grid):
+        s_row, v_row = process.evolve_step(t, s_row, v_row, t - np.append(0, t_grid)[step],
+                                           np.hstack((dw_s[step], -dw_s[step])), np.hstack((dw_v[step], -dw_v[step])))
+        assert s_paths[step + 1] == pytest.approx(s_row, rel=1e-10)
+        assert var_paths[step + 1] == pytest.approx(np.maximum(v_row, 0), rel=1e-10, abs=1e-14)
+    if scheme == HestonScheme.QE:
+        analytic = VanillaOption(strike=100, maturity=1, callput=CallPut.Call, start_date=datetime.date(2022, 1, 5),
+                                 engine=AnalyticHestonVanillaEngine(process)).price()
+        dw = rng.standard_normal((12, 200000))
+        s_paths, _ = process.evolve_log_paths(100, np.arange(1, 13) / 12, dw[:, :100000], dw[:, 100000:], True)
+        payoff = np.maximum(s_paths[-1] - 100, 0) * np.exp(-0.02)
+        assert payoff.mean() == pytest.approx(analytic, abs=4 * payoff.std() / np.sqrt(payoff.size))
+        process.var_vol, process.var_rho = 0.5, -0.5  # 布朗桥以方差期望值近似波动率，方差的波动率较小时近似误差较小
+        prices, std_errors = [], []
+        for obs_dates_only in (False, True):
+            mc_engine = MCAutoCallableEngine(process, n_path=50000, rands_method=RandsMethod.Pseudorandom, seed=0,
+                                             obs_dates_only=obs_dates_only)
+            prices.append(make_snowball(mc_engine).price())
+            std_errors.append(mc_engine.std_error)
+        assert prices[1] == pytest.approx(prices[0], abs=4 * np.hypot(*std_errors))
+    process.scheme = HestonScheme.PartialTruncation
+    with pytest.raises(ValueError):
+        process.evolve_log_paths(100, t_grid, dw_s, dw_v)
+    with pytest.raises(ValueError):
+        process.scheme = "QE"